@@ -1,6 +1,13 @@
+import functools
+import logging
 import os
+import signal
+import threading
+from dataclasses import dataclass
+from typing import Callable, Sequence
 
 import click
+from eodhp_utils.messagers import Messager
 from eodhp_utils.runner import (
     get_boto3_session,
     log_component_version,
@@ -8,43 +15,654 @@ from eodhp_utils.runner import (
     setup_logging,
 )
 
-from annotations_ingester.annotations_generator import AnnotationsMessager
-from annotations_ingester.dataset_dcat_generator import DatasetDCATMessager
+from annotations_ingester import metrics
+from annotations_ingester.annotations_generator import (
+    ANNOTATION_INDEX_PREFIX,
+    DEFAULT_STREAMING_THRESHOLD,
+    AnnotationsMessager,
+)
+from annotations_ingester.catalogue_index import DEFAULT_CATALOGUE_URL, CatalogueIndex
+from annotations_ingester.content_addressing import (
+    DEFAULT_ALIAS_MAX_AGE,
+    DEFAULT_PUBLIC_PREFIX,
+    ContentAddressedLayout,
+)
+from annotations_ingester.dataset_dcat_generator import (
+    CATALOGUE_PUBLIC_BUCKET_PREFIX,
+    DatasetDCATMessager,
+)
+from annotations_ingester.encodings import DEFAULT_MIN_ENCODE_BYTES, OutputEncoder
+from annotations_ingester.item_coverage import ItemCoverageRollup
+from annotations_ingester.jsonld_context import (
+    DEFAULT_CONTEXT_URL,
+    context_url,
+    publish_context,
+)
+from annotations_ingester.output_cache import (
+    InvalidatingS3Client,
+    OutputFingerprintCache,
+)
+from annotations_ingester.qa_index import QASummaryIndex
+from annotations_ingester.runner import run_pipelined
+from annotations_ingester.streaming import DEFAULT_SPOOL_BYTES
+from annotations_ingester.throttling import AdaptiveConcurrency, ThrottledS3Client
+from annotations_ingester.uploads import (
+    DEFAULT_UPLOAD_CONCURRENCY,
+    UploadExecutor,
+    s3_client_config,
+)
+from annotations_ingester.worker_pool import RenderPool
+
+ANNOTATIONS_TOPIC = "transformed-annotations"
 
 
 @click.command
 @click.option("--takeover", "-t", is_flag=True, default=False, help="Run in takeover mode.")
 @click.option("-v", "--verbose", count=True)
 @click.option("--pulsar-url")
-def cli(takeover: bool, verbose: int, pulsar_url=None):
+@click.option(
+    "--output-cache-size",
+    envvar="OUTPUT_CACHE_SIZE",
+    default=0,
+    help="Number of output fingerprints to remember to skip unchanged uploads. 0 disables this.",
+)
+@click.option(
+    "--output-cache-max-age",
+    envvar="OUTPUT_CACHE_MAX_AGE",
+    type=float,
+    help="Seconds after which a remembered fingerprint is no longer trusted.",
+)
+@click.option(
+    "--output-cache-snapshot",
+    envvar="OUTPUT_CACHE_SNAPSHOT",
+    help="Local file to load the output cache from at startup and save it to at exit, including"
+    " on SIGTERM.",
+)
+@click.option(
+    "--warm-output-cache",
+    envvar="WARM_OUTPUT_CACHE",
+    is_flag=True,
+    default=False,
+    help="Fill the output cache from the ETags of existing outputs at startup.",
+)
+@click.option(
+    "--workers",
+    envvar="WORKERS",
+    default=0,
+    help="Worker processes for parsing and serialisation. 0 processes messages one at a time.",
+)
+@click.option(
+    "--max-in-flight",
+    envvar="MAX_IN_FLIGHT",
+    type=int,
+    help="Messages processed concurrently by the pipelined runner. Defaults to twice --workers.",
+)
+@click.option(
+    "--upload-concurrency",
+    envvar="UPLOAD_CONCURRENCY",
+    default=0,
+    help="Concurrent S3 uploads. 0 makes uploads one at a time, as each message is processed.",
+)
+@click.option(
+    "--batch-size",
+    envvar="BATCH_SIZE",
+    default=1,
+    help="Maximum messages from one topic to process and acknowledge as a batch.",
+)
+@click.option(
+    "--batch-wait-ms",
+    envvar="BATCH_WAIT_MS",
+    default=0,
+    help="Milliseconds to wait for a batch to fill before processing it anyway.",
+)
+@click.option(
+    "--coalesce-window-ms",
+    envvar="COALESCE_WINDOW_MS",
+    default=0,
+    help="Milliseconds to hold messages so that repeated updates to an entry are processed once.",
+)
+@click.option(
+    "--metrics-port",
+    envvar="METRICS_PORT",
+    default=0,
+    help="Port to serve Prometheus metrics on at /metrics. 0 disables metrics.",
+)
+@click.option(
+    "--streaming-threshold",
+    envvar="STREAMING_THRESHOLD",
+    default=DEFAULT_STREAMING_THRESHOLD,
+    help="Size in bytes from which annotations are converted without holding them in memory,"
+    " such as 33554432. Needs the pipelined runner. 0, the default, disables this.",
+)
+@click.option(
+    "--streaming-spool-bytes",
+    envvar="STREAMING_SPOOL_BYTES",
+    default=DEFAULT_SPOOL_BYTES,
+    help="Bytes of each streamed output to keep in memory before writing it to a temporary file.",
+)
+@click.option(
+    "--jsonld-context-url",
+    envvar="JSONLD_CONTEXT_URL",
+    help="URL at which the published JSON-LD context is served, for the outputs to refer to."
+    " Defaults to its place under --catalogue-url.",
+)
+@click.option(
+    "--publish-context/--no-publish-context",
+    envvar="PUBLISH_CONTEXT",
+    default=True,
+    help="Upload the JSON-LD context at startup if it's missing or out of date.",
+)
+@click.option(
+    "--output-encodings",
+    envvar="OUTPUT_ENCODINGS",
+    default="",
+    help="Comma-separated encodings ('gzip', 'br') of compressed variants to store next to each"
+    " output.",
+)
+@click.option(
+    "--output-encoding-min-bytes",
+    envvar="OUTPUT_ENCODING_MIN_BYTES",
+    default=DEFAULT_MIN_ENCODE_BYTES,
+    help="Size in bytes below which outputs aren't compressed.",
+)
+@click.option(
+    "--content-addressed",
+    envvar="CONTENT_ADDRESSED",
+    is_flag=True,
+    default=False,
+    help="Store outputs under content hashes, with short-lived aliases at the usual keys.",
+)
+@click.option(
+    "--alias-max-age",
+    envvar="ALIAS_MAX_AGE",
+    default=DEFAULT_ALIAS_MAX_AGE,
+    help="Cache lifetime in seconds of the aliases in the content-addressed layout.",
+)
+@click.option(
+    "--content-public-prefix",
+    envvar="CONTENT_PUBLIC_PREFIX",
+    default=DEFAULT_PUBLIC_PREFIX,
+    help="Path at which the catalogue/ prefix is served, for the aliases' redirects.",
+)
+@click.option(
+    "--annotation-rollups",
+    envvar="ANNOTATION_ROLLUPS",
+    is_flag=True,
+    default=False,
+    help="Merge the annotations of each dataset into a rollup and a summary of the latest results.",
+)
+@click.option(
+    "--catalogue-index-shards",
+    envvar="CATALOGUE_INDEX_SHARDS",
+    default=0,
+    help="Shards of the catalogue-wide DCAT index to keep up to date. 0 disables the index.",
+)
+@click.option(
+    "--catalogue-url",
+    envvar="CATALOGUE_URL",
+    required=True,
+    help="URL at which this deployment's catalogue/ prefix is served, for the index's links and"
+    " the JSON-LD context.",
+)
+@click.option(
+    "--item-coverage-interval",
+    envvar="ITEM_COVERAGE_INTERVAL",
+    default=0.0,
+    help="Seconds between writes of the coverage of each Collection's Items, which are folded"
+    " into it as they arrive. 0 ignores Items.",
+)
+@click.option(
+    "--qa-index-interval",
+    envvar="QA_INDEX_INTERVAL",
+    default=0.0,
+    help="Seconds between exports of the summary index of every dataset's QA. 0 disables the"
+    " index.",
+)
+@click.option(
+    "--qa-index-path",
+    envvar="QA_INDEX_PATH",
+    help="SQLite file to keep changes to the QA index in until they're exported, so that they"
+    " survive a restart. Needed with --qa-index-interval; ':memory:' keeps them in memory only.",
+)
+@click.option(
+    "--adaptive-concurrency",
+    envvar="ADAPTIVE_CONCURRENCY",
+    is_flag=True,
+    default=False,
+    help="Adapt the S3 requests in flight to throttling, up to --upload-concurrency, and retry"
+    " within a budget, pausing consumption when it runs out.",
+)
+@click.option(
+    "--topics",
+    envvar="TOPICS",
+    default="",
+    help="Comma-separated transformed topics to follow instead of the one named by TOPIC, each"
+    " optionally with a weight, as in 'transformed_a=2,transformed_b'. The weight of"
+    f" {ANNOTATIONS_TOPIC} can be given in the same way.",
+)
+@click.option(
+    "--topic-max-in-flight",
+    envvar="TOPIC_MAX_IN_FLIGHT",
+    type=int,
+    help="Batches from any one topic processed concurrently. Defaults to --max-in-flight.",
+)
+def cli(
+    takeover: bool,
+    verbose: int,
+    pulsar_url=None,
+    output_cache_size: int = 0,
+    output_cache_max_age: float = None,
+    output_cache_snapshot: str = None,
+    warm_output_cache: bool = False,
+    workers: int = 0,
+    max_in_flight: int = None,
+    upload_concurrency: int = 0,
+    batch_size: int = 1,
+    batch_wait_ms: int = 0,
+    coalesce_window_ms: int = 0,
+    metrics_port: int = 0,
+    streaming_threshold: int = DEFAULT_STREAMING_THRESHOLD,
+    streaming_spool_bytes: int = DEFAULT_SPOOL_BYTES,
+    jsonld_context_url: str = None,
+    publish_context: bool = True,
+    output_encodings: str = "",
+    output_encoding_min_bytes: int = DEFAULT_MIN_ENCODE_BYTES,
+    content_addressed: bool = False,
+    alias_max_age: int = DEFAULT_ALIAS_MAX_AGE,
+    content_public_prefix: str = DEFAULT_PUBLIC_PREFIX,
+    annotation_rollups: bool = False,
+    catalogue_index_shards: int = 0,
+    catalogue_url: str = None,
+    item_coverage_interval: float = 0.0,
+    qa_index_interval: float = 0.0,
+    qa_index_path: str = None,
+    adaptive_concurrency: bool = False,
+    topics: str = "",
+    topic_max_in_flight: int = None,
+):
     setup_logging(verbosity=verbose)
     log_component_version("annotations_ingester")
 
+    options = IngesterOptions(
+        takeover=takeover,
+        output_cache_size=output_cache_size,
+        output_cache_max_age=output_cache_max_age,
+        output_cache_snapshot=output_cache_snapshot,
+        warm_output_cache=warm_output_cache,
+        workers=workers,
+        max_in_flight=max_in_flight,
+        upload_concurrency=upload_concurrency,
+        batch_size=batch_size,
+        batch_wait_ms=batch_wait_ms,
+        coalesce_window_ms=coalesce_window_ms,
+        metrics_port=metrics_port,
+        streaming_threshold=streaming_threshold,
+        streaming_spool_bytes=streaming_spool_bytes,
+        jsonld_context_url=jsonld_context_url,
+        publish_context=publish_context,
+        output_encodings=output_encodings,
+        output_encoding_min_bytes=output_encoding_min_bytes,
+        content_addressed=content_addressed,
+        alias_max_age=alias_max_age,
+        content_public_prefix=content_public_prefix,
+        annotation_rollups=annotation_rollups,
+        catalogue_index_shards=catalogue_index_shards,
+        catalogue_url=catalogue_url,
+        item_coverage_interval=item_coverage_interval,
+        qa_index_interval=qa_index_interval,
+        qa_index_path=qa_index_path,
+        adaptive_concurrency=adaptive_concurrency,
+        topics=topics,
+        topic_max_in_flight=topic_max_in_flight,
+    )
+
+    try:
+        options.output_encoder()
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--output-encodings") from e
+
+    try:
+        options.topic_weights()
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--topics") from e
+
+    if streaming_threshold > 0 and not options.pipelined:
+        raise click.UsageError(
+            "--streaming-threshold needs the pipelined runner, which is used with --workers,"
+            " --upload-concurrency or the other options --takeover can't be combined with"
+        )
+
+    if qa_index_interval > 0 and not qa_index_path:
+        raise click.UsageError("--qa-index-interval needs --qa-index-path")
+
+    if options.pipelined and takeover:
+        raise click.UsageError(
+            "--takeover can't be combined with --workers, --upload-concurrency, --batch-size,"
+            " --coalesce-window-ms, --output-encodings, --content-addressed,"
+            " --adaptive-concurrency or --topics"
+        )
+
     if os.getenv("TOPIC"):
         identifier = "_" + os.getenv("TOPIC")
     else:
         identifier = ""
 
     session = get_boto3_session()
-    s3_client = session.client("s3")
+    if options.pipelined:
+        # Requests are retried by the ThrottledS3Client rather than by botocore.
+        max_attempts = 1 if options.adaptive_concurrency else 3
+        s3_client = session.client(
+            "s3", config=s3_client_config(options.upload_threads, max_attempts)
+        )
+    else:
+        s3_client = session.client("s3")
+
+    ingest(options, s3_client, os.environ.get("S3_BUCKET"), identifier, pulsar_url=pulsar_url)
+
+
+@dataclass
+class IngesterOptions:
+    """The options of `cli` which affect how messages are processed."""
+
+    takeover: bool = False
+    output_cache_size: int = 0
+    output_cache_max_age: float = None
+    output_cache_snapshot: str = None
+    warm_output_cache: bool = False
+    workers: int = 0
+    max_in_flight: int = None
+    upload_concurrency: int = 0
+    batch_size: int = 1
+    batch_wait_ms: int = 0
+    coalesce_window_ms: int = 0
+    metrics_port: int = 0
+    streaming_threshold: int = DEFAULT_STREAMING_THRESHOLD
+    streaming_spool_bytes: int = DEFAULT_SPOOL_BYTES
+    jsonld_context_url: str = None
+    publish_context: bool = True
+    output_encodings: str = ""
+    output_encoding_min_bytes: int = DEFAULT_MIN_ENCODE_BYTES
+    content_addressed: bool = False
+    alias_max_age: int = DEFAULT_ALIAS_MAX_AGE
+    content_public_prefix: str = DEFAULT_PUBLIC_PREFIX
+    annotation_rollups: bool = False
+    catalogue_index_shards: int = 0
+    catalogue_url: str = DEFAULT_CATALOGUE_URL
+    item_coverage_interval: float = 0.0
+    qa_index_interval: float = 0.0
+    qa_index_path: str = None
+    adaptive_concurrency: bool = False
+    topics: str = ""
+    topic_max_in_flight: int = None
+
+    @property
+    def pipelined(self) -> bool:
+        """True if these options need the pipelined runner rather than eodhp_utils'."""
+        return (
+            self.workers > 0
+            or self.upload_concurrency > 0
+            or self.batch_size > 1
+            or self.coalesce_window_ms > 0
+            or self.output_encoder() is not None
+            or self.content_addressed
+            or self.adaptive_concurrency
+            or bool(self.topics)
+        )
+
+    @property
+    def upload_threads(self) -> int:
+        return self.upload_concurrency or DEFAULT_UPLOAD_CONCURRENCY
+
+    def output_encoder(self) -> OutputEncoder | None:
+        return OutputEncoder.from_option(self.output_encodings, self.output_encoding_min_bytes)
+
+    def content_layout(self) -> ContentAddressedLayout | None:
+        if not self.content_addressed:
+            return None
+
+        return ContentAddressedLayout(self.alias_max_age, self.content_public_prefix)
+
+    def topic_weights(self) -> dict[str, float]:
+        """The topics named by --topics, with their weights."""
+        weights = {}
+        for item in filter(None, (item.strip() for item in self.topics.split(","))):
+            topic, _, weight = item.partition("=")
+            topic = topic.strip()
+            if not topic.startswith("transformed"):
+                raise ValueError(f"{topic} isn't a transformed topic")
 
-    destination_bucket = os.environ.get("S3_BUCKET")
+            try:
+                weights[topic] = float(weight) if weight else 1.0
+            except ValueError:
+                raise ValueError(f"Invalid weight for {topic}: {weight}") from None
+            if weights[topic] <= 0:
+                raise ValueError(f"The weight of {topic} must be positive")
 
+        return weights
+
+    def context_url(self) -> str:
+        """The URL of the JSON-LD context: the one given, or its place under catalogue_url."""
+        return self.jsonld_context_url or context_url(self.catalogue_url)
+
+    def catalogue_index(self) -> CatalogueIndex | None:
+        if self.catalogue_index_shards <= 0:
+            return None
+
+        return CatalogueIndex(self.catalogue_index_shards, self.catalogue_url, self.context_url())
+
+    def item_coverage(self) -> ItemCoverageRollup | None:
+        if self.item_coverage_interval <= 0:
+            return None
+
+        return ItemCoverageRollup(self.item_coverage_interval)
+
+    def qa_index(self) -> QASummaryIndex | None:
+        if self.qa_index_interval <= 0:
+            return None
+
+        return QASummaryIndex(self.qa_index_path or ":memory:")
+
+
+def create_messagers(
+    s3_client,
+    destination_bucket: str,
+    identifier: str = "",
+    output_cache: OutputFingerprintCache = None,
+    render_pool: RenderPool = None,
+    streaming_threshold: int = DEFAULT_STREAMING_THRESHOLD,
+    streaming_spool_bytes: int = DEFAULT_SPOOL_BYTES,
+    jsonld_context_url: str = DEFAULT_CONTEXT_URL,
+    defer_actions: bool = False,
+    annotation_rollups: bool = False,
+    qa_index: QASummaryIndex = None,
+    catalogue_index: CatalogueIndex = None,
+    item_coverage: ItemCoverageRollup = None,
+    dataset_topics: Sequence[str] = None,
+) -> dict[str, Messager]:
+    """
+    Returns the messager for each topic we consume: the annotations topic, and either
+    dataset_topics or transformed{identifier}, which share a messager. Set `defer_actions`
+    when the actions are run by an UploadExecutor.
+    """
     annotations_messager = AnnotationsMessager(
-        s3_client=s3_client, output_bucket=destination_bucket
+        s3_client=s3_client,
+        output_bucket=destination_bucket,
+        output_cache=output_cache,
+        render_pool=render_pool,
+        streaming_threshold=streaming_threshold,
+        spool_bytes=streaming_spool_bytes,
+        jsonld_context_url=jsonld_context_url,
+        defer_actions=defer_actions,
+        rollups=annotation_rollups,
+        qa_index=qa_index,
     )
-    datasets_messager = DatasetDCATMessager(s3_client=s3_client, output_bucket=destination_bucket)
-
-    run(
-        {
-            "transformed-annotations": annotations_messager,
-            f"transformed{identifier}": datasets_messager,
-        },
-        "annotations-ingester",
-        takeover_mode=takeover,
-        pulsar_url=pulsar_url,
+    datasets_messager = DatasetDCATMessager(
+        s3_client=s3_client,
+        output_bucket=destination_bucket,
+        output_cache=output_cache,
+        render_pool=render_pool,
+        jsonld_context_url=jsonld_context_url,
+        defer_actions=defer_actions,
+        index=catalogue_index,
+        item_coverage=item_coverage,
+        qa_index=qa_index,
     )
 
+    return {
+        ANNOTATIONS_TOPIC: annotations_messager,
+        **dict.fromkeys(dataset_topics or [f"transformed{identifier}"], datasets_messager),
+    }
+
+
+def stop_on_sigterm(stop_event: threading.Event = None) -> Callable | int | None:
+    """
+    Stops consuming on SIGTERM, as sent before a pod is killed: by setting the pipelined
+    runner's stop_event, so that the batches in flight are finished, or by raising SystemExit
+    from the eodhp_utils runner, which can't otherwise be stopped. Either way ingest's shutdown
+    hooks then run. Signals can only be handled by the main thread, so when ingest runs in
+    another one (as in the load test) it's left to whoever started it to stop it. Returns the
+    handler this replaces, if any.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return None
+
+    def handle(signum, frame):
+        logging.info("Received SIGTERM, stopping")
+        if stop_event is None:
+            raise SystemExit(0)
+        stop_event.set()
+
+    return signal.signal(signal.SIGTERM, handle)
+
+
+def ingest(
+    options: IngesterOptions,
+    s3_client,
+    destination_bucket: str,
+    identifier: str = "",
+    pulsar_url: str = None,
+    client=None,
+    stop_event: threading.Event = None,
+):
+    """
+    Consumes messages until stopped. A Pulsar `client` (and `stop_event`) can be given to run
+    against something other than the real broker, which always uses the pipelined runner.
+    Buffered state (the QA index, Item coverage and output cache snapshot) is written out once
+    consumption stops, including on SIGTERM; see stop_on_sigterm.
+    """
+    # Run once consumption stops, in reverse order, including on SIGTERM.
+    shutdown_hooks = []
+
+    if metrics_port := options.metrics_port:
+        metrics.start_metrics_server(metrics_port)
+        s3_client = metrics.TimedS3Client(s3_client)
+
+    throttle = None
+    if options.adaptive_concurrency:
+        throttle = AdaptiveConcurrency(options.upload_threads)
+        s3_client = ThrottledS3Client(s3_client, throttle)
+
+    output_cache = None
+    if options.output_cache_size > 0:
+        output_cache = OutputFingerprintCache(
+            options.output_cache_size, max_age=options.output_cache_max_age
+        )
+        s3_client = InvalidatingS3Client(s3_client, output_cache)
+
+        if snapshot := options.output_cache_snapshot:
+            loaded = output_cache.load_snapshot(snapshot)
+            logging.info(f"Loaded {loaded} output fingerprints from {snapshot}")
+            shutdown_hooks.append(functools.partial(output_cache.save_snapshot, snapshot))
+
+        if options.warm_output_cache:
+            warmed = sum(
+                output_cache.warm_from_bucket(s3_client, destination_bucket, prefix)
+                for prefix in (CATALOGUE_PUBLIC_BUCKET_PREFIX, ANNOTATION_INDEX_PREFIX)
+            )
+            logging.info(f"Warmed output cache with {warmed} ETags")
+
+    if options.publish_context:
+        publish_context(s3_client, destination_bucket)
+
+    render_pool = RenderPool(options.workers) if options.workers > 0 else None
+    pipelined = options.pipelined or client is not None
+    topic_weights = options.topic_weights()
+    item_coverage = options.item_coverage()
+    qa_index = options.qa_index()
+
+    messagers = create_messagers(
+        s3_client,
+        destination_bucket,
+        identifier,
+        output_cache,
+        render_pool,
+        streaming_threshold=options.streaming_threshold,
+        streaming_spool_bytes=options.streaming_spool_bytes,
+        jsonld_context_url=options.context_url(),
+        defer_actions=pipelined,
+        annotation_rollups=options.annotation_rollups,
+        qa_index=qa_index,
+        catalogue_index=options.catalogue_index(),
+        item_coverage=item_coverage,
+        dataset_topics=[topic for topic in topic_weights if topic != ANNOTATIONS_TOPIC],
+    )
+
+    if item_coverage is not None:
+        # The messager is shared by every dataset topic.
+        datasets_messager = next(
+            m for m in messagers.values() if isinstance(m, DatasetDCATMessager)
+        )
+        item_coverage.start_flushing(datasets_messager.flush_item_coverage)
+        shutdown_hooks.append(item_coverage.stop_flushing)
+
+    if qa_index is not None:
+        qa_index.start_exporting(s3_client, destination_bucket, options.qa_index_interval)
+        shutdown_hooks.append(qa_index.stop_exporting)
+
+    if pipelined and stop_event is None:
+        stop_event = threading.Event()
+    previous_handler = stop_on_sigterm(stop_event if pipelined else None)
+
+    try:
+        if not pipelined:
+            run(
+                messagers,
+                "annotations-ingester",
+                takeover_mode=options.takeover,
+                pulsar_url=pulsar_url,
+            )
+            return
+
+        return run_pipelined(
+            messagers,
+            "annotations-ingester",
+            pulsar_url=pulsar_url,
+            max_in_flight=options.max_in_flight or max(2 * options.workers, 4),
+            upload_executor=UploadExecutor(
+                options.upload_threads, options.output_encoder(), options.content_layout()
+            ),
+            batch_size=options.batch_size,
+            batch_wait=options.batch_wait_ms / 1000,
+            coalesce_window=options.coalesce_window_ms / 1000,
+            client=client,
+            stop_event=stop_event,
+            throttle=throttle,
+            topic_weights=topic_weights,
+            topic_max_in_flight=options.topic_max_in_flight,
+        )
+    finally:
+        if render_pool is not None:
+            render_pool.shutdown()
+
+        if previous_handler is not None:
+            signal.signal(signal.SIGTERM, previous_handler)
+
+        for hook in reversed(shutdown_hooks):
+            try:
+                hook()
+            except Exception:
+                logging.exception(f"Shutdown hook {hook} failed")
+
 
 if __name__ == "__main__":
     cli()
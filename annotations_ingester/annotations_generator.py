@@ -1,11 +1,61 @@
-from typing import Sequence
+import functools
+import logging
+import re
+from typing import IO, TYPE_CHECKING, Callable, Sequence
 
+from botocore.exceptions import ClientError
 from eodhp_utils.messagers import CatalogueChangeBodyMessager, Messager
-from rdflib import ConjunctiveGraph, Graph, URIRef
+from rdflib import Dataset
 from rdflib.namespace import OWL, RDF
 
+from annotations_ingester import metrics
+from annotations_ingester.canonical import canonical_jsonld, canonical_turtle
+from annotations_ingester.jsonld_context import DEFAULT_CONTEXT_URL, compact_jsonld
+from annotations_ingester.output_cache import OutputCacheMixin
+from annotations_ingester.rollup import (
+    is_result_triple,
+    rollup_actions,
+    run_results,
+    skolemised_ntriples,
+)
+from annotations_ingester.streaming import (
+    DEFAULT_SPOOL_BYTES,
+    kept_triples,
+    stream_default_graph,
+)
+from annotations_ingester.uploads import DirectActionsMixin, S3DeleteAction, is_missing
+from annotations_ingester.validation import (
+    MEASUREMENT_DATASET_CLASS,
+    UUID_URN_PREFIX,
+    InvalidAnnotationError,
+    require_valid,
+)
+from annotations_ingester.worker_pool import RenderPoolMixin
 
-class AnnotationsMessager(CatalogueChangeBodyMessager):
+if TYPE_CHECKING:
+    from annotations_ingester.qa_index import QASummaryIndex
+
+OUTPUT_EXTENSIONS = (".ttl", ".jsonld")
+
+# The UUID of the annotation at each catalogue path is kept under this prefix, which isn't
+# published, because the outputs are named by UUID and it can't be read once the entry's gone.
+ANNOTATION_INDEX_PREFIX = "annotation-sources/"
+
+# Bodies at least this large are best converted by render_annotation_streaming. Its outputs
+# are files, which only the UploadExecutor uploads in parts, so streaming is off by default.
+LARGE_ANNOTATION_BYTES = 32 * 1024 * 1024
+DEFAULT_STREAMING_THRESHOLD = 0
+
+_UUID_URN_RE = re.compile(rb"<urn:uuid:([0-9A-Fa-f-]+)>")
+
+
+class AnnotationsMessager(
+    metrics.MetricsMixin,
+    DirectActionsMixin,
+    OutputCacheMixin,
+    RenderPoolMixin,
+    CatalogueChangeBodyMessager,
+):
     """
     Generates basic DCAT for catalogue entries. Supports Catalogs and Collections and is
     intended only to be sufficient for finding QA information linked to a dataset.
@@ -13,10 +63,78 @@ class AnnotationsMessager(CatalogueChangeBodyMessager):
     The output is sent to the catalogue public static files bucket under a path matching the
     catalogue API endpoint for the dataset. For example:
         /catalogue/
+
+    When an output cache is configured the output is canonicalised so that re-sent
+    annotations produce identical bytes and their uploads can be skipped.
+
+    Bodies of at least `streaming_threshold` bytes are converted in this process by
+    render_annotation_streaming, which keeps at most `spool_bytes` of each output in memory.
+    0, the default, disables this. The outputs are then files, so the actions should be run by
+    an UploadExecutor, which closes them once they're uploaded.
+
+    The JSON-LD refers to the shared context at `jsonld_context_url`.
+
+    The UUID of each annotation is recorded at annotation_index_key(cat_path) so that its
+    outputs can be deleted with it. Outputs left behind when an annotation is replaced by one
+    with a different UUID are removed by the orphan sweeper.
+
+    With `rollups` set, each annotation is also merged into the rollup and summary of the
+    annotations for its dataset (see rollup.py). Of a streamed annotation, only the triples
+    which identify its run and give its results are kept for this.
+
+    With a `qa_index`, the results of each annotation are also recorded in the summary index of
+    every dataset's QA (see qa_index.py).
     """
 
-    def process_delete(self, **kwargs):
-        return []
+    message_type = "annotation"
+
+    def __init__(
+        self,
+        *args,
+        streaming_threshold: int = DEFAULT_STREAMING_THRESHOLD,
+        spool_bytes: int = DEFAULT_SPOOL_BYTES,
+        jsonld_context_url: str = DEFAULT_CONTEXT_URL,
+        rollups: bool = False,
+        qa_index: "QASummaryIndex" = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.streaming_threshold = streaming_threshold
+        self.spool_bytes = spool_bytes
+        self.jsonld_context_url = jsonld_context_url
+        self.rollups = rollups
+        self.qa_index = qa_index
+
+    def process_delete(
+        self,
+        bucket: str = None,
+        key: str = None,
+        cat_path: str = None,
+        source: str = None,
+        target: str = None,
+        **kwargs,
+    ) -> Sequence[Messager.Action]:
+        if cat_path is None:
+            return []
+
+        if self.qa_index is not None:
+            self.qa_index.remove(cat_path)
+
+        # The outputs are named by the recorded UUID, which is read where the delete is made.
+        actions = [
+            S3DeleteAction(
+                keys=[annotation_index_key(cat_path)],
+                resolve_keys=functools.partial(recorded_output_keys, cat_path),
+                bucket=self.output_bucket,
+            )
+        ]
+        if self.rollups:
+            # Runs are also removed by their source, so the UUID isn't needed.
+            actions += rollup_actions(
+                annotation_key_root(cat_path, ""), "", cat_path, None, None, self.output_bucket
+            )
+
+        return actions
 
     def process_update_body(
         self,
@@ -26,24 +144,42 @@ class AnnotationsMessager(CatalogueChangeBodyMessager):
         target: str,
     ) -> Sequence[Messager.Action]:
 
-        short_path = "/".join(cat_path.split("/")[:-1])
+        if self.streaming_threshold and len(entry_body) >= self.streaming_threshold:
+            # The outputs are files, which can't be returned from a worker process.
+            render_rollup = render_annotation_streaming_rollup
+            render_results = render_annotation_streaming_results
+            render = render_annotation_streaming
+            args = (self.spool_bytes, self.jsonld_context_url)
+            in_process = True
+        else:
+            render_rollup = render_annotation_rollup
+            render_results = render_annotation_results
+            render = render_annotation
+            args = (self.output_cache is not None, self.jsonld_context_url)
+            in_process = False
 
-        graph = Graph()
-        graph.parse(entry_body, format="trig")
+        if self.rollups:
+            uuid, turtle, jsonld, ntriples, results = self.render(
+                render_rollup, entry_body, *args, in_process=in_process
+            )
+        elif self.qa_index is not None:
+            uuid, turtle, jsonld, results = self.render(
+                render_results, entry_body, *args, in_process=in_process
+            )
+        else:
+            uuid, turtle, jsonld = self.render(render, entry_body, *args, in_process=in_process)
 
-        uuid = get_uuid_from_graph(entry_body)
+        if self.qa_index is not None:
+            self.qa_index.record(cat_path, uuid, results)
 
         if uuid:
             cache_control_length = 60 * 60 * 24 * 7  # 1 week
         else:
             cache_control_length = 0
 
-        turtle = graph.serialize(format="turtle")
-        jsonld = graph.serialize(format="json-ld")
-
-        key_root = f"catalogue/{short_path}/annotations/{uuid}"
+        key_root = annotation_key_root(cat_path, uuid)
 
-        return [
+        actions = [
             Messager.S3UploadAction(
                 key=key_root + ".ttl",
                 file_body=turtle,
@@ -58,28 +194,312 @@ class AnnotationsMessager(CatalogueChangeBodyMessager):
                 cache_control=f"max-age={cache_control_length}",
                 bucket=self.output_bucket,
             ),
+            Messager.S3UploadAction(
+                key=annotation_index_key(cat_path),
+                file_body=uuid,
+                mime_type="text/plain",
+                bucket=self.output_bucket,
+            ),
         ]
+        if self.rollups:
+            actions += rollup_actions(
+                annotation_key_root(cat_path, ""),
+                uuid,
+                cat_path,
+                ntriples,
+                results,
+                self.output_bucket,
+            )
+
+        return actions
+
+
+def annotation_key_root(cat_path: str, uuid: str) -> str:
+    """The key of an annotation's outputs, without the extension."""
+    short_path = "/".join(cat_path.split("/")[:-1])
+
+    return f"catalogue/{short_path}/annotations/{uuid}"
+
+
+def annotation_index_key(cat_path: str) -> str:
+    """The key at which the UUID of the annotation at cat_path is recorded."""
+    return ANNOTATION_INDEX_PREFIX + cat_path.lstrip("/")
+
+
+def recorded_output_keys(cat_path: str, s3_client, bucket: str) -> list[str]:
+    """
+    The keys of the outputs of the annotation at cat_path, named by the UUID recorded for it.
+    If none was recorded they're left to the orphan sweeper.
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=annotation_index_key(cat_path))
+    except ClientError as e:
+        if not is_missing(e):
+            raise
+
+        logging.warning(f"No UUID recorded for deleted annotation {cat_path}")
+        return []
+
+    key_root = annotation_key_root(cat_path, response["Body"].read().decode("utf-8"))
+    return [key_root + extension for extension in OUTPUT_EXTENSIONS]
+
+
+def render_annotation(
+    file_contents: str | bytes,
+    canonical: bool = False,
+    jsonld_context_url: str = DEFAULT_CONTEXT_URL,
+) -> tuple[str, str, str]:
+    """
+    Returns the UUID of an annotation and the Turtle and JSON-LD of its default graph. This is
+    the CPU-bound part of processing an annotation and is safe to run in a worker process.
+    """
+    uuid, _, turtle, jsonld = _render_annotation(file_contents, canonical, jsonld_context_url)
+
+    return uuid, turtle, jsonld
+
+
+def render_annotation_rollup(
+    file_contents: str | bytes,
+    canonical: bool = False,
+    jsonld_context_url: str = DEFAULT_CONTEXT_URL,
+) -> tuple[str, str, str, bytes, dict]:
+    """
+    Like render_annotation, but also returns the annotation's section of the rollup and its
+    results for the summary (see rollup.py).
+    """
+    uuid, dataset, turtle, jsonld = _render_annotation(file_contents, canonical, jsonld_context_url)
+
+    ntriples = skolemised_ntriples(dataset.default_context, uuid)
+    results = run_results(dataset)
+    metrics.lap("rollup")
+
+    return uuid, turtle, jsonld, ntriples, results
+
+
+def render_annotation_results(
+    file_contents: str | bytes,
+    canonical: bool = False,
+    jsonld_context_url: str = DEFAULT_CONTEXT_URL,
+) -> tuple[str, str, str, dict]:
+    """
+    Like render_annotation, but also returns the annotation's results, for the QA index (see
+    qa_index.py).
+    """
+    uuid, dataset, turtle, jsonld = _render_annotation(file_contents, canonical, jsonld_context_url)
+
+    results = run_results(dataset)
+    metrics.lap("results")
+
+    return uuid, turtle, jsonld, results
+
+
+def _render_annotation(
+    file_contents: str | bytes, canonical: bool, jsonld_context_url: str
+) -> tuple[str, Dataset, str, str]:
+    # Malformed messages are rejected here, before the expensive parse. The body is then
+    # parsed exactly once and everything else is derived from that one dataset.
+    metrics.observe("entry_bytes", len(file_contents))
 
+    prescan_uuid(file_contents)
+    metrics.lap("prescan")
 
-def get_uuid_from_graph(file_contents: str) -> str:
-    """Parses file data to find UUID"""
+    dataset = parse_annotation(file_contents)
+    metrics.lap("parse_trig")
 
-    graph = ConjunctiveGraph()
-    graph.parse(data=file_contents, format="trig")
+    # Checked against the ontology before anything is generated from it (see validation.py).
+    uuid = require_valid(dataset).uuid
+    metrics.lap("validate")
+
+    # Only the default graph is published, as it was when the body was parsed into a
+    # plain Graph.
+    graph = dataset.default_context
+    metrics.observe("triples", len(graph))
+
+    turtle = canonical_turtle(graph) if canonical else graph.serialize(format="turtle")
+    metrics.lap("serialise_turtle")
+
+    if canonical:
+        jsonld = canonical_jsonld(graph, jsonld_context_url)
+    else:
+        jsonld = compact_jsonld(graph, jsonld_context_url)
+    metrics.lap("serialise_jsonld")
+
+    return uuid, dataset, turtle, jsonld
+
+
+def render_annotation_streaming(
+    file_contents: str | bytes,
+    spool_bytes: int = DEFAULT_SPOOL_BYTES,
+    jsonld_context_url: str = DEFAULT_CONTEXT_URL,
+) -> tuple[str, IO[bytes], IO[bytes]]:
+    """
+    Like render_annotation, but without holding the parsed annotation or its outputs in memory.
+    The Turtle and JSON-LD are returned as files, which spill to disk beyond spool_bytes. Only
+    the triples which identify the QA run are kept to find its UUID.
+    """
+    uuid, _, turtle, jsonld = _render_annotation_streaming(
+        file_contents, spool_bytes, jsonld_context_url, _is_identifying
+    )
+
+    return uuid, turtle, jsonld
+
+
+def render_annotation_streaming_rollup(
+    file_contents: str | bytes,
+    spool_bytes: int = DEFAULT_SPOOL_BYTES,
+    jsonld_context_url: str = DEFAULT_CONTEXT_URL,
+) -> tuple[str, IO[bytes], IO[bytes], bytes, dict]:
+    """
+    Like render_annotation_streaming, but also keeps the triples which give the run's results,
+    and returns its section of the rollup and its results for the summary (see rollup.py). The
+    section has only the kept triples of the default graph.
+    """
+    uuid, kept, turtle, jsonld = _render_annotation_streaming(
+        file_contents, spool_bytes, jsonld_context_url, _is_kept_for_results
+    )
+
+    ntriples = skolemised_ntriples(kept.default_context, uuid)
+    results = run_results(kept)
+    metrics.lap("rollup")
+
+    return uuid, turtle, jsonld, ntriples, results
+
+
+def render_annotation_streaming_results(
+    file_contents: str | bytes,
+    spool_bytes: int = DEFAULT_SPOOL_BYTES,
+    jsonld_context_url: str = DEFAULT_CONTEXT_URL,
+) -> tuple[str, IO[bytes], IO[bytes], dict]:
+    """
+    Like render_annotation_streaming, but also keeps the triples which give the run's results,
+    and returns them for the QA index.
+    """
+    uuid, kept, turtle, jsonld = _render_annotation_streaming(
+        file_contents, spool_bytes, jsonld_context_url, _is_kept_for_results
+    )
+
+    results = run_results(kept)
+    metrics.lap("results")
+
+    return uuid, turtle, jsonld, results
+
+
+def streamed_run_results(file_contents: str | bytes) -> tuple[str, dict]:
+    """
+    The UUID and results of an annotation as render_annotation_streaming_results finds them,
+    without converting it.
+    """
+    prescan_uuid(file_contents)
+    kept = kept_triples(file_contents, _is_kept_for_results)
+
+    return require_valid(_identifying(kept)).uuid, run_results(kept)
+
+
+def _render_annotation_streaming(
+    file_contents: str | bytes,
+    spool_bytes: int,
+    jsonld_context_url: str,
+    keep: Callable[[tuple], bool],
+) -> tuple[str, Dataset, IO[bytes], IO[bytes]]:
+    metrics.observe("entry_bytes", len(file_contents))
+
+    prescan_uuid(file_contents)
+    metrics.lap("prescan")
+
+    kept, triples, turtle, jsonld = stream_default_graph(
+        file_contents, keep, spool_bytes, jsonld_context_url
+    )
+    metrics.lap("stream_render")
+
+    # Only the identity of the run can be validated, as the rest wasn't kept.
+    try:
+        uuid = require_valid(_identifying(kept)).uuid
+    except InvalidAnnotationError:
+        turtle.close()
+        jsonld.close()
+        raise
+
+    metrics.lap("validate")
+    metrics.observe("triples", triples)
+
+    return uuid, kept, turtle, jsonld
+
+
+def _is_identifying(triple) -> bool:
+    """True for the triples get_uuid_from_graph looks at."""
+    _, p, o = triple
+    return (p == RDF.type and o == MEASUREMENT_DATASET_CLASS) or (
+        p == OWL.sameAs and o.startswith(UUID_URN_PREFIX)
+    )
+
+
+def _is_kept_for_results(triple) -> bool:
+    return _is_identifying(triple) or is_result_triple(triple)
+
+
+def _identifying(dataset: Dataset) -> Dataset:
+    """The triples of dataset which _is_identifying picks out, in their graphs."""
+    identifying = Dataset()
+    for s, p, o, g in dataset.quads():
+        if _is_identifying((s, p, o)):
+            identifying.add((s, p, o, g))
+
+    return identifying
+
+
+def prescan_uuid(file_contents: str | bytes) -> str | None:
+    """
+    Cheaply checks, without parsing, that file data could describe a QA run. Raises
+    InvalidAnnotationError if it can't. Returns the UUID if exactly one `<urn:uuid:...>` IRI
+    appears, otherwise None - the full parse decides which one is the run's.
+    """
+    if isinstance(file_contents, str):
+        file_contents = file_contents.encode("utf-8")
+
+    if b"EODHQualityMeasurementDataset" not in file_contents:
+        raise InvalidAnnotationError("Annotation does not mention an EODHQualityMeasurementDataset")
+
+    if UUID_URN_PREFIX.encode("ascii") not in file_contents:
+        raise InvalidAnnotationError("Annotation does not contain a urn:uuid identifier")
+
+    candidates = set(_UUID_URN_RE.findall(file_contents))
+    if len(candidates) == 1:
+        return candidates.pop().decode("ascii")
+
+    return None
+
+
+def parse_annotation(file_contents: str | bytes) -> Dataset:
+    """Parses TriG file data into a Dataset, keeping its named graphs separate."""
+    dataset = Dataset()
+    dataset.parse(data=file_contents, format="trig")
+
+    return dataset
+
+
+def get_uuid_from_graph(graph: Dataset | str | bytes) -> str:
+    """Finds the QA run UUID in a parsed annotation. Unparsed file data is parsed first."""
+
+    if isinstance(graph, (str, bytes)):
+        graph = parse_annotation(graph)
 
     # The entire QA run outputs are represented by a resource of type `eodhqa:EODHQualityMeasurementDataset`
-    # There should be only one.
-    eodhqa = URIRef("https://eodatahub.org.uk/api/ontologies/qa/")
-    measurement_dset = next(
-        graph.triples((None, RDF.type, eodhqa + "EODHQualityMeasurementDataset"))
-    )[0]
+    # There should be only one. It's normally in a named graph, so all graphs are searched.
+    try:
+        measurement_dset = next(graph.quads((None, RDF.type, MEASUREMENT_DATASET_CLASS, None)))[0]
+    except StopIteration:
+        raise InvalidAnnotationError("Annotation has no EODHQualityMeasurementDataset") from None
 
     # The eodhqa:EODHQualityMeasurementDataset should always have an `owl:sameAs` triple with its UUID.
-    uuid_ref = next(
-        obj
-        for obj in list(graph.objects(measurement_dset, OWL.sameAs))
-        if str(obj).startswith("urn:uuid:")
-    )
-    uuid = str(uuid_ref)[len("urn:uuid:") :]
+    try:
+        uuid_ref = next(
+            obj
+            for _, _, obj, _ in graph.quads((measurement_dset, OWL.sameAs, None, None))
+            if str(obj).startswith(UUID_URN_PREFIX)
+        )
+    except StopIteration:
+        raise InvalidAnnotationError("EODHQualityMeasurementDataset has no urn:uuid") from None
+
+    uuid = str(uuid_ref)[len(UUID_URN_PREFIX) :]
 
     return uuid
@@ -0,0 +1,480 @@
+"""
+Offline regeneration of the DCAT and annotation outputs from the transformed catalogue.
+
+Replaying the whole catalogue through Pulsar to pick up a change to the DCAT mapping is slow
+and competes with live traffic. `backfill` instead reads STAC JSON (`*.json`) and TriG
+(`*.trig`) entries straight from a local directory or an S3 prefix, renders them in worker
+processes with the same messagers as `cli` and uploads the outputs concurrently.
+
+Entries are visited in lexicographic key order, which is the order S3 lists them in, and at
+most `max_in_flight` are held at once, so memory use doesn't depend on the corpus size. The
+checkpoint file records the last key up to which every entry has been dealt with, so an
+interrupted backfill can be resumed from there. Keys which failed are appended to
+`<checkpoint>.failed`.
+
+Run with, for example:
+    python -m annotations_ingester.backfill s3://harvested/transformed/ --checkpoint bf.json
+"""
+
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Iterator
+
+import click
+from eodhp_utils.messagers import Messager
+from eodhp_utils.runner import get_boto3_session, setup_logging
+
+from annotations_ingester import jsonld_context
+from annotations_ingester.annotations_generator import (
+    LARGE_ANNOTATION_BYTES,
+    AnnotationsMessager,
+)
+from annotations_ingester.content_addressing import (
+    DEFAULT_ALIAS_MAX_AGE,
+    DEFAULT_PUBLIC_PREFIX,
+    ContentAddressedLayout,
+)
+from annotations_ingester.dataset_dcat_generator import DatasetDCATMessager
+from annotations_ingester.encodings import DEFAULT_MIN_ENCODE_BYTES, OutputEncoder
+from annotations_ingester.jsonld_context import DEFAULT_CONTEXT_URL
+from annotations_ingester.uploads import (
+    DEFAULT_UPLOAD_CONCURRENCY,
+    MessageUploads,
+    UploadExecutor,
+    body_size,
+    is_file_body,
+    s3_client_config,
+)
+
+ENTRY_KINDS = {".json": "stac", ".trig": "annotation"}
+CHECKPOINT_VERSION = 1
+
+
+@dataclass
+class SourceEntry:
+    # The key relative to the source root, which is used as the catalogue path.
+    key: str
+    kind: str
+    # A local file path or an S3 key.
+    location: str
+
+
+def entry_kind(key: str) -> str | None:
+    return ENTRY_KINDS.get(os.path.splitext(key)[1])
+
+
+def local_entries(root: str, relative: str = "") -> Iterator[SourceEntry]:
+    """Walks a directory, yielding entries in lexicographic order of their relative paths."""
+    directory = os.path.join(root, relative)
+
+    with os.scandir(directory) as it:
+        # A directory's contents sort as if its name ended in '/'.
+        children = sorted(it, key=lambda e: e.name + "/" if e.is_dir() else e.name)
+
+    for child in children:
+        key = f"{relative}{child.name}"
+        if child.is_dir():
+            yield from local_entries(root, key + "/")
+        elif kind := entry_kind(key):
+            yield SourceEntry(key=key, kind=kind, location=child.path)
+
+
+def s3_entries(s3_client, bucket: str, prefix: str) -> Iterator[SourceEntry]:
+    paginator = s3_client.get_paginator("list_objects_v2")
+
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            key = obj["Key"][len(prefix) :].lstrip("/")
+            if kind := entry_kind(key):
+                yield SourceEntry(key=key, kind=kind, location=obj["Key"])
+
+
+def parse_s3_url(source: str) -> tuple[str, str] | None:
+    """Splits 's3://bucket/prefix' into (bucket, prefix), or returns None for a local path."""
+    if not source.startswith("s3://"):
+        return None
+
+    bucket, _, prefix = source[len("s3://") :].partition("/")
+    return bucket, prefix
+
+
+@functools.cache
+def _backfill_messagers(
+    output_bucket: str, jsonld_context_url: str, rollups: bool
+) -> dict[str, Messager]:
+    # Rendering doesn't use the S3 client.
+    return {
+        "stac": DatasetDCATMessager(None, output_bucket, jsonld_context_url=jsonld_context_url),
+        "annotation": AnnotationsMessager(
+            None,
+            output_bucket,
+            streaming_threshold=LARGE_ANNOTATION_BYTES,
+            jsonld_context_url=jsonld_context_url,
+            rollups=rollups,
+        ),
+    }
+
+
+def render_entry(
+    kind: str,
+    cat_path: str,
+    body: bytes,
+    output_bucket: str,
+    jsonld_context_url: str = DEFAULT_CONTEXT_URL,
+    rollups: bool = False,
+) -> list[Messager.Action]:
+    """Returns the actions for one entry. This runs in a worker process."""
+    messager = _backfill_messagers(output_bucket, jsonld_context_url, rollups)[kind]
+
+    if kind == "stac":
+        return list(messager.process_update_stac(json.loads(body), cat_path, "/", "/"))
+    else:
+        return list(messager.process_update_body(body, cat_path, "/", "/"))
+
+
+class InlineExecutor:
+    """Runs submitted functions immediately, for when no worker processes are wanted."""
+
+    def submit(self, fn, *args) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+        return future
+
+    def shutdown(self):
+        pass
+
+
+class Checkpoint:
+    """
+    The last key up to which every entry has been dealt with, for one source. It's saved at
+    most every `interval` seconds, and by `save`. A read-only checkpoint is loaded but never
+    written, for dry runs.
+    """
+
+    def __init__(
+        self, path: str | None, source: str, interval: float = 10.0, read_only: bool = False
+    ):
+        self.path = path
+        self.source = source
+        self.interval = interval
+        self.read_only = read_only
+        self.last_key: str | None = None
+        self.processed = 0
+        self.failed = 0
+        self._last_saved = time.monotonic()
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+
+            if saved.get("source") != source:
+                raise click.UsageError(
+                    f"Checkpoint {path} is for {saved.get('source')}, not {source}"
+                )
+
+            self.last_key = saved["last_key"]
+            self.processed = saved["processed"]
+            self.failed = saved["failed"]
+
+    def is_done(self, key: str) -> bool:
+        return self.last_key is not None and key <= self.last_key
+
+    def advance(self, key: str, failed: bool):
+        self.last_key = key
+        self.processed += 1
+
+        if failed:
+            self.failed += 1
+            if self.path and not self.read_only:
+                with open(f"{self.path}.failed", "a") as f:
+                    f.write(key + "\n")
+
+        if time.monotonic() - self._last_saved >= self.interval:
+            self.save()
+
+    def save(self):
+        self._last_saved = time.monotonic()
+        if not self.path or self.read_only:
+            return
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "version": CHECKPOINT_VERSION,
+                    "source": self.source,
+                    "last_key": self.last_key,
+                    "processed": self.processed,
+                    "failed": self.failed,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.path)
+
+
+def run_backfill(
+    entries: Iterator[SourceEntry],
+    read_body: Callable[[SourceEntry], bytes],
+    uploader: Messager,
+    checkpoint: Checkpoint,
+    executor=None,
+    upload_executor: UploadExecutor = None,
+    max_in_flight: int = 16,
+    dry_run: bool = False,
+    jsonld_context_url: str = DEFAULT_CONTEXT_URL,
+    rollups: bool = False,
+) -> Checkpoint:
+    """
+    Renders each entry not yet done according to the checkpoint and uploads its outputs using
+    `uploader`'s S3 client and bucket. The checkpoint advances past each entry, in order, once
+    its uploads have finished. In a dry run the outputs are logged instead of uploaded.
+    """
+    executor = executor or InlineExecutor()
+    upload_executor = upload_executor or UploadExecutor()
+
+    # Each stage holds (entry, future or tracker) in key order.
+    rendering: deque[tuple[SourceEntry, Future]] = deque()
+    uploading: deque[tuple[SourceEntry, MessageUploads | Exception]] = deque()
+
+    def finish_upload():
+        entry, tracker = uploading.popleft()
+        failure = tracker if isinstance(tracker, Exception) else tracker.result()
+
+        if failure is not None:
+            logging.error(f"Backfill of {entry.key} failed: {failure}")
+
+        checkpoint.advance(entry.key, failed=failure is not None)
+
+    def finish_render():
+        entry, future = rendering.popleft()
+
+        try:
+            actions = future.result()
+        except Exception as e:
+            uploading.append((entry, e))
+            return
+
+        if dry_run:
+            for action in actions:
+                if isinstance(action, Messager.S3UploadAction):
+                    size = body_size(action.file_body)
+                    logging.info(f"Would upload {size} bytes to {action.key}")
+                    if is_file_body(action.file_body):
+                        action.file_body.close()
+                else:
+                    logging.info(f"Would update {action.key}")
+            actions = []
+
+        uploading.append((entry, upload_executor.submit(uploader, actions)))
+
+        while len(uploading) > max_in_flight:
+            finish_upload()
+
+    for entry in entries:
+        if checkpoint.is_done(entry.key):
+            continue
+
+        try:
+            body = read_body(entry)
+
+            # Large annotations are rendered to files, which can't be returned from a worker
+            # process, so they're rendered here.
+            if entry.kind == "annotation" and len(body) >= LARGE_ANNOTATION_BYTES:
+                render_executor = InlineExecutor()
+            else:
+                render_executor = executor
+
+            future = render_executor.submit(
+                render_entry,
+                entry.kind,
+                entry.key,
+                body,
+                uploader.output_bucket,
+                jsonld_context_url,
+                rollups,
+            )
+        except Exception as e:
+            future = Future()
+            future.set_exception(e)
+
+        rendering.append((entry, future))
+
+        while len(rendering) > max_in_flight or (rendering and rendering[0][1].done()):
+            finish_render()
+
+    while rendering:
+        finish_render()
+    while uploading:
+        finish_upload()
+
+    checkpoint.save()
+
+    return checkpoint
+
+
+@click.command
+@click.argument("source")
+@click.option(
+    "--output-bucket", envvar="S3_BUCKET", required=True, help="Bucket to write outputs to."
+)
+@click.option("--workers", default=os.cpu_count(), help="Worker processes for rendering.")
+@click.option("--max-in-flight", default=64, help="Entries being rendered or uploaded at once.")
+@click.option(
+    "--upload-concurrency", default=DEFAULT_UPLOAD_CONCURRENCY, help="Concurrent S3 uploads."
+)
+@click.option("--checkpoint", type=click.Path(dir_okay=False), help="File to resume from.")
+@click.option("--dry-run", is_flag=True, default=False, help="Render but don't upload.")
+@click.option(
+    "--catalogue-url",
+    envvar="CATALOGUE_URL",
+    required=True,
+    help="URL at which the catalogue/ prefix is served, for the JSON-LD context.",
+)
+@click.option(
+    "--jsonld-context-url",
+    envvar="JSONLD_CONTEXT_URL",
+    help="URL at which the published JSON-LD context is served. Defaults to its place under"
+    " --catalogue-url.",
+)
+@click.option(
+    "--publish-context/--no-publish-context",
+    envvar="PUBLISH_CONTEXT",
+    default=True,
+    help="Upload the JSON-LD context if it's missing or out of date.",
+)
+@click.option(
+    "--output-encodings",
+    envvar="OUTPUT_ENCODINGS",
+    default="",
+    help="Comma-separated encodings ('gzip', 'br') of compressed variants to store.",
+)
+@click.option(
+    "--output-encoding-min-bytes",
+    envvar="OUTPUT_ENCODING_MIN_BYTES",
+    default=DEFAULT_MIN_ENCODE_BYTES,
+    help="Size in bytes below which outputs aren't compressed.",
+)
+@click.option(
+    "--content-addressed",
+    envvar="CONTENT_ADDRESSED",
+    is_flag=True,
+    default=False,
+    help="Store outputs under content hashes, with short-lived aliases at the usual keys.",
+)
+@click.option(
+    "--alias-max-age",
+    envvar="ALIAS_MAX_AGE",
+    default=DEFAULT_ALIAS_MAX_AGE,
+    help="Cache lifetime in seconds of the aliases in the content-addressed layout.",
+)
+@click.option(
+    "--content-public-prefix",
+    envvar="CONTENT_PUBLIC_PREFIX",
+    default=DEFAULT_PUBLIC_PREFIX,
+    help="Path at which the catalogue/ prefix is served, for the aliases' redirects.",
+)
+@click.option(
+    "--annotation-rollups",
+    envvar="ANNOTATION_ROLLUPS",
+    is_flag=True,
+    default=False,
+    help="Merge the annotations of each dataset into a rollup and a summary of the latest results.",
+)
+@click.option("-v", "--verbose", count=True)
+def backfill(
+    source: str,
+    output_bucket: str,
+    workers: int,
+    max_in_flight: int,
+    upload_concurrency: int,
+    checkpoint: str,
+    dry_run: bool,
+    catalogue_url: str,
+    jsonld_context_url: str,
+    publish_context: bool,
+    output_encodings: str,
+    output_encoding_min_bytes: int,
+    content_addressed: bool,
+    alias_max_age: int,
+    content_public_prefix: str,
+    annotation_rollups: bool,
+    verbose: int,
+):
+    """Regenerates the outputs for every entry in SOURCE, a directory or s3://bucket/prefix."""
+    setup_logging(verbosity=verbose)
+
+    try:
+        encoder = OutputEncoder.from_option(output_encodings, output_encoding_min_bytes)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--output-encodings") from e
+
+    s3_client = get_boto3_session().client("s3", config=s3_client_config(upload_concurrency))
+
+    if s3_source := parse_s3_url(source):
+        bucket, prefix = s3_source
+        entries = s3_entries(s3_client, bucket, prefix)
+
+        def read_body(entry: SourceEntry) -> bytes:
+            return s3_client.get_object(Bucket=bucket, Key=entry.location)["Body"].read()
+
+    else:
+        entries = local_entries(source)
+
+        def read_body(entry: SourceEntry) -> bytes:
+            with open(entry.location, "rb") as f:
+                return f.read()
+
+    if publish_context and not dry_run:
+        jsonld_context.publish_context(s3_client, output_bucket)
+
+    jsonld_context_url = jsonld_context_url or jsonld_context.context_url(catalogue_url)
+
+    progress = Checkpoint(checkpoint, source, read_only=dry_run)
+    if progress.last_key is not None:
+        logging.info(f"Resuming after {progress.last_key}")
+
+    if workers > 0:
+        executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    else:
+        executor = InlineExecutor()
+
+    layout = None
+    if content_addressed:
+        layout = ContentAddressedLayout(alias_max_age, content_public_prefix)
+
+    upload_executor = UploadExecutor(upload_concurrency, encoder, layout)
+    try:
+        run_backfill(
+            entries,
+            read_body,
+            DatasetDCATMessager(s3_client, output_bucket),
+            progress,
+            executor=executor,
+            upload_executor=upload_executor,
+            max_in_flight=max_in_flight,
+            dry_run=dry_run,
+            jsonld_context_url=jsonld_context_url,
+            rollups=annotation_rollups,
+        )
+    finally:
+        executor.shutdown()
+        upload_executor.shutdown()
+
+    logging.info(f"Backfilled {progress.processed} entries, of which {progress.failed} failed")
+
+
+if __name__ == "__main__":
+    backfill()
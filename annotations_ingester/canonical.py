@@ -0,0 +1,49 @@
+"""
+Byte-stable serialisation of rdflib graphs.
+
+rdflib labels blank nodes randomly on each parse and its JSON-LD serialiser doesn't order its
+output, so serialising the same annotation twice gives different bytes. These functions give
+identical output for isomorphic graphs, which content hashing relies on.
+"""
+
+import json
+
+from rdflib import Graph
+from rdflib.compare import to_canonical_graph
+
+from annotations_ingester.jsonld_context import DEFAULT_CONTEXT_URL, compact_jsonld
+
+
+def canonical_graph(graph: Graph) -> Graph:
+    """Returns a copy of graph with deterministic blank node labels and the same prefixes."""
+    canonical = to_canonical_graph(graph)
+    canonical.namespace_manager = graph.namespace_manager
+
+    return canonical
+
+
+def canonical_turtle(graph: Graph) -> str:
+    return canonical_graph(graph).serialize(format="turtle")
+
+
+def canonical_jsonld(graph: Graph, context_url: str = DEFAULT_CONTEXT_URL) -> str:
+    return sort_jsonld(compact_jsonld(canonical_graph(graph), context_url))
+
+
+def sort_jsonld(jsonld: str) -> str:
+    """Orders the nodes and values of expanded or compacted JSON-LD output."""
+    document = json.loads(jsonld)
+
+    nodes = document.get("@graph") if isinstance(document, dict) else document
+    if isinstance(nodes, list):
+        for node in nodes:
+            for values in node.values():
+                if isinstance(values, list):
+                    values.sort(key=_sort_key)
+        nodes.sort(key=_sort_key)
+
+    return json.dumps(document, indent=2, sort_keys=True, ensure_ascii=False)
+
+
+def _sort_key(value) -> str:
+    return json.dumps(value, sort_keys=True)
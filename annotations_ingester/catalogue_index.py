@@ -0,0 +1,445 @@
+"""
+A catalogue-wide DCAT index of the Catalogs and Collections.
+
+DatasetDCATMessager publishes a small DCAT document for each entry, so a harvester wanting all
+of them would have to crawl the catalogue. With a CatalogueIndex, each entry is also listed in
+one of a fixed number of shards under catalogue/index/:
+
+    catalog.ttl, catalog.jsonld     a dcat:Catalog with a dcat:catalog for each shard
+    0007.ttl, 0007.jsonld           a dcat:Catalog with a dcat:dataset for each Collection in
+                                    the shard and a dcat:catalog for each Catalog
+
+Each entry has its type, its identifiers (including any DOI) and an rdfs:seeAlso link to its
+own DCAT document. Entries are assigned to shards by a hash of their catalogue path, so an
+update or delete can find its shard without reading anything, and changes only that shard,
+with S3UpdateActions as for the rollups of annotations (see rollup.py). Deleting a Catalog
+also removes the entries beneath it, which changes every shard.
+
+The Turtle shards are written as N-Triples, which is also Turtle, in a section per entry so
+that an update needn't parse the others. The JSON-LD shards are small enough to load.
+
+The list of shards is only written by `rebuild`, which regenerates the whole index from the
+transformed catalogue. Run it when the index is first enabled, after changing the number of
+shards, or to recover an index which has missed updates, for example:
+    python -m annotations_ingester.catalogue_index s3://harvested/transformed/ --shards 64
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import re
+from pathlib import Path
+from typing import Iterator
+from urllib.parse import quote, unquote
+
+import click
+from eodhp_utils.runner import get_boto3_session, setup_logging
+from rdflib import DCAT, DCTERMS, RDF, RDFS, Graph, URIRef
+
+from annotations_ingester.backfill import local_entries, parse_s3_url, s3_entries
+from annotations_ingester.dataset_dcat_generator import (
+    CATALOGUE_PUBLIC_BUCKET_PREFIX,
+    INDEX_PREFIX,
+    ITEMS_DIRECTORY,
+    DatasetDCATMessager,
+    dcat_key_root,
+)
+from annotations_ingester.dcat_serialiser import DCATRecord
+from annotations_ingester.jsonld_context import (
+    DEFAULT_CONTEXT_URL,
+    compact_iri,
+    context_url,
+)
+from annotations_ingester.orphans import list_directory
+from annotations_ingester.uploads import S3UpdateAction, delete_keys
+
+DEFAULT_CATALOGUE_URL = "https://eodatahub.org.uk/api/catalogue/stac/"
+INDEX_ROOT_NAME = "catalog"
+INDEX_CACHE_CONTROL = "max-age=60"
+
+# Deleting an entry in this directory deletes the entries beneath it too.
+CATALOGS_DIRECTORY = "catalogs"
+
+MEMBER_PROPERTIES = {str(DCAT.Dataset): DCAT.dataset, str(DCAT.Catalog): DCAT.catalog}
+
+# Each entry's section of a Turtle shard starts with: # entry <see also> <type> <IRI>
+_SECTION_RE = re.compile(rb"^# entry (\S+) (\S+) (\S+)\n", re.MULTILINE)
+
+
+class CatalogueIndex:
+    """Where the index is kept, how it's divided into shards and the URLs it's served at."""
+
+    def __init__(
+        self,
+        shards: int,
+        catalogue_url: str = DEFAULT_CATALOGUE_URL,
+        jsonld_context_url: str = DEFAULT_CONTEXT_URL,
+    ):
+        if shards < 1:
+            raise ValueError("The index needs at least one shard")
+
+        self.shards = shards
+        self.catalogue_url = catalogue_url if catalogue_url.endswith("/") else catalogue_url + "/"
+        self.jsonld_context_url = jsonld_context_url
+
+    def shard_of(self, cat_path: str) -> int:
+        digest = hashlib.sha256(cat_path.lstrip("/").encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") % self.shards
+
+    def shard_key_root(self, shard: int) -> str:
+        return f"{INDEX_PREFIX}{shard:04}"
+
+    def root_key_root(self) -> str:
+        return INDEX_PREFIX + INDEX_ROOT_NAME
+
+    def url(self, key_root: str) -> str:
+        """The URL at which the outputs at key_root are served, without the extension."""
+        return self.catalogue_url + key_root.removeprefix(CATALOGUE_PUBLIC_BUCKET_PREFIX)
+
+    def see_also(self, cat_path: str) -> str:
+        """The URL of the DCAT document for an entry, which also identifies it in the index."""
+        return self.url(dcat_key_root(cat_path)) + ".ttl"
+
+    def update_actions(
+        self, record: DCATRecord, cat_path: str, bucket: str = None
+    ) -> list[S3UpdateAction]:
+        """The updates adding or replacing an entry in its shard."""
+        if record.rdf_type not in MEMBER_PROPERTIES:
+            return []
+
+        return self.shard_actions(
+            self.shard_of(cat_path),
+            bucket,
+            see_also=self.see_also(cat_path),
+            beneath=False,
+            record=record,
+        )
+
+    def delete_actions(self, cat_path: str, bucket: str = None) -> list[S3UpdateAction]:
+        """The updates removing an entry, and for a Catalog the entries beneath it."""
+        if Path(cat_path).parent.name == CATALOGS_DIRECTORY:
+            shards = range(self.shards)
+        else:
+            shards = [self.shard_of(cat_path)]
+
+        return [
+            action
+            for shard in shards
+            for action in self.shard_actions(
+                shard,
+                bucket,
+                see_also=self.see_also(cat_path),
+                beneath=len(shards) > 1,
+                record=None,
+            )
+        ]
+
+    def shard_actions(self, shard: int, bucket: str, **change) -> list[S3UpdateAction]:
+        key_root = self.shard_key_root(shard)
+        shard_iris = {"shard_iri": self.url(key_root), "root_iri": self.url(self.root_key_root())}
+
+        return [
+            S3UpdateAction(
+                key=key_root + ".ttl",
+                update=functools.partial(update_turtle_shard, **shard_iris, **change),
+                bucket=bucket,
+                mime_type="text/turtle",
+                cache_control=INDEX_CACHE_CONTROL,
+            ),
+            S3UpdateAction(
+                key=key_root + ".jsonld",
+                update=functools.partial(
+                    update_jsonld_shard,
+                    **shard_iris,
+                    **change,
+                    context_url=self.jsonld_context_url,
+                ),
+                bucket=bucket,
+                mime_type="application/ld+json",
+                cache_control=INDEX_CACHE_CONTROL,
+            ),
+        ]
+
+    def root_documents(self) -> tuple[str, str]:
+        """The Turtle and JSON-LD of the catalogue of shards."""
+        root_iri = URIRef(self.url(self.root_key_root()))
+        shard_iris = [self.url(self.shard_key_root(shard)) for shard in range(self.shards)]
+
+        graph = Graph()
+        graph.bind("dcat", DCAT)
+        graph.add((root_iri, RDF.type, DCAT.Catalog))
+        for shard_iri in shard_iris:
+            graph.add((root_iri, DCAT.catalog, URIRef(shard_iri)))
+
+        document = {
+            "@context": self.jsonld_context_url,
+            "@id": str(root_iri),
+            "@type": compact_iri(str(DCAT.Catalog)),
+            compact_iri(str(DCAT.catalog)): [{"@id": iri} for iri in shard_iris],
+        }
+        return graph.serialize(format="turtle"), json.dumps(document, indent=2)
+
+
+def _is_removed(entry_see_also: str, see_also: str, beneath: bool) -> bool:
+    if entry_see_also == see_also:
+        return True
+
+    return beneath and entry_see_also.startswith(see_also.removesuffix(".ttl") + "/")
+
+
+def turtle_section(record: DCATRecord, see_also: str) -> bytes:
+    graph = record.to_graph()
+    graph.add((URIRef(record.iri), RDFS.seeAlso, URIRef(see_also)))
+
+    lines = graph.serialize(format="nt", encoding="utf-8").splitlines()
+    marker = " ".join(quote(value, safe="") for value in (see_also, record.rdf_type, record.iri))
+
+    return f"# entry {marker}\n".encode("utf-8") + b"".join(
+        sorted(line + b"\n" for line in lines if line.strip())
+    )
+
+
+def turtle_shard(sections: dict[str, bytes], shard_iri: str, root_iri: str) -> bytes:
+    """A Turtle shard from the sections of its entries, by their rdfs:seeAlso."""
+    header = Graph()
+    header.add((URIRef(shard_iri), RDF.type, DCAT.Catalog))
+    header.add((URIRef(shard_iri), DCTERMS.isPartOf, URIRef(root_iri)))
+
+    for section in sections.values():
+        _, rdf_type, iri = (unquote(v.decode()) for v in _SECTION_RE.match(section).groups())
+        header.add((URIRef(shard_iri), MEMBER_PROPERTIES[rdf_type], URIRef(iri)))
+
+    lines = header.serialize(format="nt", encoding="utf-8").splitlines()
+    parts = sorted(line + b"\n" for line in lines if line.strip())
+    parts += [b"\n" + sections[see_also] for see_also in sorted(sections)]
+
+    return b"".join(parts)
+
+
+def update_turtle_shard(
+    turtle: bytes | None,
+    *,
+    shard_iri: str,
+    root_iri: str,
+    see_also: str,
+    beneath: bool,
+    record: DCATRecord | None,
+) -> bytes:
+    """
+    Returns the Turtle shard with the entry for see_also replaced by record, or removed if that's
+    None, along with the entries beneath it if `beneath` is set.
+    """
+    turtle = turtle or b""
+    starts = list(_SECTION_RE.finditer(turtle))
+    sections = {}
+
+    for n, start in enumerate(starts):
+        entry_see_also = unquote(start.group(1).decode())
+        if not _is_removed(entry_see_also, see_also, beneath):
+            end = starts[n + 1].start() if n + 1 < len(starts) else len(turtle)
+            # The blank line before each section is added by turtle_shard.
+            sections[entry_see_also] = turtle[start.start() : end].rstrip(b"\n") + b"\n"
+
+    if record is not None:
+        sections[see_also] = turtle_section(record, see_also)
+
+    return turtle_shard(sections, shard_iri, root_iri)
+
+
+def jsonld_node(record: DCATRecord, see_also: str) -> dict:
+    node = json.loads(record.to_jsonld())
+    del node["@context"]
+    node[compact_iri(str(RDFS.seeAlso))] = {"@id": see_also}
+
+    return node
+
+
+def jsonld_shard(nodes: dict[str, dict], shard_iri: str, root_iri: str, context_url: str) -> bytes:
+    """A JSON-LD shard from the nodes of its entries, by their rdfs:seeAlso."""
+    document = {
+        "@context": context_url,
+        "@id": shard_iri,
+        "@type": compact_iri(str(DCAT.Catalog)),
+        compact_iri(str(DCTERMS.isPartOf)): {"@id": root_iri},
+    }
+
+    for rdf_type, member_property in MEMBER_PROPERTIES.items():
+        members = [
+            nodes[see_also]
+            for see_also in sorted(nodes)
+            if nodes[see_also]["@type"] == compact_iri(rdf_type)
+        ]
+        if members:
+            document[compact_iri(str(member_property))] = members
+
+    return json.dumps(document, indent=2, ensure_ascii=False).encode("utf-8")
+
+
+def update_jsonld_shard(
+    jsonld: bytes | None,
+    *,
+    shard_iri: str,
+    root_iri: str,
+    see_also: str,
+    beneath: bool,
+    record: DCATRecord | None,
+    context_url: str,
+) -> bytes:
+    """The JSON-LD equivalent of update_turtle_shard."""
+    nodes = {}
+    if jsonld:
+        document = json.loads(jsonld)
+        for member_property in MEMBER_PROPERTIES.values():
+            for node in document.get(compact_iri(str(member_property)), []):
+                nodes[node[compact_iri(str(RDFS.seeAlso))]["@id"]] = node
+
+    nodes = {k: v for k, v in nodes.items() if not _is_removed(k, see_also, beneath)}
+    if record is not None:
+        nodes[see_also] = jsonld_node(record, see_also)
+
+    return jsonld_shard(nodes, shard_iri, root_iri, context_url)
+
+
+def catalogue_records(source_entries: Iterator, read) -> Iterator[tuple[str, DCATRecord]]:
+    """
+    The catalogue path and DCAT record of each Catalog and Collection among the backfill
+    entries, reading each with `read(entry)`. Entries which can't be read are logged and skipped.
+    """
+    generator = DatasetDCATMessager(None, None)
+
+    for entry in source_entries:
+        if entry.kind != "stac" or Path(entry.key).parent.name == ITEMS_DIRECTORY:
+            continue
+
+        try:
+            record = generator.generate_record(json.loads(read(entry)))
+        except Exception:
+            logging.exception(f"Couldn't index {entry.key}")
+            continue
+
+        if record is not None and record.rdf_type in MEMBER_PROPERTIES:
+            yield entry.key, record
+
+
+def rebuild_index(s3_client, bucket: str, index: CatalogueIndex, records) -> dict:
+    """
+    Replaces the whole index with one of `records`, pairs of catalogue path and DCATRecord, and
+    deletes any shards beyond the number the index now has. Returns counts of what was written.
+    """
+    sections = [{} for _ in range(index.shards)]
+    nodes = [{} for _ in range(index.shards)]
+
+    for cat_path, record in records:
+        shard, see_also = index.shard_of(cat_path), index.see_also(cat_path)
+        sections[shard][see_also] = turtle_section(record, see_also)
+        nodes[shard][see_also] = jsonld_node(record, see_also)
+
+    root_iri = index.url(index.root_key_root())
+    for shard in range(index.shards):
+        key_root = index.shard_key_root(shard)
+        shard_iri = index.url(key_root)
+        documents = {
+            ".ttl": (turtle_shard(sections[shard], shard_iri, root_iri), "text/turtle"),
+            ".jsonld": (
+                jsonld_shard(nodes[shard], shard_iri, root_iri, index.jsonld_context_url),
+                "application/ld+json",
+            ),
+        }
+        for extension, (body, mime_type) in documents.items():
+            _put(s3_client, bucket, key_root + extension, body, mime_type)
+
+    turtle, jsonld = index.root_documents()
+    _put(s3_client, bucket, index.root_key_root() + ".ttl", turtle, "text/turtle")
+    _put(s3_client, bucket, index.root_key_root() + ".jsonld", jsonld, "application/ld+json")
+
+    expected = {
+        key_root + extension
+        for key_root in [index.root_key_root()]
+        + [index.shard_key_root(shard) for shard in range(index.shards)]
+        for extension in (".ttl", ".jsonld")
+    }
+    keys, _ = list_directory(s3_client, bucket, INDEX_PREFIX)
+    stale = [key for key in keys if key not in expected]
+    failed = delete_keys(s3_client, bucket, stale) if stale else []
+
+    return {
+        "entries": sum(len(shard) for shard in nodes),
+        "shards": index.shards,
+        "deleted": len(stale) - len(failed),
+        "failed": len(failed),
+    }
+
+
+def _put(s3_client, bucket: str, key: str, body, mime_type: str):
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=body,
+        ContentType=mime_type,
+        CacheControl=INDEX_CACHE_CONTROL,
+    )
+
+
+@click.command
+@click.argument("source")
+@click.option("--bucket", envvar="S3_BUCKET", required=True, help="Bucket the outputs are in.")
+@click.option(
+    "--shards",
+    envvar="CATALOGUE_INDEX_SHARDS",
+    type=click.IntRange(min=1),
+    required=True,
+    help="Number of shards to divide the index into.",
+)
+@click.option(
+    "--catalogue-url",
+    envvar="CATALOGUE_URL",
+    required=True,
+    help="URL at which the catalogue/ prefix is served, for the index's links.",
+)
+@click.option(
+    "--jsonld-context-url",
+    envvar="JSONLD_CONTEXT_URL",
+    help="URL at which the published JSON-LD context is served, for the outputs to refer to."
+    " Defaults to its place under --catalogue-url.",
+)
+@click.option("-v", "--verbose", count=True)
+def rebuild(
+    source: str,
+    bucket: str,
+    shards: int,
+    catalogue_url: str,
+    jsonld_context_url: str,
+    verbose: int,
+):
+    """
+    Rebuilds the catalogue DCAT index from SOURCE, the transformed catalogue as a directory or
+    s3://bucket/prefix. Updates made by the ingester while this runs may be lost, so rebuild
+    when it's stopped or run this again afterwards.
+    """
+    setup_logging(verbosity=verbose)
+
+    s3_client = get_boto3_session().client("s3")
+
+    if s3_source := parse_s3_url(source):
+        source_bucket, prefix = s3_source
+        entries = s3_entries(s3_client, source_bucket, prefix)
+
+        def read(entry) -> bytes:
+            return s3_client.get_object(Bucket=source_bucket, Key=entry.location)["Body"].read()
+
+    else:
+        entries = local_entries(source)
+
+        def read(entry) -> bytes:
+            with open(entry.location, "rb") as f:
+                return f.read()
+
+    index = CatalogueIndex(shards, catalogue_url, jsonld_context_url or context_url(catalogue_url))
+    stats = rebuild_index(s3_client, bucket, index, catalogue_records(entries, read))
+
+    logging.info(f"Rebuilt the catalogue index: {stats}")
+
+
+if __name__ == "__main__":
+    rebuild()
@@ -0,0 +1,164 @@
+"""
+Coalescing of bursts of messages which touch the same catalogue entries.
+
+When a collection is edited repeatedly or re-harvested, the same entry keys can appear in
+several messages within a few seconds. Only the last of them determines what the outputs should
+be, so Coalescer holds each message for a short window and drops keys from it which a newer
+message also touches. A message left with no keys is superseded: it's acknowledged without
+being processed. One left with some keys is processed with just those.
+"""
+
+import json
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+KEY_FIELDS = ("added_keys", "updated_keys", "deleted_keys")
+
+
+class PrunedMessage:
+    """A Pulsar message with some of its keys removed. Everything but data() is delegated."""
+
+    def __init__(self, message, data: bytes):
+        self.message = message
+        self._data = data
+
+    def data(self) -> bytes:
+        return self._data
+
+    def __getattr__(self, name):
+        return getattr(self.message, name)
+
+
+def unwrap(msg):
+    """Returns the message which was received from Pulsar, for acknowledging."""
+    return msg.message if isinstance(msg, PrunedMessage) else msg
+
+
+@dataclass
+class HeldMessage:
+    message: object
+    received_at: float
+    body: dict | None
+    # Keys of entries still to be processed for this message.
+    keys: set[tuple[str, str]] = field(default_factory=set)
+    pruned: bool = False
+
+    def effective_message(self):
+        """The message to process: the original or, if keys were removed, a pruned copy."""
+        if not self.pruned:
+            return self.message
+
+        body = dict(self.body)
+        for key_field in KEY_FIELDS:
+            body[key_field] = [
+                k for k in body.get(key_field, []) if (body.get("bucket_name"), k) in self.keys
+            ]
+
+        return PrunedMessage(self.message, json.dumps(body).encode("utf-8"))
+
+
+class Coalescer:
+    """
+    Holds messages for `window` seconds, in the order they arrived. When a message arrives its
+    keys are removed from the held messages for the same topic. Messages are keyed by
+    (bucket, key) within a topic.
+    """
+
+    def __init__(self, window: float, topic_of=None):
+        self.window = window
+        self._topic_of = topic_of or (lambda msg: msg.topic_name())
+        self._held: OrderedDict[int, HeldMessage] = OrderedDict()
+        # The sequence of the held message which each (topic, bucket, key) is still to be
+        # processed for, so that adding a message costs time in its keys, not in what's held.
+        self._holders: dict[tuple[str, str, str], int] = {}
+        self._sequence = 0
+
+        self.messages_seen = 0
+        self.messages_superseded = 0
+        self.keys_seen = 0
+        self.keys_pruned = 0
+
+    def __len__(self):
+        return len(self._held)
+
+    def add(self, msg, now: float) -> list:
+        """Holds msg and returns the messages it supersedes, which should be acknowledged."""
+        self.messages_seen += 1
+
+        try:
+            body = json.loads(msg.data())
+            keys = {(body.get("bucket_name"), k) for f in KEY_FIELDS for k in body.get(f, [])}
+        except (ValueError, TypeError, AttributeError):
+            # Let the messager deal with it.
+            body, keys = None, set()
+
+        self.keys_seen += len(keys)
+
+        topic = self._topic_of(msg)
+        superseded = {}
+        for key in keys:
+            sequence = self._holders.get((topic, *key))
+            if sequence is None:
+                continue
+
+            held = self._held[sequence]
+            held.keys.discard(key)
+            held.pruned = True
+            self.keys_pruned += 1
+
+            if not held.keys:
+                del self._held[sequence]
+                self.messages_superseded += 1
+                superseded[sequence] = held.message
+                logging.debug(f"Message {held.message.message_id()} superseded")
+
+        for key in keys:
+            self._holders[(topic, *key)] = self._sequence
+
+        self._held[self._sequence] = HeldMessage(msg, now, body, keys)
+        self._sequence += 1
+
+        return [superseded[sequence] for sequence in sorted(superseded)]
+
+    def _release(self, held: HeldMessage):
+        """Forgets which keys a message which is no longer held was holding."""
+        topic = self._topic_of(held.message)
+        for key in held.keys:
+            del self._holders[(topic, *key)]
+
+    def seconds_until_due(self, now: float) -> float | None:
+        if not self._held:
+            return None
+
+        oldest = next(iter(self._held.values()))
+        return max(0.0, oldest.received_at + self.window - now)
+
+    def pop_ready(self, now: float) -> list:
+        """Returns the messages which have been held for the window, ready to process."""
+        ready = []
+        while self._held:
+            sequence, held = next(iter(self._held.items()))
+            if now - held.received_at < self.window:
+                break
+
+            del self._held[sequence]
+            self._release(held)
+            ready.append(held.effective_message())
+
+        return ready
+
+    def flush(self) -> list:
+        ready = [held.effective_message() for held in self._held.values()]
+        self._held.clear()
+        self._holders.clear()
+
+        return ready
+
+    def stats(self) -> dict:
+        return {
+            "messages_seen": self.messages_seen,
+            "messages_superseded": self.messages_superseded,
+            "keys_seen": self.keys_seen,
+            "keys_pruned": self.keys_pruned,
+        }
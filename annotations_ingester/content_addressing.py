@@ -0,0 +1,260 @@
+"""
+An optional layout which stores each output once, under a key derived from its content, so
+that the CDN can cache it indefinitely.
+
+Normally outputs are written to keys such as catalogue/<path>/<name>.ttl, which are rewritten
+in place whenever the entry changes and so can only be cached briefly. With the content
+addressed layout, UploadExecutor writes the output to
+
+    catalogue/content/<sha256 of the body>.ttl     Cache-Control: public, max-age=31536000, immutable
+
+and then writes an empty alias at the usual key, with a short max-age, which points at it:
+
+    catalogue/<path>/<name>.ttl    x-amz-website-redirect-location: /api/catalogue/stac/content/...
+                                   x-amz-meta-content-key: catalogue/content/<sha256>.ttl
+
+S3 website endpoints answer a request for the alias with a redirect. Behind a proxy, the proxy
+should follow the redirect location itself. Compressed variants (see encodings.py) are made of
+the content object, not the alias.
+
+Nothing deletes a content object when its alias moves on, so `sweep_content`, which is run
+from the command line, deletes those which no alias refers to. An object has to be seen
+unreferenced by sweeps at least `grace` seconds apart, and be at least `grace` seconds old,
+before it's deleted. That covers clients holding a cached alias that points to it, and aliases
+written during a sweep: the content object is always rewritten just before its alias, so it's
+never old when the alias is new. Since aliases are only listed at the start of a sweep, each
+object is checked again just before it's deleted.
+
+Run the sweeper with, for example:
+    python -m annotations_ingester.content_addressing --state sweep.json
+"""
+
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import time
+from typing import IO
+
+import click
+from botocore.exceptions import ClientError
+from eodhp_utils.runner import get_boto3_session, setup_logging
+
+from annotations_ingester.encodings import original_key
+from annotations_ingester.uploads import MAX_DELETE_BATCH, delete_keys, is_missing
+
+CATALOGUE_PREFIX = "catalogue/"
+CONTENT_PREFIX = "catalogue/content/"
+CONTENT_CACHE_CONTROL = "public, max-age=31536000, immutable"
+CONTENT_KEY_METADATA = "content-key"
+
+DEFAULT_ALIAS_MAX_AGE = 60
+DEFAULT_PUBLIC_PREFIX = "/api/catalogue/stac/"
+DEFAULT_SWEEP_GRACE = 24 * 60 * 60
+
+SWEEP_STATE_VERSION = 1
+
+
+def content_digest(body: str | bytes | IO[bytes]) -> str:
+    """The hex SHA-256 of a body. A file is read a block at a time and left at its start."""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+
+    if isinstance(body, bytes):
+        return hashlib.sha256(body).hexdigest()
+
+    body.seek(0)
+    digest = hashlib.file_digest(body, "sha256").hexdigest()
+    body.seek(0)
+
+    return digest
+
+
+class ContentAddressedLayout:
+    """
+    Decides the content and alias keys for outputs. `public_prefix` is the path at which the
+    front end serves the catalogue/ prefix of the bucket, and is used in the aliases' redirects.
+    """
+
+    content_cache_control = CONTENT_CACHE_CONTROL
+
+    def __init__(
+        self,
+        alias_max_age: int = DEFAULT_ALIAS_MAX_AGE,
+        public_prefix: str = DEFAULT_PUBLIC_PREFIX,
+    ):
+        self.alias_max_age = alias_max_age
+        self.public_prefix = public_prefix
+
+    @property
+    def alias_cache_control(self) -> str:
+        return f"max-age={self.alias_max_age}"
+
+    def applies_to(self, key: str) -> bool:
+        return key.startswith(CATALOGUE_PREFIX) and not key.startswith(CONTENT_PREFIX)
+
+    def content_key(self, key: str, body: str | bytes | IO[bytes]) -> str:
+        """The content-addressed key for body, keeping the extension of its alias, `key`."""
+        extension = posixpath.splitext(key)[1]
+        return f"{CONTENT_PREFIX}{content_digest(body)}{extension}"
+
+    def alias_args(self, content_key: str) -> dict:
+        """Arguments for put_object which make an object an alias for content_key."""
+        return {
+            "WebsiteRedirectLocation": self.public_prefix
+            + content_key.removeprefix(CATALOGUE_PREFIX),
+            "Metadata": {CONTENT_KEY_METADATA: content_key},
+        }
+
+
+class SweepState:
+    """
+    When each content object was first seen unreferenced, kept between sweeps in a local file.
+    Only objects which are still unreferenced are remembered.
+    """
+
+    def __init__(self, path: str | None):
+        self.path = path
+        self.unreferenced: dict[str, float] = {}
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.unreferenced = json.load(f)["unreferenced"]
+
+    def save(self):
+        if not self.path:
+            return
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": SWEEP_STATE_VERSION, "unreferenced": self.unreferenced}, f)
+        os.replace(tmp_path, self.path)
+
+
+def referenced_content(s3_client, bucket: str) -> set[str]:
+    """
+    The content keys which aliases point to. Aliases are empty, so only empty objects are
+    checked for the content key metadata.
+    """
+    referenced = set()
+    paginator = s3_client.get_paginator("list_objects_v2")
+
+    for page in paginator.paginate(Bucket=bucket, Prefix=CATALOGUE_PREFIX):
+        for obj in page.get("Contents", []):
+            if obj["Size"] != 0 or obj["Key"].startswith(CONTENT_PREFIX):
+                continue
+
+            metadata = s3_client.head_object(Bucket=bucket, Key=obj["Key"]).get("Metadata", {})
+            if content_key := metadata.get(CONTENT_KEY_METADATA):
+                referenced.add(content_key)
+
+    return referenced
+
+
+def sweep_content(
+    s3_client,
+    bucket: str,
+    state: SweepState,
+    grace: float = DEFAULT_SWEEP_GRACE,
+    dry_run: bool = False,
+    now: float = None,
+) -> dict:
+    """
+    Deletes the content objects, and their compressed variants, which no alias refers to and
+    which have been unreferenced and unmodified for `grace` seconds. Each is checked again just
+    before it's deleted, and kept if it has been rewritten since it was listed. Returns counts
+    of what was found.
+    """
+    now = time.time() if now is None else now
+    referenced = referenced_content(s3_client, bucket)
+    stats = {"referenced": 0, "unreferenced": 0, "rewritten": 0, "deleted": 0, "failed": 0}
+
+    still_unreferenced = {}
+    due = []
+
+    def delete_due():
+        # An alias written since the aliases were listed may point to one of these, so each is
+        # checked again first. Writing an alias rewrites its content object just before it, so
+        # the content object is no longer old.
+        unchanged, failed = [], []
+        for key in due:
+            try:
+                head = s3_client.head_object(Bucket=bucket, Key=original_key(key))
+            except ClientError as e:
+                if not is_missing(e):
+                    logging.warning(f"Couldn't check {key} again: {e}")
+                    failed.append(key)
+                    continue
+            else:
+                if now - head["LastModified"].timestamp() < grace:
+                    stats["rewritten"] += 1
+                    continue
+
+            unchanged.append(key)
+
+        not_deleted = [] if dry_run else delete_keys(s3_client, bucket, unchanged)
+        failed += not_deleted
+        for key in failed:
+            still_unreferenced[key] = state.unreferenced[key]
+
+        stats["deleted"] += len(unchanged) - len(not_deleted)
+        stats["failed"] += len(failed)
+        due.clear()
+
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=CONTENT_PREFIX):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            if original_key(key) in referenced:
+                stats["referenced"] += 1
+                continue
+
+            stats["unreferenced"] += 1
+            first_seen = state.unreferenced.setdefault(key, now)
+
+            if now - first_seen >= grace and now - obj["LastModified"].timestamp() >= grace:
+                logging.debug(f"Deleting unreferenced {key}")
+                due.append(key)
+                if len(due) >= MAX_DELETE_BATCH:
+                    delete_due()
+            else:
+                still_unreferenced[key] = first_seen
+
+    if due:
+        delete_due()
+
+    if not dry_run:
+        state.unreferenced = still_unreferenced
+        state.save()
+
+    return stats
+
+
+@click.command
+@click.option("--bucket", envvar="S3_BUCKET", required=True, help="Bucket the outputs are in.")
+@click.option(
+    "--state",
+    type=click.Path(dir_okay=False),
+    required=True,
+    help="File remembering unreferenced objects between sweeps.",
+)
+@click.option(
+    "--grace",
+    default=DEFAULT_SWEEP_GRACE,
+    help="Seconds an object must be unreferenced for, between sweeps, before it's deleted.",
+)
+@click.option("--dry-run", is_flag=True, default=False, help="Report but don't delete.")
+@click.option("-v", "--verbose", count=True)
+def sweep(bucket: str, state: str, grace: int, dry_run: bool, verbose: int):
+    """Deletes content-addressed outputs which no alias refers to any longer."""
+    setup_logging(verbosity=verbose)
+
+    s3_client = get_boto3_session().client("s3")
+    stats = sweep_content(s3_client, bucket, SweepState(state), grace, dry_run=dry_run)
+
+    logging.info(f"Swept content-addressed outputs: {stats}")
+
+
+if __name__ == "__main__":
+    sweep()
@@ -1,16 +1,80 @@
+import functools
+import logging
 from pathlib import Path
-from typing import Sequence
+from typing import TYPE_CHECKING, Sequence
+from urllib.parse import urljoin
 
 import pystac
+from botocore.exceptions import BotoCoreError, ClientError
 from eodhp_utils.messagers import CatalogueSTACChangeMessager, Messager
 from pystac import Catalog, Collection, STACTypeError
-from rdflib import DCAT, DCTERMS, RDF, Graph, Literal, URIRef
+from rdflib import DCAT, Graph
+
+from annotations_ingester import metrics
+from annotations_ingester.annotations_generator import annotation_index_key
+from annotations_ingester.content_addressing import CONTENT_PREFIX
+from annotations_ingester.dcat_serialiser import DCATRecord
+from annotations_ingester.item_coverage import (
+    ItemCoverageRollup,
+    coverage_actions,
+    coverage_of_item,
+    item_collection,
+)
+from annotations_ingester.jsonld_context import (
+    CONTEXTS_PREFIX,
+    DEFAULT_CONTEXT_URL,
+    compact_jsonld,
+)
+from annotations_ingester.output_cache import OutputCacheMixin
+from annotations_ingester.uploads import (
+    DirectActionsMixin,
+    S3DeleteAction,
+    TemporaryFailure,
+    run_updates,
+)
+from annotations_ingester.worker_pool import RenderPoolMixin
+
+if TYPE_CHECKING:
+    from annotations_ingester.catalogue_index import CatalogueIndex
+    from annotations_ingester.qa_index import QASummaryIndex
 
 DOI_URL_PREFIX = "https://doi.org/"
 CATALOGUE_PUBLIC_BUCKET_PREFIX = "catalogue/"
+OUTPUT_EXTENSIONS = (".ttl", ".jsonld")
+
+# The catalogue-wide DCAT index (see catalogue_index.py).
+INDEX_PREFIX = f"{CATALOGUE_PUBLIC_BUCKET_PREFIX}index/"
+
+# The summary index of the latest QA for each dataset (see qa_index.py).
+QA_INDEX_PREFIX = f"{CATALOGUE_PUBLIC_BUCKET_PREFIX}qa-index/"
+
+# Prefixes under catalogue/ which hold shared objects rather than the outputs of one entry.
+SHARED_OUTPUT_PREFIXES = (CONTENT_PREFIX, CONTEXTS_PREFIX, INDEX_PREFIX, QA_INDEX_PREFIX)
+
+# STAC Items are kept in directories of this name. They have no DCAT or annotations of their
+# own, so deleting one needn't touch the bucket. Their coverage may be rolled up into their
+# Collection's (see item_coverage.py).
+ITEMS_DIRECTORY = "items"
 
+# Top-level fields pystac requires before it will load each type. Documents missing any of these
+# are left to pystac so that they fail in the same way as before.
+REQUIRED_STAC_FIELDS = {
+    "Catalog": ("id", "description", "links"),
+    "Collection": ("id", "description", "links", "license", "extent"),
+}
 
-class DatasetDCATMessager(CatalogueSTACChangeMessager):
+
+class AmbiguousSTACError(Exception):
+    """Raised when the fields DCAT needs can't be read from a STAC dict without pystac."""
+
+
+class DatasetDCATMessager(
+    metrics.MetricsMixin,
+    DirectActionsMixin,
+    OutputCacheMixin,
+    RenderPoolMixin,
+    CatalogueSTACChangeMessager,
+):
     """
     Generates basic DCAT for catalogue entries. Supports Catalogs and Collections and is
     intended only to be sufficient for finding QA information linked to a dataset.
@@ -18,8 +82,42 @@ class DatasetDCATMessager(CatalogueSTACChangeMessager):
     The output is sent to the cataloge public static files bucket under a path matching the
     catalogue API endpoint for the dataset. For example:
         /catalogue/
+
+    Deleting a Catalog or Collection deletes its outputs and everything generated for the
+    entries beneath it, including their annotations, the UUIDs recorded for those and, with a
+    `qa_index`, their lines in the summary index of every dataset's QA (see qa_index.py).
+
+    Output is written straight from templates for speed. Set `fast_serialiser=False` to always
+    build an rdflib Graph and use rdflib's serialisers instead. The JSON-LD refers to the shared
+    context at `jsonld_context_url`.
+
+    With an `index`, each Catalog and Collection is also listed in the catalogue-wide DCAT
+    index (see catalogue_index.py).
+
+    With an `item_coverage` rollup, the extent and asset media types of each Item are folded
+    into its Collection's coverage documents (see item_coverage.py). Updates to Items return no
+    actions; the coverage is written by flush_item_coverage.
     """
 
+    message_type = "dataset_dcat"
+
+    def __init__(
+        self,
+        *args,
+        fast_serialiser: bool = True,
+        jsonld_context_url: str = DEFAULT_CONTEXT_URL,
+        index: "CatalogueIndex" = None,
+        item_coverage: ItemCoverageRollup = None,
+        qa_index: "QASummaryIndex" = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.fast_serialiser = fast_serialiser
+        self.jsonld_context_url = jsonld_context_url
+        self.index = index
+        self.item_coverage = item_coverage
+        self.qa_index = qa_index
+
     def process_update_stac(
         self,
         stac: dict,
@@ -28,27 +126,27 @@ class DatasetDCATMessager(CatalogueSTACChangeMessager):
         target: str,
         **kwargs,
     ) -> Sequence[Messager.Action]:
-        ld_graph = self.generate_dcat(stac)
+        if self.item_coverage is not None and stac.get("type") == "Feature":
+            return self.process_update_item(stac, cat_path)
+
+        rendered = self.render(
+            render_dcat_record if self.index is not None else render_dcat,
+            stac,
+            self.fast_serialiser,
+            self.jsonld_context_url,
+        )
 
-        if ld_graph is None:
+        if rendered is None:
             return []
         else:
-            ld_ttl = ld_graph.serialize(format="turtle")
-            ld_jsonld = ld_graph.serialize(format="json-ld")
+            ld_ttl, ld_jsonld = rendered[:2]
 
-            short_path = "/".join(cat_path.split("/")[:-1])
-            if short_path == "/":
-                short_path = ""
-
-            file_name = Path(cat_path).stem
-
-            key_root = f"{CATALOGUE_PUBLIC_BUCKET_PREFIX}/{short_path}/{file_name}"
-            key_root = key_root.replace("//", "/")
+            key_root = dcat_key_root(cat_path)
 
             # This saves the output directly to the catalogue public bucket. With a little nginx
             # config, this means it can appear at, say,
             #  /api/catalogue/stac/catalogs/my-catalog/collections/collection.jsonld
-            return (
+            actions = [
                 Messager.S3UploadAction(
                     key=f"{key_root}.ttl",
                     file_body=ld_ttl,
@@ -59,37 +157,182 @@ class DatasetDCATMessager(CatalogueSTACChangeMessager):
                     file_body=ld_jsonld,
                     mime_type="application/ld+json",
                 ),
+            ]
+            if self.index is not None:
+                actions += self.index.update_actions(rendered[2], cat_path, self.output_bucket)
+
+            return actions
+
+    def process_update_item(self, stac: dict, cat_path: str) -> Sequence[Messager.Action]:
+        """
+        Folds an Item into its Collection's pending coverage, which is written later by
+        flush_item_coverage. This is cheap enough not to be worth sending to the render pool.
+        """
+        if collection := item_collection(stac, cat_path):
+            self.item_coverage.add(*collection, coverage_of_item(stac))
+        metrics.lap("fold_item")
+
+        return []
+
+    def flush_item_coverage(self, force: bool = False) -> int:
+        """
+        Writes the coverage of each Collection which is due, or of all of them, and returns how
+        many were written. Coverage which can't be written is kept to be tried again. This is
+        called periodically once ItemCoverageRollup.start_flushing has been called.
+        """
+        written = 0
+        for collection_path, iri, coverage in self.item_coverage.take_due(force):
+            actions = coverage_actions(
+                dcat_key_root(collection_path),
+                iri,
+                coverage,
+                self.jsonld_context_url,
+                self.output_bucket,
             )
 
+            try:
+                for action in actions:
+                    run_updates(self.s3_client, self.output_bucket, [action])
+            except (BotoCoreError, ClientError, TemporaryFailure):
+                logging.exception(f"Couldn't write the coverage of {collection_path}")
+                self.item_coverage.restore(collection_path, iri, coverage)
+            else:
+                written += 1
+
+        return written
+
+    def serialize_record(self, record: DCATRecord) -> tuple[str, str]:
+        """Returns the Turtle and JSON-LD forms of a record."""
+        metrics.observe("triples", 1 + len(record.identifiers))
+
+        if self.fast_serialiser and record.is_templatable():
+            turtle = record.to_turtle()
+            metrics.lap("serialise_turtle")
+            jsonld = record.to_jsonld(self.jsonld_context_url)
+            metrics.lap("serialise_jsonld")
+
+            return turtle, jsonld
+
+        ld_graph = record.to_graph()
+        turtle = ld_graph.serialize(format="turtle")
+        metrics.lap("serialise_turtle")
+        jsonld = compact_jsonld(ld_graph, self.jsonld_context_url)
+        metrics.lap("serialise_jsonld")
+
+        return turtle, jsonld
+
     def generate_dcat(self, stac: dict) -> Graph:
+        record = self.generate_record(stac)
+
+        if record is None:
+            return None
+
+        return record.to_graph()
+
+    def generate_record(self, stac: dict) -> DCATRecord:
         if stac.get("type") not in ("Catalog", "Collection"):
             return None
 
+        # Loading the full pystac object model is expensive for large Collections, so the few
+        # fields we need are read from the dict directly unless the document is unusual.
+        try:
+            record = self.record_from_dict(stac)
+            metrics.lap("extract")
+            return record
+        except AmbiguousSTACError:
+            metrics.lap("extract")
+
         try:
             stac_obj = pystac.read_dict(stac)
+            metrics.lap("read_dict")
         except STACTypeError:
             return None
 
+        record = None
         if isinstance(stac_obj, Collection):
-            return self.generate_for_collection(stac_obj)
+            record = self.record_for_collection(stac_obj)
         elif isinstance(stac_obj, Catalog):
-            return self.generate_for_catalog(stac_obj)
-        else:
-            return None
+            record = self.record_for_catalog(stac_obj)
 
-    def generate_for_catalog(self, stac: Catalog) -> Graph:
-        g = Graph()
-        self_uriref = URIRef(stac.get_self_href())
-        g.add((self_uriref, RDF.type, DCAT.Catalog))
-        g.add((self_uriref, DCTERMS.identifier, self_uriref))
+        metrics.lap("generate_dcat")
+        return record
+
+    def record_from_dict(self, stac: dict) -> DCATRecord:
+        """
+        Produces the same record as pystac-based generation without loading the document into
+        pystac. Raises AmbiguousSTACError where the result might differ.
+        """
+        stac_type = stac.get("type")
+        if stac_type not in REQUIRED_STAC_FIELDS:
+            raise AmbiguousSTACError(f"Unsupported type {stac_type}")
+
+        if not str(stac.get("stac_version", "")).startswith("1."):
+            # Older versions are migrated by pystac.
+            raise AmbiguousSTACError("Not STAC 1.x")
+
+        if any(field not in stac for field in REQUIRED_STAC_FIELDS[stac_type]):
+            raise AmbiguousSTACError("Required field missing")
+
+        links = stac["links"]
+        if not isinstance(links, list) or not all(
+            isinstance(link, dict)
+            and isinstance(link.get("rel"), str)
+            and isinstance(link.get("href"), str)
+            for link in links
+        ):
+            raise AmbiguousSTACError("Malformed links")
+
+        self_hrefs = [link["href"] for link in links if link["rel"] == "self"]
+        if len(self_hrefs) != 1 or not self_hrefs[0].startswith(("http://", "https://")):
+            # pystac resolves relative self links against the working directory.
+            raise AmbiguousSTACError("No single absolute self link")
+
+        self_href = self_hrefs[0]
 
-        return g
+        if stac_type == "Catalog":
+            record = DCATRecord(iri=self_href, rdf_type=str(DCAT.Catalog))
+            record.add_identifier(self_href, is_iri=True)
+            return record
+
+        record = DCATRecord(iri=self_href, rdf_type=str(DCAT.Dataset))
+        record.add_identifier(self_href, is_iri=True)
+
+        cite_as = None
+        citation_hrefs = [link["href"] for link in links if link["rel"] == "cite-as"]
+        if citation_hrefs:
+            # pystac uses the first link, as get_single_link does.
+            cite_as = resolve_href(citation_hrefs[0], self_href)
+
+        sci_doi = stac.get("sci:doi")
+
+        if cite_as is not None:
+            record.add_identifier(cite_as, is_iri=True)
+
+            if cite_as.startswith(DOI_URL_PREFIX) and sci_doi is None:
+                sci_doi = cite_as[len(DOI_URL_PREFIX) :]
+
+        if sci_doi is not None:
+            record.add_identifier(sci_doi, is_iri=False)
+
+        return record
+
+    def generate_for_catalog(self, stac: Catalog) -> Graph:
+        return self.record_for_catalog(stac).to_graph()
 
     def generate_for_collection(self, stac: Collection) -> Graph:
-        g = Graph()
-        self_uriref = URIRef(stac.get_self_href())
-        g.add((self_uriref, RDF.type, DCAT.Dataset))
-        g.add((self_uriref, DCTERMS.identifier, self_uriref))
+        return self.record_for_collection(stac).to_graph()
+
+    def record_for_catalog(self, stac: Catalog) -> DCATRecord:
+        self_href = stac.get_self_href()
+        record = DCATRecord(iri=self_href, rdf_type=str(DCAT.Catalog))
+        record.add_identifier(self_href, is_iri=True)
+
+        return record
+
+    def record_for_collection(self, stac: Collection) -> DCATRecord:
+        self_href = stac.get_self_href()
+        record = DCATRecord(iri=self_href, rdf_type=str(DCAT.Dataset))
+        record.add_identifier(self_href, is_iri=True)
 
         # The STAC Scientific extensions specifies that DOIs can be included as rel=cite-as links
         # (in URL form) or a sci:doi property (in bare form, such as 10.5270/S2_-742ikth).
@@ -104,17 +347,102 @@ class DatasetDCATMessager(CatalogueSTACChangeMessager):
         sci_doi = stac.extra_fields.get("sci:doi")
 
         if cite_as is not None:
-            g.add((self_uriref, DCTERMS.identifier, URIRef(cite_as)))
+            record.add_identifier(cite_as, is_iri=True)
 
             if cite_as.startswith(DOI_URL_PREFIX) and sci_doi is None:
                 sci_doi = cite_as[len(DOI_URL_PREFIX) :]
 
         if sci_doi is not None:
-            g.add((self_uriref, DCTERMS.identifier, Literal(sci_doi)))
+            record.add_identifier(sci_doi, is_iri=False)
 
-        return g
+        return record
 
     def process_delete(
-        self, bucket: str, key: str, id: str, source: str, target: str
+        self,
+        bucket: str = None,
+        key: str = None,
+        cat_path: str = None,
+        source: str = None,
+        target: str = None,
+        **kwargs,
     ) -> Sequence[Messager.Action]:
-        return []
+        if cat_path is None or Path(cat_path).parent.name == ITEMS_DIRECTORY:
+            return []
+
+        if self.item_coverage is not None:
+            self.item_coverage.discard(cat_path)
+
+        key_root = dcat_key_root(cat_path)
+        entry_path = key_root.removeprefix(CATALOGUE_PUBLIC_BUCKET_PREFIX)
+
+        if self.qa_index is not None:
+            self.qa_index.remove_prefix(f"{entry_path}/")
+
+        actions = [
+            S3DeleteAction(
+                keys=[key_root + extension for extension in OUTPUT_EXTENSIONS],
+                prefixes=[f"{key_root}/", annotation_index_key(entry_path) + "/"],
+                bucket=self.output_bucket,
+            )
+        ]
+        if self.index is not None:
+            actions += self.index.delete_actions(cat_path, self.output_bucket)
+
+        return actions
+
+
+def dcat_key_root(cat_path: str) -> str:
+    """The key of an entry's outputs, without the extension."""
+    short_path = "/".join(cat_path.split("/")[:-1])
+    if short_path == "/":
+        short_path = ""
+
+    file_name = Path(cat_path).stem
+
+    key_root = f"{CATALOGUE_PUBLIC_BUCKET_PREFIX}/{short_path}/{file_name}"
+    return key_root.replace("//", "/")
+
+
+def resolve_href(href: str, self_href: str) -> str:
+    """
+    Makes a link href absolute relative to an absolute http(s) self href, as pystac's
+    Link.absolute_href does. Raises AmbiguousSTACError for the forms where urljoin and pystac
+    disagree.
+    """
+    if href == "" or href.startswith("//"):
+        raise AmbiguousSTACError(f"Can't resolve {href!r} without pystac")
+
+    return urljoin(self_href, href)
+
+
+@functools.cache
+def _dcat_renderer(fast_serialiser: bool, jsonld_context_url: str) -> "DatasetDCATMessager":
+    # Record generation and serialisation don't use the S3 client or bucket.
+    return DatasetDCATMessager(
+        None, None, fast_serialiser=fast_serialiser, jsonld_context_url=jsonld_context_url
+    )
+
+
+def render_dcat(
+    stac: dict, fast_serialiser: bool = True, jsonld_context_url: str = DEFAULT_CONTEXT_URL
+) -> tuple[str, str] | None:
+    """
+    Returns the Turtle and JSON-LD DCAT for a STAC dict, or None if it's not a Catalog or
+    Collection. This is a plain function so that it can run in a worker process.
+    """
+    rendered = render_dcat_record(stac, fast_serialiser, jsonld_context_url)
+
+    return rendered[:2] if rendered is not None else None
+
+
+def render_dcat_record(
+    stac: dict, fast_serialiser: bool = True, jsonld_context_url: str = DEFAULT_CONTEXT_URL
+) -> tuple[str, str, DCATRecord] | None:
+    """Like render_dcat, but also returns the record, for the catalogue index."""
+    messager = _dcat_renderer(fast_serialiser, jsonld_context_url)
+    record = messager.generate_record(stac)
+
+    if record is None:
+        return None
+
+    return *messager.serialize_record(record), record
@@ -0,0 +1,119 @@
+"""
+Fast serialisation for the small, fixed-shape graphs made by DatasetDCATMessager.
+
+Every DCAT document we generate is one subject with an `rdf:type` and a few
+`dcterms:identifier`s, so the Turtle and JSON-LD can be written from templates rather than by
+building an rdflib Graph and running its general-purpose serialisers. The output is
+semantically equivalent to rdflib's (see tests/test_dcat_serialiser.py) but not byte-identical.
+
+Anything the templates can't represent safely (such as an IRI containing characters that need
+escaping in Turtle, or a non-string identifier) is reported by `is_templatable` so callers can
+use `to_graph()` and rdflib instead.
+"""
+
+import json
+import re
+from dataclasses import dataclass, field
+
+from rdflib import DCAT, DCTERMS, RDF, Graph, Literal, URIRef
+
+from annotations_ingester.jsonld_context import DEFAULT_CONTEXT_URL, compact_iri
+
+# Characters which may not appear in a Turtle IRIREF, even escaped as-is.
+_INVALID_IRI_RE = re.compile(r'[\x00-\x20<>"{}|^`\\]')
+
+_TURTLE_ESCAPES = {
+    "\\": "\\\\",
+    '"': '\\"',
+    "\n": "\\n",
+    "\r": "\\r",
+    "\t": "\\t",
+    "\b": "\\b",
+    "\f": "\\f",
+}
+_TURTLE_ESCAPE_RE = re.compile(r'[\\"\x00-\x1f\x7f]')
+
+TURTLE_PREFIXES = (
+    "@prefix dcat: <http://www.w3.org/ns/dcat#> .\n"
+    "@prefix dcterms: <http://purl.org/dc/terms/> .\n"
+)
+
+_JSONLD_IDENTIFIER = compact_iri(str(DCTERMS.identifier))
+
+_TURTLE_TYPES = {
+    str(DCAT.Catalog): "dcat:Catalog",
+    str(DCAT.Dataset): "dcat:Dataset",
+}
+
+
+@dataclass
+class DCATRecord:
+    """The facts DatasetDCATMessager publishes about one Catalog or Collection."""
+
+    iri: str
+    rdf_type: str
+    # Each identifier is (value, is_iri). The subject's own IRI is always the first.
+    identifiers: list[tuple[object, bool]] = field(default_factory=list)
+
+    def add_identifier(self, value, is_iri: bool):
+        if (value, is_iri) not in self.identifiers:
+            self.identifiers.append((value, is_iri))
+
+    def is_templatable(self) -> bool:
+        """True if `to_turtle` and `to_jsonld` can represent this record exactly."""
+        if self.rdf_type not in _TURTLE_TYPES or not is_plain_iri(self.iri):
+            return False
+
+        for value, is_iri in self.identifiers:
+            if not isinstance(value, str):
+                return False
+            if is_iri and not is_plain_iri(value):
+                return False
+
+        return True
+
+    def to_graph(self) -> Graph:
+        g = Graph()
+        self_uriref = URIRef(self.iri)
+        g.add((self_uriref, RDF.type, URIRef(self.rdf_type)))
+
+        for value, is_iri in self.identifiers:
+            g.add((self_uriref, DCTERMS.identifier, URIRef(value) if is_iri else Literal(value)))
+
+        return g
+
+    def to_turtle(self) -> str:
+        lines = [TURTLE_PREFIXES, "\n", f"<{self.iri}> a {_TURTLE_TYPES[self.rdf_type]}"]
+
+        if self.identifiers:
+            objects = ",\n        ".join(
+                f"<{value}>" if is_iri else turtle_string(value)
+                for value, is_iri in self.identifiers
+            )
+            lines.append(f" ;\n    dcterms:identifier {objects}")
+
+        lines.append(" .\n\n")
+        return "".join(lines)
+
+    def to_jsonld(self, context_url: str = DEFAULT_CONTEXT_URL) -> str:
+        """Returns JSON-LD compacted against the shared context (see jsonld_context.py)."""
+        node = {"@context": context_url, "@id": self.iri, "@type": compact_iri(self.rdf_type)}
+
+        if self.identifiers:
+            node[_JSONLD_IDENTIFIER] = [
+                {"@id": value} if is_iri else value for value, is_iri in self.identifiers
+            ]
+
+        return json.dumps(node, indent=2, ensure_ascii=False)
+
+
+def is_plain_iri(value) -> bool:
+    return isinstance(value, str) and value != "" and not _INVALID_IRI_RE.search(value)
+
+
+def turtle_string(value: str) -> str:
+    def escape(match: re.Match) -> str:
+        char = match.group(0)
+        return _TURTLE_ESCAPES.get(char) or f"\\u{ord(char):04X}"
+
+    return '"' + _TURTLE_ESCAPE_RE.sub(escape, value) + '"'
@@ -0,0 +1,166 @@
+"""
+Pre-compressed variants of the outputs.
+
+The Turtle and JSON-LD outputs compress several times over, and without stored variants the
+front end compresses them again for every request. OutputEncoder makes gzip and, if the
+`brotli` package is installed, brotli variants of each upload, which UploadExecutor stores
+next to the original:
+
+    catalogue/.../entry.ttl      Content-Type: text/turtle
+    catalogue/.../entry.ttl.gz   Content-Type: text/turtle, Content-Encoding: gzip
+    catalogue/.../entry.ttl.br   Content-Type: text/turtle, Content-Encoding: br
+
+The original stays in place for clients which don't accept either encoding. S3 can't store a
+Vary header, so the front end should choose the variant from Accept-Encoding and add
+`Vary: Accept-Encoding` to every response for these keys.
+
+Compression runs on the upload threads, not the thread consuming messages, and bodies smaller
+than `min_size` are left alone, as their variants would save less than a request costs.
+"""
+
+import gzip
+import logging
+import tempfile
+import time
+import zlib
+from typing import IO, Sequence
+
+from annotations_ingester import metrics
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - depends on the environment
+    brotli = None
+
+DEFAULT_MIN_ENCODE_BYTES = 1024
+DEFAULT_GZIP_LEVEL = 6
+DEFAULT_BROTLI_QUALITY = 5
+
+# Content-Encoding -> suffix of the variant's key.
+ENCODING_SUFFIXES = {"gzip": ".gz", "br": ".br"}
+
+# Files are compressed a block at a time, into a file which stays in memory up to this size.
+_BLOCK_BYTES = 1024 * 1024
+_SPOOL_BYTES = 8 * 1024 * 1024
+
+ENCODE_SECONDS = metrics.REGISTRY.histogram(
+    "annotations_ingester_encode_seconds",
+    "Time taken to make each compressed variant of an output.",
+    ("encoding",),
+)
+ENCODED_BYTES = metrics.REGISTRY.counter(
+    "annotations_ingester_encoded_bytes_total",
+    "Bytes of outputs given to ('in') and produced by ('out') each encoding.",
+    ("encoding", "direction"),
+)
+
+
+def available_encodings() -> list[str]:
+    return ["gzip", "br"] if brotli is not None else ["gzip"]
+
+
+def variant_key(key: str, encoding: str) -> str:
+    return key + ENCODING_SUFFIXES[encoding]
+
+
+def original_key(key: str) -> str:
+    """Returns the key of the output a variant was made from, or key if it isn't a variant."""
+    for suffix in ENCODING_SUFFIXES.values():
+        if key.endswith(suffix):
+            return key.removesuffix(suffix)
+
+    return key
+
+
+class _Compressor:
+    """The streaming compressor interface shared by zlib and brotli."""
+
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        if encoding == "gzip":
+            # wbits=31 writes a gzip header with no file name or time, so the same input always
+            # gives the same bytes, and so the same ETag.
+            compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+            self.compress, self.finish = compressor.compress, compressor.flush
+        else:
+            compressor = brotli.Compressor(quality=brotli_quality)
+            self.compress, self.finish = compressor.process, compressor.finish
+
+
+class OutputEncoder:
+    """Makes compressed variants of upload bodies in the configured `encodings`."""
+
+    def __init__(
+        self,
+        encodings: Sequence[str] = ("gzip",),
+        min_size: int = DEFAULT_MIN_ENCODE_BYTES,
+        gzip_level: int = DEFAULT_GZIP_LEVEL,
+        brotli_quality: int = DEFAULT_BROTLI_QUALITY,
+    ):
+        for encoding in encodings:
+            if encoding not in ENCODING_SUFFIXES:
+                raise ValueError(f"Unsupported output encoding {encoding!r}")
+            if encoding not in available_encodings():
+                raise ValueError(f"Output encoding {encoding!r} needs the brotli package")
+
+        self.encodings = tuple(encodings)
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    @classmethod
+    def from_option(cls, value: str, min_size: int = DEFAULT_MIN_ENCODE_BYTES):
+        """Returns an encoder for a comma-separated list of encodings, or None if it's empty."""
+        encodings = [e.strip() for e in value.split(",") if e.strip()]
+        return cls(encodings, min_size) if encodings else None
+
+    def applies_to(self, size: int) -> bool:
+        return bool(self.encodings) and size >= self.min_size
+
+    def encode(self, body: str | bytes | IO[bytes], encoding: str) -> bytes | IO[bytes]:
+        """
+        Returns body compressed with `encoding`. A file body is compressed a block at a time
+        into a temporary file, positioned at its start, and is itself left at its start.
+        """
+        start = time.perf_counter()
+        compressor = _Compressor(encoding, self.gzip_level, self.brotli_quality)
+
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        if isinstance(body, bytes):
+            in_bytes = len(body)
+            encoded = compressor.compress(body) + compressor.finish()
+            out_bytes = len(encoded)
+        else:
+            body.seek(0)
+            encoded = tempfile.SpooledTemporaryFile(max_size=_SPOOL_BYTES)
+            try:
+                in_bytes = 0
+                while block := body.read(_BLOCK_BYTES):
+                    in_bytes += len(block)
+                    encoded.write(compressor.compress(block))
+                encoded.write(compressor.finish())
+            except BaseException:
+                encoded.close()
+                raise
+            finally:
+                body.seek(0)
+
+            out_bytes = encoded.tell()
+            encoded.seek(0)
+
+        if metrics.is_enabled():
+            ENCODE_SECONDS.observe(time.perf_counter() - start, encoding)
+            ENCODED_BYTES.inc(encoding, "in", amount=in_bytes)
+            ENCODED_BYTES.inc(encoding, "out", amount=out_bytes)
+
+        logging.debug(f"Encoded {in_bytes} bytes as {out_bytes} bytes of {encoding}")
+        return encoded
+
+
+def decode(body: bytes, encoding: str) -> bytes:
+    """Reverses OutputEncoder.encode, for tests and checks on stored variants."""
+    if encoding == "gzip":
+        return gzip.decompress(body)
+
+    return brotli.decompress(body)
@@ -0,0 +1,456 @@
+"""
+The coverage of each Collection's Items, folded into its DCAT as they arrive.
+
+Items are most of the catalogue, so DatasetDCATMessager doesn't publish anything for each one.
+With an ItemCoverageRollup, it instead reads three things from each Item's dict, without
+pystac: its bbox, its datetime (or start_datetime and end_datetime) and the media types of its
+assets. These are merged in memory into an ItemCoverage for the Item's Collection, and every
+`flush_interval` seconds, or after `max_pending_items` Items, the Collection's coverage is
+written to two objects next to its DCAT:
+
+    coverage.ttl      the Collection's dcat:Dataset with its dcterms:temporal and
+    coverage.jsonld   dcterms:spatial extent and a dcat:distribution for each media type
+
+So a Collection with a million Items costs a couple of S3 updates per interval rather than a
+million uploads.
+
+Both are changed with S3UpdateActions (see rollup.py) which merge the pending coverage into
+what's already published, so several processes can fold Items from the same Collection, and
+a process that restarts loses nothing it had written. The merge only widens the extent and adds
+media types, so it's the same whichever order updates arrive in and however often one is
+repeated. Deleting an Item doesn't narrow the coverage. Deleting the Collection deletes it,
+along with the rest of the Collection's outputs.
+
+The coverage is written by DatasetDCATMessager.flush_item_coverage, called from a thread
+started by ItemCoverageRollup.start_flushing. Coverage whose update fails is kept pending and
+tried again on the next flush. What's pending is written when the thread is stopped, as on
+SIGTERM, and is only lost if the process dies without that.
+"""
+
+import functools
+import json
+import math
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable
+
+from annotations_ingester.dcat_serialiser import (
+    TURTLE_PREFIXES,
+    is_plain_iri,
+    turtle_string,
+)
+from annotations_ingester.jsonld_context import DEFAULT_CONTEXT_URL
+from annotations_ingester.uploads import S3UpdateAction
+
+COVERAGE_NAME = "coverage"
+COVERAGE_CACHE_CONTROL = "max-age=60"
+
+DEFAULT_FLUSH_INTERVAL = 60.0
+DEFAULT_MAX_PENDING_ITEMS = 10_000
+
+IANA_MEDIA_TYPES = "https://www.iana.org/assignments/media-types/"
+WKT_LITERAL = "http://www.opengis.net/ont/geosparql#wktLiteral"
+
+# The Turtle starts with a comment holding the coverage as JSON, so it needn't be parsed back
+# from the RDF: # coverage {...}
+_STATE_RE = re.compile(rb"^# coverage (\{.*\})\n")
+
+_MEDIA_TYPE_RE = re.compile(r"^[\w.+-]+/[\w.+-]+$")
+_NUMBER_RE = re.compile(r"-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?")
+
+
+@dataclass
+class ItemCoverage:
+    """The extent of some Items and the media types of their assets."""
+
+    # west, south, east, north
+    bbox: list[float] | None = None
+    start: str | None = None
+    end: str | None = None
+    media_types: set[str] = field(default_factory=set)
+
+    def merge(self, other: "ItemCoverage"):
+        if other.bbox is not None:
+            self.bbox = (
+                list(other.bbox)
+                if self.bbox is None
+                else [
+                    min(self.bbox[0], other.bbox[0]),
+                    min(self.bbox[1], other.bbox[1]),
+                    max(self.bbox[2], other.bbox[2]),
+                    max(self.bbox[3], other.bbox[3]),
+                ]
+            )
+
+        # Times are all UTC in the same format, so they compare as strings.
+        if other.start is not None and (self.start is None or other.start < self.start):
+            self.start = other.start
+        if other.end is not None and (self.end is None or other.end > self.end):
+            self.end = other.end
+
+        self.media_types |= other.media_types
+
+    def is_empty(self) -> bool:
+        return self.bbox is None and self.start is None and not self.media_types
+
+    def to_json(self) -> dict:
+        return {
+            "bbox": self.bbox,
+            "start": self.start,
+            "end": self.end,
+            "mediaTypes": sorted(self.media_types),
+        }
+
+    @classmethod
+    def from_json(cls, document: dict) -> "ItemCoverage":
+        return cls(
+            bbox=document.get("bbox"),
+            start=document.get("start"),
+            end=document.get("end"),
+            media_types=set(document.get("mediaTypes", ())),
+        )
+
+    def wkt(self) -> str:
+        west, south, east, north = self.bbox
+        corners = [(west, south), (east, south), (east, north), (west, north), (west, south)]
+        return "POLYGON((" + ", ".join(f"{x!r} {y!r}" for x, y in corners) + "))"
+
+    def to_turtle(self, iri: str) -> str:
+        lines = [
+            f"# coverage {json.dumps(self.to_json(), separators=(',', ':'))}\n",
+            TURTLE_PREFIXES,
+            "@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .\n",
+            "\n",
+            f"<{iri}> a dcat:Dataset",
+        ]
+
+        if self.start is not None:
+            lines.append(
+                " ;\n    dcterms:temporal [ a dcterms:PeriodOfTime ;\n"
+                f'        dcat:startDate "{self.start}"^^xsd:dateTime ;\n'
+                f'        dcat:endDate "{self.end}"^^xsd:dateTime ]'
+            )
+
+        if self.bbox is not None:
+            lines.append(
+                " ;\n    dcterms:spatial [ a dcterms:Location ;\n"
+                f'        dcat:bbox "{self.wkt()}"^^<{WKT_LITERAL}> ]'
+            )
+
+        if self.media_types:
+            distributions = ",\n        ".join(
+                "[ a dcat:Distribution ;\n"
+                f"            dcat:mediaType <{media_type_iri(media_type)}> ;\n"
+                f"            dcterms:format {turtle_string(media_type)} ]"
+                for media_type in sorted(self.media_types)
+            )
+            lines.append(f" ;\n    dcat:distribution {distributions}")
+
+        lines.append(" .\n")
+        return "".join(lines)
+
+    def to_jsonld(self, iri: str, context_url: str = DEFAULT_CONTEXT_URL) -> str:
+        node = {"@context": context_url, "@id": iri, "@type": "dcat:Dataset"}
+
+        if self.start is not None:
+            node["dcterms:temporal"] = {
+                "@type": "dcterms:PeriodOfTime",
+                "dcat:startDate": {"@value": self.start, "@type": "xsd:dateTime"},
+                "dcat:endDate": {"@value": self.end, "@type": "xsd:dateTime"},
+            }
+
+        if self.bbox is not None:
+            node["dcterms:spatial"] = {
+                "@type": "dcterms:Location",
+                "dcat:bbox": {"@value": self.wkt(), "@type": WKT_LITERAL},
+            }
+
+        if self.media_types:
+            node["dcat:distribution"] = [
+                {
+                    "@type": "dcat:Distribution",
+                    "dcat:mediaType": {"@id": media_type_iri(media_type)},
+                    "dcterms:format": media_type,
+                }
+                for media_type in sorted(self.media_types)
+            ]
+
+        return json.dumps(node, indent=2, ensure_ascii=False)
+
+
+def media_type_iri(media_type: str) -> str:
+    """The IANA IRI of a media type, without its parameters."""
+    return IANA_MEDIA_TYPES + media_type.split(";")[0].strip().lower()
+
+
+def normalise_datetime(value) -> str | None:
+    """An RFC 3339 datetime as UTC to the second, or None if it isn't one."""
+    if not isinstance(value, str):
+        return None
+
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+
+    return parsed.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def item_bbox(bbox) -> list[float] | None:
+    """The 2D extent of a STAC bbox, or None if it isn't one."""
+    if not isinstance(bbox, list) or len(bbox) not in (4, 6):
+        return None
+    if not all(
+        isinstance(n, (int, float)) and not isinstance(n, bool) and math.isfinite(n) for n in bbox
+    ):
+        return None
+
+    half = len(bbox) // 2
+    west, south, east, north = bbox[0], bbox[1], bbox[half], bbox[half + 1]
+    if west > east:
+        # Crossing the antimeridian, which a single rectangle can't show.
+        west, east = -180.0, 180.0
+
+    return [float(west), float(south), float(east), float(north)]
+
+
+def coverage_of_item(stac: dict) -> ItemCoverage:
+    """Reads the coverage of one STAC Item dict. Fields which are missing or invalid are skipped."""
+    properties = stac.get("properties")
+    if not isinstance(properties, dict):
+        properties = {}
+
+    start = normalise_datetime(properties.get("start_datetime") or properties.get("datetime"))
+    end = normalise_datetime(properties.get("end_datetime") or properties.get("datetime"))
+    if start is None or end is None:
+        start = end = start or end
+
+    media_types = set()
+    assets = stac.get("assets")
+    if isinstance(assets, dict):
+        for asset in assets.values():
+            media_type = asset.get("type") if isinstance(asset, dict) else None
+            if isinstance(media_type, str) and _MEDIA_TYPE_RE.match(
+                media_type.split(";")[0].strip()
+            ):
+                media_types.add(media_type.strip())
+
+    return ItemCoverage(
+        bbox=item_bbox(stac.get("bbox")), start=start, end=end, media_types=media_types
+    )
+
+
+def item_collection(stac: dict, cat_path: str) -> tuple[str, str] | None:
+    """
+    The catalogue path and IRI of an Item's Collection, from the Item's place in the catalogue
+    and its rel=collection link, or None if either is missing.
+    """
+    item_path = Path(cat_path)
+    if item_path.parent.name != "items":
+        return None
+
+    links = stac.get("links")
+    hrefs = [
+        link.get("href")
+        for link in (links if isinstance(links, list) else [])
+        if isinstance(link, dict) and link.get("rel") == "collection"
+    ]
+    if not hrefs or not isinstance(hrefs[0], str):
+        return None
+    if not hrefs[0].startswith(("http://", "https://")) or not is_plain_iri(hrefs[0]):
+        return None
+
+    return f"{item_path.parent.parent}.json", hrefs[0]
+
+
+def coverage_from_turtle(body: bytes | None) -> ItemCoverage:
+    match = _STATE_RE.match(body or b"")
+    return ItemCoverage.from_json(json.loads(match.group(1))) if match else ItemCoverage()
+
+
+def coverage_from_jsonld(body: bytes | None) -> ItemCoverage:
+    """Reads back the coverage from JSON-LD written by ItemCoverage.to_jsonld."""
+    if not body:
+        return ItemCoverage()
+
+    node = json.loads(body)
+    coverage = ItemCoverage()
+
+    if temporal := node.get("dcterms:temporal"):
+        coverage.start = temporal["dcat:startDate"]["@value"]
+        coverage.end = temporal["dcat:endDate"]["@value"]
+
+    if spatial := node.get("dcterms:spatial"):
+        numbers = [float(n) for n in _NUMBER_RE.findall(spatial["dcat:bbox"]["@value"])]
+        xs, ys = numbers[0::2], numbers[1::2]
+        coverage.bbox = [min(xs), min(ys), max(xs), max(ys)]
+
+    coverage.media_types = {
+        distribution["dcterms:format"] for distribution in node.get("dcat:distribution", ())
+    }
+    return coverage
+
+
+def merge_turtle(body: bytes | None, *, iri: str, coverage: ItemCoverage) -> bytes:
+    merged = coverage_from_turtle(body)
+    merged.merge(coverage)
+    return merged.to_turtle(iri).encode("utf-8")
+
+
+def merge_jsonld(
+    body: bytes | None, *, iri: str, coverage: ItemCoverage, context_url: str
+) -> bytes:
+    merged = coverage_from_jsonld(body)
+    merged.merge(coverage)
+    return merged.to_jsonld(iri, context_url).encode("utf-8")
+
+
+def coverage_actions(
+    key_root: str,
+    iri: str,
+    coverage: ItemCoverage,
+    context_url: str = DEFAULT_CONTEXT_URL,
+    bucket: str | None = None,
+) -> list[S3UpdateAction]:
+    """
+    The updates merging coverage into the coverage documents of the Collection whose DCAT is
+    at key_root (see dataset_dcat_generator.dcat_key_root).
+    """
+    return [
+        S3UpdateAction(
+            key=f"{key_root}/{COVERAGE_NAME}.ttl",
+            update=functools.partial(merge_turtle, iri=iri, coverage=coverage),
+            bucket=bucket,
+            mime_type="text/turtle",
+            cache_control=COVERAGE_CACHE_CONTROL,
+        ),
+        S3UpdateAction(
+            key=f"{key_root}/{COVERAGE_NAME}.jsonld",
+            update=functools.partial(
+                merge_jsonld, iri=iri, coverage=coverage, context_url=context_url
+            ),
+            bucket=bucket,
+            mime_type="application/ld+json",
+            cache_control=COVERAGE_CACHE_CONTROL,
+        ),
+    ]
+
+
+@dataclass
+class _Pending:
+    iri: str
+    coverage: ItemCoverage
+    since: float
+    items: int = 0
+
+
+class ItemCoverageRollup:
+    """
+    The coverage of the Items seen for each Collection since it was last written. Safe to use
+    from several threads.
+    """
+
+    def __init__(
+        self,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        max_pending_items: int = DEFAULT_MAX_PENDING_ITEMS,
+        clock=time.monotonic,
+    ):
+        self.flush_interval = flush_interval
+        self.max_pending_items = max_pending_items
+        self._clock = clock
+        self._pending: dict[str, _Pending] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher: threading.Thread | None = None
+        self._flush: Callable[[bool], object] | None = None
+
+    def add(self, collection_path: str, iri: str, coverage: ItemCoverage):
+        with self._lock:
+            pending = self._pending.get(collection_path)
+            if pending is None:
+                pending = self._pending[collection_path] = _Pending(
+                    iri, ItemCoverage(), self._clock()
+                )
+
+            pending.iri = iri
+            pending.coverage.merge(coverage)
+            pending.items += 1
+
+    def restore(self, collection_path: str, iri: str, coverage: ItemCoverage):
+        """
+        Puts back coverage which was taken by take_due but couldn't be written, merging it with
+        any which has arrived since. It's due again after another `flush_interval`.
+        """
+        with self._lock:
+            pending = self._pending.get(collection_path)
+            if pending is None:
+                pending = self._pending[collection_path] = _Pending(
+                    iri, ItemCoverage(), self._clock()
+                )
+
+            pending.coverage.merge(coverage)
+
+    def discard(self, collection_path: str):
+        """Forgets the pending coverage of a Collection, as when it's deleted."""
+        with self._lock:
+            self._pending.pop(collection_path, None)
+
+    def pending_items(self) -> int:
+        with self._lock:
+            return sum(pending.items for pending in self._pending.values())
+
+    def take_due(self, force: bool = False) -> list[tuple[str, str, ItemCoverage]]:
+        """
+        Removes and returns (collection path, IRI, coverage) for each Collection which is due
+        to be written, or every Collection if `force` is set. Coverage which then can't be
+        written should be given back to restore.
+        """
+        now = self._clock()
+        due = []
+
+        with self._lock:
+            for collection_path, pending in list(self._pending.items()):
+                if (
+                    force
+                    or now - pending.since >= self.flush_interval
+                    or pending.items >= self.max_pending_items
+                ):
+                    del self._pending[collection_path]
+                    if not pending.coverage.is_empty():
+                        due.append((collection_path, pending.iri, pending.coverage))
+
+        return due
+
+    def start_flushing(self, flush: Callable[[bool], object]):
+        """
+        Calls `flush(False)` on a thread, often enough to write each Collection's coverage
+        soon after it's due, until stop_flushing. `flush` is normally
+        DatasetDCATMessager.flush_item_coverage.
+        """
+
+        def run():
+            while not self._stop.wait(min(self.flush_interval, 1.0)):
+                flush(False)
+
+        self._stop.clear()
+        self._flush = flush
+        self._flusher = threading.Thread(target=run, name="item-coverage-flush", daemon=True)
+        self._flusher.start()
+
+    def stop_flushing(self):
+        """Stops the flushing thread and writes everything that's pending."""
+        if self._flusher is None:
+            return
+
+        self._stop.set()
+        self._flusher.join()
+        self._flusher = None
+        self._flush(True)
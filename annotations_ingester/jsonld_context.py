@@ -0,0 +1,136 @@
+"""
+The JSON-LD @context shared by the DCAT and annotation outputs.
+
+rdflib's JSON-LD serialiser writes expanded JSON-LD, with an absolute IRI for every property and
+type, which makes the .jsonld outputs larger than they need to be. The outputs
+are compacted against PREFIXES instead, which covers the vocabularies in ontology/, and refer to
+the context by URL rather than including it.
+
+The context is uploaded once, under a key which includes CONTEXT_VERSION, with headers which let
+clients cache it indefinitely. Any change to PREFIXES must therefore come with a new version.
+It's served from contexts/ under the URL at which the catalogue/ prefix is served, so each
+deployment derives the URL its outputs refer to from its own catalogue URL (see context_url).
+"""
+
+import hashlib
+import json
+import logging
+from urllib.parse import urljoin
+
+from botocore.exceptions import BotoCoreError, ClientError
+from rdflib import Graph
+
+CONTEXT_VERSION = 1
+
+PREFIXES = {
+    "daq": "http://purl.org/eis/vocab/daq#",
+    "dcat": "http://www.w3.org/ns/dcat#",
+    "dcterms": "http://purl.org/dc/terms/",
+    "dctype": "http://purl.org/dc/dcmitype/",
+    "dqv": "http://www.w3.org/ns/dqv#",
+    "duv": "http://www.w3.org/ns/duv#",
+    "eodh": "https://eodatahub.org.uk/api/ontologies/annotations/",
+    "eodhqa": "https://eodatahub.org.uk/api/ontologies/qa/",
+    "eodhweblinks": "https://eodatahub.org.uk/api/ontologies/weblinks/",
+    "foaf": "http://xmlns.com/foaf/0.1/",
+    "oa": "http://www.w3.org/ns/oa#",
+    "owl": "http://www.w3.org/2002/07/owl#",
+    "prov": "http://www.w3.org/ns/prov#",
+    "qb": "http://purl.org/linked-data/cube#",
+    "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+    "rdfs": "http://www.w3.org/2000/01/rdf-schema#",
+    "sdmx-attribute": "http://purl.org/linked-data/sdmx/2009/attribute#",
+    "sdo": "http://schema.org/",
+    "skos": "http://www.w3.org/2004/02/skos/core#",
+    "vcard": "http://www.w3.org/2006/vcard/ns#",
+    "xsd": "http://www.w3.org/2001/XMLSchema#",
+}
+
+CONTEXT_FILE_NAME = f"eodh-v{CONTEXT_VERSION}.jsonld"
+CONTEXTS_PREFIX = "catalogue/contexts/"
+CONTEXT_KEY = f"{CONTEXTS_PREFIX}{CONTEXT_FILE_NAME}"
+# Production's, for library callers which don't give one. Deployments use context_url.
+DEFAULT_CONTEXT_URL = f"https://eodatahub.org.uk/api/catalogue/stac/contexts/{CONTEXT_FILE_NAME}"
+CONTEXT_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# In reverse order, a namespace comes before any it extends, so the most specific prefix is used.
+_NAMESPACES = sorted(((ns, p) for p, ns in PREFIXES.items()), reverse=True)
+
+
+def context_url(catalogue_url: str) -> str:
+    """The URL of the context for a deployment whose catalogue/ prefix is at catalogue_url."""
+    return urljoin(catalogue_url.rstrip("/") + "/", CONTEXT_KEY.removeprefix("catalogue/"))
+
+
+def context_document() -> str:
+    return json.dumps({"@context": PREFIXES}, indent=2, sort_keys=True) + "\n"
+
+
+def compact_iri(iri: str) -> str:
+    """Returns iri as a compact IRI using PREFIXES, or unchanged if none applies."""
+    for namespace, prefix in _NAMESPACES:
+        # A suffix starting '//' would make the compact IRI look like an absolute one.
+        if iri.startswith(namespace) and not iri.startswith("//", len(namespace)):
+            return f"{prefix}:{iri[len(namespace):]}"
+
+    return iri
+
+
+def compact_jsonld(graph: Graph, context_url: str = DEFAULT_CONTEXT_URL) -> str:
+    """Serialises graph as JSON-LD compacted against PREFIXES, referring to the context by URL."""
+    document = json.loads(graph.serialize(format="json-ld", context=PREFIXES))
+    document["@context"] = context_url
+
+    return json.dumps(document, indent=2, ensure_ascii=False)
+
+
+def with_inline_context(jsonld: str) -> str:
+    """
+    Replaces a reference to the published context with the context itself, so the document can
+    be expanded without fetching it. Other documents are returned unchanged.
+    """
+    document = json.loads(jsonld)
+
+    if isinstance(document, dict) and str(document.get("@context")).endswith(CONTEXT_FILE_NAME):
+        document["@context"] = PREFIXES
+        return json.dumps(document)
+
+    return jsonld
+
+
+def publish_context(s3_client, bucket: str) -> bool:
+    """
+    Uploads the context to CONTEXT_KEY unless it's already there with the same content. Returns
+    True if it was uploaded. Failures are logged rather than raised, as the outputs are still
+    usable, and the upload is tried again at the next start.
+    """
+    document = context_document()
+    try:
+        published = s3_client.head_object(Bucket=bucket, Key=CONTEXT_KEY)
+        if published["ETag"].strip('"') == hashlib.md5(document.encode("utf-8")).hexdigest():
+            return False
+
+        # PREFIXES changed without a new CONTEXT_VERSION.
+        logging.warning(f"The JSON-LD context at {CONTEXT_KEY} is out of date, replacing it")
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+            logging.exception(f"Couldn't check for the JSON-LD context at {CONTEXT_KEY}")
+            return False
+    except BotoCoreError:
+        logging.exception(f"Couldn't check for the JSON-LD context at {CONTEXT_KEY}")
+        return False
+
+    try:
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=CONTEXT_KEY,
+            Body=document,
+            ContentType="application/ld+json",
+            CacheControl=CONTEXT_CACHE_CONTROL,
+        )
+    except (BotoCoreError, ClientError):
+        logging.exception(f"Couldn't publish the JSON-LD context to {CONTEXT_KEY}")
+        return False
+
+    logging.info(f"Published the JSON-LD context to {CONTEXT_KEY}")
+    return True
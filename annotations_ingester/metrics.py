@@ -0,0 +1,410 @@
+"""
+Per-stage latency, size and triple-count metrics, exported in the Prometheus text format.
+
+Render functions call `lap(name)` as each stage finishes, which records the time since the
+previous lap (or since recording began) as that stage, and report sizes with
+`observe(name, n)`. These do nothing unless the call is wrapped in `recording`, which collects
+them as a list of observations. That lets them work the same whether rendering happens in this
+process or in a RenderPool worker: the observations are returned with the result and recorded
+here, labelled with the message type and topic of the message being processed (see
+MetricsMixin).
+
+Recorded observations are queued and only added to the histograms when the metrics are
+scraped, or when the queue gets long, so that the message path takes no locks. Metrics are off
+until `enable` is called, and then cost a few microseconds per message.
+"""
+
+import bisect
+import logging
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Sequence
+
+from eodhp_utils.messagers import Messager
+
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)  # fmt: skip
+SIZE_BUCKETS = tuple(4**n for n in range(4, 14))  # 256 B to 64 MiB
+COUNT_BUCKETS = tuple(4**n for n in range(0, 12))  # 1 to ~4 million
+LAG_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# Recorded observations are added to the histograms once this many messages are queued.
+MAX_PENDING = 10_000
+
+_enabled = False
+
+# The current render call's recording, if it's being recorded.
+_recording: ContextVar["_Recording | None"] = ContextVar("recording", default=None)
+
+# (message type, topic) of the message being processed.
+_labels: ContextVar[tuple[str, str]] = ContextVar("labels", default=("", ""))
+
+# (labels, observations) waiting to be added to the histograms.
+_pending: deque[tuple[tuple[str, str], list]] = deque()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values, strict=True)]
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """A Prometheus-style histogram with a fixed set of label names."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str], buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+
+        # label values -> [per-bucket counts (the last is +Inf), sum]
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues: str):
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, *labelvalues: str) -> int:
+        series = self._series.get(labelvalues)
+        return sum(series[0]) if series else 0
+
+    def exposition(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+
+        with self._lock:
+            series = sorted((k, (list(v[0]), v[1])) for k, v in self._series.items())
+
+        for labelvalues, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts, strict=True):
+                cumulative += count
+                labels = _format_labels(self.labelnames, labelvalues, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+
+        return lines
+
+
+class Counter:
+    """A Prometheus-style counter with a fixed set of label names."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues: str, amount: float = 1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues: str) -> float:
+        return self._values.get(labelvalues, 0)
+
+    def exposition(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+
+        with self._lock:
+            values = sorted(self._values.items())
+
+        for labelvalues, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}")
+
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Histogram | Counter] = {}
+        self._before_exposition = []
+
+    def before_exposition(self, fn):
+        """Registers fn to be called before the metrics are exported."""
+        self._before_exposition.append(fn)
+
+    def histogram(self, name, documentation, labelnames, buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, documentation, labelnames, buckets))
+
+    def counter(self, name, documentation, labelnames) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, documentation, labelnames))
+
+    def exposition(self) -> str:
+        for fn in self._before_exposition:
+            fn()
+
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.exposition())
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+MESSAGE_SECONDS = REGISTRY.histogram(
+    "annotations_ingester_message_seconds",
+    "Time taken by process_msg, including rendering.",
+    ("message_type", "topic"),
+)
+MESSAGES = REGISTRY.counter(
+    "annotations_ingester_messages_total",
+    "Messages processed, by outcome.",
+    ("message_type", "topic", "outcome"),
+)
+MESSAGE_BYTES = REGISTRY.histogram(
+    "annotations_ingester_message_bytes",
+    "Size of the Pulsar message.",
+    ("message_type", "topic"),
+    SIZE_BUCKETS,
+)
+STAGE_SECONDS = REGISTRY.histogram(
+    "annotations_ingester_stage_seconds",
+    "Time taken by each stage of rendering an entry.",
+    ("stage", "message_type", "topic"),
+)
+ENTRY_BYTES = REGISTRY.histogram(
+    "annotations_ingester_entry_bytes",
+    "Size of the catalogue entry body, where it's available unparsed.",
+    ("message_type", "topic"),
+    SIZE_BUCKETS,
+)
+TRIPLES = REGISTRY.histogram(
+    "annotations_ingester_triples",
+    "Triples in the generated output.",
+    ("message_type", "topic"),
+    COUNT_BUCKETS,
+)
+S3_SECONDS = REGISTRY.histogram(
+    "annotations_ingester_s3_seconds",
+    "Time taken by S3 requests, by the message they were made for where there is one.",
+    ("operation", "message_type", "topic"),
+)
+S3_RETRIES = REGISTRY.counter(
+    "annotations_ingester_s3_retries_total",
+    "S3 requests retried by the adaptive concurrency controller, by reason.",
+    ("operation", "reason", "message_type", "topic"),
+)
+TOPIC_MESSAGES = REGISTRY.counter(
+    "annotations_ingester_topic_messages_total",
+    "Messages received from and settled on each topic by the pipelined runner.",
+    ("topic", "event"),
+)
+TOPIC_LAG_SECONDS = REGISTRY.histogram(
+    "annotations_ingester_topic_lag_seconds",
+    "Time from a message being published to its being settled by the pipelined runner.",
+    ("topic",),
+    LAG_BUCKETS,
+)
+
+_VALUE_HISTOGRAMS = {
+    "message_seconds": MESSAGE_SECONDS,
+    "message_bytes": MESSAGE_BYTES,
+    "entry_bytes": ENTRY_BYTES,
+    "triples": TRIPLES,
+}
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+class _Recording:
+    __slots__ = ("observations", "last_lap")
+
+    def __init__(self):
+        self.observations = []
+        self.last_lap = time.perf_counter()
+
+
+def lap(name: str):
+    """Records the time since the last lap as the duration of stage `name`."""
+    recording = _recording.get()
+    if recording is not None:
+        now = time.perf_counter()
+        recording.observations.append((name, now - recording.last_lap))
+        recording.last_lap = now
+
+
+def observe(name: str, value: float):
+    """Reports a quantity, such as 'entry_bytes' or 'triples', for the call being recorded."""
+    recording = _recording.get()
+    if recording is not None:
+        recording.observations.append((name, value))
+
+
+def recording(fn, *args):
+    """Calls fn(*args) and returns its result and the observations it made."""
+    current = _Recording()
+    token = _recording.set(current)
+    try:
+        return fn(*args), current.observations
+    finally:
+        _recording.reset(token)
+
+
+def topic_label(msg) -> str:
+    """The topic label of a Pulsar message: the last part of its topic name."""
+    return msg.topic_name().rsplit("/", 1)[-1]
+
+
+def current_labels() -> tuple[str, str]:
+    """(message type, topic) of the message being processed, or empty strings."""
+    return _labels.get()
+
+
+def labelled(labels: tuple[str, str], fn, *args):
+    """
+    Calls fn(*args) as if processing a message with these labels, as when its actions are
+    carried out on another thread by UploadExecutor.
+    """
+    token = _labels.set(labels)
+    try:
+        return fn(*args)
+    finally:
+        _labels.reset(token)
+
+
+def record(observations: list[tuple[str, float]]):
+    """Queues observations returned by `recording` to be added to the histograms."""
+    _pending.append((_labels.get(), observations))
+
+    if len(_pending) > MAX_PENDING:
+        flush()
+
+
+def flush():
+    """Adds the queued observations to the histograms."""
+    while True:
+        try:
+            (message_type, topic), observations = _pending.popleft()
+        except IndexError:
+            return
+
+        for name, value in observations:
+            if name == "outcome":
+                MESSAGES.inc(message_type, topic, value)
+            elif (histogram := _VALUE_HISTOGRAMS.get(name)) is not None:
+                histogram.observe(value, message_type, topic)
+            else:
+                STAGE_SECONDS.observe(value, name, message_type, topic)
+
+
+REGISTRY.before_exposition(flush)
+
+
+class MetricsMixin:
+    """
+    Records the time, size and outcome of each message processed by a Messager, and labels the
+    observations made while rendering it. Messagers set `message_type` to name themselves.
+    """
+
+    message_type = "unknown"
+
+    def process_msg(self, msg) -> Sequence[Messager.Action]:
+        if not _enabled:
+            return super().process_msg(msg)
+
+        token = _labels.set((self.message_type, topic_label(msg)))
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            actions = super().process_msg(msg)
+            if any(isinstance(action, Messager.FailureAction) for action in actions):
+                outcome = "failed"
+            else:
+                outcome = "ok"
+
+            return actions
+        finally:
+            record(
+                [
+                    ("message_seconds", time.perf_counter() - start),
+                    ("message_bytes", len(msg.data())),
+                    ("outcome", outcome),
+                ]
+            )
+            _labels.reset(token)
+
+
+class TimedS3Client:
+    """
+    Wraps a boto3 S3 client so that the time taken by each request is recorded, labelled with
+    the message it's made for.
+    """
+
+    def __init__(self, s3_client):
+        self._s3_client = s3_client
+
+    def __getattr__(self, name):
+        attr = getattr(self._s3_client, name)
+        if not callable(attr) or name == "get_paginator":
+            return attr
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                S3_SECONDS.observe(time.perf_counter() - start, name, *_labels.get())
+
+        return timed
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: Registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.registry.exposition().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def start_metrics_server(port: int, addr: str = "") -> ThreadingHTTPServer:
+    """Enables metrics and serves them at /metrics on a background thread."""
+    enable()
+
+    server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+    logging.info(f"Serving metrics on port {server.server_address[1]}")
+    return server
@@ -0,0 +1,258 @@
+"""
+Deletion of outputs whose catalogue entries no longer exist.
+
+Deletes are normally handled as they arrive (see S3DeleteAction in uploads.py), but one can
+be missed, for example if the output bucket couldn't be reached for longer than the message
+was retried, or leave something behind, as when an annotation is replaced by a different QA
+run. `sweep_orphans` finds those by comparing the outputs with the transformed catalogue they're
+generated from.
+
+The comparison is made a directory at a time. For each directory under catalogue/, the
+outputs expected are worked out from the matching directory of the source: <name>.ttl and
+<name>.jsonld for each <name>.json, and in an annotations/ directory, <uuid>.ttl and
+<uuid>.jsonld for each .trig beside it, and the rollup and summary if there are any (see
+rollup.py), and in a Collection's directory, its coverage if it has Items (see
+item_coverage.py). Anything else, with its compressed variants, is an
+orphan. Only one directory of each listing is held at a time, so memory use depends on the
+size of the largest directory rather than of the catalogue. The records of annotation UUIDs
+are swept in the same way.
+
+Run with, for example:
+    python -m annotations_ingester.orphans s3://harvested/transformed/ --dry-run
+"""
+
+import logging
+import os
+import posixpath
+
+import click
+from eodhp_utils.runner import get_boto3_session, setup_logging
+
+from annotations_ingester import annotations_generator, dataset_dcat_generator
+from annotations_ingester.annotations_generator import (
+    ANNOTATION_INDEX_PREFIX,
+    annotation_key_root,
+    get_uuid_from_graph,
+    prescan_uuid,
+)
+from annotations_ingester.backfill import parse_s3_url
+from annotations_ingester.dataset_dcat_generator import (
+    CATALOGUE_PUBLIC_BUCKET_PREFIX,
+    ITEMS_DIRECTORY,
+    SHARED_OUTPUT_PREFIXES,
+    dcat_key_root,
+)
+from annotations_ingester.encodings import original_key
+from annotations_ingester.item_coverage import COVERAGE_NAME
+from annotations_ingester.rollup import ROLLUP_NAME, SUMMARY_NAME
+from annotations_ingester.uploads import MAX_DELETE_BATCH, delete_keys
+
+ANNOTATIONS_DIRECTORY = "annotations/"
+
+
+def list_directory(s3_client, bucket: str, prefix: str) -> tuple[list[str], list[str]]:
+    """The keys directly under prefix, and the prefixes of its subdirectories."""
+    keys, subdirectories = [], []
+    paginator = s3_client.get_paginator("list_objects_v2")
+
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+        keys += [obj["Key"] for obj in page.get("Contents", [])]
+        subdirectories += [p["Prefix"] for p in page.get("CommonPrefixes", [])]
+
+    return keys, subdirectories
+
+
+class LocalSource:
+    """A transformed catalogue in a local directory."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def list_dir(self, relative: str) -> tuple[set[str], set[str]]:
+        """The names of the files and subdirectories in a directory, which may not exist."""
+        files, subdirectories = set(), set()
+
+        try:
+            with os.scandir(os.path.join(self.root, relative)) as it:
+                for entry in it:
+                    (subdirectories if entry.is_dir() else files).add(entry.name)
+        except FileNotFoundError:
+            pass
+
+        return files, subdirectories
+
+    def read(self, relative: str) -> bytes:
+        with open(os.path.join(self.root, relative), "rb") as f:
+            return f.read()
+
+
+class S3Source:
+    """A transformed catalogue under an S3 prefix."""
+
+    def __init__(self, s3_client, bucket: str, prefix: str):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix if prefix == "" or prefix.endswith("/") else f"{prefix}/"
+
+    def list_dir(self, relative: str) -> tuple[set[str], set[str]]:
+        directory = self.prefix + relative
+        keys, subdirectories = list_directory(self.s3_client, self.bucket, directory)
+
+        return (
+            {key[len(directory) :] for key in keys},
+            {p[len(directory) :].rstrip("/") for p in subdirectories},
+        )
+
+    def read(self, relative: str) -> bytes:
+        return self.s3_client.get_object(Bucket=self.bucket, Key=self.prefix + relative)[
+            "Body"
+        ].read()
+
+
+def expected_outputs(source, relative: str) -> set[str] | None:
+    """
+    The output keys which should be in the directory catalogue/<relative>, without compressed
+    variants. Returns None if that can't be worked out because an annotation couldn't be read.
+    """
+    files, directories = source.list_dir(relative)
+    expected = {
+        dcat_key_root(relative + name) + extension
+        for name in files
+        if name.endswith(".json")
+        for extension in dataset_dcat_generator.OUTPUT_EXTENSIONS
+    }
+
+    if relative and ITEMS_DIRECTORY in directories:
+        key_root = dcat_key_root(relative.removesuffix("/") + ".json")
+        expected.update(
+            f"{key_root}/{COVERAGE_NAME}{extension}"
+            for extension in dataset_dcat_generator.OUTPUT_EXTENSIONS
+        )
+
+    if relative == ANNOTATIONS_DIRECTORY or relative.endswith("/" + ANNOTATIONS_DIRECTORY):
+        parent = relative.removesuffix(ANNOTATIONS_DIRECTORY)
+        parent_files, _ = source.list_dir(parent)
+
+        trig_files = sorted(name for name in parent_files if name.endswith(".trig"))
+        if trig_files:
+            directory = annotation_key_root(parent + trig_files[0], "")
+            expected.update(directory + name for name in (ROLLUP_NAME, SUMMARY_NAME))
+
+        for name in trig_files:
+
+            try:
+                body = source.read(parent + name)
+                uuid = prescan_uuid(body) or get_uuid_from_graph(body)
+            except Exception:
+                # Without the UUID it's not known which of the outputs belongs to this entry.
+                logging.exception(f"Couldn't find the UUID of {parent + name}")
+                return None
+
+            key_root = annotation_key_root(parent + name, uuid)
+            expected.update(
+                key_root + extension for extension in annotations_generator.OUTPUT_EXTENSIONS
+            )
+
+    return expected
+
+
+def sweep_orphans(s3_client, bucket: str, source, dry_run: bool = False) -> dict:
+    """
+    Deletes the outputs, and records of annotation UUIDs, in bucket whose entries aren't in
+    source. Returns counts of what was found.
+    """
+    root_files, root_subdirectories = source.list_dir("")
+    if not root_files and not root_subdirectories:
+        # Most likely a mistyped source, which would make every output look orphaned.
+        raise ValueError("The source catalogue is empty")
+
+    stats = {"directories": 0, "objects": 0, "orphans": 0, "deleted": 0, "failed": 0}
+    due = []
+
+    def delete_due():
+        failed = [] if dry_run else delete_keys(s3_client, bucket, due)
+        stats["deleted"] += len(due) - len(failed)
+        stats["failed"] += len(failed)
+        due.clear()
+
+    def found_orphan(key: str):
+        logging.info(f"Orphaned output {key}")
+        stats["orphans"] += 1
+        due.append(key)
+        if len(due) >= MAX_DELETE_BATCH:
+            delete_due()
+
+    pending = [""]
+    while pending:
+        relative = pending.pop()
+        if relative.startswith("/") or "//" in relative:
+            logging.warning(f"Not sweeping {CATALOGUE_PUBLIC_BUCKET_PREFIX}{relative}")
+            continue
+
+        keys, subdirectories = list_directory(
+            s3_client, bucket, CATALOGUE_PUBLIC_BUCKET_PREFIX + relative
+        )
+        stats["directories"] += 1
+        stats["objects"] += len(keys)
+
+        if keys and (expected := expected_outputs(source, relative)) is not None:
+            for key in keys:
+                if original_key(key) not in expected:
+                    found_orphan(key)
+
+        pending += [
+            p.removeprefix(CATALOGUE_PUBLIC_BUCKET_PREFIX)
+            for p in subdirectories
+            if p not in SHARED_OUTPUT_PREFIXES
+        ]
+
+    pending = [""]
+    while pending:
+        relative = pending.pop()
+        keys, subdirectories = list_directory(s3_client, bucket, ANNOTATION_INDEX_PREFIX + relative)
+        stats["directories"] += 1
+        stats["objects"] += len(keys)
+
+        if keys:
+            files, _ = source.list_dir(relative)
+            for key in keys:
+                if posixpath.basename(key) not in files:
+                    found_orphan(key)
+
+        pending += [p.removeprefix(ANNOTATION_INDEX_PREFIX) for p in subdirectories]
+
+    if due:
+        delete_due()
+
+    return stats
+
+
+@click.command
+@click.argument("source")
+@click.option("--bucket", envvar="S3_BUCKET", required=True, help="Bucket the outputs are in.")
+@click.option("--dry-run", is_flag=True, default=False, help="Report but don't delete.")
+@click.option("-v", "--verbose", count=True)
+def sweep(source: str, bucket: str, dry_run: bool, verbose: int):
+    """
+    Deletes outputs whose entries aren't in SOURCE, the transformed catalogue as a directory or
+    s3://bucket/prefix.
+    """
+    setup_logging(verbosity=verbose)
+
+    s3_client = get_boto3_session().client("s3")
+
+    if s3_source := parse_s3_url(source):
+        catalogue = S3Source(s3_client, *s3_source)
+    else:
+        catalogue = LocalSource(source)
+
+    try:
+        stats = sweep_orphans(s3_client, bucket, catalogue, dry_run=dry_run)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="SOURCE") from e
+
+    logging.info(f"Swept orphaned outputs: {stats}")
+
+
+if __name__ == "__main__":
+    sweep()
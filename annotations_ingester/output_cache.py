@@ -0,0 +1,259 @@
+"""
+Suppression of S3 uploads whose content hasn't changed.
+
+Re-harvests resend large numbers of unchanged entries, and each one would otherwise be
+regenerated and uploaded again. OutputFingerprintCache remembers a hash of the last body
+uploaded to each key and lets the messagers drop uploads that would write the same bytes.
+
+The fingerprint is the hex MD5 of the body, which is also the ETag S3 gives single-part,
+non-KMS uploads. That lets the cache be warmed from a bucket listing.
+
+The cache only knows what this process has uploaded or seen listed. With several replicas
+sharing a subscription, set max_age so that a write by another replica can't be masked for
+long.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import IO, Sequence
+
+from eodhp_utils.messagers import Messager
+
+from annotations_ingester.content_addressing import CONTENT_PREFIX
+from annotations_ingester.encodings import original_key
+from annotations_ingester.uploads import S3DeleteAction, is_file_body
+
+
+class OutputFingerprintCache:
+    """
+    A bounded LRU map from (bucket, key) to the fingerprint of the last upload. It's safe to
+    share between threads.
+    """
+
+    def __init__(self, max_entries: int = 100_000, max_age: float | None = None):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+        # cache key -> (fingerprint, time recorded)
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def fingerprint(body: str | bytes | IO[bytes]) -> str:
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        if isinstance(body, bytes):
+            return hashlib.md5(body, usedforsecurity=False).hexdigest()
+
+        # A file is hashed a block at a time and left at its start.
+        body.seek(0)
+        fingerprint = hashlib.file_digest(body, lambda: hashlib.md5(usedforsecurity=False))
+        body.seek(0)
+
+        return fingerprint.hexdigest()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_unchanged(self, bucket: str, key: str, fingerprint: str) -> bool:
+        """Checks, and counts as a hit or miss, whether key was last given this content."""
+        cache_key = f"{bucket}/{key}"
+
+        with self._lock:
+            entry = self._entries.get(cache_key)
+
+            if (
+                entry is not None
+                and self.max_age is not None
+                and time.time() - entry[1] > self.max_age
+            ):
+                del self._entries[cache_key]
+                entry = None
+
+            if entry is not None and entry[0] == fingerprint:
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return True
+
+            self.misses += 1
+            return False
+
+    def record(self, bucket: str, key: str, fingerprint: str, recorded_at: float | None = None):
+        cache_key = f"{bucket}/{key}"
+
+        with self._lock:
+            self._entries[cache_key] = (
+                fingerprint,
+                time.time() if recorded_at is None else recorded_at,
+            )
+            self._entries.move_to_end(cache_key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, bucket: str, key: str):
+        with self._lock:
+            self._entries.pop(f"{bucket}/{key}", None)
+
+    def invalidate_prefix(self, bucket: str, prefix: str):
+        """Invalidates every key under prefix. This looks at every entry, but deletes are rare."""
+        cache_prefix = f"{bucket}/{prefix}"
+
+        with self._lock:
+            for cache_key in [k for k in self._entries if k.startswith(cache_prefix)]:
+                del self._entries[cache_key]
+
+    def drop_unchanged(
+        self, actions: Sequence[Messager.Action], default_bucket: str
+    ) -> list[Messager.Action]:
+        """
+        Returns actions without the S3 uploads whose body matches the last one sent to the same
+        key. The remaining uploads are recorded as if they've succeeded - see
+        InvalidatingS3Client for undoing that when they don't. Deleted keys are forgotten, so
+        that they're written again if they're recreated with the same content.
+        """
+        remaining = []
+
+        for action in actions:
+            if isinstance(action, S3DeleteAction):
+                bucket = action.bucket or default_bucket
+                for key in action.keys:
+                    self.invalidate(bucket, key)
+                for prefix in action.prefixes:
+                    self.invalidate_prefix(bucket, prefix)
+            elif isinstance(action, Messager.S3UploadAction):
+                bucket = action.bucket or default_bucket
+                fingerprint = self.fingerprint(action.file_body)
+
+                with self._lock:
+                    if self.is_unchanged(bucket, action.key, fingerprint):
+                        logging.debug(f"Skipping unchanged upload to {action.key}")
+                        if is_file_body(action.file_body):
+                            action.file_body.close()
+                        continue
+
+                    self.record(bucket, action.key, fingerprint)
+
+            remaining.append(action)
+
+        return remaining
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    def warm_from_bucket(self, s3_client, bucket: str, prefix: str = "") -> int:
+        """
+        Records the ETags of existing objects as their fingerprints, stopping when the cache
+        is full. Multipart ETags aren't MD5s and are skipped. So are content objects and empty
+        objects, which are the aliases pointing to them: in the content addressed layout the
+        fingerprint of an output isn't the ETag of anything. Returns the number recorded.
+        """
+        recorded = 0
+        paginator = s3_client.get_paginator("list_objects_v2")
+
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                etag = obj["ETag"].strip('"')
+                if "-" in etag or obj["Size"] == 0 or obj["Key"].startswith(CONTENT_PREFIX):
+                    continue
+
+                self.record(bucket, obj["Key"], etag, obj["LastModified"].timestamp())
+                recorded += 1
+
+                if recorded >= self.max_entries:
+                    return recorded
+
+        return recorded
+
+    def save_snapshot(self, path: str):
+        """Writes the cache to a local file, replacing it atomically."""
+        with self._lock:
+            entries = [[k, fp, t] for k, (fp, t) in self._entries.items()]
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": 1, "entries": entries}, f)
+        os.replace(tmp_path, path)
+
+        logging.info(f"Saved {len(self._entries)} output fingerprints to {path}: {self.stats()}")
+
+    def load_snapshot(self, path: str) -> int:
+        """Loads a snapshot written by save_snapshot, if there is one."""
+        if not os.path.exists(path):
+            return 0
+
+        with open(path) as f:
+            snapshot = json.load(f)
+
+        for cache_key, fingerprint, recorded_at in snapshot["entries"]:
+            bucket, key = cache_key.split("/", 1)
+            self.record(bucket, key, fingerprint, recorded_at)
+
+        return len(snapshot["entries"])
+
+
+class InvalidatingS3Client:
+    """
+    Wraps a boto3 S3 client so that a failed put_object or upload_fileobj invalidates the
+    fingerprint recorded for that key, so the upload isn't skipped when the message is retried.
+    Only the original output's fingerprint is recorded, so a failed upload of a compressed
+    variant invalidates that.
+    """
+
+    def __init__(self, s3_client, cache: OutputFingerprintCache):
+        self._s3_client = s3_client
+        self._cache = cache
+
+    def put_object(self, **kwargs):
+        try:
+            return self._s3_client.put_object(**kwargs)
+        except Exception:
+            self._cache.invalidate(kwargs.get("Bucket"), original_key(kwargs.get("Key")))
+            raise
+
+    def upload_fileobj(self, Fileobj, Bucket: str, Key: str, **kwargs):
+        try:
+            return self._s3_client.upload_fileobj(Fileobj, Bucket, Key, **kwargs)
+        except Exception:
+            self._cache.invalidate(Bucket, original_key(Key))
+            raise
+
+    def invalidate(self, Bucket: str, Key: str):
+        """Invalidates the fingerprint for a key whose upload failed before it was attempted."""
+        self._cache.invalidate(Bucket, Key)
+
+    def __getattr__(self, name):
+        return getattr(self._s3_client, name)
+
+
+class OutputCacheMixin:
+    """
+    Adds an optional `output_cache` to a Messager. When set, uploads of unchanged content are
+    removed from the actions returned by process_msg.
+    """
+
+    def __init__(self, *args, output_cache: OutputFingerprintCache | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.output_cache = output_cache
+
+    def process_msg(self, msg) -> Sequence[Messager.Action]:
+        actions = super().process_msg(msg)
+
+        if self.output_cache is None:
+            return actions
+
+        return self.output_cache.drop_unchanged(actions, self.output_bucket)
@@ -0,0 +1,548 @@
+"""
+A summary index of the QA of every dataset, for looking up many datasets at once.
+
+A client wanting the latest QA for a dataset would otherwise have to list its annotations/
+directory and fetch and parse each annotation, or fetch its summary.json (see rollup.py), which
+is still a request per dataset. With a QASummaryIndex, AnnotationsMessager also records a line
+of JSON for each annotation it converts:
+
+    {"dataset": "catalogs/c/collections/x", "source": "catalogs/c/collections/x/qa.trig",
+     "uuid": "...", "generatedAtTime": "...", "results": {"eodhqa:snr": {"value": 42.5}}}
+
+These are exported every so often to two objects under catalogue/qa-index/:
+
+    data/<digest>.jsonl     every dataset's lines, sorted by dataset and then source
+    index.json              which data file is current, and the dataset and byte offset of
+                            the line at the start of each block of about 64KiB of it
+
+so a client can look up thousands of datasets with one request for index.json and a ranged GET
+for each run of blocks which holds any of them (see `lookup`). A data file is never changed once
+written. index.json names the one before it too, which is deleted by the export after next, so
+a client whose copy of index.json is at least one export old may find its data file gone, and
+should fetch index.json again.
+
+Changes are kept in a SQLite database until they've been exported, so with a database file
+which outlives the process none are lost when it restarts. An export merges the changes into
+the current data file as it streams it, writes a new one and replaces index.json with a
+conditional put, starting again if another process exported in between. So several processes
+can keep the index, each exporting only what it has changed. DatasetDCATMessager removes the
+records under a deleted Catalog or Collection by prefix, as it can't know which they are.
+
+`rebuild` regenerates the whole index from the annotations in the transformed catalogue, using
+a temporary database to sort them. Run it when the index is first enabled, or to recover one
+which has missed changes, for example:
+    python -m annotations_ingester.qa_index s3://harvested/transformed/ --bucket outputs
+"""
+
+import hashlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from typing import Iterable, Iterator
+
+import click
+from botocore.exceptions import BotoCoreError, ClientError
+from eodhp_utils.runner import get_boto3_session, setup_logging
+
+from annotations_ingester.annotations_generator import (
+    DEFAULT_STREAMING_THRESHOLD,
+    parse_annotation,
+    streamed_run_results,
+)
+from annotations_ingester.backfill import local_entries, parse_s3_url, s3_entries
+from annotations_ingester.dataset_dcat_generator import QA_INDEX_PREFIX
+from annotations_ingester.rollup import run_results
+from annotations_ingester.uploads import (
+    CONDITIONAL_WRITE_CONFLICTS,
+    FILE_TRANSFER_CONFIG,
+    UPDATE_ATTEMPTS,
+    UPDATE_BACKOFF,
+    TemporaryFailure,
+    delete_keys,
+    is_missing,
+)
+from annotations_ingester.validation import require_valid
+
+QA_INDEX_NAME = "index.json"
+QA_INDEX_VERSION = 1
+DATA_DIRECTORY = "data/"
+
+DEFAULT_BLOCK_BYTES = 64 * 1024
+DEFAULT_EXPORT_INTERVAL = 300.0
+
+QA_INDEX_CACHE_CONTROL = "max-age=60"
+DATA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Exported data is held in memory up to this size while it's written.
+SPOOL_BYTES = 16 * 1024 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS changes (
+    dataset TEXT NOT NULL,
+    source TEXT NOT NULL,
+    -- The record's line, or NULL if the annotation was deleted.
+    line TEXT,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (dataset, source)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS removed_prefixes (
+    -- Every exported record whose source starts with this is removed.
+    prefix TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def dataset_of(cat_path: str) -> str:
+    """The catalogue path of the dataset an annotation belongs to."""
+    return "/".join(cat_path.lstrip("/").split("/")[:-1])
+
+
+def summary_line(cat_path: str, uuid: str, results: dict) -> str:
+    """The index's line for an annotation, given its results from rollup.run_results."""
+    record = {
+        "dataset": dataset_of(cat_path),
+        "source": cat_path.lstrip("/"),
+        "uuid": uuid,
+        "generatedAtTime": results["generatedAtTime"],
+        "results": results["results"],
+    }
+    return json.dumps(record, separators=(",", ":"), ensure_ascii=False)
+
+
+class QASummaryIndex:
+    """
+    The changes to the index which haven't been exported yet, in SQLite at `path`. Safe to use
+    from several threads.
+    """
+
+    def __init__(self, path: str = ":memory:", block_bytes: int = DEFAULT_BLOCK_BYTES):
+        self.path = path
+        self.block_bytes = block_bytes
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ":memory:":
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(_SCHEMA)
+        self._seq = self._connection.execute(
+            "SELECT MAX(COALESCE((SELECT MAX(seq) FROM changes), 0),"
+            " COALESCE((SELECT MAX(seq) FROM removed_prefixes), 0))"
+        ).fetchone()[0]
+
+        self._stop = threading.Event()
+        self._exporter: threading.Thread | None = None
+
+    def record(self, cat_path: str, uuid: str, results: dict):
+        self.add_line(summary_line(cat_path, uuid, results))
+
+    def add_line(self, line: str):
+        self._put(record_key(line), line)
+
+    def remove(self, cat_path: str):
+        self._put((dataset_of(cat_path), cat_path.lstrip("/")), None)
+
+    def remove_prefix(self, prefix: str):
+        """
+        Removes every annotation whose catalogue path starts with `prefix`, such as those under
+        a deleted Catalog or Collection.
+        """
+        prefix = prefix.lstrip("/")
+        with self._lock:
+            self._seq += 1
+            # Changes made before the removal are removed with it.
+            self._connection.execute(
+                "DELETE FROM changes WHERE substr(source, 1, ?) = ?", (len(prefix), prefix)
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO removed_prefixes VALUES (?, ?)", (prefix, self._seq)
+            )
+
+    def _put(self, key: tuple[str, str], line: str | None):
+        with self._lock:
+            self._seq += 1
+            self._connection.execute(
+                "INSERT OR REPLACE INTO changes VALUES (?, ?, ?, ?)", (*key, line, self._seq)
+            )
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT (SELECT COUNT(*) FROM changes) + (SELECT COUNT(*) FROM removed_prefixes)"
+            ).fetchone()[0]
+
+    def changes(self) -> tuple[list[tuple[tuple[str, str], str | None]], list[str], int]:
+        """
+        The changes in index order, the prefixes removed before any of them, and the sequence
+        number they go up to.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT dataset, source, line FROM changes ORDER BY dataset, source"
+            ).fetchall()
+            prefixes = [
+                prefix
+                for (prefix,) in self._connection.execute("SELECT prefix FROM removed_prefixes")
+            ]
+            changes = [((dataset, source), line) for dataset, source, line in rows]
+            return changes, prefixes, self._seq
+
+    def lines(self) -> Iterator[str]:
+        """
+        Streams the lines of the changes which aren't deletions, in index order. Nothing else
+        should be changed until it's finished.
+        """
+        rows = self._connection.execute(
+            "SELECT line FROM changes WHERE line IS NOT NULL ORDER BY dataset, source"
+        )
+        for (line,) in rows:
+            yield line
+
+    def forget(self, seq: int):
+        """Drops the changes up to `seq`, once they've been exported."""
+        with self._lock:
+            self._connection.execute("DELETE FROM changes WHERE seq <= ?", (seq,))
+            self._connection.execute("DELETE FROM removed_prefixes WHERE seq <= ?", (seq,))
+
+    def export(self, s3_client, bucket: str) -> dict | None:
+        """
+        Merges the changes into the exported index, or returns None if there are none. Raises
+        TemporaryFailure if other processes keep exporting at the same time.
+        """
+        changes, removed_prefixes, seq = self.changes()
+        if not changes and not removed_prefixes:
+            return None
+
+        for attempt in range(UPDATE_ATTEMPTS):
+            current, condition = read_index(s3_client, bucket)
+            existing = iter_data(s3_client, bucket, current) if current else iter([])
+
+            try:
+                stats = write_index(
+                    s3_client,
+                    bucket,
+                    merge_changes(existing, changes, removed_prefixes),
+                    current,
+                    condition,
+                    self.block_bytes,
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in CONDITIONAL_WRITE_CONFLICTS:
+                    raise
+            else:
+                self.forget(seq)
+                return {
+                    **stats,
+                    "changes": len(changes),
+                    "removed_prefixes": len(removed_prefixes),
+                }
+
+            logging.debug("Conflicting export of the QA index, retrying")
+            time.sleep(random.uniform(0, UPDATE_BACKOFF * 2**attempt))
+
+        raise TemporaryFailure(f"Gave up exporting the QA index after {UPDATE_ATTEMPTS} conflicts")
+
+    def start_exporting(self, s3_client, bucket: str, interval: float = DEFAULT_EXPORT_INTERVAL):
+        """Exports the changes every `interval` seconds on a thread, until stop_exporting."""
+
+        def run():
+            while not self._stop.wait(interval):
+                self._export_logged(s3_client, bucket)
+
+        self._stop.clear()
+        self._export_target = (s3_client, bucket)
+        self._exporter = threading.Thread(target=run, name="qa-index-export", daemon=True)
+        self._exporter.start()
+
+    def stop_exporting(self):
+        """Stops the exporting thread and exports what's left."""
+        if self._exporter is None:
+            return
+
+        self._stop.set()
+        self._exporter.join()
+        self._exporter = None
+        self._export_logged(*self._export_target)
+
+    def _export_logged(self, s3_client, bucket: str):
+        try:
+            if stats := self.export(s3_client, bucket):
+                logging.info(f"Exported the QA index: {stats}")
+        except (BotoCoreError, ClientError, TemporaryFailure):
+            logging.exception("Couldn't export the QA index")
+
+    def close(self):
+        self._connection.close()
+
+
+def record_key(line: str | bytes) -> tuple[str, str]:
+    record = json.loads(line)
+    return record["dataset"], record["source"]
+
+
+def merge_changes(
+    existing: Iterable[str],
+    changes: Iterable[tuple[tuple[str, str], str | None]],
+    removed_prefixes: Iterable[str] = (),
+) -> Iterator[str]:
+    """
+    The lines of the existing data, which must be in index order, with the changes applied. A
+    change replaces the line with the same key, or removes it if the change's line is None.
+    Existing lines whose source starts with one of `removed_prefixes` are removed.
+    """
+    removed_prefixes = tuple(removed_prefixes)
+    changes = iter(changes)
+    change = next(changes, None)
+
+    for line in existing:
+        key = record_key(line)
+        while change is not None and change[0] < key:
+            if change[1] is not None:
+                yield change[1]
+            change = next(changes, None)
+
+        if change is not None and change[0] == key:
+            if change[1] is not None:
+                yield change[1]
+            change = next(changes, None)
+        elif not key[1].startswith(removed_prefixes):
+            yield line
+
+    while change is not None:
+        if change[1] is not None:
+            yield change[1]
+        change = next(changes, None)
+
+
+def read_index(s3_client, bucket: str) -> tuple[dict | None, dict]:
+    """The exported index.json, or None, and the condition for replacing it."""
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=QA_INDEX_PREFIX + QA_INDEX_NAME)
+    except ClientError as e:
+        if not is_missing(e):
+            raise
+        return None, {"IfNoneMatch": "*"}
+
+    return json.loads(response["Body"].read()), {"IfMatch": response["ETag"]}
+
+
+def iter_data(s3_client, bucket: str, index: dict) -> Iterator[str]:
+    """Streams the lines of the data file named by index."""
+    body = s3_client.get_object(Bucket=bucket, Key=QA_INDEX_PREFIX + index["data"])["Body"]
+    lines = body.iter_lines() if hasattr(body, "iter_lines") else body
+
+    for line in lines:
+        if line := line.rstrip(b"\n"):
+            yield line.decode("utf-8")
+
+
+def write_index(
+    s3_client,
+    bucket: str,
+    lines: Iterable[str],
+    current: dict | None = None,
+    condition: dict | None = None,
+    block_bytes: int = DEFAULT_BLOCK_BYTES,
+) -> dict:
+    """
+    Writes lines, in index order, as a new data file and index.json, replacing `current`. The
+    put of index.json is made with `condition`, if given. Returns counts of what was written.
+    """
+    digest = hashlib.sha256()
+    blocks, records, size = [], 0, 0
+
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) as data:
+        for line in lines:
+            if not blocks or size - blocks[-1][1] >= block_bytes:
+                blocks.append([record_key(line)[0], size])
+
+            encoded = line.encode("utf-8") + b"\n"
+            data.write(encoded)
+            digest.update(encoded)
+            records += 1
+            size += len(encoded)
+
+        data_name = f"{DATA_DIRECTORY}{digest.hexdigest()[:32]}.jsonl"
+        data.seek(0)
+        s3_client.upload_fileobj(
+            data,
+            bucket,
+            QA_INDEX_PREFIX + data_name,
+            ExtraArgs={"ContentType": "application/jsonl", "CacheControl": DATA_CACHE_CONTROL},
+            Config=FILE_TRANSFER_CONFIG,
+        )
+
+    index = {
+        "version": QA_INDEX_VERSION,
+        "exportedAt": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "data": data_name,
+        "previous": current["data"] if current else None,
+        "records": records,
+        "bytes": size,
+        "blocks": blocks,
+    }
+    try:
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=QA_INDEX_PREFIX + QA_INDEX_NAME,
+            Body=json.dumps(index, separators=(",", ":")).encode("utf-8"),
+            ContentType="application/json",
+            CacheControl=QA_INDEX_CACHE_CONTROL,
+            **(condition or {}),
+        )
+    except ClientError:
+        # Nothing refers to the new data file unless it's the same as one which is current.
+        if current is None or data_name not in (current["data"], current.get("previous")):
+            delete_keys(s3_client, bucket, [QA_INDEX_PREFIX + data_name])
+        raise
+
+    # The data file before the one replaced is now two exports old.
+    stale = current.get("previous") if current else None
+    if stale and stale not in (data_name, index["previous"]):
+        delete_keys(s3_client, bucket, [QA_INDEX_PREFIX + stale])
+
+    return {"records": records, "bytes": size, "blocks": len(blocks)}
+
+
+def lookup(s3_client, bucket: str, datasets: Iterable[str]) -> dict[str, list[dict]]:
+    """
+    The records of each of datasets, as a client would find them: with one GET of index.json,
+    and a ranged GET of the data file for each run of blocks which holds any of them.
+    """
+    index, _ = read_index(s3_client, bucket)
+    wanted = set(datasets)
+    found = {dataset: [] for dataset in wanted}
+    if index is None or not index["blocks"]:
+        return found
+
+    firsts = [first for first, _ in index["blocks"]]
+    offsets = [offset for _, offset in index["blocks"]] + [index["bytes"]]
+
+    # A dataset's lines may start in the block before the first which starts with it.
+    needed = set()
+    for dataset in wanted:
+        needed.update(
+            range(max(bisect_left(firsts, dataset) - 1, 0), bisect_right(firsts, dataset))
+        )
+
+    runs = []
+    for block in sorted(needed):
+        if runs and runs[-1][1] == block:
+            runs[-1][1] = block + 1
+        else:
+            runs.append([block, block + 1])
+
+    for first_block, end_block in runs:
+        body = s3_client.get_object(
+            Bucket=bucket,
+            Key=QA_INDEX_PREFIX + index["data"],
+            Range=f"bytes={offsets[first_block]}-{offsets[end_block] - 1}",
+        )["Body"].read()
+
+        for line in body.splitlines():
+            record = json.loads(line)
+            if record["dataset"] in wanted:
+                found[record["dataset"]].append(record)
+
+    return found
+
+
+def annotation_lines(
+    source_entries: Iterator, read, streaming_threshold: int = DEFAULT_STREAMING_THRESHOLD
+) -> Iterator[str]:
+    """
+    The index line of each annotation among the backfill entries, reading each with
+    `read(entry)`. Entries which can't be read or aren't valid are logged and skipped. Bodies
+    of at least `streaming_threshold` bytes are read as AnnotationsMessager streams them, so
+    they're indexed if and only if the ingester would index them.
+    """
+    for entry in source_entries:
+        if entry.kind != "annotation":
+            continue
+
+        try:
+            body = read(entry)
+            if streaming_threshold and len(body) >= streaming_threshold:
+                uuid, results = streamed_run_results(body)
+            else:
+                dataset = parse_annotation(body)
+                uuid, results = require_valid(dataset).uuid, run_results(dataset)
+
+            yield summary_line(entry.key, uuid, results)
+        except Exception:
+            logging.exception(f"Couldn't index {entry.key}")
+
+
+def rebuild_index(
+    s3_client, bucket: str, lines: Iterable[str], block_bytes: int = DEFAULT_BLOCK_BYTES
+) -> dict:
+    """
+    Replaces the exported index with one of `lines`, in any order, sorting them in a temporary
+    database so that they needn't fit in memory.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        index = QASummaryIndex(os.path.join(directory, "rebuild.sqlite"), block_bytes)
+        try:
+            for line in lines:
+                index.add_line(line)
+
+            current, _ = read_index(s3_client, bucket)
+            return write_index(s3_client, bucket, index.lines(), current, None, block_bytes)
+        finally:
+            index.close()
+
+
+@click.command
+@click.argument("source")
+@click.option("--bucket", envvar="S3_BUCKET", required=True, help="Bucket the outputs are in.")
+@click.option(
+    "--block-bytes",
+    default=DEFAULT_BLOCK_BYTES,
+    help="Approximate size of the blocks of the data file which index.json points into.",
+)
+@click.option(
+    "--streaming-threshold",
+    envvar="STREAMING_THRESHOLD",
+    default=DEFAULT_STREAMING_THRESHOLD,
+    help="The ingester's --streaming-threshold, so that the same annotations are indexed.",
+)
+@click.option("-v", "--verbose", count=True)
+def rebuild(source: str, bucket: str, block_bytes: int, streaming_threshold: int, verbose: int):
+    """
+    Rebuilds the QA summary index from the annotations in SOURCE, the transformed catalogue as
+    a directory or s3://bucket/prefix. Changes exported by the ingester while this runs may be
+    lost, so rebuild when it's stopped or run this again afterwards.
+    """
+    setup_logging(verbosity=verbose)
+
+    s3_client = get_boto3_session().client("s3")
+
+    if s3_source := parse_s3_url(source):
+        source_bucket, prefix = s3_source
+        entries = s3_entries(s3_client, source_bucket, prefix)
+
+        def read(entry) -> bytes:
+            return s3_client.get_object(Bucket=source_bucket, Key=entry.location)["Body"].read()
+
+    else:
+        entries = local_entries(source)
+
+        def read(entry) -> bytes:
+            with open(entry.location, "rb") as f:
+                return f.read()
+
+    lines = annotation_lines(entries, read, streaming_threshold)
+    stats = rebuild_index(s3_client, bucket, lines, block_bytes)
+
+    logging.info(f"Rebuilt the QA index: {stats}")
+
+
+if __name__ == "__main__":
+    rebuild()
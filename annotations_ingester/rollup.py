@@ -0,0 +1,206 @@
+"""
+Per-dataset rollups of the annotations, kept up to date as each one arrives.
+
+Each annotation is published on its own, so a client wanting all the QA for a dataset would
+have to list its annotations/ directory and fetch every object. AnnotationsMessager can also
+keep two objects in that directory:
+
+    rollup.nt       the published graphs of every annotation, merged, as N-Triples
+    summary.json    the latest result for each metric, and the results of each run
+
+Both are changed with S3UpdateActions, which read the object, splice in the new run and write
+it back with a conditional put, retrying if another writer changed it in between. Neither
+update parses the earlier runs. The rollup is kept as one section of N-Triples per run, which
+merge by concatenation because each run's blank nodes are replaced with IRIs of its own. The
+summary is a small JSON document. So the work for an annotation depends on its size, plus
+copying the bytes of the two objects.
+
+A run's section and results are replaced when it's re-sent, or when another run arrives from
+the same catalogue path, and removed when the annotation is deleted. Of a body large enough
+to be streamed (see streaming.py), only the triples which identify the run and give its results
+are added, as the whole of it is too large to copy into the rollup on every update.
+"""
+
+import functools
+import hashlib
+import json
+import re
+from urllib.parse import quote, unquote
+
+from rdflib import RDF, BNode, Dataset, Graph, Namespace, URIRef
+from rdflib.compare import to_canonical_graph
+from rdflib.namespace import PROV
+from rdflib.term import Literal, Node
+
+from annotations_ingester.jsonld_context import compact_iri
+from annotations_ingester.uploads import S3UpdateAction
+
+ROLLUP_NAME = "rollup.nt"
+SUMMARY_NAME = "summary.json"
+SUMMARY_VERSION = 1
+ROLLUP_CACHE_CONTROL = "max-age=60"
+
+# Blank nodes in the rollup become IRIs under this, followed by the run's UUID.
+SKOLEM_BASE = "https://eodatahub.org.uk/.well-known/genid/"
+
+DQV = Namespace("http://www.w3.org/ns/dqv#")
+SDMX_ATTRIBUTE = Namespace("http://purl.org/linked-data/sdmx/2009/attribute#")
+
+_RESULT_PREDICATES = frozenset(
+    (PROV.generatedAtTime, DQV.isMeasurementOf, DQV.value, SDMX_ATTRIBUTE.unitMeasure)
+)
+
+# Each section of the rollup starts with a comment: # run <uuid> <quoted source> <digest>
+_SECTION_RE = re.compile(rb"^# run (\S+) (\S+) \S+\n", re.MULTILINE)
+
+
+def skolemised_ntriples(graph: Graph, uuid: str) -> bytes:
+    """
+    The N-Triples of graph, sorted, with each blank node replaced by an IRI which is specific
+    to the run and the same each time the annotation is parsed.
+    """
+    base = f"{SKOLEM_BASE}{uuid}/"
+
+    def skolemise(node: Node) -> Node:
+        return URIRef(base + str(node)) if isinstance(node, BNode) else node
+
+    skolemised = Graph()
+    for triple in to_canonical_graph(graph):
+        skolemised.add(tuple(skolemise(node) for node in triple))
+
+    lines = skolemised.serialize(format="nt", encoding="utf-8").splitlines()
+    return b"".join(sorted(line + b"\n" for line in lines if line.strip()))
+
+
+def is_result_triple(triple: tuple[Node, Node, Node]) -> bool:
+    """True for the triples run_results looks at."""
+    _, p, o = triple
+    return p in _RESULT_PREDICATES or (p == RDF.type and o == DQV.QualityMeasurement)
+
+
+def run_results(dataset: Dataset) -> dict:
+    """
+    When an annotation was generated and the result of each metric it measures, from every
+    graph of the annotation.
+    """
+
+    def value(subject: Node, predicate: URIRef) -> Node | None:
+        return next((o for _, _, o, _ in dataset.quads((subject, predicate, None, None))), None)
+
+    generated = value(None, PROV.generatedAtTime)
+
+    measurements = {
+        s for s, _, _, _ in dataset.quads((None, RDF.type, DQV.QualityMeasurement, None))
+    }
+    results = {}
+    for measurement in sorted(measurements):
+        metric, result = value(measurement, DQV.isMeasurementOf), value(measurement, DQV.value)
+        if metric is None or result is None:
+            continue
+
+        results[compact_iri(str(metric))] = {"value": json_value(result)}
+        if unit := value(measurement, SDMX_ATTRIBUTE.unitMeasure):
+            results[compact_iri(str(metric))]["unit"] = json_value(unit)
+
+    return {
+        "generatedAtTime": str(generated) if generated is not None else None,
+        "results": results,
+    }
+
+
+def json_value(node: Node):
+    """A plain JSON value for an RDF term: numbers and booleans as such, otherwise a string."""
+    if isinstance(node, Literal):
+        value = node.toPython()
+        if isinstance(value, (bool, int, float)):
+            return value
+        return str(node)
+
+    return compact_iri(str(node))
+
+
+def splice_run(rollup: bytes | None, *, uuid: str, source: str, ntriples: bytes | None) -> bytes:
+    """
+    Returns the rollup with the section for the run replaced by ntriples, or removed if that's
+    None. A section from the same source for another run is removed too. Sections aren't
+    parsed, only found by their first lines.
+    """
+    rollup = rollup or b""
+    section = None
+    if ntriples is not None:
+        digest = hashlib.sha256(ntriples).hexdigest()[:16]
+        section = f"# run {uuid} {quote(source, safe='')} {digest}\n".encode("utf-8") + ntriples
+
+    starts = list(_SECTION_RE.finditer(rollup))
+    parts = [rollup[: starts[0].start()] if starts else rollup]
+
+    for n, start in enumerate(starts):
+        end = starts[n + 1].start() if n + 1 < len(starts) else len(rollup)
+        run_uuid, run_source = start.group(1).decode(), unquote(start.group(2).decode())
+
+        if run_uuid != uuid and run_source != source:
+            parts.append(rollup[start.start() : end])
+        elif section is not None:
+            # The new section takes the place of the first it replaces, so re-sending a run
+            # leaves the rollup unchanged.
+            parts.append(section)
+            section = None
+
+    if section is not None:
+        parts.append(section)
+
+    return b"".join(parts)
+
+
+def update_summary(summary: bytes | None, *, uuid: str, source: str, results: dict | None) -> bytes:
+    """
+    Returns the summary with the run's results replaced, or removed if they're None, and the
+    latest result for each metric worked out again from the runs' results.
+    """
+    runs = json.loads(summary)["runs"] if summary else {}
+    runs = {u: r for u, r in runs.items() if u != uuid and r["source"] != source}
+    if results is not None:
+        runs[uuid] = {"source": source, **results}
+
+    latest = {}
+    by_time = sorted(runs.items(), key=lambda run: (run[1]["generatedAtTime"] or "", run[0]))
+    for run_uuid, run in by_time:
+        for metric, result in run["results"].items():
+            latest[metric] = {**result, "run": run_uuid, "generatedAtTime": run["generatedAtTime"]}
+
+    document = {
+        "version": SUMMARY_VERSION,
+        "latest": dict(sorted(latest.items())),
+        "runs": dict(sorted(runs.items())),
+    }
+    return json.dumps(document, indent=1).encode("utf-8")
+
+
+def rollup_actions(
+    annotations_directory: str,
+    uuid: str,
+    source: str,
+    ntriples: bytes | None,
+    results: dict | None,
+    bucket: str | None = None,
+) -> list[S3UpdateAction]:
+    """
+    The updates adding a run to the rollup and summary in annotations_directory, or removing
+    it if ntriples and results are None. `source` is the catalogue path of the annotation.
+    """
+    return [
+        S3UpdateAction(
+            key=annotations_directory + ROLLUP_NAME,
+            update=functools.partial(splice_run, uuid=uuid, source=source, ntriples=ntriples),
+            bucket=bucket,
+            mime_type="application/n-triples",
+            cache_control=ROLLUP_CACHE_CONTROL,
+        ),
+        S3UpdateAction(
+            key=annotations_directory + SUMMARY_NAME,
+            update=functools.partial(update_summary, uuid=uuid, source=source, results=results),
+            bucket=bucket,
+            mime_type="application/json",
+            cache_control=ROLLUP_CACHE_CONTROL,
+        ),
+    ]
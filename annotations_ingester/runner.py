@@ -0,0 +1,625 @@
+"""
+A Pulsar consumer loop which processes several messages at once.
+
+eodhp_utils.runner.run handles one message at a time, so a process pool doesn't help it. This
+runner keeps up to `max_in_flight` messages in process on a thread pool. Messages are then
+settled in the order they were received: the uploads of each group of completed messages are
+made concurrently (with later writes to a key superseding earlier ones) and each message is
+acknowledged once all of its own uploads have succeeded.
+
+Messages can also be collected into per-topic micro-batches of up to `batch_size` messages, or
+whatever arrives within `batch_wait` seconds of the first. Each batch is processed by one task,
+its uploads are made together and then each of its messages is acknowledged or, if it failed,
+negatively acknowledged individually. BatchMetrics reports how batching trades latency for
+throughput.
+
+With a coalescing window, messages are first held by a Coalescer so that entries updated several
+times in quick succession are only processed once.
+
+Given the AdaptiveConcurrency its S3 requests are made through (see throttling.py), the runner
+stops receiving messages while S3 is throttling badly enough to exhaust the retry budget, so
+that messages wait in Pulsar rather than failing here.
+
+Each topic has a consumer of its own, received from on its own thread into a bounded queue, and
+a worker pool of its own of up to `topic_max_in_flight` batches. A TopicScheduler shares the
+`max_in_flight` batches between the topics by weighted fair queuing, so one process can follow
+several catalogue topics without a harvest storm on one of them starving the rest. BatchMetrics
+also reports each topic's lag (from publishing a message to settling it) and throughput.
+
+It's used instead of eodhp_utils' runner when any of the pipeline options are given to `cli`.
+"""
+
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Sequence
+
+import pulsar
+from botocore.exceptions import BotoCoreError, ClientError
+from eodhp_utils.messagers import Messager
+
+from annotations_ingester import metrics
+from annotations_ingester.coalescing import Coalescer, unwrap
+from annotations_ingester.throttling import AdaptiveConcurrency
+from annotations_ingester.uploads import TemporaryFailure, UploadExecutor
+
+DEFAULT_PULSAR_URL = "pulsar://pulsar-proxy.pulsar:6650"
+RECEIVE_TIMEOUT_MS = 100
+METRICS_LOG_INTERVAL = 60
+
+_PARTITION_SUFFIX_RE = re.compile(r"-partition-\d+$")
+
+
+def topic_short_name(topic_name: str) -> str:
+    """Turns 'persistent://public/default/transformed-partition-3' into 'transformed'."""
+    return _PARTITION_SUFFIX_RE.sub("", topic_name.rsplit("/", 1)[-1])
+
+
+def publish_lag(msg, now: float) -> float | None:
+    """Seconds from the message being published until `now`, a time.time(), if it's known."""
+    try:
+        published = msg.publish_timestamp()
+    except AttributeError:
+        return None
+
+    return max(0.0, now - published / 1000) if published else None
+
+
+@dataclass
+class Batch:
+    topic: str
+    opened_at: float
+    # (message, time received)
+    messages: list[tuple[object, float]] = field(default_factory=list)
+
+
+class BatchCollector:
+    """
+    Groups messages into per-topic batches. A batch is ready when it has max_size messages or
+    max_wait seconds after its first message arrived, whichever comes first.
+    """
+
+    def __init__(self, max_size: int = 1, max_wait: float = 0.0):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._open: dict[str, Batch] = {}
+        self._ready: deque[Batch] = deque()
+
+    def add(self, msg, now: float):
+        topic = topic_short_name(msg.topic_name())
+
+        batch = self._open.get(topic)
+        if batch is None:
+            batch = self._open[topic] = Batch(topic=topic, opened_at=now)
+
+        batch.messages.append((msg, now))
+
+        if len(batch.messages) >= self.max_size:
+            self._ready.append(self._open.pop(topic))
+
+    def seconds_until_due(self, now: float) -> float | None:
+        """Time until the next batch becomes ready, if any are open."""
+        if self._ready:
+            return 0.0
+        if not self._open:
+            return None
+
+        return max(0.0, min(b.opened_at for b in self._open.values()) + self.max_wait - now)
+
+    def pop_ready(self, now: float) -> Batch | None:
+        for topic, batch in list(self._open.items()):
+            if now - batch.opened_at >= self.max_wait:
+                self._ready.append(self._open.pop(topic))
+
+        return self._ready.popleft() if self._ready else None
+
+    def flush(self) -> list[Batch]:
+        batches = list(self._ready) + list(self._open.values())
+        self._ready.clear()
+        self._open.clear()
+
+        return batches
+
+
+class BatchMetrics:
+    """
+    Counts batch sizes, the latency batching adds and the resulting throughput, and for each
+    topic the messages received and settled and their lag.
+    """
+
+    def __init__(self, log_interval: float = METRICS_LOG_INTERVAL):
+        self.log_interval = log_interval
+        self.batch_sizes: Counter[int] = Counter()
+        self.messages = 0
+        self.added_latency_total = 0.0
+        self.added_latency_max = 0.0
+        self.received: Counter[str] = Counter()
+        self.settled: Counter[str] = Counter()
+        self.lag_total: defaultdict[str, float] = defaultdict(float)
+        self.lag_max: defaultdict[str, float] = defaultdict(float)
+        self.lag_count: Counter[str] = Counter()
+        self.started_at = time.monotonic()
+        self._last_logged = self.started_at
+
+    def record_received(self, topic: str):
+        self.received[topic] += 1
+        if metrics.is_enabled():
+            metrics.TOPIC_MESSAGES.inc(topic, "received")
+
+    def record_settled(self, topic: str, msg, now: float):
+        """Records a message acknowledged or negatively acknowledged at `now`, a time.time()."""
+        self.settled[topic] += 1
+        lag = publish_lag(msg, now)
+        if lag is not None:
+            self.lag_total[topic] += lag
+            self.lag_max[topic] = max(self.lag_max[topic], lag)
+            self.lag_count[topic] += 1
+
+        if metrics.is_enabled():
+            metrics.TOPIC_MESSAGES.inc(topic, "settled")
+            if lag is not None:
+                metrics.TOPIC_LAG_SECONDS.observe(lag, topic)
+
+    def record_dispatch(self, batch: Batch, now: float):
+        self.batch_sizes[len(batch.messages)] += 1
+        self.messages += len(batch.messages)
+
+        for _, received_at in batch.messages:
+            waited = now - received_at
+            self.added_latency_total += waited
+            self.added_latency_max = max(self.added_latency_max, waited)
+
+    def snapshot(self, now: float = None) -> dict:
+        now = time.monotonic() if now is None else now
+        batches = sum(self.batch_sizes.values())
+
+        return {
+            "batches": batches,
+            "messages": self.messages,
+            "mean_batch_size": self.messages / batches if batches else 0.0,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "mean_added_latency": (
+                self.added_latency_total / self.messages if self.messages else 0.0
+            ),
+            "max_added_latency": self.added_latency_max,
+            "throughput": self.messages / (now - self.started_at) if now > self.started_at else 0.0,
+            "topics": {
+                topic: self.topic_snapshot(topic, now - self.started_at)
+                for topic in sorted(self.received.keys() | self.settled.keys())
+            },
+        }
+
+    def topic_snapshot(self, topic: str, elapsed: float) -> dict:
+        lags = self.lag_count[topic]
+
+        return {
+            "received": self.received[topic],
+            "settled": self.settled[topic],
+            "in_process": self.received[topic] - self.settled[topic],
+            "throughput": self.settled[topic] / elapsed if elapsed > 0 else 0.0,
+            "mean_lag": self.lag_total[topic] / lags if lags else None,
+            "max_lag": self.lag_max[topic] if lags else None,
+        }
+
+    def maybe_log(self, now: float) -> bool:
+        if now - self._last_logged < self.log_interval:
+            return False
+
+        self._last_logged = now
+        logging.info(f"Batching: {self.snapshot(now)}")
+        return True
+
+
+class OrderedPipeline:
+    """
+    Runs `process` on items concurrently and returns the results in submission order. At most
+    `max_in_flight` items are submitted but not yet returned. `on_done` is called from the
+    worker thread as each item completes.
+    """
+
+    def __init__(self, process: Callable, max_in_flight: int, on_done: Callable[[], None] = None):
+        self.max_in_flight = max_in_flight
+        self._process = process
+        self._on_done = on_done
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._in_flight: deque[tuple[object, Future]] = deque()
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def full(self) -> bool:
+        return len(self._in_flight) >= self.max_in_flight
+
+    def submit(self, item):
+        future = self._executor.submit(self._process, item)
+        if self._on_done is not None:
+            future.add_done_callback(lambda _: self._on_done())
+
+        self._in_flight.append((item, future))
+
+    def pop_completed(self, block: bool = False) -> list[tuple[object, Future]]:
+        """
+        Returns the completed items at the head of the queue, with their futures. If block is
+        set and there's anything in flight, waits for at least one.
+        """
+        if block and self._in_flight:
+            self._in_flight[0][1].exception()
+
+        completed = []
+        while self._in_flight and self._in_flight[0][1].done():
+            completed.append(self._in_flight.popleft())
+
+        return completed
+
+    def drain(self) -> list[tuple[object, Future]]:
+        completed = []
+        while self._in_flight:
+            completed.extend(self.pop_completed(block=True))
+
+        return completed
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+class TopicScheduler:
+    """
+    Runs each topic's batches on an OrderedPipeline of its own, of up to `topic_max_in_flight`
+    batches, with at most `max_in_flight` batches in process in all.
+
+    Batches wait here until there's room, and are then dispatched by weighted fair queuing. As
+    a batch arrives it's tagged with a virtual start, the later of the virtual time and the
+    finish of its topic's previous batch, and a finish len(batch) / weight after that. The
+    waiting batch with the earliest finish goes next, and the virtual time moves on to its
+    start. So while several topics have batches waiting each gets a share of the workers in
+    proportion to its weight, and a topic on its own can use them all.
+    """
+
+    def __init__(
+        self,
+        process: Callable,
+        weights: dict[str, float],
+        topic_max_in_flight: int,
+        max_in_flight: int,
+        on_done: Callable[[], None] = None,
+    ):
+        self.weights = weights
+        self.topic_max_in_flight = topic_max_in_flight
+        self.max_in_flight = max_in_flight
+        self._pipelines = {
+            topic: OrderedPipeline(process, topic_max_in_flight, on_done) for topic in weights
+        }
+        # (virtual start, virtual finish, batch)
+        self._waiting: dict[str, deque[tuple[float, float, Batch]]] = {
+            topic: deque() for topic in weights
+        }
+        self._finish = dict.fromkeys(weights, 0.0)
+        self._virtual_time = 0.0
+
+    def __len__(self):
+        return sum(len(pipeline) for pipeline in self._pipelines.values())
+
+    def has_room(self, topic: str) -> bool:
+        """True unless a pool's worth of the topic's batches are already waiting."""
+        return len(self._waiting[topic]) < self.topic_max_in_flight
+
+    def add(self, batch: Batch):
+        start = max(self._virtual_time, self._finish[batch.topic])
+        self._finish[batch.topic] = start + len(batch.messages) / self.weights[batch.topic]
+        self._waiting[batch.topic].append((start, self._finish[batch.topic], batch))
+
+    def dispatch_next(self, ignore_limits: bool = False) -> Batch | None:
+        """
+        Submits the next batch to its topic's pipeline, if there's one with room or
+        ignore_limits is set.
+        """
+        if len(self) >= self.max_in_flight and not ignore_limits:
+            return None
+
+        heads = [
+            (waiting[0][1], topic)
+            for topic, waiting in self._waiting.items()
+            if waiting and (ignore_limits or not self._pipelines[topic].full())
+        ]
+        if not heads:
+            return None
+
+        _, topic = min(heads)
+        start, _, batch = self._waiting[topic].popleft()
+        self._virtual_time = max(self._virtual_time, start)
+        self._pipelines[topic].submit(batch)
+
+        return batch
+
+    def pop_completed(self) -> list[tuple[Batch, Future]]:
+        """The completed batches at the head of each topic's pipeline, in each topic's order."""
+        return [item for pipeline in self._pipelines.values() for item in pipeline.pop_completed()]
+
+    def drain(self) -> list[tuple[Batch, Future]]:
+        return [item for pipeline in self._pipelines.values() for item in pipeline.drain()]
+
+    def shutdown(self):
+        for pipeline in self._pipelines.values():
+            pipeline.shutdown()
+
+
+class TopicReceiver:
+    """
+    Receives a topic's messages on a thread of its own into a queue of up to `max_queued`. When
+    the queue is full the thread stops receiving, so that the topic backs up in Pulsar without
+    holding up the other topics. `wake` is set as each message is queued.
+    """
+
+    def __init__(self, consumer, topic: str, max_queued: int, wake: threading.Event):
+        self.consumer = consumer
+        self.topic = topic
+        self._queue: queue.Queue = queue.Queue(max_queued)
+        self._wake = wake
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"receive-{topic}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                msg = self.consumer.receive(timeout_millis=RECEIVE_TIMEOUT_MS)
+            except pulsar.Timeout:
+                # A short pause in case the consumer didn't wait for the timeout.
+                self._stopping.wait(0.001)
+                continue
+            except Exception:
+                logging.exception(f"Failed to receive from {self.topic}")
+                self._stopping.wait(RECEIVE_TIMEOUT_MS / 1000)
+                continue
+
+            while True:
+                try:
+                    self._queue.put(msg, timeout=RECEIVE_TIMEOUT_MS / 1000)
+                    self._wake.set()
+                    break
+                except queue.Full:
+                    if self._stopping.is_set():
+                        # Not taken before stopping, so handed back to be redelivered.
+                        self.consumer.negative_acknowledge(msg)
+                        break
+
+    def poll(self):
+        """A received message, or None if there aren't any waiting."""
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            return None
+
+    def stop(self) -> list:
+        """Stops receiving and returns the messages received but not yet taken."""
+        self._stopping.set()
+        self._thread.join()
+
+        remaining = []
+        while (msg := self.poll()) is not None:
+            remaining.append(msg)
+
+        return remaining
+
+
+def process_message(messagers: dict[str, Messager], msg) -> Sequence[Messager.Action]:
+    messager = messagers[topic_short_name(msg.topic_name())]
+
+    try:
+        return messager.process_msg(msg)
+    except (BotoCoreError, ClientError) as e:
+        # Most likely a failure to read the entry from S3, which may work next time.
+        raise TemporaryFailure("S3 error while processing message") from e
+
+
+def process_batch(
+    messagers: dict[str, Messager], batch: Batch
+) -> list[tuple[object, Sequence[Messager.Action] | Exception]]:
+    """Processes each message in a batch, returning its actions or the exception it raised."""
+    results = []
+    for msg, _ in batch.messages:
+        try:
+            results.append((msg, process_message(messagers, msg)))
+        except Exception as e:
+            results.append((msg, e))
+
+    return results
+
+
+def settle(
+    consumers: dict[str, object],
+    messagers: dict[str, Messager],
+    completed: list[tuple[Batch, Future]],
+    upload_executor: UploadExecutor,
+    batch_metrics: BatchMetrics = None,
+):
+    """
+    Runs the actions for processed batches, given in the order each topic's were received, and
+    then acknowledges each message that succeeded or failed permanently, on its topic's
+    consumer.
+    """
+    results = [result for _, future in completed for result in future.result()]
+
+    batch, labels = [], []
+    for msg, outcome in results:
+        messager = messagers[topic_short_name(msg.topic_name())]
+        batch.append((messager, [] if isinstance(outcome, Exception) else outcome))
+        labels.append((getattr(messager, "message_type", ""), metrics.topic_label(msg)))
+
+    # The S3 requests are labelled in the metrics as the messages' processing was.
+    trackers = upload_executor.submit_batch(batch, labels)
+
+    for (msg, outcome), tracker in zip(results, trackers, strict=True):
+        failure = outcome if isinstance(outcome, Exception) else tracker.result()
+        topic = topic_short_name(msg.topic_name())
+        acknowledge(consumers[topic], msg, failure)
+
+        if batch_metrics is not None:
+            batch_metrics.record_settled(topic, msg, time.time())
+
+
+def acknowledge(consumer, msg, failure: Exception | None):
+    msg = unwrap(msg)
+
+    if failure is None:
+        consumer.acknowledge(msg)
+    elif isinstance(failure, TemporaryFailure):
+        logging.error(f"Temporary failure processing message {msg.message_id()}: {failure}")
+        consumer.negative_acknowledge(msg)
+    else:
+        # Retrying a malformed message would only fail again.
+        logging.error(
+            f"Permanent failure processing message {msg.message_id()}",
+            exc_info=failure,
+        )
+        consumer.acknowledge(msg)
+
+
+def run_pipelined(
+    messagers: dict[str, Messager],
+    subscription_name: str,
+    pulsar_url: str = None,
+    max_in_flight: int = 4,
+    upload_executor: UploadExecutor = None,
+    batch_size: int = 1,
+    batch_wait: float = 0.0,
+    coalesce_window: float = 0.0,
+    client: pulsar.Client = None,
+    stop_event: threading.Event = None,
+    throttle: AdaptiveConcurrency = None,
+    topic_weights: dict[str, float] = None,
+    topic_max_in_flight: int = None,
+) -> BatchMetrics:
+    """
+    Consumes from each topic in `messagers` until stop_event is set. Messages are grouped into
+    per-topic batches (see BatchCollector) and up to max_in_flight batches are processed
+    concurrently, with up to topic_max_in_flight (by default max_in_flight) from any one topic,
+    shared between the topics in proportion to topic_weights (by default equally). Uploads for
+    batches which complete together are made concurrently by upload_executor. If
+    coalesce_window is set, messages are held for that long first and those superseded by newer
+    ones are acknowledged without being processed. While `throttle` is saturated no more
+    messages are taken.
+    """
+    if upload_executor is None:
+        upload_executor = UploadExecutor()
+
+    if client is None:
+        client = pulsar.Client(pulsar_url or os.environ.get("PULSAR_URL", DEFAULT_PULSAR_URL))
+
+    topic_max_in_flight = topic_max_in_flight or max_in_flight
+    weights = {topic: (topic_weights or {}).get(topic, 1.0) for topic in messagers}
+
+    wake = threading.Event()
+    consumers = {
+        topic: client.subscribe(
+            topic,
+            subscription_name=subscription_name,
+            consumer_type=pulsar.ConsumerType.Shared,
+        )
+        for topic in messagers
+    }
+    receivers = {
+        topic: TopicReceiver(consumer, topic, batch_size * topic_max_in_flight, wake)
+        for topic, consumer in consumers.items()
+    }
+
+    collector = BatchCollector(batch_size, batch_wait)
+    coalescer = None
+    if coalesce_window > 0:
+        coalescer = Coalescer(coalesce_window, lambda msg: topic_short_name(msg.topic_name()))
+    batch_metrics = BatchMetrics()
+    scheduler = TopicScheduler(
+        lambda batch: process_batch(messagers, batch),
+        weights,
+        topic_max_in_flight,
+        max_in_flight,
+        on_done=wake.set,
+    )
+
+    def take(msg, now: float):
+        topic = topic_short_name(msg.topic_name())
+        batch_metrics.record_received(topic)
+
+        if coalescer is None:
+            collector.add(msg, now)
+        else:
+            for superseded in coalescer.add(msg, now):
+                consumers[topic].acknowledge(superseded)
+                batch_metrics.record_settled(topic, superseded, time.time())
+
+    def wait_timeout() -> float:
+        now = time.monotonic()
+        timeout = RECEIVE_TIMEOUT_MS / 1000
+        for stage in (collector, coalescer):
+            if stage is not None and (due := stage.seconds_until_due(now)) is not None:
+                timeout = max(0.001, min(timeout, due))
+
+        return timeout
+
+    for receiver in receivers.values():
+        receiver.start()
+
+    try:
+        while stop_event is None or not stop_event.is_set():
+            wake.clear()
+
+            now = time.monotonic()
+            if throttle is None or not throttle.saturated():
+                for topic, receiver in receivers.items():
+                    while scheduler.has_room(topic) and (msg := receiver.poll()) is not None:
+                        take(msg, now)
+
+            if coalescer is not None:
+                for msg in coalescer.pop_ready(now):
+                    collector.add(msg, now)
+
+            while (batch := collector.pop_ready(now)) is not None:
+                scheduler.add(batch)
+
+            while (batch := scheduler.dispatch_next()) is not None:
+                batch_metrics.record_dispatch(batch, now)
+
+            completed = scheduler.pop_completed()
+            if completed:
+                settle(consumers, messagers, completed, upload_executor, batch_metrics)
+            else:
+                wake.wait(wait_timeout())
+
+            if batch_metrics.maybe_log(now):
+                if coalescer is not None:
+                    logging.info(f"Coalescing: {coalescer.stats()}")
+                if throttle is not None:
+                    logging.info(f"Adaptive concurrency: {throttle.stats()}")
+
+        now = time.monotonic()
+        for receiver in receivers.values():
+            for msg in receiver.stop():
+                take(msg, now)
+
+        if coalescer is not None:
+            for msg in coalescer.flush():
+                collector.add(msg, now)
+
+        for batch in collector.flush():
+            scheduler.add(batch)
+
+        while (batch := scheduler.dispatch_next(ignore_limits=True)) is not None:
+            batch_metrics.record_dispatch(batch, now)
+
+        settle(consumers, messagers, scheduler.drain(), upload_executor, batch_metrics)
+    finally:
+        for receiver in receivers.values():
+            receiver.stop()
+        scheduler.shutdown()
+        upload_executor.shutdown()
+        client.close()
+
+    return batch_metrics
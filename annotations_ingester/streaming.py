@@ -0,0 +1,278 @@
+"""
+Bounded-memory conversion of large TriG documents.
+
+Parsing a body into an rdflib Dataset and serialising it as complete Turtle and JSON-LD strings
+needs many times the size of the body in memory. QA runs with per-item measurements can have
+hundreds of thousands of triples, which is enough to get the ingester OOM-killed.
+
+`stream_default_graph` instead parses into a store which holds nothing: each triple in the
+default graph is written out as Turtle and compacted JSON-LD as soon as it's parsed, and only the triples
+picked out by `keep` are retained. `kept_triples` retains them without writing anything. The
+outputs are written to SpooledTemporaryFiles, which stay
+in memory up to `spool_bytes` each and are moved to disk beyond that.
+
+The output is equivalent to rdflib's but not byte-identical. Consecutive triples about the same
+subject are grouped, rather than all of them, and blank nodes are labelled in the order they
+appear, so the same body always gives the same bytes.
+"""
+
+import io
+import json
+import re
+import tempfile
+from typing import IO, Callable
+
+from rdflib import RDF, XSD, BNode, Dataset, Literal, URIRef
+from rdflib.graph import DATASET_DEFAULT_GRAPH_ID
+from rdflib.store import Store
+from rdflib.term import Node
+
+from annotations_ingester.jsonld_context import DEFAULT_CONTEXT_URL, compact_iri
+
+DEFAULT_SPOOL_BYTES = 8 * 1024 * 1024
+
+# Prefix declarations in TriG. Any of these which the body really declares can be used in the
+# Turtle output. A match inside a literal only adds an unused prefix.
+_PREFIX_RE = re.compile(
+    rb"(?:@prefix|PREFIX)\s+([A-Za-z](?:[\w.-]*[\w-])?)?:\s*<([^<>\"{}|^`\\\x00-\x20]*)>"
+)
+
+# Local names which can follow a prefix in Turtle without escaping. This is narrower than the
+# grammar allows, and other IRIs are written in full.
+_LOCAL_NAME_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_-]*\Z")
+
+# The most values written in one JSON-LD node object, so a subject with a very large number of
+# triples is split over several node objects rather than held in memory.
+_MAX_NODE_VALUES = 1000
+
+Triple = tuple[Node, Node, Node]
+
+
+def scan_prefixes(body: bytes) -> dict[str, str]:
+    """Returns the prefixes declared in a TriG body, leaving out any declared inconsistently."""
+    prefixes = {}
+    conflicting = set()
+
+    for prefix, namespace in _PREFIX_RE.findall(body):
+        prefix, namespace = (prefix or b"").decode("ascii"), namespace.decode("utf-8")
+        if prefixes.setdefault(prefix, namespace) != namespace:
+            conflicting.add(prefix)
+
+    return {p: ns for p, ns in prefixes.items() if p not in conflicting}
+
+
+class _BlankNodeLabels(dict):
+    """Labels blank nodes b0, b1, ... in the order they're first seen."""
+
+    def __missing__(self, bnode: BNode) -> str:
+        label = self[bnode] = f"b{len(self)}"
+        return label
+
+
+class _TurtleWriter:
+    def __init__(self, out: IO[str], prefixes: dict[str, str], bnodes: _BlankNodeLabels):
+        self._out = out
+        self._bnodes = bnodes
+        self._subject = None
+
+        # In reverse order, a namespace comes before any it extends, so the most specific prefix
+        # is used.
+        self._namespaces = sorted(((ns, p) for p, ns in prefixes.items()), reverse=True)
+        for prefix, namespace in sorted(prefixes.items()):
+            out.write(f"@prefix {prefix}: <{namespace}> .\n")
+        out.write("\n")
+
+    def _term(self, node: Node) -> str:
+        if isinstance(node, BNode):
+            return f"_:{self._bnodes[node]}"
+
+        if isinstance(node, URIRef):
+            for namespace, prefix in self._namespaces:
+                if node.startswith(namespace) and _LOCAL_NAME_RE.match(node, len(namespace)):
+                    return f"{prefix}:{node[len(namespace):]}"
+
+        return node.n3()
+
+    def add(self, s: Node, p: Node, o: Node):
+        predicate = "a" if p == RDF.type else self._term(p)
+
+        if s == self._subject:
+            self._out.write(f" ;\n    {predicate} {self._term(o)}")
+        else:
+            if self._subject is not None:
+                self._out.write(" .\n\n")
+
+            self._subject = s
+            self._out.write(f"{self._term(s)} {predicate} {self._term(o)}")
+
+    def close(self):
+        if self._subject is not None:
+            self._out.write(" .\n")
+
+
+class _JSONLDWriter:
+    """Writes JSON-LD compacted against the shared context, as a @graph of node objects."""
+
+    def __init__(self, out: IO[str], bnodes: _BlankNodeLabels, context_url: str):
+        self._out = out
+        self._bnodes = bnodes
+        self._node = None
+        self._values = 0
+        self._written = 0
+
+        out.write(f'{{\n  "@context": {json.dumps(context_url)},\n  "@graph": [')
+
+    def _id(self, node: Node) -> str:
+        return f"_:{self._bnodes[node]}" if isinstance(node, BNode) else str(node)
+
+    def _value(self, node: Node) -> dict | str:
+        if not isinstance(node, Literal):
+            return {"@id": self._id(node)}
+
+        if node.language:
+            return {"@value": str(node), "@language": node.language}
+
+        if node.datatype is not None and node.datatype != XSD.string:
+            return {"@value": str(node), "@type": compact_iri(str(node.datatype))}
+
+        return str(node)
+
+    def _flush(self):
+        if self._node is not None:
+            self._out.write(",\n    " if self._written else "\n    ")
+            self._out.write(json.dumps(self._node, ensure_ascii=False))
+            self._written += 1
+
+        self._node = None
+        self._values = 0
+
+    def add(self, s: Node, p: Node, o: Node):
+        subject_id = self._id(s)
+        if (
+            self._node is None
+            or self._node["@id"] != subject_id
+            or self._values >= _MAX_NODE_VALUES
+        ):
+            self._flush()
+            self._node = {"@id": subject_id}
+
+        if p == RDF.type and isinstance(o, URIRef):
+            self._node.setdefault("@type", []).append(compact_iri(str(o)))
+        else:
+            self._node.setdefault(compact_iri(str(p)), []).append(self._value(o))
+
+        self._values += 1
+
+    def close(self):
+        self._flush()
+        self._out.write("\n  ]\n}\n" if self._written else "]\n}\n")
+
+
+class _StreamingStore(Store):
+    """
+    A write-only store for rdflib's TriG parser. Each triple in the default graph is passed to
+    `on_default_triple` and each triple for which `keep` is true, in any graph, is kept in
+    `kept`. Nothing else is stored.
+    """
+
+    context_aware = True
+    graph_aware = True
+
+    def __init__(
+        self, on_default_triple: Callable[[Node, Node, Node], None], keep: Callable[[Triple], bool]
+    ):
+        super().__init__()
+        self.on_default_triple = on_default_triple
+        self.keep = keep
+        self.kept = Dataset()
+        self.default_triples = 0
+        self._namespaces: dict[str, URIRef] = {}
+
+    def add(self, triple: Triple, context, quoted: bool = False):
+        if self.keep(triple):
+            self.kept.add((*triple, context.identifier))
+
+        if context.identifier == DATASET_DEFAULT_GRAPH_ID:
+            self.default_triples += 1
+            self.on_default_triple(*triple)
+
+    def add_graph(self, graph):
+        pass
+
+    def bind(self, prefix: str, namespace: URIRef, override: bool = True):
+        if override or prefix not in self._namespaces:
+            self._namespaces[prefix] = namespace
+
+    def namespace(self, prefix: str) -> URIRef | None:
+        return self._namespaces.get(prefix)
+
+    def prefix(self, namespace: URIRef) -> str | None:
+        return next((p for p, ns in self._namespaces.items() if ns == namespace), None)
+
+    def namespaces(self):
+        return iter(self._namespaces.items())
+
+
+def stream_default_graph(
+    body: str | bytes,
+    keep: Callable[[Triple], bool],
+    spool_bytes: int = DEFAULT_SPOOL_BYTES,
+    jsonld_context_url: str = DEFAULT_CONTEXT_URL,
+) -> tuple[Dataset, int, IO[bytes], IO[bytes]]:
+    """
+    Parses a TriG body, writing its default graph as Turtle and as JSON-LD compacted against the
+    shared context (see jsonld_context.py). Returns a Dataset of the triples, from any graph, for
+    which `keep` is true, the number of triples in the default graph and the Turtle and JSON-LD
+    files, positioned at their start.
+    """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+
+    bnodes = _BlankNodeLabels()
+    outputs = []
+    writers = []
+    for make_writer in (
+        lambda out: _TurtleWriter(out, scan_prefixes(body), bnodes),
+        lambda out: _JSONLDWriter(out, bnodes, jsonld_context_url),
+    ):
+        spool = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+        out = io.TextIOWrapper(spool, encoding="utf-8", newline="")
+        outputs.append(out)
+        writers.append(make_writer(out))
+
+    def write(s: Node, p: Node, o: Node):
+        for writer in writers:
+            writer.add(s, p, o)
+
+    store = _StreamingStore(write, keep)
+    try:
+        Dataset(store=store).parse(data=body, format="trig")
+    except BaseException:
+        for out in outputs:
+            out.close()
+        raise
+
+    files = []
+    for writer, out in zip(writers, outputs, strict=True):
+        writer.close()
+        out.flush()
+        spool = out.detach()
+        spool.seek(0)
+        files.append(spool)
+
+    turtle, jsonld = files
+    return store.kept, store.default_triples, turtle, jsonld
+
+
+def kept_triples(body: str | bytes, keep: Callable[[Triple], bool]) -> Dataset:
+    """
+    Parses a TriG body, returning a Dataset of the triples, from any graph, for which `keep` is
+    true, as stream_default_graph does, but writing nothing.
+    """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+
+    store = _StreamingStore(lambda s, p, o: None, keep)
+    Dataset(store=store).parse(data=body, format="trig")
+
+    return store.kept
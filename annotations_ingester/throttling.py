@@ -0,0 +1,291 @@
+"""
+Adaptive concurrency for S3 requests, for when S3 throttles us.
+
+Every output is written under the catalogue/ prefix, so when a bulk harvest keeps both
+messagers busy S3 starts answering with SlowDown (503). Retrying blindly, as botocore does,
+only adds to the load. ThrottledS3Client instead passes each request through an
+AdaptiveConcurrency shared by the whole process:
+
+- An AIMDLimiter caps the requests in flight. Each success raises the cap by about one per
+  round of requests, and a throttled response halves it, once for the requests which were
+  already in flight when it happened.
+- Throttled and other transient failures are retried after a jittered exponential backoff,
+  but only while the RetryBudget allows. Each first attempt adds a fraction of a retry to the
+  budget, and it also refills slowly with time, so retries can't multiply the load.
+- While the budget is exhausted, retries wait for it rather than failing the message, and
+  `saturated()` tells run_pipelined to stop taking new messages from Pulsar until it recovers.
+
+botocore's own retries should be turned off for a client wrapped like this (see
+s3_client_config), so that throttling is seen here.
+"""
+
+import logging
+import random
+import threading
+import time
+from typing import Callable
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+from annotations_ingester import metrics
+
+THROTTLING_ERROR_CODES = (
+    "SlowDown",
+    "ServiceUnavailable",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "503",
+)
+
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_BASE_BACKOFF = 0.05
+DEFAULT_MAX_BACKOFF = 5.0
+
+
+def is_throttling(error: Exception) -> bool:
+    if not isinstance(error, ClientError):
+        return False
+
+    return (
+        error.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+        or error.response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 503
+    )
+
+
+def is_retryable(error: Exception) -> bool:
+    """True for throttling, server errors and dropped connections."""
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return True
+    if not isinstance(error, ClientError):
+        return False
+
+    return (
+        is_throttling(error)
+        or error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+    )
+
+
+class AIMDLimiter:
+    """
+    A limit on concurrent requests, increased additively on success and decreased
+    multiplicatively on throttling.
+    """
+
+    def __init__(
+        self,
+        max_limit: int,
+        min_limit: int = 1,
+        initial: float = None,
+        decrease: float = 0.5,
+    ):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.decrease = decrease
+        self.limit = float(initial or max_limit)
+        self.in_flight = 0
+
+        # Incremented on each decrease. A throttled request which started before the latest
+        # decrease doesn't cause another, as the cap it saw is already gone.
+        self._epoch = 0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> int:
+        """Waits for a slot and returns the token to release it with."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+            return self._epoch
+
+    def release(self, token: int, throttled: bool = False):
+        with self._condition:
+            self.in_flight -= 1
+
+            if not throttled:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            elif token == self._epoch:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self._epoch += 1
+
+            self._condition.notify_all()
+
+
+class RetryBudget:
+    """
+    Allows retries in proportion to first attempts, `ratio` of a retry each, plus
+    `min_per_second` regardless, up to `max_tokens` saved.
+    """
+
+    def __init__(
+        self,
+        ratio: float = 0.2,
+        min_per_second: float = 10.0,
+        max_tokens: float = 20.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._clock = clock
+        self._tokens = max_tokens
+        self._refilled_at = clock()
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(
+            self.max_tokens, self._tokens + (now - self._refilled_at) * self.min_per_second
+        )
+        self._refilled_at = now
+
+    def deposit(self):
+        with self._condition:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+            self._condition.notify_all()
+
+    def try_withdraw(self) -> bool:
+        with self._condition:
+            self._refill()
+            if self._tokens < 1:
+                return False
+
+            self._tokens -= 1
+            return True
+
+    def withdraw(self, timeout: float = None) -> bool:
+        """Waits until a retry is allowed, or `timeout` passes, and takes it."""
+        deadline = None if timeout is None else self._clock() + timeout
+
+        while not self.try_withdraw():
+            with self._condition:
+                self._refill()
+                wait = (1 - self._tokens) / self.min_per_second if self.min_per_second else 1.0
+                if deadline is not None:
+                    wait = min(wait, deadline - self._clock())
+                    if wait <= 0:
+                        return False
+
+                self._condition.wait(max(wait, 0.001))
+
+        return True
+
+    def exhausted(self) -> bool:
+        with self._condition:
+            self._refill()
+            return self._tokens < 1
+
+
+class AdaptiveConcurrency:
+    """The limiter and retry budget shared by the S3 requests of a process."""
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        base_backoff: float = DEFAULT_BASE_BACKOFF,
+        max_backoff: float = DEFAULT_MAX_BACKOFF,
+        budget: RetryBudget = None,
+    ):
+        self.limiter = AIMDLimiter(max_concurrency)
+        self.budget = budget or RetryBudget()
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        self.throttled = 0
+        self.retries = 0
+        self.budget_waits = 0
+        self._lock = threading.Lock()
+
+    def call(self, operation: str, fn: Callable, *args, rewind: Callable = None, **kwargs):
+        """
+        Calls fn, retrying retryable failures. `rewind` is called before each retry, to return
+        a body being uploaded to its start.
+        """
+        self.budget.deposit()
+
+        for attempt in range(self.max_attempts):
+            token = self.limiter.acquire()
+            throttled = False
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                throttled = is_throttling(e)
+                if not is_retryable(e) or attempt + 1 == self.max_attempts:
+                    raise
+
+                self._count_retry(operation, throttled)
+                logging.debug(f"Retrying {operation} after {e}")
+            finally:
+                self.limiter.release(token, throttled)
+
+            time.sleep(random.uniform(0, min(self.max_backoff, self.base_backoff * 2**attempt)))
+
+            if not self.budget.try_withdraw():
+                with self._lock:
+                    self.budget_waits += 1
+                self.budget.withdraw()
+
+            if rewind is not None:
+                rewind()
+
+    def _count_retry(self, operation: str, throttled: bool):
+        with self._lock:
+            self.retries += 1
+            self.throttled += throttled
+
+        metrics.S3_RETRIES.inc(
+            operation, "throttled" if throttled else "error", *metrics.current_labels()
+        )
+
+    def saturated(self) -> bool:
+        """True while retries are waiting for the budget, so no more work should be taken on."""
+        return self.budget.exhausted()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "limit": round(self.limiter.limit, 2),
+                "in_flight": self.limiter.in_flight,
+                "throttled": self.throttled,
+                "retries": self.retries,
+                "budget_waits": self.budget_waits,
+            }
+
+
+class ThrottledS3Client:
+    """Wraps a boto3 S3 client so that its requests are made through an AdaptiveConcurrency."""
+
+    def __init__(self, s3_client, concurrency: AdaptiveConcurrency):
+        self._s3_client = s3_client
+        self.concurrency = concurrency
+
+    def upload_fileobj(self, Fileobj, Bucket: str, Key: str, **kwargs):
+        return self.concurrency.call(
+            "upload_fileobj",
+            self._s3_client.upload_fileobj,
+            Fileobj,
+            Bucket,
+            Key,
+            rewind=lambda: Fileobj.seek(0),
+            **kwargs,
+        )
+
+    def put_object(self, **kwargs):
+        body = kwargs.get("Body")
+        rewind = (lambda: body.seek(0)) if hasattr(body, "seek") else None
+
+        return self.concurrency.call(
+            "put_object", self._s3_client.put_object, rewind=rewind, **kwargs
+        )
+
+    def __getattr__(self, name):
+        attr = getattr(self._s3_client, name)
+        if not callable(attr) or name == "get_paginator":
+            return attr
+
+        def throttled(*args, **kwargs):
+            return self.concurrency.call(name, attr, *args, **kwargs)
+
+        return throttled
@@ -0,0 +1,616 @@
+"""
+Concurrent execution of the actions returned by the messagers.
+
+Each message produces a .ttl and a .jsonld upload. Messager runs them one after the other, so
+each message waits for two S3 round-trips. UploadExecutor runs the uploads for one message, or
+for a batch of messages, concurrently, and reports the outcome for each message. A message
+should only be acknowledged once all of its uploads have succeeded.
+
+An upload's body may be a file rather than a string, as for large annotations (see
+streaming.py). Those are sent with upload_fileobj, which uses a multipart upload once the file
+is larger than a part, so the body is never read into memory whole. The executor closes each
+file once it's been uploaded, or skipped.
+
+Given an OutputEncoder, the executor also stores compressed variants of each upload (see
+encodings.py). Those are made on the upload threads too. Given a ContentAddressedLayout, it
+stores each upload under a content-addressed key with an alias at the original key (see
+content_addressing.py).
+
+Outputs are removed with S3DeleteActions, which the executor also carries out in the order
+the messages were received, so that a delete and an upload of the same output can't race.
+Objects which several messages contribute to are changed with S3UpdateActions, which are
+written with conditional puts so that concurrent writers don't lose each other's changes.
+
+The runner in eodhp_utils only carries out uploads. DirectActionsMixin makes messagers carry
+out their other actions themselves, unless they're deferred to an UploadExecutor.
+"""
+
+import io
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable, Sequence
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from eodhp_utils.messagers import Messager
+
+from annotations_ingester import metrics
+from annotations_ingester.encodings import ENCODING_SUFFIXES, OutputEncoder, variant_key
+
+if TYPE_CHECKING:
+    from annotations_ingester.content_addressing import ContentAddressedLayout
+
+DEFAULT_UPLOAD_CONCURRENCY = 16
+
+# DeleteObjects accepts at most this many keys.
+MAX_DELETE_BATCH = 1000
+
+# Attempts at a conditional put before giving up, and the base of the backoff between them.
+UPDATE_ATTEMPTS = 8
+UPDATE_BACKOFF = 0.05
+
+# Error codes S3 gives when a conditional put loses to another writer.
+CONDITIONAL_WRITE_CONFLICTS = ("PreconditionFailed", "ConditionalRequestConflict")
+
+# Each upload thread sends the parts of a file one at a time, buffering one part.
+FILE_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024, use_threads=False
+)
+
+
+class TemporaryFailure(Exception):
+    """Raised when a message should be redelivered rather than acknowledged."""
+
+
+class PermanentFailure(Exception):
+    """Raised when a message failed and retrying it would fail again."""
+
+
+def s3_client_config(
+    max_concurrency: int = DEFAULT_UPLOAD_CONCURRENCY, max_attempts: int = 3
+) -> Config:
+    """
+    botocore configuration for a client shared by max_concurrency upload threads. botocore's
+    default pool of 10 connections would otherwise make threads queue for a connection. Set
+    max_attempts to 1 when the client's requests are retried by a ThrottledS3Client.
+    """
+    return Config(
+        max_pool_connections=max_concurrency + 4,
+        tcp_keepalive=True,
+        retries={"mode": "standard", "max_attempts": max_attempts},
+    )
+
+
+@dataclass
+class MessageUploads:
+    """Tracks the uploads belonging to one message."""
+
+    futures: list[Future] = field(default_factory=list)
+    failure: Exception | None = None
+
+    def result(self) -> Exception | None:
+        """Waits for the uploads and returns the reason the message failed, if it did."""
+        wait(self.futures)
+
+        if self.failure is not None:
+            return self.failure
+
+        for future in self.futures:
+            if future.exception() is not None:
+                return TemporaryFailure(f"Upload failed: {future.exception()}")
+
+        return None
+
+
+@dataclass(kw_only=True)
+class S3DeleteAction(Messager.Action):
+    """
+    Deletes outputs: each of `keys` along with its compressed variants, and every object whose
+    key starts with one of `prefixes`.
+
+    `resolve_keys`, if given, is called with the client and bucket when the delete is carried
+    out, before anything is deleted, and returns more keys to delete. It's for outputs whose
+    keys have to be read from S3, so that the read is made on the upload threads.
+    """
+
+    keys: list[str] = field(default_factory=list)
+    prefixes: list[str] = field(default_factory=list)
+    bucket: str | None = None
+    resolve_keys: Callable[..., list[str]] | None = None
+
+
+@dataclass(kw_only=True)
+class S3UpdateAction(Messager.Action):
+    """
+    Rewrites an object from its current content. `update` is given the current body, or None
+    if there's no object, and returns the new body. It may be called more than once, if another
+    writer changes the object in between, so it should only depend on its argument.
+    """
+
+    key: str
+    update: Callable[[bytes | None], bytes]
+    bucket: str | None = None
+    mime_type: str = "application/json"
+    cache_control: str = "max-age=0"
+
+
+def is_file_body(body) -> bool:
+    return hasattr(body, "read")
+
+
+def body_size(body) -> int:
+    """The size in bytes of an upload body, which may be a file."""
+    if not is_file_body(body):
+        return len(body.encode("utf-8") if isinstance(body, str) else body)
+
+    position = body.tell()
+    size = body.seek(0, io.SEEK_END)
+    body.seek(position)
+    return size
+
+
+def delete_keys(s3_client, bucket: str, keys: Sequence[str]) -> list[str]:
+    """
+    Deletes keys with as few DeleteObjects requests as possible. Returns the keys which couldn't
+    be deleted.
+    """
+    failed = []
+
+    for start in range(0, len(keys), MAX_DELETE_BATCH):
+        batch = keys[start : start + MAX_DELETE_BATCH]
+        response = s3_client.delete_objects(
+            Bucket=bucket, Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+        )
+
+        for error in response.get("Errors", []):
+            logging.error(f"Couldn't delete {error['Key']} from {bucket}: {error.get('Message')}")
+            failed.append(error["Key"])
+
+    return failed
+
+
+def delete_prefix(s3_client, bucket: str, prefix: str) -> list[str]:
+    """
+    Deletes every object under prefix, a listing page at a time. Returns the keys which couldn't
+    be deleted.
+    """
+    failed = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, MaxKeys=MAX_DELETE_BATCH):
+        keys = [obj["Key"] for obj in page.get("Contents", [])]
+        if keys:
+            failed += delete_keys(s3_client, bucket, keys)
+
+    return failed
+
+
+def with_variants(keys: Sequence[str]) -> list[str]:
+    """
+    keys and the keys of their compressed variants. Every encoding is included, as variants may
+    have been written with a different configuration.
+    """
+    return [k for key in keys for k in (key, *(variant_key(key, e) for e in ENCODING_SUFFIXES))]
+
+
+def run_delete(s3_client, bucket: str, action: S3DeleteAction) -> list[str]:
+    """Carries out an S3DeleteAction, returning the keys which couldn't be deleted."""
+    keys = action.keys
+    if action.resolve_keys is not None:
+        resolved = action.resolve_keys(s3_client, bucket)
+        # An output cache only knows about keys it's been given, so it has to be told.
+        if invalidate := getattr(s3_client, "invalidate", None):
+            for key in resolved:
+                invalidate(bucket, key)
+        keys = keys + resolved
+
+    failed = delete_keys(s3_client, bucket, with_variants(keys)) if keys else []
+
+    for prefix in action.prefixes:
+        logging.info(f"Deleting everything under {prefix} in {bucket}")
+        failed += delete_prefix(s3_client, bucket, prefix)
+
+    return failed
+
+
+def is_missing(error: ClientError) -> bool:
+    return error.response["Error"]["Code"] in ("NoSuchKey", "404")
+
+
+def run_updates(s3_client, bucket: str, actions: Sequence[S3UpdateAction]):
+    """
+    Applies the updates, in order, to the object they all change and writes it once. The put
+    is conditional on the object being as it was read, and if another writer got there first
+    the updates are applied again to what it wrote, after a jittered exponential backoff.
+    Raises TemporaryFailure if that keeps happening.
+    """
+    key = actions[0].key
+
+    for attempt in range(UPDATE_ATTEMPTS):
+        try:
+            response = s3_client.get_object(Bucket=bucket, Key=key)
+            current, condition = response["Body"].read(), {"IfMatch": response["ETag"]}
+        except ClientError as e:
+            if not is_missing(e):
+                raise
+            current, condition = None, {"IfNoneMatch": "*"}
+
+        body = current
+        for action in actions:
+            body = action.update(body)
+
+        if body == current:
+            return
+
+        try:
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=key,
+                Body=body,
+                ContentType=actions[-1].mime_type,
+                CacheControl=actions[-1].cache_control,
+                **condition,
+            )
+            return
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in CONDITIONAL_WRITE_CONFLICTS:
+                raise
+
+        logging.debug(f"Conflicting write to {key}, retrying")
+        time.sleep(random.uniform(0, UPDATE_BACKOFF * 2**attempt))
+
+    raise TemporaryFailure(f"Gave up updating {key} after {UPDATE_ATTEMPTS} conflicting writes")
+
+
+class DirectActionsMixin:
+    """
+    Carries out the S3DeleteActions and S3UpdateActions returned by process_msg and removes
+    them from its actions, unless `defer_actions` is set because they'll be run by an
+    UploadExecutor. An action which fails is replaced by a temporary FailureAction.
+    """
+
+    def __init__(self, *args, defer_actions: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.defer_actions = defer_actions
+
+    def process_msg(self, msg) -> Sequence[Messager.Action]:
+        actions = super().process_msg(msg)
+
+        if self.defer_actions:
+            return actions
+
+        remaining = []
+        for action in actions:
+            if isinstance(action, S3DeleteAction):
+                bucket = action.bucket or self.output_bucket
+                if failed := run_delete(self.s3_client, bucket, action):
+                    logging.error(f"Couldn't delete {len(failed)} objects from {bucket}")
+                    remaining.append(Messager.FailureAction(permanent=False))
+            elif isinstance(action, S3UpdateAction):
+                try:
+                    run_updates(self.s3_client, action.bucket or self.output_bucket, [action])
+                except (BotoCoreError, ClientError, TemporaryFailure):
+                    logging.exception(f"Couldn't update {action.key}")
+                    remaining.append(Messager.FailureAction(permanent=False))
+            else:
+                remaining.append(action)
+
+        return remaining
+
+
+class UploadExecutor:
+    """
+    Runs S3 uploads on a bounded pool of threads, with compressed variants of each if `encoder`
+    is given, and in the content-addressed layout if `layout` is given.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = DEFAULT_UPLOAD_CONCURRENCY,
+        encoder: OutputEncoder | None = None,
+        layout: "ContentAddressedLayout | None" = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.encoder = encoder
+        self.layout = layout
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="upload"
+        )
+        # Updates to the same object from this process are made one at a time, so they only
+        # conflict with other processes'. Objects share a fixed number of locks.
+        self._update_locks = [threading.Lock() for _ in range(64)]
+
+    def submit(self, messager: Messager, actions: Sequence[Messager.Action]) -> MessageUploads:
+        """Starts the uploads for one message and returns a tracker for them."""
+        return self.submit_batch([(messager, actions)])[0]
+
+    def submit_batch(
+        self,
+        batch: Sequence[tuple[Messager, Sequence[Messager.Action]]],
+        labels: Sequence[tuple[str, str]] = None,
+    ) -> list[MessageUploads]:
+        """
+        Starts the uploads for several messages, given in the order they were received. If two
+        messages write or delete the same key only the later one's action is carried out, so the
+        result doesn't depend on which finishes first.
+
+        Deletes of prefixes are made before this returns, and before any later message's
+        uploads are started. Uploads under a prefix which a later message deletes are skipped.
+
+        The updates to each object are applied in order and written together. Every message
+        with an update to the object fails if that write does.
+
+        The S3 requests for each message are labelled in the metrics with its (message type,
+        topic) from `labels`, or by default with those of the calling thread.
+        """
+        if labels is None:
+            labels = [metrics.current_labels()] * len(batch)
+
+        last_writer = {}
+        # (index, bucket, prefix) for each prefix deleted.
+        prefix_deletes = []
+        for index, (messager, actions) in enumerate(batch):
+            for action in actions:
+                if isinstance(action, Messager.S3UploadAction):
+                    last_writer[(action.bucket or messager.output_bucket, action.key)] = index
+                elif isinstance(action, S3DeleteAction):
+                    bucket = action.bucket or messager.output_bucket
+                    for key in action.keys:
+                        last_writer[(bucket, key)] = index
+                    prefix_deletes += [(index, bucket, prefix) for prefix in action.prefixes]
+
+        def is_deleted_later(index: int, bucket: str, key: str) -> bool:
+            return any(
+                later > index and b == bucket and key.startswith(prefix)
+                for later, b, prefix in prefix_deletes
+            )
+
+        def is_superseded(index: int, bucket: str, key: str) -> bool:
+            return last_writer[(bucket, key)] != index or is_deleted_later(index, bucket, key)
+
+        def unsuperseded(index: int, bucket: str, resolve_keys: Callable[..., list[str]]):
+            """Resolves keys for a delete, leaving out those which later messages write."""
+
+            def resolve(s3_client, resolved_bucket: str) -> list[str]:
+                return [
+                    key
+                    for key in resolve_keys(s3_client, resolved_bucket)
+                    if last_writer.get((bucket, key), index) <= index
+                    and not is_deleted_later(index, bucket, key)
+                ]
+
+            return resolve
+
+        # (bucket, key) -> [(index, messager, action)] for the updates to each object.
+        updates = {}
+
+        trackers = []
+        for index, (messager, actions) in enumerate(batch):
+            tracker = MessageUploads()
+
+            for action in actions:
+                if isinstance(action, Messager.S3UploadAction):
+                    bucket = action.bucket or messager.output_bucket
+                    if is_superseded(index, bucket, action.key):
+                        logging.debug(f"Skipping superseded upload to {action.key}")
+                        if is_file_body(action.file_body):
+                            action.file_body.close()
+                        continue
+
+                    tracker.futures.extend(
+                        self._submit_upload(labels[index], messager.s3_client, bucket, action)
+                    )
+                elif isinstance(action, S3DeleteAction):
+                    bucket = action.bucket or messager.output_bucket
+                    delete = S3DeleteAction(
+                        keys=[k for k in action.keys if not is_superseded(index, bucket, k)],
+                        bucket=bucket,
+                    )
+                    if action.resolve_keys is not None:
+                        delete.resolve_keys = unsuperseded(index, bucket, action.resolve_keys)
+                    if delete.keys or delete.resolve_keys is not None:
+                        tracker.futures.append(
+                            self._submit(
+                                labels[index], self._delete, messager.s3_client, bucket, delete
+                            )
+                        )
+
+                    for prefix in action.prefixes:
+                        if failure := metrics.labelled(
+                            labels[index], self._delete_prefix, messager.s3_client, bucket, prefix
+                        ):
+                            tracker.failure = tracker.failure or failure
+                elif isinstance(action, S3UpdateAction):
+                    bucket = action.bucket or messager.output_bucket
+                    if is_deleted_later(index, bucket, action.key):
+                        logging.debug(f"Skipping update to {action.key}, which is deleted later")
+                        continue
+
+                    updates.setdefault((bucket, action.key), []).append((index, messager, action))
+                elif isinstance(action, Messager.FailureAction):
+                    if action.permanent:
+                        tracker.failure = tracker.failure or PermanentFailure(
+                            "Messager reported a permanent failure"
+                        )
+                    else:
+                        tracker.failure = TemporaryFailure("Messager reported a temporary failure")
+                else:
+                    tracker.failure = PermanentFailure(f"Unsupported action {action}")
+
+            trackers.append(tracker)
+
+        for (bucket, key), object_updates in updates.items():
+            future = self._submit(
+                labels[object_updates[0][0]],
+                self._update,
+                object_updates[0][1].s3_client,
+                bucket,
+                key,
+                [action for _, _, action in object_updates],
+            )
+            for index in {index for index, _, _ in object_updates}:
+                trackers[index].futures.append(future)
+
+        return trackers
+
+    def run(self, messager: Messager, actions: Sequence[Messager.Action]):
+        """Runs the actions for one message, raising TemporaryFailure or PermanentFailure."""
+        failure = self.submit(messager, actions).result()
+        if failure is not None:
+            raise failure
+
+    def _submit(self, labels: tuple[str, str], fn, *args) -> Future:
+        return self._executor.submit(metrics.labelled, labels, fn, *args)
+
+    def _submit_upload(
+        self, labels: tuple[str, str], s3_client, bucket: str, action: Messager.S3UploadAction
+    ) -> list[Future]:
+        encodings = ()
+        if self.encoder is not None and self.encoder.applies_to(body_size(action.file_body)):
+            encodings = self.encoder.encodings
+
+        # The alias mustn't be written until the content it points to has been.
+        if self.layout is not None and self.layout.applies_to(action.key):
+            upload = self._upload_addressed
+        # A file can only be read by one thread at a time, so its variants are made and
+        # uploaded after it, by the same thread.
+        elif is_file_body(action.file_body):
+            upload = self._upload
+        else:
+            upload = None
+
+        if upload is not None:
+            return [
+                self._submit(
+                    labels, self._upload_and_close, upload, s3_client, bucket, action, encodings
+                )
+            ]
+
+        return [self._submit(labels, self._upload, s3_client, bucket, action)] + [
+            self._submit(labels, self._upload_variant, s3_client, bucket, action, encoding)
+            for encoding in encodings
+        ]
+
+    def _upload_and_close(
+        self, upload, s3_client, bucket: str, action: Messager.S3UploadAction, encodings
+    ):
+        """Runs upload, then closes the body if it's a file, whether or not it succeeded."""
+        try:
+            upload(s3_client, bucket, action, encodings)
+        finally:
+            if is_file_body(action.file_body):
+                action.file_body.close()
+
+    def _upload(self, s3_client, bucket: str, action: Messager.S3UploadAction, encodings=()):
+        self._put(s3_client, bucket, action.key, action.file_body, action)
+
+        for encoding in encodings:
+            self._upload_variant(s3_client, bucket, action, encoding)
+
+    def _upload_addressed(self, s3_client, bucket: str, action: Messager.S3UploadAction, encodings):
+        content_key = self.layout.content_key(action.key, action.file_body)
+        content = Messager.S3UploadAction(
+            key=content_key,
+            file_body=action.file_body,
+            mime_type=action.mime_type,
+            cache_control=self.layout.content_cache_control,
+        )
+        alias = Messager.S3UploadAction(
+            key=action.key,
+            file_body=b"",
+            mime_type=action.mime_type,
+            cache_control=self.layout.alias_cache_control,
+        )
+
+        try:
+            self._upload(s3_client, bucket, content, encodings)
+        except Exception:
+            # An output cache only knows about the alias, so it has to be told that it wasn't
+            # written.
+            if invalidate := getattr(s3_client, "invalidate", None):
+                invalidate(bucket, action.key)
+            raise
+
+        self._put(
+            s3_client,
+            bucket,
+            alias.key,
+            alias.file_body,
+            alias,
+            **self.layout.alias_args(content_key),
+        )
+
+    def _upload_variant(
+        self, s3_client, bucket: str, action: Messager.S3UploadAction, encoding: str
+    ):
+        encoded = self.encoder.encode(action.file_body, encoding)
+        try:
+            self._put(
+                s3_client,
+                bucket,
+                variant_key(action.key, encoding),
+                encoded,
+                action,
+                ContentEncoding=encoding,
+            )
+        finally:
+            if is_file_body(encoded):
+                encoded.close()
+
+    def _update(self, s3_client, bucket: str, key: str, actions: Sequence[S3UpdateAction]):
+        with self._update_locks[hash((bucket, key)) % len(self._update_locks)]:
+            run_updates(s3_client, bucket, actions)
+
+    def _delete(self, s3_client, bucket: str, action: S3DeleteAction):
+        if failed := run_delete(s3_client, bucket, action):
+            raise TemporaryFailure(f"Couldn't delete {len(failed)} objects")
+
+    def _delete_prefix(self, s3_client, bucket: str, prefix: str) -> Exception | None:
+        try:
+            failed = delete_prefix(s3_client, bucket, prefix)
+        except (BotoCoreError, ClientError) as e:
+            logging.exception(f"Deleting {prefix} from {bucket} failed")
+            return TemporaryFailure(f"Couldn't delete {prefix}: {e}")
+
+        if failed:
+            return TemporaryFailure(f"Couldn't delete {len(failed)} objects under {prefix}")
+
+        return None
+
+    def _put(
+        self, s3_client, bucket: str, key: str, body, action: Messager.S3UploadAction, **extra
+    ):
+        try:
+            if is_file_body(body):
+                body.seek(0)
+                s3_client.upload_fileobj(
+                    body,
+                    bucket,
+                    key,
+                    ExtraArgs={
+                        "ContentType": action.mime_type,
+                        "CacheControl": action.cache_control,
+                        **extra,
+                    },
+                    Config=FILE_TRANSFER_CONFIG,
+                )
+            else:
+                s3_client.put_object(
+                    Bucket=bucket,
+                    Key=key,
+                    Body=body,
+                    ContentType=action.mime_type,
+                    CacheControl=action.cache_control,
+                    **extra,
+                )
+        except (BotoCoreError, ClientError):
+            logging.exception(f"Upload of {key} to {bucket} failed")
+            raise
+
+    def shutdown(self):
+        self._executor.shutdown()
@@ -0,0 +1,410 @@
+"""
+Validation of QA annotations against the constraints of ontology/qa-ontology.ttl.
+
+An annotation must describe exactly one eodhqa:EODHQualityMeasurementDataset, which has exactly
+one `owl:sameAs <urn:uuid:...>` with a well-formed UUID. A dqv:QualityMeasurement in it with one
+dqv:isMeasurementOf and one dqv:value, measuring a metric the ontology defines, must have a
+value of the metric's dqv:expectedDataType: a number
+for xsd:double, or for xsd:string a string or one of the ontology's grades. eodhqa: properties
+whose range is an XSD datatype, such as eodhqa:validityEnd, must have well-formed literals of
+that type. Breaking any of these is an error, and the annotation is rejected.
+
+Warnings, which are only logged, are raised for measurements of eodhqa: metrics and eodhqa:
+values which the ontology doesn't define, for measurements which aren't linked to the run by
+qb:dataSet, and for those without exactly one dqv:isMeasurementOf IRI and one dqv:value, which
+the ontology doesn't require. Annotations written before the ontology settled have all of these.
+
+Reasoning over the ontology for each message would cost more than parsing it, so it's compiled
+ahead of time into OntologyTables, which are plain sets and dicts of IRIs. The ontology isn't
+part of the package, so the tables are kept in qa_ontology.json beside this module and rebuilt
+whenever the ontology changes with:
+    python -m annotations_ingester.validation ontology/qa-ontology.ttl
+
+They're loaded once per process. Validating an annotation is then one pass over the triples of
+each predicate it checks, which is small next to parsing it.
+"""
+
+import functools
+import json
+import logging
+import os
+import re
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+
+import click
+from rdflib import Graph, Literal, URIRef
+from rdflib.namespace import OWL, RDF, RDFS, SKOS, XSD, Namespace
+
+EODHQA = URIRef("https://eodatahub.org.uk/api/ontologies/qa/")
+MEASUREMENT_DATASET_CLASS = EODHQA + "EODHQualityMeasurementDataset"
+UUID_URN_PREFIX = "urn:uuid:"
+
+DQV = Namespace("http://www.w3.org/ns/dqv#")
+QB = Namespace("http://purl.org/linked-data/cube#")
+
+TABLES_VERSION = 1
+TABLES_FILE = os.path.join(os.path.dirname(__file__), "qa_ontology.json")
+
+ERROR = "error"
+WARNING = "warning"
+
+# Issues of each code kept in a report. The rest are only counted.
+MAX_ISSUES_PER_CODE = 5
+
+NUMERIC_DATATYPES = frozenset(
+    XSD[name]
+    for name in (
+        "double", "float", "decimal", "integer", "int", "long", "short", "byte",
+        "nonNegativeInteger", "positiveInteger", "nonPositiveInteger", "negativeInteger",
+        "unsignedLong", "unsignedInt", "unsignedShort", "unsignedByte",
+    )
+)  # fmt: skip
+
+_UUID_RE = re.compile(
+    r"^[0-9A-Fa-f]{8}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{12}$"
+)
+
+
+class InvalidAnnotationError(ValueError):
+    """Raised when an annotation body does not describe an identifiable QA run."""
+
+
+@dataclass
+class ValidationIssue:
+    code: str
+    message: str
+    severity: str = ERROR
+    # The IRI of the resource the issue was found on, if there is one.
+    subject: str | None = None
+
+
+@dataclass
+class ValidationReport:
+    """The issues found in an annotation, and its UUID if it could be found."""
+
+    uuid: str | None = None
+    measurements: int = 0
+    issues: list[ValidationIssue] = field(default_factory=list)
+    counts: Counter[str] = field(default_factory=Counter)
+    severities: dict[str, str] = field(default_factory=dict)
+
+    def add(self, code: str, message: str, severity: str = ERROR, subject=None):
+        self.counts[code] += 1
+        self.severities[code] = severity
+        if self.counts[code] <= MAX_ISSUES_PER_CODE:
+            subject = str(subject) if subject is not None else None
+            self.issues.append(ValidationIssue(code, message, severity, subject))
+
+    @property
+    def errors(self) -> list[ValidationIssue]:
+        return [issue for issue in self.issues if issue.severity == ERROR]
+
+    @property
+    def warnings(self) -> list[ValidationIssue]:
+        return [issue for issue in self.issues if issue.severity == WARNING]
+
+    @property
+    def valid(self) -> bool:
+        return not self.errors
+
+    def summary(self, severity: str = ERROR) -> str:
+        """The number of issues of each code of one severity, as in 'missing-uuid x1'."""
+        return ", ".join(
+            f"{code} x{count}"
+            for code, count in sorted(self.counts.items())
+            if self.severities[code] == severity
+        )
+
+    def as_dict(self) -> dict:
+        return {
+            "uuid": self.uuid,
+            "valid": self.valid,
+            "measurements": self.measurements,
+            "counts": dict(sorted(self.counts.items())),
+            "issues": [issue.__dict__ for issue in self.issues],
+        }
+
+
+class AnnotationValidationError(InvalidAnnotationError):
+    """Raised when an annotation breaks the ontology's constraints. `report` says how."""
+
+    def __init__(self, report: ValidationReport):
+        self.report = report
+        first = report.errors[0]
+        super().__init__(f"Invalid annotation ({report.summary()}): {first.message}")
+
+
+@dataclass(frozen=True)
+class OntologyTables:
+    """The parts of the QA ontology which annotations are checked against, keyed by IRI."""
+
+    # Metric -> the datatype of its values ("" if it has no dqv:expectedDataType).
+    metrics: dict[str, str]
+    # skos:Concepts, such as the grades.
+    concepts: frozenset[str]
+    # Property -> the XSD datatype of its values, for properties whose range is one.
+    literal_ranges: dict[str, str]
+    # Every eodhqa: IRI the ontology defines.
+    terms: frozenset[str]
+
+    def to_json(self) -> str:
+        document = {
+            "version": TABLES_VERSION,
+            "metrics": dict(sorted(self.metrics.items())),
+            "concepts": sorted(self.concepts),
+            "literal_ranges": dict(sorted(self.literal_ranges.items())),
+            "terms": sorted(self.terms),
+        }
+        return json.dumps(document, indent=1) + "\n"
+
+    @classmethod
+    def from_json(cls, text: str) -> "OntologyTables":
+        document = json.loads(text)
+        if document["version"] != TABLES_VERSION:
+            raise ValueError(f"Unsupported ontology tables version {document['version']}")
+
+        return cls(
+            metrics=document["metrics"],
+            concepts=frozenset(document["concepts"]),
+            literal_ranges=document["literal_ranges"],
+            terms=frozenset(document["terms"]),
+        )
+
+
+def compile_ontology(ontology: Graph) -> OntologyTables:
+    metrics = {
+        str(metric): str(ontology.value(metric, DQV.expectedDataType) or "")
+        for metric in ontology.subjects(RDF.type, DQV.Metric)
+        if isinstance(metric, URIRef)
+    }
+    literal_ranges = {
+        str(prop): str(range_)
+        for prop, range_ in ontology.subject_objects(RDFS.range)
+        if isinstance(prop, URIRef) and str(range_).startswith(str(XSD))
+    }
+    terms = {
+        str(subject)
+        for subject in ontology.subjects()
+        if isinstance(subject, URIRef) and subject.startswith(EODHQA)
+    }
+
+    return OntologyTables(
+        metrics=metrics,
+        concepts=frozenset(str(c) for c in ontology.subjects(RDF.type, SKOS.Concept)),
+        literal_ranges=literal_ranges,
+        terms=frozenset(terms),
+    )
+
+
+@functools.cache
+def ontology_tables() -> OntologyTables:
+    """The tables compiled from the QA ontology, loaded on first use."""
+    with open(TABLES_FILE) as f:
+        return OntologyTables.from_json(f.read())
+
+
+def _triples(graph, pattern):
+    """
+    The triples matching pattern in every graph of a Dataset, or in a Graph. The store is asked
+    directly, as the Dataset's quads() looks up the graphs of every triple, which would be most
+    of the cost of validating.
+    """
+    for triple, _ in graph.store.triples(pattern, None):
+        yield triple
+
+
+def _pairs(graph, predicate, obj=None) -> dict:
+    """The distinct objects of predicate for each subject, from every graph."""
+    found = defaultdict(set)
+    for s, _, o in _triples(graph, (None, predicate, obj)):
+        found[s].add(o)
+
+    return found
+
+
+def _has_datatype(value, datatype: str) -> bool:
+    if not isinstance(value, Literal) or value.ill_typed:
+        return False
+    if datatype == str(XSD.double):
+        return value.datatype in NUMERIC_DATATYPES
+    if datatype == str(XSD.string):
+        return value.datatype in (None, XSD.string)
+
+    return str(value.datatype) == datatype
+
+
+class AnnotationValidator:
+    """Checks parsed annotations against compiled OntologyTables."""
+
+    def __init__(self, tables: OntologyTables):
+        self.tables = tables
+
+    def validate(self, graph) -> ValidationReport:
+        """Validates a parsed annotation, a Dataset or Graph, searching all its graphs."""
+        report = ValidationReport()
+
+        self._check_run(graph, report)
+        self._check_measurements(graph, report)
+        self._check_literal_ranges(graph, report)
+
+        return report
+
+    def _check_run(self, graph, report: ValidationReport):
+        runs = set(_pairs(graph, RDF.type, MEASUREMENT_DATASET_CLASS))
+        if not runs:
+            report.add("no-measurement-dataset", "Annotation has no EODHQualityMeasurementDataset")
+            return
+        if len(runs) > 1:
+            report.add(
+                "multiple-measurement-datasets",
+                f"Annotation has {len(runs)} EODHQualityMeasurementDatasets",
+            )
+            return
+
+        (run,) = runs
+        uuids = {
+            str(o)[len(UUID_URN_PREFIX) :]
+            for _, _, o in _triples(graph, (run, OWL.sameAs, None))
+            if str(o).startswith(UUID_URN_PREFIX)
+        }
+        if not uuids:
+            report.add("missing-uuid", "EODHQualityMeasurementDataset has no urn:uuid", subject=run)
+        elif len(uuids) > 1:
+            report.add(
+                "multiple-uuids",
+                f"EODHQualityMeasurementDataset has {len(uuids)} urn:uuids",
+                subject=run,
+            )
+        elif not _UUID_RE.match(uuid := uuids.pop()):
+            report.add("malformed-uuid", f"urn:uuid:{uuid} isn't a UUID", subject=run)
+        else:
+            report.uuid = uuid
+
+    def _check_measurements(self, graph, report: ValidationReport):
+        measurements = set(_pairs(graph, RDF.type, DQV.QualityMeasurement))
+        report.measurements = len(measurements)
+        if not measurements:
+            return
+
+        metrics_of = _pairs(graph, DQV.isMeasurementOf)
+        values_of = _pairs(graph, DQV.value)
+        datasets_of = _pairs(graph, QB.dataSet)
+        runs = set(_pairs(graph, RDF.type, MEASUREMENT_DATASET_CLASS))
+
+        for measurement in measurements:
+            metrics, values = metrics_of.get(measurement, ()), values_of.get(measurement, ())
+
+            # The ontology doesn't restrict how many of each a measurement has, so only one
+            # with a single metric and value is checked further.
+            if len(metrics) != 1:
+                report.add(
+                    "measurement-metric",
+                    f"Measurement has {len(metrics)} dqv:isMeasurementOf, not 1",
+                    WARNING,
+                    measurement,
+                )
+            if len(values) != 1:
+                report.add(
+                    "measurement-value",
+                    f"Measurement has {len(values)} dqv:value, not 1",
+                    WARNING,
+                    measurement,
+                )
+            if not datasets_of.get(measurement, set()) & runs:
+                report.add(
+                    "measurement-not-in-run",
+                    "Measurement isn't linked to the run by qb:dataSet",
+                    WARNING,
+                    measurement,
+                )
+
+            if len(metrics) != 1 or len(values) != 1:
+                continue
+
+            (metric,), (value,) = metrics, values
+            if not isinstance(metric, URIRef):
+                report.add(
+                    "measurement-metric", "dqv:isMeasurementOf isn't an IRI", WARNING, measurement
+                )
+                continue
+
+            self._check_value(str(metric), value, measurement, report)
+
+    def _check_value(self, metric: str, value, measurement, report: ValidationReport):
+        tables = self.tables
+
+        if (
+            isinstance(value, URIRef)
+            and value.startswith(EODHQA)
+            and str(value) not in tables.terms
+        ):
+            report.add("unknown-term", f"{value} isn't defined", WARNING, measurement)
+
+        expected = tables.metrics.get(metric)
+        if expected is None:
+            if metric.startswith(EODHQA):
+                report.add("unknown-metric", f"{metric} isn't defined", WARNING, measurement)
+            return
+
+        if expected == str(XSD.string) and isinstance(value, URIRef):
+            valid = str(value) in tables.concepts
+        else:
+            valid = not expected or _has_datatype(value, expected)
+
+        if not valid:
+            report.add(
+                "measurement-datatype",
+                f"The value of {metric}, {value!r}, isn't of type {expected}",
+                subject=measurement,
+            )
+
+    def _check_literal_ranges(self, graph, report: ValidationReport):
+        for prop, datatype in self.tables.literal_ranges.items():
+            for s, _, o in _triples(graph, (None, URIRef(prop), None)):
+                if not _has_datatype(o, datatype):
+                    report.add(
+                        "property-datatype",
+                        f"The value of {prop}, {o!r}, isn't of type {datatype}",
+                        subject=s,
+                    )
+
+
+@functools.cache
+def default_validator() -> AnnotationValidator:
+    return AnnotationValidator(ontology_tables())
+
+
+def require_valid(graph) -> ValidationReport:
+    """
+    Validates a parsed annotation, raising AnnotationValidationError if it has errors and
+    logging any warnings.
+    """
+    report = default_validator().validate(graph)
+    if not report.valid:
+        raise AnnotationValidationError(report)
+
+    if report.warnings:
+        logging.warning(f"Annotation {report.uuid} has warnings: {report.summary(WARNING)}")
+
+    return report
+
+
+@click.command
+@click.argument("ontology", default="ontology/qa-ontology.ttl")
+@click.option("--output", default=TABLES_FILE, help="File to write the compiled tables to.")
+def compile_tables(ontology: str, output: str):
+    """Compiles the QA ONTOLOGY, in Turtle, into the tables annotations are validated against."""
+    tables = compile_ontology(Graph().parse(ontology, format="turtle"))
+
+    with open(output, "w") as f:
+        f.write(tables.to_json())
+
+    click.echo(
+        f"Wrote {len(tables.metrics)} metrics, {len(tables.concepts)} concepts and"
+        f" {len(tables.literal_ranges)} typed properties to {output}"
+    )
+
+
+if __name__ == "__main__":
+    compile_tables()
@@ -0,0 +1,56 @@
+"""
+Process-pool execution of the CPU-bound parse and serialise steps.
+
+rdflib is pure Python, so one process can only use one core however many messages are waiting.
+When a RenderPool is given to a messager, the messager hands its render function (such as
+`render_annotation` or `render_dcat`) to a worker process and waits for the result. Several
+messages must be in flight at once for this to help - see runner.run_pipelined.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from annotations_ingester import metrics
+
+
+class RenderPool:
+    """A pool of worker processes for running picklable module-level render functions."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+
+        # 'spawn' rather than 'fork' because the Pulsar client has background threads.
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def run(self, fn, *args):
+        """Runs fn(*args) in a worker process, blocking until it returns or raises."""
+        return self._executor.submit(fn, *args).result()
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+class RenderPoolMixin:
+    """Adds an optional `render_pool` to a Messager, used by `render`."""
+
+    def __init__(self, *args, render_pool: RenderPool | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.render_pool = render_pool
+
+    def render(self, fn, *args, in_process: bool = False):
+        """Runs fn(*args) in the render pool, if there is one and in_process isn't set."""
+        pool = None if in_process else self.render_pool
+
+        if not metrics.is_enabled():
+            return fn(*args) if pool is None else pool.run(fn, *args)
+
+        # The stage timings are returned with the result so they can be recorded here.
+        if pool is None:
+            result, observations = metrics.recording(fn, *args)
+        else:
+            result, observations = pool.run(metrics.recording, fn, *args)
+
+        metrics.record(observations)
+        return result
@@ -0,0 +1,73 @@
+"""
+Measures the cost of metrics on the message hot path, by timing decoding and rendering an
+entry (everything process_msg does apart from S3 and Pulsar I/O) with and without metrics.
+
+Run from the repository root with:
+    python -m benchmarks.bench_instrumentation
+"""
+
+import json
+import timeit
+
+import click
+
+from annotations_ingester import metrics
+from annotations_ingester.annotations_generator import AnnotationsMessager
+from annotations_ingester.dataset_dcat_generator import DatasetDCATMessager
+
+STAC_FILE = "test_data/test_dcat_generation_s2_l2a.json"
+ANNOTATION_FILE = "ontology/qa-output-1.trig"
+
+
+def time_modes(fn, label: str, number: int, repeat: int) -> tuple[float, float]:
+    """Returns the best time per call without and with metrics, alternating between them."""
+    bare, instrumented = [], []
+
+    for _ in range(repeat):
+        metrics._enabled = False
+        bare.append(timeit.timeit(fn, number=number))
+
+        # As MetricsMixin.process_msg does for each message.
+        metrics.enable()
+        token = metrics._labels.set((label, "benchmark"))
+        try:
+            instrumented.append(timeit.timeit(fn, number=number))
+        finally:
+            metrics._labels.reset(token)
+
+    return min(bare) / number, min(instrumented) / number
+
+
+@click.command
+@click.option("--number", "-n", default=200, help="Calls per repeat.")
+@click.option("--repeat", "-r", default=5, help="Repeats; the fastest is reported.")
+def main(number: int, repeat: int):
+    with open(STAC_FILE) as f:
+        stac_text = f.read()
+    with open(ANNOTATION_FILE) as f:
+        annotation = f.read()
+
+    dcat_messager = DatasetDCATMessager(None, "bucket")
+    annotations_messager = AnnotationsMessager(None, "bucket")
+
+    cases = {
+        "dataset_dcat": lambda: dcat_messager.process_update_stac(
+            json.loads(stac_text), "catalogs/a/collections/b.json", "/", "/"
+        ),
+        "annotation": lambda: annotations_messager.process_update_body(
+            annotation, "catalogs/a/collections/b/annotations/c.trig", "/", "/"
+        ),
+    }
+
+    for name, fn in cases.items():
+        fn()
+        bare, instrumented = time_modes(fn, name, number, repeat)
+        overhead = (instrumented - bare) / bare * 100
+        click.echo(
+            f"{name:>14}: {bare * 1e6:10.1f} us bare, {instrumented * 1e6:10.1f} us instrumented"
+            f" ({overhead:+.1f}%)"
+        )
+
+
+if __name__ == "__main__":
+    main()
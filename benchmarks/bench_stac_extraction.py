@@ -0,0 +1,50 @@
+"""
+Compares reading the DCAT fields from a STAC dict directly with loading it into pystac first,
+using the Sentinel-2 L2A collection from test_data.
+
+Run from the repository root with:
+    python -m benchmarks.bench_stac_extraction
+"""
+
+import json
+import timeit
+
+import click
+
+from annotations_ingester.dataset_dcat_generator import (
+    AmbiguousSTACError,
+    DatasetDCATMessager,
+)
+
+STAC_FILE = "test_data/test_dcat_generation_s2_l2a.json"
+
+
+class PystacOnlyMessager(DatasetDCATMessager):
+    def record_from_dict(self, stac: dict):
+        raise AmbiguousSTACError("Disabled for benchmarking")
+
+
+@click.command
+@click.option("--number", "-n", default=200, help="Calls per repeat.")
+@click.option("--repeat", "-r", default=5, help="Repeats; the fastest is reported.")
+def main(number: int, repeat: int):
+    with open(STAC_FILE) as f:
+        stac = json.load(f)
+
+    results = {}
+    for name, messager in (
+        ("pystac.read_dict", PystacOnlyMessager(None, None)),
+        ("dict extraction", DatasetDCATMessager(None, None)),
+    ):
+        best = min(
+            timeit.repeat(lambda m=messager: m.generate_record(stac), number=number, repeat=repeat)
+        )
+        results[name] = best / number
+        click.echo(f"{name:>20}: {results[name] * 1e6:10.1f} us/call")
+
+    speedup = results["pystac.read_dict"] / results["dict extraction"]
+    click.echo(f"{'speedup':>20}: {speedup:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Measures the cost of validating annotations against the compiled QA ontology, by timing
+parsing a synthetic QA run (see benchmarks/corpora.py) and then validating it, at several
+numbers of measurements.
+
+Run from the repository root with:
+    python -m benchmarks.bench_validation
+    python -m benchmarks.bench_validation --measurements 10,10000 --repeat 3
+"""
+
+import timeit
+
+import click
+
+from annotations_ingester.annotations_generator import parse_annotation
+from annotations_ingester.validation import default_validator, ontology_tables
+from benchmarks.corpora import synthetic_qa_trig
+
+
+def time_validation(measurements: int, repeat: int) -> tuple[float, float]:
+    """Returns the best time to parse, and to validate, a QA run of `measurements`."""
+    body = synthetic_qa_trig(measurements)
+    validator = default_validator()
+    dataset = parse_annotation(body)
+
+    number = max(1, 1000 // max(measurements, 1))
+    parse = min(timeit.repeat(lambda: parse_annotation(body), number=number, repeat=repeat))
+    validate = min(timeit.repeat(lambda: validator.validate(dataset), number=number, repeat=repeat))
+
+    return parse / number, validate / number
+
+
+@click.command
+@click.option(
+    "--measurements", default="10,100,1000,10000", help="Comma-separated run sizes to time."
+)
+@click.option("--repeat", "-r", default=5, help="Repeats; the fastest is reported.")
+def main(measurements: str, repeat: int):
+    load = timeit.timeit(lambda: (ontology_tables.cache_clear(), ontology_tables()), number=10)
+    click.echo(f"Loading the compiled ontology: {load / 10 * 1e6:.1f} us, once per process")
+
+    for size in (int(n) for n in measurements.split(",")):
+        parse, validate = time_validation(size, repeat)
+        click.echo(
+            f"{size:>7} measurements: {parse * 1e3:10.2f} ms parse, {validate * 1e3:8.2f} ms"
+            f" validate ({validate / parse * 100:+.1f}% of parsing)"
+        )
+
+
+if __name__ == "__main__":
+    main()
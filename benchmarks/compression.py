@@ -0,0 +1,121 @@
+"""
+Reports the CPU time each output encoding costs against the bytes it saves, for the outputs of
+the sample data and of synthetic corpora of a few sizes.
+
+Run from the repository root with:
+    python -m benchmarks.compression
+    python -m benchmarks.compression --gzip-levels 1,6,9 --brotli-qualities 1,5,11
+
+Brotli is only measured if the brotli package is installed.
+"""
+
+import json
+import time
+
+import click
+
+from annotations_ingester.annotations_generator import render_annotation
+from annotations_ingester.dataset_dcat_generator import render_dcat
+from annotations_ingester.encodings import OutputEncoder, available_encodings
+from benchmarks.corpora import synthetic_collection, synthetic_qa_trig
+
+
+def sample_outputs(measurements=(100, 10_000)) -> dict[str, str]:
+    """The Turtle and JSON-LD outputs for the sample data and synthetic corpora."""
+    outputs = {}
+
+    def add(name: str, turtle: str, jsonld: str):
+        outputs[f"{name}.ttl"] = turtle
+        outputs[f"{name}.jsonld"] = jsonld
+
+    with open("test_data/test_dcat_generation_s2_l2a.json") as f:
+        add("dcat/s2_l2a", *render_dcat(json.load(f)))
+
+    # A Collection's DCAT doesn't depend on its links, so there's only one size of those.
+    add("dcat/synthetic_collection", *render_dcat(synthetic_collection()))
+
+    for n in (1, 2):
+        with open(f"ontology/qa-output-{n}.trig") as f:
+            add(f"annotation/qa-output-{n}", *render_annotation(f.read())[1:])
+
+    for n in measurements:
+        trig = synthetic_qa_trig(n)
+        # Measurements are in a named graph and aren't published, so publish them all.
+        trig = trig.replace(":qualityCheckResults {\n", "").rstrip().removesuffix("}")
+        add(f"annotation/synthetic_qa_{n}", *render_annotation(trig)[1:])
+
+    return outputs
+
+
+def cpu_seconds(fn, min_time: float = 0.2) -> float:
+    """The mean CPU time of fn, called until at least min_time seconds have been used."""
+    calls = 0
+    start = time.process_time()
+    while (elapsed := time.process_time() - start) < min_time or calls == 0:
+        fn()
+        calls += 1
+
+    return elapsed / calls
+
+
+def compression_report(
+    gzip_levels=(1, 6, 9),
+    brotli_qualities=(1, 5, 11),
+    min_time: float = 0.2,
+    measurements=(100, 10_000),
+) -> list[dict]:
+    settings = [("gzip", level) for level in gzip_levels]
+    if "br" in available_encodings():
+        settings += [("br", quality) for quality in brotli_qualities]
+
+    report = []
+    for name, output in sample_outputs(measurements).items():
+        body = output.encode("utf-8")
+
+        for encoding, level in settings:
+            encoder = OutputEncoder((encoding,), gzip_level=level, brotli_quality=level)
+            encoded = encoder.encode(body, encoding)
+            seconds = cpu_seconds(lambda e=encoder, b=body, c=encoding: e.encode(b, c), min_time)
+
+            report.append(
+                {
+                    "output": name,
+                    "encoding": encoding,
+                    "level": level,
+                    "bytes": len(body),
+                    "encoded_bytes": len(encoded),
+                    "ratio": len(body) / len(encoded),
+                    "cpu_ms": seconds * 1000,
+                    "saved_bytes_per_cpu_ms": (len(body) - len(encoded)) / (seconds * 1000),
+                }
+            )
+
+    return report
+
+
+def parse_levels(value: str) -> tuple[int, ...]:
+    return tuple(int(v) for v in value.split(","))
+
+
+@click.command
+@click.option("--gzip-levels", default="1,6,9", help="Comma-separated gzip levels.")
+@click.option("--brotli-qualities", default="1,5,11", help="Comma-separated brotli qualities.")
+@click.option("--min-time", default=0.2, help="CPU seconds to spend timing each case.")
+@click.option("--json", "as_json", is_flag=True, default=False, help="Print the report as JSON.")
+def main(gzip_levels: str, brotli_qualities: str, min_time: float, as_json: bool):
+    report = compression_report(parse_levels(gzip_levels), parse_levels(brotli_qualities), min_time)
+
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+
+    for row in report:
+        click.echo(
+            f"{row['output']:<44} {row['encoding']:>4}-{row['level']:<2}"
+            f" {row['bytes']:>9} -> {row['encoded_bytes']:>8} bytes ({row['ratio']:4.1f}x)"
+            f" {row['cpu_ms']:8.3f} ms CPU, {row['saved_bytes_per_cpu_ms']:>9.0f} bytes saved/ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
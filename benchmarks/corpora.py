@@ -0,0 +1,151 @@
+"""
+Synthetic inputs for benchmarking and load testing, at configurable scale.
+
+STAC Catalogs and Collections are generated with any number of links (the part of a STAC
+document that grows with the catalogue) and QA TriG documents are modelled on
+ontology/qa-output-1.trig with any number of measurements.
+"""
+
+import random
+import uuid as uuid_module
+
+CATALOGUE_ROOT = "https://dev.eodatahub.org.uk/api/catalogue/stac"
+
+QA_PREFIXES = """\
+@prefix dcat: <http://www.w3.org/ns/dcat#> .
+@prefix foaf: <http://xmlns.com/foaf/0.1/> .
+@prefix owl: <http://www.w3.org/2002/07/owl#> .
+@prefix prov: <http://www.w3.org/ns/prov#> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+@prefix sdmx-attribute: <http://purl.org/linked-data/sdmx/2009/attribute#> .
+@prefix qb: <http://purl.org/linked-data/cube#> .
+@prefix dqv: <http://www.w3.org/ns/dqv#> .
+@prefix eodhqa: <https://eodatahub.org.uk/api/ontologies/qa/> .
+@prefix eodhweblinks: <https://eodatahub.org.uk/api/ontologies/weblinks/> .
+@prefix : <https://dev.eodatahub.org.uk/ades/qa-workspace/ogc-api/jobs/{run_uuid}> .
+"""
+
+QA_HEADER = """
+_:org
+    a prov:Agent, prov:Organization;
+    foaf:name "National Physical Laboratory"^^xsd:string .
+
+_:author
+    a prov:Agent, prov:Person;
+    foaf:givenName "S Malone"^^xsd:string;
+    prov:actedOnBehalfOf _:org .
+
+<https://dev.eodatahub.org.uk/ades/qa-workspace/ogc-api/jobs/{run_uuid}>
+    a prov:Activity;
+    prov:used <https://dev.eodatahub.org.uk/ades/qa-workspace/ogc-api/processes/qa-workflow-id-1>;
+    prov:wasAssociatedWith _:author .
+
+:qualityCheckResults
+    a dqv:QualityMetadata, prov:Entity ;
+    prov:generatedAtTime "2024-07-26T16:10:00Z"^^xsd:dateTime ;
+    prov:wasGeneratedBy <https://dev.eodatahub.org.uk/ades/qa-workspace/ogc-api/jobs/{run_uuid}>;
+    prov:wasAttributedTo _:author .
+
+:qualityCheckResults {{
+    :checkRun
+        a eodhqa:EODHQualityMeasurementDataset;
+        rdfs:label "synthetic run {run_uuid}";
+        owl:sameAs <urn:uuid:{run_uuid}>;
+        eodhqa:datasetComputedOn <{dataset}> ;
+        eodhqa:validityEnd "2025-01-25T04:10:00Z"^^xsd:dateTime .
+"""
+
+QA_MEASUREMENT = """
+    :measurement{index}
+        a dqv:QualityMeasurement ;
+        sdmx-attribute:unitMeasure <http://www.ontology-of-units-of-measure.org/resource/om-2/decibel> ;
+        dqv:isMeasurementOf eodhqa:metric{metric} ;
+        dqv:computedOn <{dataset}> ;
+        qb:dataSet :checkRun ;
+        dqv:value {value} .
+"""
+
+
+def collection_href(collection_id: str) -> str:
+    return f"{CATALOGUE_ROOT}/catalogs/benchmark/collections/{collection_id}"
+
+
+def synthetic_catalog(links: int = 10, catalog_id: str = "benchmark") -> dict:
+    """A STAC Catalog with a self link and `links` child links."""
+    self_href = f"{CATALOGUE_ROOT}/catalogs/{catalog_id}"
+
+    return {
+        "type": "Catalog",
+        "id": catalog_id,
+        "stac_version": "1.0.0",
+        "description": f"Synthetic catalog with {links} children",
+        "links": [
+            {"rel": "self", "href": self_href, "type": "application/json"},
+            {"rel": "root", "href": CATALOGUE_ROOT, "type": "application/json"},
+        ]
+        + [
+            {"rel": "child", "href": f"{self_href}/collections/c{i}", "type": "application/json"}
+            for i in range(links)
+        ],
+    }
+
+
+def synthetic_collection(links: int = 10, collection_id: str = "benchmark", seed: int = 0) -> dict:
+    """
+    A STAC Collection with a DOI, `links` item links and summaries of a similar size, like the
+    larger collections the harvesters produce.
+    """
+    rng = random.Random(seed)
+    self_href = collection_href(collection_id)
+
+    return {
+        "type": "Collection",
+        "id": collection_id,
+        "stac_version": "1.0.0",
+        "stac_extensions": ["https://stac-extensions.github.io/scientific/v1.0.0/schema.json"],
+        "description": f"Synthetic collection with {links} items",
+        "license": "proprietary",
+        "sci:doi": f"10.5270/{collection_id}",
+        "extent": {
+            "spatial": {"bbox": [[-180, -90, 180, 90]]},
+            "temporal": {"interval": [["2015-06-27T10:25:31Z", None]]},
+        },
+        "links": [
+            {"rel": "self", "href": self_href, "type": "application/json"},
+            {"rel": "root", "href": CATALOGUE_ROOT, "type": "application/json"},
+            {"rel": "cite-as", "href": f"https://doi.org/10.5270/{collection_id}"},
+        ]
+        + [
+            {"rel": "item", "href": f"{self_href}/items/item{i}", "type": "application/geo+json"}
+            for i in range(links)
+        ],
+        "summaries": {
+            "eo:cloud_cover": {"minimum": 0, "maximum": 100},
+            "platform": [f"platform-{i}" for i in range(max(1, links // 100))],
+            "view:sun_elevation": [round(rng.uniform(-90, 90), 3) for _ in range(links)],
+        },
+    }
+
+
+def synthetic_qa_trig(
+    measurements: int = 10, run_uuid: str = None, dataset: str = None, seed: int = 0
+) -> str:
+    """A QA run, in the form of ontology/qa-output-1.trig, with `measurements` measurements."""
+    rng = random.Random(seed)
+    run_uuid = run_uuid or str(uuid_module.UUID(int=rng.getrandbits(128), version=4))
+    dataset = dataset or collection_href("benchmark")
+
+    parts = [
+        QA_PREFIXES.format(run_uuid=run_uuid),
+        QA_HEADER.format(run_uuid=run_uuid, dataset=dataset),
+    ]
+    parts.extend(
+        QA_MEASUREMENT.format(
+            index=i, metric=i % 20, dataset=dataset, value=round(rng.uniform(0, 200), 3)
+        )
+        for i in range(measurements)
+    )
+    parts.append("}\n")
+
+    return "".join(parts)
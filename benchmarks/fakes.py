@@ -0,0 +1,429 @@
+"""
+In-process stand-ins for external services, for tests, benchmarks and load testing. They live
+here rather than in annotations_ingester so that they aren't shipped with it.
+"""
+
+import hashlib
+import io
+import itertools
+import queue
+import random
+import re
+import threading
+import time
+from array import array
+from datetime import datetime, timezone
+
+import pulsar
+from botocore.exceptions import ClientError
+
+
+def etag(body: bytes) -> str:
+    """The ETag S3 gives a single-part upload."""
+    return '"' + hashlib.md5(body, usedforsecurity=False).hexdigest() + '"'
+
+
+class FakeS3Client:
+    """
+    A thread-safe, in-memory imitation of the parts of the boto3 S3 client we use. Each call
+    sleeps for `latency` seconds and fails with probability `error_rate`, or always for keys in
+    `failing_keys`. Puts which fail their conditions are counted in `conflicts`.
+
+    With a `rate_limit`, requests beyond that many a second (with bursts of a tenth of a
+    second's worth) are refused with SlowDown, as S3 does for a busy prefix, and counted in
+    `throttled`.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = None,
+        rate_limit: float = 0.0,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.throttled = 0
+        self.failing_keys: set[str] = set()
+        self.objects: dict[tuple[str, str], dict] = {}
+        self.put_count = 0
+        self.delete_requests = 0
+        self.conflicts = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = None
+        self._refilled_at = time.monotonic()
+
+    def _call(self, operation: str, key: str):
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            fail = key in self.failing_keys or self._random.random() < self.error_rate
+            throttle = self.rate_limit > 0 and not self._take_token()
+
+        if throttle:
+            raise ClientError(
+                {
+                    "Error": {"Code": "SlowDown", "Message": "Please reduce your request rate."},
+                    "ResponseMetadata": {"HTTPStatusCode": 503},
+                },
+                operation,
+            )
+
+        if fail:
+            raise ClientError(
+                {
+                    "Error": {"Code": "InternalError", "Message": "Injected failure"},
+                    "ResponseMetadata": {"HTTPStatusCode": 500},
+                },
+                operation,
+            )
+
+    def _take_token(self) -> bool:
+        burst = max(1.0, self.rate_limit / 10)
+        now = time.monotonic()
+        if self._tokens is None:
+            self._tokens = burst
+        self._tokens = min(burst, self._tokens + (now - self._refilled_at) * self.rate_limit)
+        self._refilled_at = now
+
+        if self._tokens < 1:
+            self.throttled += 1
+            return False
+
+        self._tokens -= 1
+        return True
+
+    def put_object(
+        self, Bucket: str, Key: str, Body, IfMatch: str = None, IfNoneMatch: str = None, **kwargs
+    ):
+        """Stores an object. IfMatch and IfNoneMatch="*" make the put conditional, as in S3."""
+        self._call("PutObject", Key)
+
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+
+        with self._lock:
+            existing = self.objects.get((Bucket, Key))
+            if (IfNoneMatch == "*" and existing is not None) or (
+                IfMatch is not None and (existing is None or etag(existing["Body"]) != IfMatch)
+            ):
+                self.conflicts += 1
+                raise ClientError(
+                    {
+                        "Error": {"Code": "PreconditionFailed", "Message": "Condition not met"},
+                        "ResponseMetadata": {"HTTPStatusCode": 412},
+                    },
+                    "PutObject",
+                )
+
+            self.objects[(Bucket, Key)] = {
+                "Body": Body,
+                "LastModified": datetime.now(timezone.utc),
+                **kwargs,
+            }
+            self.put_count += 1
+
+        return {"ETag": etag(Body)}
+
+    def upload_fileobj(self, Fileobj, Bucket: str, Key: str, ExtraArgs=None, Config=None, **kwargs):
+        """
+        Stores a file, reading it a part at a time as boto3 does. Files larger than the
+        multipart threshold are recorded as having been sent in `parts` parts.
+        """
+        self._call("UploadFileobj", Key)
+
+        chunksize = Config.multipart_chunksize if Config else 8 * 1024 * 1024
+        threshold = Config.multipart_threshold if Config else 8 * 1024 * 1024
+
+        body = io.BytesIO()
+        parts = 0
+        while chunk := Fileobj.read(chunksize):
+            body.write(chunk)
+            parts += 1
+
+        with self._lock:
+            self.objects[(Bucket, Key)] = {
+                "Body": body.getvalue(),
+                "parts": parts if body.tell() > threshold else 0,
+                "LastModified": datetime.now(timezone.utc),
+                **(ExtraArgs or {}),
+            }
+            self.put_count += 1
+
+    def get_object(self, Bucket: str, Key: str, **kwargs):
+        self._call("GetObject", Key)
+
+        with self._lock:
+            obj = self.objects.get((Bucket, Key))
+
+        if obj is None:
+            raise ClientError(
+                {
+                    "Error": {"Code": "NoSuchKey", "Message": "Not found"},
+                    "ResponseMetadata": {"HTTPStatusCode": 404},
+                },
+                "GetObject",
+            )
+
+        body = obj["Body"]
+        if match := re.fullmatch(r"bytes=(\d+)-(\d*)", kwargs.get("Range", "")):
+            start, end = int(match.group(1)), match.group(2)
+            body = body[start : int(end) + 1 if end else None]
+
+        return {"Body": io.BytesIO(body), "ETag": etag(obj["Body"])}
+
+    def head_object(self, Bucket: str, Key: str, **kwargs):
+        self._call("HeadObject", Key)
+
+        with self._lock:
+            obj = self.objects.get((Bucket, Key))
+
+        if obj is None:
+            raise ClientError(
+                {"Error": {"Code": "404", "Message": "Not Found"}, "ResponseMetadata": {}},
+                "HeadObject",
+            )
+
+        return {
+            "ContentLength": len(obj["Body"]),
+            "ETag": etag(obj["Body"]),
+            **{k: v for k, v in obj.items() if k != "Body"},
+        }
+
+    def delete_objects(self, Bucket: str, Delete: dict, **kwargs):
+        keys = [obj["Key"] for obj in Delete["Objects"]]
+        if len(keys) > 1000:
+            raise ClientError(
+                {"Error": {"Code": "MalformedXML", "Message": "Too many keys"}}, "DeleteObjects"
+            )
+
+        # Keys in failing_keys fail individually, as S3 reports them, rather than the request.
+        self._call("DeleteObjects", "")
+
+        with self._lock:
+            self.delete_requests += 1
+            errors = []
+            for key in keys:
+                if key in self.failing_keys:
+                    errors.append({"Key": key, "Code": "InternalError", "Message": "Injected"})
+                else:
+                    self.objects.pop((Bucket, key), None)
+
+        return {"Errors": errors} if errors else {}
+
+    def list_objects_v2(
+        self,
+        Bucket: str,
+        Prefix: str = "",
+        Delimiter: str = None,
+        MaxKeys: int = 1000,
+        ContinuationToken: str = None,
+        StartAfter: str = None,
+        **kwargs,
+    ):
+        self._call("ListObjectsV2", Prefix)
+
+        with self._lock:
+            keys = sorted(k for b, k in self.objects if b == Bucket and k.startswith(Prefix))
+
+        after = ContinuationToken or StartAfter
+        contents, common_prefixes = [], []
+        for key in keys:
+            if after is not None and key <= after:
+                continue
+
+            if Delimiter and Delimiter in key[len(Prefix) :]:
+                common_prefix = key[: key.index(Delimiter, len(Prefix)) + len(Delimiter)]
+                if common_prefix not in common_prefixes:
+                    common_prefixes.append(common_prefix)
+                continue
+
+            with self._lock:
+                obj = self.objects[(Bucket, key)]
+
+            contents.append(
+                {
+                    "Key": key,
+                    "Size": len(obj["Body"]),
+                    "ETag": etag(obj["Body"]),
+                    "LastModified": obj.get("LastModified", datetime.now(timezone.utc)),
+                }
+            )
+            if len(contents) >= MaxKeys:
+                return {
+                    "Contents": contents,
+                    "CommonPrefixes": [{"Prefix": p} for p in common_prefixes],
+                    "IsTruncated": True,
+                    "NextContinuationToken": key,
+                }
+
+        response = {"IsTruncated": False}
+        if contents:
+            response["Contents"] = contents
+        if common_prefixes:
+            response["CommonPrefixes"] = [{"Prefix": p} for p in common_prefixes]
+
+        return response
+
+    def get_paginator(self, operation_name: str):
+        if operation_name != "list_objects_v2":
+            raise NotImplementedError(operation_name)
+
+        return FakeListObjectsPaginator(self)
+
+    def body(self, bucket: str, key: str) -> bytes:
+        return self.objects[(bucket, key)]["Body"]
+
+
+class FakeListObjectsPaginator:
+    def __init__(self, s3_client: FakeS3Client):
+        self._s3_client = s3_client
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            page = self._s3_client.list_objects_v2(**kwargs, ContinuationToken=token)
+            yield page
+
+            if not page["IsTruncated"]:
+                return
+            token = page["NextContinuationToken"]
+
+
+class FakeMessage:
+    """A message delivered by FakeBroker, with the parts of pulsar.Message we use."""
+
+    def __init__(self, topic: str, data: bytes, message_id: int, published_at: float):
+        self._topic = topic
+        self._data = data
+        self._message_id = message_id
+        self.published_at = published_at
+        self.redelivery_count = 0
+
+    def topic_name(self) -> str:
+        return f"persistent://public/default/{self._topic}"
+
+    def data(self) -> bytes:
+        return self._data
+
+    def message_id(self) -> int:
+        return self._message_id
+
+    def publish_timestamp(self) -> int:
+        """Milliseconds since the epoch, as Pulsar gives it."""
+        return int((time.time() - (time.monotonic() - self.published_at)) * 1000)
+
+
+class FakeBroker:
+    """
+    An in-process stand-in for Pulsar with one shared subscription per topic. Negatively
+    acknowledged messages are redelivered after `redelivery_delay` seconds. The time from
+    publishing each message to its acknowledgement is recorded in `latencies`.
+    """
+
+    def __init__(self, redelivery_delay: float = 1.0):
+        self.redelivery_delay = redelivery_delay
+        # A compact array so that long runs don't skew their own memory measurements.
+        self.latencies = array("d")
+        self.published = 0
+        self.acknowledged = 0
+        self.redelivered = 0
+
+        self._queues: dict[str, queue.Queue] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._settled = threading.Condition(self._lock)
+
+    def _queue(self, topic: str) -> queue.Queue:
+        with self._lock:
+            return self._queues.setdefault(topic, queue.Queue())
+
+    def publish(self, topic: str, data: bytes) -> FakeMessage:
+        msg = FakeMessage(topic, data, next(self._ids), time.monotonic())
+
+        with self._lock:
+            self.published += 1
+
+        self._queue(topic).put(msg)
+        return msg
+
+    def backlog(self) -> int:
+        with self._lock:
+            return self.published - self.acknowledged
+
+    def wait_until_settled(self, timeout: float = None) -> bool:
+        """Waits until every published message has been acknowledged."""
+        with self._settled:
+            return self._settled.wait_for(lambda: self.acknowledged >= self.published, timeout)
+
+    def acknowledge(self, msg: FakeMessage):
+        with self._settled:
+            self.acknowledged += 1
+            self.latencies.append(time.monotonic() - msg.published_at)
+            self._settled.notify_all()
+
+    def negative_acknowledge(self, msg: FakeMessage):
+        with self._lock:
+            self.redelivered += 1
+        msg.redelivery_count += 1
+
+        timer = threading.Timer(
+            self.redelivery_delay, self._queue(msg.topic_name().rsplit("/", 1)[-1]).put, (msg,)
+        )
+        timer.daemon = True
+        timer.start()
+
+
+class FakeConsumer:
+    """Receives from several FakeBroker topics, taking from each in turn."""
+
+    def __init__(self, broker: FakeBroker, topics: list[str]):
+        self._broker = broker
+        self._queues = [broker._queue(topic) for topic in topics]
+        self._next = 0
+
+    def receive(self, timeout_millis: int = None):
+        deadline = None if timeout_millis is None else time.monotonic() + timeout_millis / 1000
+
+        while True:
+            for _ in range(len(self._queues)):
+                q = self._queues[self._next]
+                self._next = (self._next + 1) % len(self._queues)
+                try:
+                    return q.get_nowait()
+                except queue.Empty:
+                    pass
+
+            if deadline is not None and time.monotonic() >= deadline:
+                raise pulsar.Timeout()
+
+            time.sleep(0.001)
+
+    def acknowledge(self, msg: FakeMessage):
+        self._broker.acknowledge(msg)
+
+    def negative_acknowledge(self, msg: FakeMessage):
+        self._broker.negative_acknowledge(msg)
+
+    def close(self):
+        pass
+
+
+class FakePulsarClient:
+    """A pulsar.Client which subscribes to a FakeBroker."""
+
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+
+    def subscribe(self, topics, subscription_name: str, **kwargs) -> FakeConsumer:
+        if isinstance(topics, str):
+            topics = [topics]
+
+        return FakeConsumer(self.broker, topics)
+
+    def close(self):
+        pass
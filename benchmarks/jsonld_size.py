@@ -0,0 +1,70 @@
+"""
+Reports the size of the JSON-LD outputs for the sample data, expanded as rdflib writes it and
+compacted against the shared context, both as uploaded and gzipped.
+
+Run from the repository root with:
+    python -m benchmarks.jsonld_size
+"""
+
+import gzip
+import json
+
+import click
+
+from annotations_ingester.annotations_generator import parse_annotation
+from annotations_ingester.dataset_dcat_generator import DatasetDCATMessager
+from annotations_ingester.jsonld_context import compact_jsonld
+from benchmarks.corpora import synthetic_collection
+
+SAMPLES = {
+    "dcat/test_dcat_generation_s2_l2a.json": "test_data/test_dcat_generation_s2_l2a.json",
+    "annotation/qa-output-1.trig": "ontology/qa-output-1.trig",
+    "annotation/qa-output-2.trig": "ontology/qa-output-2.trig",
+}
+
+
+def sample_graphs() -> dict:
+    messager = DatasetDCATMessager(None, None)
+    graphs = {}
+
+    for name, path in SAMPLES.items():
+        with open(path) as f:
+            if name.startswith("dcat/"):
+                graphs[name] = messager.generate_dcat(json.load(f))
+            else:
+                graphs[name] = parse_annotation(f.read()).default_context
+
+    graphs["dcat/synthetic_collection"] = messager.generate_dcat(synthetic_collection(100))
+    return graphs
+
+
+def size_report() -> dict:
+    report = {}
+
+    for name, graph in sample_graphs().items():
+        expanded = graph.serialize(format="json-ld").encode("utf-8")
+        compacted = compact_jsonld(graph).encode("utf-8")
+
+        report[name] = {
+            "expanded_bytes": len(expanded),
+            "compacted_bytes": len(compacted),
+            "expanded_gzip_bytes": len(gzip.compress(expanded)),
+            "compacted_gzip_bytes": len(gzip.compress(compacted)),
+            "reduction": 1 - len(compacted) / len(expanded),
+        }
+
+    return report
+
+
+@click.command
+def main():
+    for name, sizes in size_report().items():
+        click.echo(
+            f"{name:<40} {sizes['expanded_bytes']:>7} -> {sizes['compacted_bytes']:>7} bytes"
+            f" ({sizes['reduction']:.0%} smaller),"
+            f" gzipped {sizes['expanded_gzip_bytes']:>6} -> {sizes['compacted_gzip_bytes']:>6}"
+        )
+
+
+if __name__ == "__main__":
+    main()
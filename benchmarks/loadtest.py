@@ -0,0 +1,289 @@
+"""
+End-to-end load test of the ingester against in-process stand-ins for Pulsar and S3.
+
+Messages are published to a FakeBroker for the transformed-annotations and transformed{_TOPIC}
+topics, with the entries they refer to in a FakeS3Client, and consumed by
+`annotations_ingester.__main__.ingest` with the given options. This always uses the pipelined
+runner, as eodhp_utils' runner can only connect to a real broker. The report gives the
+sustained throughput, publish-to-acknowledge latency percentiles and the growth in resident
+memory.
+
+Run from the repository root with, for example:
+    python -m benchmarks.loadtest --messages 5000 --rate 200 --s3-latency-ms 20 --workers 4
+    python -m benchmarks.loadtest --duration 3600 --rate 50 --output soak.json
+    python -m benchmarks.loadtest --replay recorded.jsonl
+    python -m benchmarks.loadtest --s3-rate-limit 300 --upload-concurrency 32 --adaptive-concurrency
+
+A recorded stream is a JSON Lines file with one {"topic": ..., "message": {...}} per message,
+where "message" is the harvester's message body. Each line may also have "entries", a map of
+key to entry body, which is put in the fake S3 bucket named by the message.
+"""
+
+import itertools
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from typing import Iterable, Iterator
+
+import click
+
+from annotations_ingester.__main__ import IngesterOptions, ingest
+from benchmarks.corpora import synthetic_collection, synthetic_qa_trig
+from benchmarks.fakes import FakeBroker, FakePulsarClient, FakeS3Client
+from benchmarks.suite import percentile
+
+SOURCE_BUCKET = "loadtest-harvested"
+OUTPUT_BUCKET = "loadtest-public"
+ANNOTATIONS_TOPIC = "transformed-annotations"
+
+
+def synthetic_stream(
+    distinct_entries: int, annotation_ratio: float, links: int, measurements: int
+) -> Iterator[tuple[str, dict, dict]]:
+    """
+    Yields (topic, message, entries) for `distinct_entries` entries, which are a mix of QA
+    annotations and STAC Collections. Repeating the stream updates the same entries again.
+    """
+    annotations = round(distinct_entries * annotation_ratio)
+
+    for i in range(distinct_entries):
+        if i < annotations:
+            topic = ANNOTATIONS_TOPIC
+            key = f"transformed/catalogs/loadtest/collections/c{i}/qa{i}.trig"
+            body = synthetic_qa_trig(measurements, seed=i)
+        else:
+            topic = "transformed"
+            key = f"transformed/catalogs/loadtest/collections/c{i}.json"
+            body = json.dumps(synthetic_collection(links, collection_id=f"c{i}", seed=i))
+
+        message = {
+            "id": f"loadtest-{i}",
+            "bucket_name": SOURCE_BUCKET,
+            "source": "/",
+            "target": "/",
+            "added_keys": [],
+            "updated_keys": [key],
+            "deleted_keys": [],
+        }
+        yield topic, message, {key: body}
+
+
+def recorded_stream(path: str) -> Iterator[tuple[str, dict, dict]]:
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield record["topic"], record["message"], record.get("entries", {})
+
+
+def rss_bytes() -> int:
+    """Resident memory of this process, or its peak where the current figure isn't available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemorySampler(threading.Thread):
+    def __init__(self, interval: float):
+        super().__init__(name="memory-sampler", daemon=True)
+        self.interval = interval
+        self.samples: list[tuple[float, int]] = []
+        self._stop_event = threading.Event()
+        self._started_at = time.monotonic()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.samples.append((time.monotonic() - self._started_at, rss_bytes()))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.samples.append((time.monotonic() - self._started_at, rss_bytes()))
+
+
+def run_load_test(
+    stream: Iterable[tuple[str, dict, dict]],
+    options: IngesterOptions,
+    messages: int = None,
+    duration: float = None,
+    rate: float = 0,
+    s3_latency: float = 0,
+    s3_error_rate: float = 0,
+    s3_rate_limit: float = 0,
+    settle_timeout: float = 300,
+    topic_identifier: str = "",
+    memory_interval: float = 1.0,
+) -> dict:
+    """
+    Publishes the stream, repeated as needed, until `messages` have been sent or `duration`
+    seconds have passed, at `rate` messages per second (0 for as fast as possible). Then waits
+    for them all to be acknowledged and returns a report. Fake S3 requests beyond
+    `s3_rate_limit` a second are throttled.
+    """
+    stream = list(stream)
+    s3_client = FakeS3Client(latency=s3_latency, seed=0)
+    for _, message, entries in stream:
+        for key, body in entries.items():
+            s3_client.put_object(Bucket=message["bucket_name"], Key=key, Body=body)
+
+    # Errors are only injected once the inputs are in place.
+    s3_client.error_rate = s3_error_rate
+    s3_client.rate_limit = s3_rate_limit
+    input_puts = s3_client.put_count
+
+    broker = FakeBroker(redelivery_delay=0.1)
+    stop_event = threading.Event()
+    ingester = threading.Thread(
+        target=ingest,
+        args=(options, s3_client, OUTPUT_BUCKET, topic_identifier),
+        kwargs={"client": FakePulsarClient(broker), "stop_event": stop_event},
+        name="ingester",
+    )
+
+    sampler = MemorySampler(memory_interval)
+    sampler.start()
+    ingester.start()
+
+    started = time.monotonic()
+    published = 0
+    for topic, message, _ in itertools.cycle(stream):
+        if messages is not None and published >= messages:
+            break
+        if duration is not None and time.monotonic() - started >= duration:
+            break
+
+        if topic == "transformed" and topic_identifier:
+            topic = f"transformed{topic_identifier}"
+
+        if rate > 0:
+            time.sleep(max(0.0, started + published / rate - time.monotonic()))
+
+        broker.publish(topic, json.dumps(message).encode("utf-8"))
+        published += 1
+
+    publishing_time = time.monotonic() - started
+    settled = broker.wait_until_settled(settle_timeout)
+    elapsed = time.monotonic() - started
+
+    stop_event.set()
+    ingester.join()
+    sampler.stop()
+
+    latencies = sorted(broker.latencies)
+    rss = [value for _, value in sampler.samples]
+
+    return {
+        "options": options.__dict__,
+        "published": published,
+        "acknowledged": broker.acknowledged,
+        "redelivered": broker.redelivered,
+        "settled": settled,
+        "publishing_s": publishing_time,
+        "elapsed_s": elapsed,
+        "throughput_msgs_per_s": broker.acknowledged / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "p50": percentile(latencies, 50) * 1000 if latencies else None,
+            "p95": percentile(latencies, 95) * 1000 if latencies else None,
+            "p99": percentile(latencies, 99) * 1000 if latencies else None,
+            "max": latencies[-1] * 1000 if latencies else None,
+        },
+        "memory": {
+            "rss_start_bytes": rss[0],
+            "rss_end_bytes": rss[-1],
+            "rss_peak_bytes": max(rss),
+            "rss_growth_bytes": rss[-1] - rss[0],
+            "samples": sampler.samples,
+        },
+        "s3_puts": s3_client.put_count - input_puts,
+        "s3_throttled": s3_client.throttled,
+    }
+
+
+@click.command
+@click.option("--messages", "-n", type=int, help="Messages to publish.")
+@click.option("--duration", type=float, help="Seconds to publish for, instead of --messages.")
+@click.option("--rate", default=0.0, help="Messages per second to publish. 0 publishes at once.")
+@click.option("--replay", type=click.Path(exists=True, dir_okay=False), help="Recorded stream.")
+@click.option("--distinct-entries", default=1000, help="Entries in the synthetic stream.")
+@click.option("--annotation-ratio", default=0.5, help="Fraction of synthetic annotations.")
+@click.option("--links", default=100, help="Links in each synthetic STAC Collection.")
+@click.option("--measurements", default=10, help="Measurements in each synthetic QA run.")
+@click.option("--s3-latency-ms", default=0.0, help="Latency of each fake S3 request.")
+@click.option("--s3-error-rate", default=0.0, help="Fraction of fake S3 requests which fail.")
+@click.option("--s3-rate-limit", default=0.0, help="Fake S3 requests a second before throttling.")
+@click.option("--workers", default=0)
+@click.option("--max-in-flight", type=int)
+@click.option("--upload-concurrency", default=0)
+@click.option("--batch-size", default=1)
+@click.option("--batch-wait-ms", default=0)
+@click.option("--coalesce-window-ms", default=0)
+@click.option("--output-cache-size", default=0)
+@click.option("--adaptive-concurrency", is_flag=True, default=False)
+@click.option("--settle-timeout", default=300.0, help="Seconds to wait for the backlog to clear.")
+@click.option("--output", "-o", type=click.Path(dir_okay=False), help="File to write JSON to.")
+@click.option("-v", "--verbose", count=True)
+def main(
+    messages: int,
+    duration: float,
+    rate: float,
+    replay: str,
+    distinct_entries: int,
+    annotation_ratio: float,
+    links: int,
+    measurements: int,
+    s3_latency_ms: float,
+    s3_error_rate: float,
+    s3_rate_limit: float,
+    settle_timeout: float,
+    output: str,
+    verbose: int,
+    **ingester_options,
+):
+    # Injected failures are logged as errors, so only show them when asked.
+    logging.basicConfig(level=max(logging.DEBUG, logging.CRITICAL - 10 * verbose))
+
+    if messages is None and duration is None:
+        messages = distinct_entries
+
+    if replay:
+        stream = recorded_stream(replay)
+    else:
+        stream = synthetic_stream(distinct_entries, annotation_ratio, links, measurements)
+
+    report = run_load_test(
+        stream,
+        IngesterOptions(**ingester_options),
+        messages=messages,
+        duration=duration,
+        rate=rate,
+        s3_latency=s3_latency_ms / 1000,
+        s3_error_rate=s3_error_rate,
+        s3_rate_limit=s3_rate_limit,
+        settle_timeout=settle_timeout,
+    )
+
+    latency = report["latency_ms"]
+    click.echo(
+        f"{report['acknowledged']}/{report['published']} acknowledged"
+        f" ({report['redelivered']} redeliveries, {report['s3_throttled']} throttled)"
+        f" in {report['elapsed_s']:.1f} s:"
+        f" {report['throughput_msgs_per_s']:.1f} msgs/s,"
+        f" latency p50 {latency['p50']:.1f} ms p95 {latency['p95']:.1f} ms"
+        f" p99 {latency['p99']:.1f} ms,"
+        f" RSS growth {report['memory']['rss_growth_bytes'] / 2**20:.1f} MiB",
+        err=True,
+    )
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
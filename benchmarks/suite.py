@@ -0,0 +1,213 @@
+"""
+Benchmarks the generators against synthetic corpora (see benchmarks/corpora.py), reporting
+throughput, latency percentiles and peak traced memory for each case as JSON.
+
+Run from the repository root with, for example:
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --measurements 10,1000,100000 --compare baseline.json
+
+With --compare, a case regresses when its median latency or peak memory is more than
+--threshold (as a fraction) above the baseline's, and the exit status is 1 if any do. Baselines
+are only meaningful from the same machine.
+"""
+
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Callable
+
+import click
+import rdflib
+
+from annotations_ingester.annotations_generator import (
+    AnnotationsMessager,
+    get_uuid_from_graph,
+    parse_annotation,
+)
+from annotations_ingester.dataset_dcat_generator import DatasetDCATMessager
+from benchmarks.corpora import (
+    synthetic_catalog,
+    synthetic_collection,
+    synthetic_qa_trig,
+)
+
+RESULTS_VERSION = 1
+
+# Measures compared against a baseline, all of which are better when lower, with the smallest
+# absolute increase that counts. Small cases allocate too little for their peaks to be stable.
+COMPARED_MEASURES = {"p50_ms": 0, "peak_memory_bytes": 64 * 1024}
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    """The nearest-rank percentile, for q between 0 and 100."""
+    rank = max(1, round(q / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def measure(fn: Callable, max_iterations: int, max_time: float, min_iterations: int = 3) -> dict:
+    """
+    Times fn until max_iterations calls or max_time seconds, then calls it once more with
+    tracemalloc running to find its peak memory use.
+    """
+    fn()  # Warm up, filling caches such as rdflib's plugin registry.
+
+    latencies = []
+    started = time.perf_counter()
+    while len(latencies) < max_iterations:
+        call_started = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - call_started)
+
+        if len(latencies) >= min_iterations and time.perf_counter() - started > max_time:
+            break
+
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "iterations": len(latencies),
+        "throughput_per_s": len(latencies) / elapsed,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "peak_memory_bytes": peak,
+    }
+
+
+def build_cases(link_counts: list[int], measurement_counts: list[int]) -> dict[str, Callable]:
+    dcat_messager = DatasetDCATMessager(None, "bucket")
+    annotations_messager = AnnotationsMessager(None, "bucket")
+
+    cases = {}
+    for links in link_counts:
+        catalog = synthetic_catalog(links)
+        collection = synthetic_collection(links)
+
+        cases[f"generate_dcat/catalog/links={links}"] = (
+            lambda stac=catalog: dcat_messager.generate_dcat(stac)
+        )
+        cases[f"generate_dcat/collection/links={links}"] = (
+            lambda stac=collection: dcat_messager.generate_dcat(stac)
+        )
+
+    for measurements in measurement_counts:
+        trig = synthetic_qa_trig(measurements)
+        dataset = parse_annotation(trig)
+
+        cases[f"process_update_body/measurements={measurements}"] = (
+            lambda body=trig: annotations_messager.process_update_body(
+                body, "catalogs/benchmark/collections/benchmark/annotations/qa.trig", "/", "/"
+            )
+        )
+        cases[f"get_uuid_from_graph/measurements={measurements}"] = (
+            lambda graph=dataset: get_uuid_from_graph(graph)
+        )
+
+    return cases
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Returns a description of each measure which regressed by more than threshold."""
+    regressions = []
+
+    for case, current in results["results"].items():
+        previous = baseline["results"].get(case)
+        if previous is None:
+            continue
+
+        for measure_name, min_increase in COMPARED_MEASURES.items():
+            before, after = previous.get(measure_name), current.get(measure_name)
+            if not before or after is None:
+                continue
+
+            if after > before * (1 + threshold) and after - before > min_increase:
+                regressions.append(
+                    f"{case}: {measure_name} {before:.6g} -> {after:.6g}"
+                    f" ({(after - before) / before:+.0%})"
+                )
+
+    return regressions
+
+
+def parse_counts(value: str) -> list[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+@click.command
+@click.option("--links", default="10,1000,10000", help="Comma-separated STAC link counts.")
+@click.option(
+    "--measurements", default="10,100,1000", help="Comma-separated QA measurement counts."
+)
+@click.option("--only", help="Only run cases whose name contains this.")
+@click.option("--max-iterations", default=200, help="Most calls to time per case.")
+@click.option("--max-time", default=2.0, help="Most seconds to spend timing each case.")
+@click.option("--output", "-o", type=click.Path(dir_okay=False), help="File to write JSON to.")
+@click.option("--compare", "baseline_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--threshold", default=0.2, help="Fractional slow-down counted as a regression.")
+def main(
+    links: str,
+    measurements: str,
+    only: str,
+    max_iterations: int,
+    max_time: float,
+    output: str,
+    baseline_path: str,
+    threshold: float,
+):
+    cases = build_cases(parse_counts(links), parse_counts(measurements))
+
+    results = {
+        "version": RESULTS_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "rdflib": rdflib.__version__,
+        "machine": platform.machine(),
+        "results": {},
+    }
+
+    for name, fn in cases.items():
+        if only and only not in name:
+            continue
+
+        stats = measure(fn, max_iterations, max_time)
+        results["results"][name] = stats
+        click.echo(
+            f"{name:<45} {stats['throughput_per_s']:10.1f}/s"
+            f"  p50 {stats['p50_ms']:9.3f} ms  p95 {stats['p95_ms']:9.3f} ms"
+            f"  p99 {stats['p99_ms']:9.3f} ms  peak {stats['peak_memory_bytes'] / 1024:10.1f} KiB",
+            err=True,
+        )
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        click.echo(json.dumps(results, indent=2))
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline, threshold)
+        for regression in regressions:
+            click.echo(f"REGRESSION {regression}", err=True)
+
+        if regressions:
+            sys.exit(1)
+
+        click.echo(f"No regressions against {baseline_path}", err=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,19 @@
 import collections
+import io
+import json
 
 import pytest
+from rdflib import XSD, Graph, Literal
+from rdflib.plugins.parsers.trig import TrigParser
 
 from annotations_ingester.annotations_generator import (
     AnnotationsMessager,
+    InvalidAnnotationError,
     get_uuid_from_graph,
+    parse_annotation,
+    prescan_uuid,
 )
+from annotations_ingester.jsonld_context import with_inline_context
 
 
 @pytest.fixture
@@ -129,8 +137,125 @@ def test_process_update_body(mock_file_contents, mock_uuid):
 
     assert isinstance(actions, collections.abc.Sequence)
 
-    assert len(actions) == 2
+    assert len(actions) == 3
 
     assert actions[0].bucket == bucket_name
     assert actions[0].cache_control == "max-age=604800"
     assert mock_uuid in actions[0].key
+
+    # The UUID is recorded for when the annotation is deleted.
+    assert actions[2].key == "annotation-sources/path"
+    assert actions[2].file_body == mock_uuid
+
+
+@pytest.fixture
+def trig_parse_counter(monkeypatch):
+    calls = []
+    original_parse = TrigParser.parse
+
+    def counting_parse(self, *args, **kwargs):
+        calls.append(1)
+        return original_parse(self, *args, **kwargs)
+
+    monkeypatch.setattr(TrigParser, "parse", counting_parse)
+    return calls
+
+
+def test_process_update_body_parses_once(mock_file_contents, trig_parse_counter):
+    messenger = AnnotationsMessager(None, "test_bucket", None, None)
+
+    messenger.process_update_body(mock_file_contents.encode("utf-8"), "path", "source", "target")
+
+    assert len(trig_parse_counter) == 1
+
+
+def test_get_uuid_from_parsed_graph_does_not_reparse(
+    mock_uuid, mock_file_contents, trig_parse_counter
+):
+    dataset = parse_annotation(mock_file_contents)
+
+    assert get_uuid_from_graph(dataset) == mock_uuid
+    assert len(trig_parse_counter) == 1
+
+
+def test_process_update_body_outputs_default_graph(mock_file_contents):
+    messenger = AnnotationsMessager(None, "test_bucket", None, None)
+
+    actions = messenger.process_update_body(
+        mock_file_contents.encode("utf-8"), "path", "source", "target"
+    )
+
+    expected = Graph()
+    expected.parse(data=mock_file_contents, format="trig")
+
+    for action in actions[:2]:
+        g = Graph()
+        g.parse(io.StringIO(with_inline_context_if_jsonld(action)), format=action.mime_type)
+        assert plain_strings(g).isomorphic(plain_strings(expected))
+
+
+def with_inline_context_if_jsonld(action) -> str:
+    if action.mime_type == "application/ld+json":
+        return with_inline_context(action.file_body)
+
+    return action.file_body
+
+
+def plain_strings(graph: Graph) -> Graph:
+    """
+    Returns graph with xsd:string literals made plain. They're the same in RDF 1.1, but not to
+    rdflib, and compacted JSON-LD doesn't distinguish them.
+    """
+    result = Graph()
+    for s, p, o in graph:
+        if isinstance(o, Literal) and o.datatype == XSD.string:
+            o = Literal(str(o))
+        result.add((s, p, o))
+
+    return result
+
+
+def test_jsonld_output_is_compacted(mock_file_contents):
+    messenger = AnnotationsMessager(None, "test_bucket", jsonld_context_url="https://x/ctx.jsonld")
+
+    _, jsonld, _ = messenger.process_update_body(
+        mock_file_contents.encode("utf-8"), "path", "source", "target"
+    )
+
+    document = json.loads(jsonld.file_body)
+    assert document["@context"] == "https://x/ctx.jsonld"
+    assert "http://www.w3.org/ns/prov#" not in jsonld.file_body
+
+
+def test_prescan_finds_uuid(mock_uuid, mock_file_contents):
+    assert prescan_uuid(mock_file_contents) == mock_uuid
+    assert prescan_uuid(mock_file_contents.encode("utf-8")) == mock_uuid
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        "",
+        "<https://example.com/a> <https://example.com/b> <urn:uuid:1234> .",
+        "<https://example.com/a> a <https://eodatahub.org.uk/api/ontologies/qa/"
+        "EODHQualityMeasurementDataset> .",
+    ],
+)
+def test_prescan_rejects_malformed_bodies(body, trig_parse_counter):
+    messenger = AnnotationsMessager(None, "test_bucket", None, None)
+
+    with pytest.raises(InvalidAnnotationError):
+        messenger.process_update_body(body.encode("utf-8"), "path", "source", "target")
+
+    assert len(trig_parse_counter) == 0
+
+
+def test_missing_uuid_raises_invalid_annotation(mock_file_contents, mock_uuid):
+    # This passes the pre-scan but the urn:uuid isn't attached to the run.
+    body = mock_file_contents.replace(
+        f"owl:sameAs                  <urn:uuid:{mock_uuid}>;",
+        f"rdfs:seeAlso                <urn:uuid:{mock_uuid}>;",
+    )
+
+    with pytest.raises(InvalidAnnotationError):
+        get_uuid_from_graph(body)
@@ -0,0 +1,162 @@
+import json
+import shutil
+
+import pytest
+
+from annotations_ingester.backfill import (
+    Checkpoint,
+    SourceEntry,
+    local_entries,
+    parse_s3_url,
+    run_backfill,
+    s3_entries,
+)
+from annotations_ingester.dataset_dcat_generator import DatasetDCATMessager
+from benchmarks.fakes import FakeS3Client
+
+OUTPUT_BUCKET = "public"
+
+
+@pytest.fixture
+def source_dir(tmp_path):
+    root = tmp_path / "transformed"
+    collections = root / "catalogs" / "test" / "collections"
+    (collections / "s2" / "annotations").mkdir(parents=True)
+
+    shutil.copy("test_data/test_dcat_generation_s2_l2a.json", collections / "s2.json")
+    shutil.copy("ontology/qa-output-1.trig", collections / "s2" / "annotations" / "qa.trig")
+    (collections / "README.md").write_text("Not an entry")
+
+    return root
+
+
+def read_local(entry: SourceEntry) -> bytes:
+    with open(entry.location, "rb") as f:
+        return f.read()
+
+
+def output_keys(s3_client: FakeS3Client) -> set[str]:
+    return {key for bucket, key in s3_client.objects if bucket == OUTPUT_BUCKET}
+
+
+def test_local_entries_are_in_key_order(source_dir):
+    entries = list(local_entries(str(source_dir)))
+
+    assert [(e.key, e.kind) for e in entries] == [
+        ("catalogs/test/collections/s2.json", "stac"),
+        ("catalogs/test/collections/s2/annotations/qa.trig", "annotation"),
+    ]
+    assert [e.key for e in entries] == sorted(e.key for e in entries)
+
+
+def test_backfill_uploads_outputs_and_saves_checkpoint(source_dir, tmp_path):
+    s3_client = FakeS3Client()
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"), str(source_dir))
+
+    run_backfill(
+        local_entries(str(source_dir)),
+        read_local,
+        DatasetDCATMessager(s3_client, OUTPUT_BUCKET),
+        checkpoint,
+        max_in_flight=1,
+    )
+
+    keys = output_keys(s3_client)
+    assert any(key.endswith(".ttl") for key in keys)
+    assert any("s2/annotations" in key for key in keys)
+
+    with open(tmp_path / "checkpoint.json") as f:
+        saved = json.load(f)
+
+    assert saved["last_key"] == "catalogs/test/collections/s2/annotations/qa.trig"
+    assert saved["processed"] == 2
+    assert saved["failed"] == 0
+
+
+def test_backfill_resumes_after_checkpoint(source_dir, tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    checkpoint = Checkpoint(path, str(source_dir))
+    checkpoint.advance("catalogs/test/collections/s2.json", failed=False)
+    checkpoint.save()
+
+    s3_client = FakeS3Client()
+    resumed = run_backfill(
+        local_entries(str(source_dir)),
+        read_local,
+        DatasetDCATMessager(s3_client, OUTPUT_BUCKET),
+        Checkpoint(path, str(source_dir)),
+    )
+
+    assert resumed.processed == 2
+    assert output_keys(s3_client)
+    assert all("s2/annotations" in key for key in output_keys(s3_client))
+
+
+def test_backfill_records_failed_keys(source_dir, tmp_path):
+    (source_dir / "catalogs" / "broken.json").write_text("{")
+    path = str(tmp_path / "checkpoint.json")
+
+    checkpoint = run_backfill(
+        local_entries(str(source_dir)),
+        read_local,
+        DatasetDCATMessager(FakeS3Client(), OUTPUT_BUCKET),
+        Checkpoint(path, str(source_dir)),
+    )
+
+    assert checkpoint.processed == 3
+    assert checkpoint.failed == 1
+    with open(f"{path}.failed") as f:
+        assert f.read() == "catalogs/broken.json\n"
+
+
+def test_dry_run_writes_nothing(source_dir, tmp_path):
+    s3_client = FakeS3Client()
+    path = tmp_path / "checkpoint.json"
+
+    checkpoint = run_backfill(
+        local_entries(str(source_dir)),
+        read_local,
+        DatasetDCATMessager(s3_client, OUTPUT_BUCKET),
+        Checkpoint(str(path), str(source_dir), read_only=True),
+        dry_run=True,
+    )
+
+    assert checkpoint.processed == 2
+    assert not s3_client.objects
+    assert not path.exists()
+
+
+def test_checkpoint_for_another_source_is_rejected(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    Checkpoint(path, "s3://a/").save()
+
+    with pytest.raises(Exception, match="is for s3://a/"):
+        Checkpoint(path, "s3://b/")
+
+
+def test_backfill_from_s3_prefix(source_dir):
+    s3_client = FakeS3Client()
+    for entry in local_entries(str(source_dir)):
+        s3_client.put_object(
+            Bucket="harvested", Key=f"transformed/{entry.key}", Body=read_local(entry)
+        )
+
+    bucket, prefix = parse_s3_url("s3://harvested/transformed/")
+    entries = list(s3_entries(s3_client, bucket, prefix))
+    assert [e.key for e in entries] == [e.key for e in local_entries(str(source_dir))]
+
+    checkpoint = run_backfill(
+        iter(entries),
+        lambda entry: s3_client.get_object(Bucket=bucket, Key=entry.location)["Body"].read(),
+        DatasetDCATMessager(s3_client, OUTPUT_BUCKET),
+        Checkpoint(None, "s3://harvested/transformed/"),
+    )
+
+    assert checkpoint.failed == 0
+    assert output_keys(s3_client)
+
+
+def test_parse_s3_url():
+    assert parse_s3_url("s3://bucket/some/prefix/") == ("bucket", "some/prefix/")
+    assert parse_s3_url("s3://bucket") == ("bucket", "")
+    assert parse_s3_url("/local/path") is None
@@ -0,0 +1,67 @@
+import pystac
+from rdflib.namespace import RDF
+
+from annotations_ingester.annotations_generator import (
+    get_uuid_from_graph,
+    parse_annotation,
+)
+from annotations_ingester.dataset_dcat_generator import DatasetDCATMessager
+from benchmarks.corpora import (
+    synthetic_catalog,
+    synthetic_collection,
+    synthetic_qa_trig,
+)
+from benchmarks.suite import compare, measure, percentile
+
+
+def test_synthetic_qa_trig_is_a_valid_annotation():
+    run_uuid = "7462319b-947c-4900-83a7-5341362cfab6"
+    trig = synthetic_qa_trig(25, run_uuid=run_uuid)
+    dataset = parse_annotation(trig)
+
+    assert get_uuid_from_graph(dataset) == run_uuid
+    measurements = set(
+        s for s, _, _, _ in dataset.quads((None, RDF.type, None, None)) if "measurement" in s
+    )
+    assert len(measurements) == 25
+
+
+def test_synthetic_stac_uses_the_dict_fast_path():
+    messager = DatasetDCATMessager(None, None)
+
+    for stac in (synthetic_catalog(50), synthetic_collection(50)):
+        record = messager.record_from_dict(stac)
+        pystac_obj = pystac.read_dict(stac)
+
+        assert record.iri == pystac_obj.get_self_href()
+
+    assert len(messager.record_from_dict(synthetic_collection(5)).identifiers) == 3
+
+
+def test_percentile():
+    values = list(range(1, 101))
+
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([7], 95) == 7
+
+
+def test_measure_reports_stats():
+    stats = measure(lambda: bytearray(100_000), max_iterations=5, max_time=10)
+
+    assert stats["iterations"] == 5
+    assert stats["p50_ms"] <= stats["p99_ms"]
+    assert stats["peak_memory_bytes"] >= 100_000
+
+
+def test_compare_flags_regressions():
+    baseline = {"results": {"a": {"p50_ms": 1.0, "peak_memory_bytes": 1_000_000}, "b": {}}}
+    results = {
+        "results": {
+            "a": {"p50_ms": 1.5, "peak_memory_bytes": 1_100_000},
+            "c": {"p50_ms": 100.0, "peak_memory_bytes": 1},
+        }
+    }
+
+    assert compare(results, baseline, threshold=0.2) == ["a: p50_ms 1 -> 1.5 (+50%)"]
+    assert compare(results, baseline, threshold=0.6) == []
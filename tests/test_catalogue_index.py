@@ -0,0 +1,158 @@
+import json
+
+import pytest
+from rdflib import DCAT, DCTERMS, RDFS, Graph, Literal, URIRef
+
+from annotations_ingester.backfill import local_entries
+from annotations_ingester.catalogue_index import (
+    CatalogueIndex,
+    catalogue_records,
+    rebuild_index,
+)
+from annotations_ingester.dataset_dcat_generator import DatasetDCATMessager
+from annotations_ingester.jsonld_context import with_inline_context
+from annotations_ingester.uploads import UploadExecutor
+from benchmarks.fakes import FakeS3Client
+
+BUCKET = "test-bucket"
+CATALOGUE_URL = "https://example.com/stac/"
+
+
+def stac(stac_type: str, path: str, doi: str = None) -> dict:
+    document = {
+        "type": stac_type,
+        "stac_version": "1.0.0",
+        "id": path.rsplit("/", 1)[-1],
+        "description": "",
+        "links": [{"rel": "self", "href": CATALOGUE_URL + path}],
+    }
+    if stac_type == "Collection":
+        document.update(license="proprietary", extent={})
+    if doi:
+        document["sci:doi"] = doi
+
+    return document
+
+
+ENTRIES = {
+    "catalogs/c.json": stac("Catalog", "catalogs/c"),
+    "catalogs/c/collections/x.json": stac("Collection", "catalogs/c/collections/x", "10.1/x"),
+    "catalogs/c/collections/y.json": stac("Collection", "catalogs/c/collections/y"),
+    "catalogs/d/collections/z.json": stac("Collection", "catalogs/d/collections/z"),
+}
+
+
+@pytest.fixture
+def executor():
+    executor = UploadExecutor(max_concurrency=4)
+    yield executor
+    executor.shutdown()
+
+
+def index_graph(s3_client, index: CatalogueIndex, extension: str = ".ttl") -> Graph:
+    graph = Graph()
+    for shard in range(index.shards):
+        key = (BUCKET, index.shard_key_root(shard) + extension)
+        if key in s3_client.objects:
+            body = s3_client.objects[key]["Body"]
+            if extension == ".ttl":
+                graph.parse(data=body, format="turtle")
+            else:
+                graph.parse(data=with_inline_context(body.decode()), format="json-ld")
+
+    return graph
+
+
+def ingest(executor, messager, entries: dict):
+    for cat_path, document in entries.items():
+        executor.run(messager, messager.process_update_stac(document, cat_path, "/", "/"))
+
+
+def listed(graph: Graph) -> set[str]:
+    return {str(o) for _, p, o in graph if p in (DCAT.dataset, DCAT.catalog)}
+
+
+def test_each_entry_is_listed_in_one_shard(executor):
+    s3_client = FakeS3Client()
+    index = CatalogueIndex(4, CATALOGUE_URL)
+    messager = DatasetDCATMessager(s3_client, BUCKET, index=index)
+
+    ingest(executor, messager, ENTRIES)
+
+    for extension in (".ttl", ".jsonld"):
+        graph = index_graph(s3_client, index, extension)
+        assert listed(graph) == {CATALOGUE_URL + path[:-5] for path in ENTRIES}
+
+        x = URIRef(CATALOGUE_URL + "catalogs/c/collections/x")
+        assert (x, DCTERMS.identifier, Literal("10.1/x")) in graph
+        assert (x, RDFS.seeAlso, URIRef(CATALOGUE_URL + "catalogs/c/collections/x.ttl")) in graph
+        assert (URIRef(CATALOGUE_URL + "catalogs/c"), None, None) in graph
+
+
+def test_an_update_changes_one_shard(executor):
+    s3_client = FakeS3Client()
+    index = CatalogueIndex(4, CATALOGUE_URL)
+    messager = DatasetDCATMessager(s3_client, BUCKET, index=index)
+    ingest(executor, messager, ENTRIES)
+
+    cat_path = "catalogs/c/collections/x.json"
+    actions = messager.process_update_stac(stac("Collection", cat_path[:-5]), cat_path, "/", "/")
+    shard_keys = {index.shard_key_root(index.shard_of(cat_path)) + e for e in (".ttl", ".jsonld")}
+    assert {action.key for action in actions[2:]} == shard_keys
+
+    executor.run(messager, actions)
+    graph = index_graph(s3_client, index)
+    assert (None, DCTERMS.identifier, Literal("10.1/x")) not in graph
+    assert len(listed(graph)) == len(ENTRIES)
+
+    # Re-sending it doesn't rewrite the shard.
+    puts = s3_client.put_count
+    executor.run(
+        messager,
+        messager.process_update_stac(stac("Collection", cat_path[:-5]), cat_path, "/", "/"),
+    )
+    assert s3_client.put_count == puts + 2
+
+
+def test_deleting_a_catalog_removes_the_entries_beneath_it(executor):
+    s3_client = FakeS3Client()
+    index = CatalogueIndex(4, CATALOGUE_URL)
+    messager = DatasetDCATMessager(s3_client, BUCKET, index=index)
+    ingest(executor, messager, ENTRIES)
+
+    executor.run(messager, messager.process_delete(cat_path="catalogs/d/collections/z.json"))
+    executor.run(messager, messager.process_delete(cat_path="catalogs/c.json"))
+
+    for extension in (".ttl", ".jsonld"):
+        assert listed(index_graph(s3_client, index, extension)) == set()
+
+
+def test_rebuild_matches_the_incremental_index(executor, tmp_path):
+    incremental, rebuilt = FakeS3Client(), FakeS3Client()
+    index = CatalogueIndex(4, CATALOGUE_URL)
+    ingest(executor, DatasetDCATMessager(incremental, BUCKET, index=index), ENTRIES)
+
+    for cat_path, document in ENTRIES.items():
+        path = tmp_path / cat_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(document))
+    (tmp_path / "catalogs/c/collections/x/items").mkdir(parents=True)
+    (tmp_path / "catalogs/c/collections/x/items/i.json").write_text("not read")
+    rebuilt.put_object(Bucket=BUCKET, Key="catalogue/index/0009.ttl", Body="stale")
+
+    def read(entry) -> bytes:
+        with open(entry.location, "rb") as f:
+            return f.read()
+
+    records = catalogue_records(local_entries(str(tmp_path)), read)
+    stats = rebuild_index(rebuilt, BUCKET, index, records)
+
+    assert stats == {"entries": len(ENTRIES), "shards": 4, "deleted": 1, "failed": 0}
+    for shard in range(index.shards):
+        for extension in (".ttl", ".jsonld"):
+            key = (BUCKET, index.shard_key_root(shard) + extension)
+            if key in incremental.objects:
+                assert rebuilt.objects[key]["Body"] == incremental.objects[key]["Body"]
+
+    root = Graph().parse(data=rebuilt.objects[(BUCKET, "catalogue/index/catalog.ttl")]["Body"])
+    assert len(list(root.objects(None, DCAT.catalog))) == 4
@@ -0,0 +1,101 @@
+import json
+
+from annotations_ingester.coalescing import Coalescer, PrunedMessage, unwrap
+
+
+class FakeMessage:
+    def __init__(self, topic: str, data: bytes, message_id: int):
+        self._topic = topic
+        self._data = data
+        self._message_id = message_id
+
+    def topic_name(self):
+        return self._topic
+
+    def data(self):
+        return self._data
+
+    def message_id(self):
+        return self._message_id
+
+
+def harvest_message(message_id, added=(), updated=(), deleted=(), topic="transformed"):
+    body = {
+        "bucket_name": "bucket",
+        "source": "/",
+        "target": "/",
+        "added_keys": list(added),
+        "updated_keys": list(updated),
+        "deleted_keys": list(deleted),
+    }
+    return FakeMessage(topic, json.dumps(body).encode(), message_id)
+
+
+def test_newer_message_supersedes_older_one_for_same_keys():
+    coalescer = Coalescer(window=1)
+
+    assert coalescer.add(harvest_message(0, updated=["a"]), now=0) == []
+    superseded = coalescer.add(harvest_message(1, updated=["a"]), now=0.5)
+
+    assert [m.message_id() for m in superseded] == [0]
+    assert coalescer.pop_ready(now=1) == []
+    assert [m.message_id() for m in coalescer.pop_ready(now=1.5)] == [1]
+    assert coalescer.stats() == {
+        "messages_seen": 2,
+        "messages_superseded": 1,
+        "keys_seen": 2,
+        "keys_pruned": 1,
+    }
+
+
+def test_partially_superseded_message_is_pruned():
+    coalescer = Coalescer(window=1)
+
+    coalescer.add(harvest_message(0, added=["a", "b"], deleted=["c"]), now=0)
+    coalescer.add(harvest_message(1, updated=["b"]), now=0)
+    coalescer.add(harvest_message(2, added=["c"]), now=0)
+
+    pruned, newer_b, newer_c = coalescer.pop_ready(now=1)
+
+    assert isinstance(pruned, PrunedMessage)
+    assert unwrap(pruned).message_id() == 0
+    assert pruned.topic_name() == newer_b.topic_name()
+    body = json.loads(pruned.data())
+    assert body["added_keys"] == ["a"]
+    assert body["deleted_keys"] == []
+    assert unwrap(newer_b) is newer_b
+    assert coalescer.stats()["keys_pruned"] == 2
+
+
+def test_messages_on_other_topics_or_unparseable_are_not_coalesced():
+    coalescer = Coalescer(window=1)
+
+    coalescer.add(harvest_message(0, updated=["a"], topic="transformed"), now=0)
+    coalescer.add(FakeMessage("transformed", b"not json", 1), now=0)
+    superseded = coalescer.add(harvest_message(2, updated=["a"], topic="other"), now=0)
+
+    assert superseded == []
+    assert [m.message_id() for m in coalescer.flush()] == [0, 1, 2]
+    assert len(coalescer) == 0
+
+
+def test_released_messages_are_not_pruned():
+    coalescer = Coalescer(window=1)
+
+    coalescer.add(harvest_message(0, updated=["a"]), now=0)
+    [released] = coalescer.pop_ready(now=1)
+
+    assert coalescer.add(harvest_message(1, updated=["a"]), now=1) == []
+    assert unwrap(released) is released
+    assert coalescer.stats()["keys_pruned"] == 0
+
+
+def test_many_held_messages_are_superseded_in_order():
+    coalescer = Coalescer(window=1)
+    for n in range(20_000):
+        coalescer.add(harvest_message(n, updated=[f"k{n}"]), now=0)
+
+    superseded = coalescer.add(harvest_message(-1, updated=[f"k{n}" for n in range(20_000)]), now=0)
+
+    assert [m.message_id() for m in superseded] == list(range(20_000))
+    assert len(coalescer) == 1
@@ -0,0 +1,194 @@
+import io
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from annotations_ingester import content_addressing
+from annotations_ingester.content_addressing import (
+    CONTENT_CACHE_CONTROL,
+    CONTENT_PREFIX,
+    ContentAddressedLayout,
+    SweepState,
+    content_digest,
+    sweep_content,
+)
+from annotations_ingester.encodings import OutputEncoder
+from annotations_ingester.output_cache import (
+    InvalidatingS3Client,
+    OutputFingerprintCache,
+)
+from annotations_ingester.uploads import Messager, TemporaryFailure, UploadExecutor
+from benchmarks.fakes import FakeS3Client
+
+BUCKET = "test-bucket"
+GRACE = 3600
+TURTLE = "".join(f"<https://example.com/{n}> a <https://example.com/Thing> .\n" for n in range(50))
+
+
+def upload(key: str, body):
+    return Messager.S3UploadAction(key=key, file_body=body, mime_type="text/turtle")
+
+
+def run_uploads(s3_client, actions, encoder: OutputEncoder = None):
+    executor = UploadExecutor(max_concurrency=4, encoder=encoder, layout=ContentAddressedLayout())
+    try:
+        executor.run(SimpleNamespace(s3_client=s3_client, output_bucket=BUCKET), actions)
+    finally:
+        executor.shutdown()
+
+
+def content_key(body: str, extension: str = ".ttl") -> str:
+    return f"{CONTENT_PREFIX}{content_digest(body)}{extension}"
+
+
+def age(s3_client, key: str, seconds: float):
+    s3_client.objects[(BUCKET, key)]["LastModified"] = datetime.now(timezone.utc) - timedelta(
+        seconds=seconds
+    )
+
+
+def test_output_is_stored_by_content_with_an_alias():
+    s3_client = FakeS3Client()
+
+    run_uploads(s3_client, [upload("catalogue/catalogs/a.ttl", TURTLE)])
+
+    content = s3_client.objects[(BUCKET, content_key(TURTLE))]
+    assert content["Body"] == TURTLE.encode()
+    assert content["CacheControl"] == CONTENT_CACHE_CONTROL
+    assert content["ContentType"] == "text/turtle"
+
+    alias = s3_client.objects[(BUCKET, "catalogue/catalogs/a.ttl")]
+    assert alias["Body"] == b""
+    assert alias["CacheControl"] == "max-age=60"
+    assert alias["Metadata"] == {"content-key": content_key(TURTLE)}
+    assert alias["WebsiteRedirectLocation"] == (
+        f"/api/catalogue/stac/content/{content_digest(TURTLE)}.ttl"
+    )
+
+
+def test_identical_outputs_share_content():
+    s3_client = FakeS3Client()
+
+    run_uploads(
+        s3_client,
+        [upload("catalogue/a.ttl", TURTLE), upload("catalogue/b.ttl", TURTLE)],
+    )
+
+    assert [k for _, k in s3_client.objects if k.startswith(CONTENT_PREFIX)] == [
+        content_key(TURTLE)
+    ]
+
+
+def test_variants_are_made_of_the_content():
+    s3_client = FakeS3Client()
+
+    run_uploads(
+        s3_client,
+        [upload("catalogue/a.ttl", io.BytesIO(TURTLE.encode()))],
+        OutputEncoder(["gzip"]),
+    )
+
+    assert (BUCKET, content_key(TURTLE) + ".gz") in s3_client.objects
+    assert (BUCKET, "catalogue/a.ttl.gz") not in s3_client.objects
+
+
+def test_alias_is_not_written_if_the_content_fails():
+    cache = OutputFingerprintCache()
+    fake = FakeS3Client()
+    fake.failing_keys.add(content_key(TURTLE))
+    actions = cache.drop_unchanged([upload("catalogue/a.ttl", TURTLE)], BUCKET)
+
+    with pytest.raises(TemporaryFailure):
+        run_uploads(InvalidatingS3Client(fake, cache), actions)
+
+    assert (BUCKET, "catalogue/a.ttl") not in fake.objects
+    assert len(cache.drop_unchanged([upload("catalogue/a.ttl", TURTLE)], BUCKET)) == 1
+
+
+def test_sweep_deletes_content_unreferenced_for_the_grace_period(tmp_path):
+    s3_client = FakeS3Client()
+    run_uploads(s3_client, [upload("catalogue/a.ttl", "old " + TURTLE)], OutputEncoder(["gzip"]))
+    run_uploads(s3_client, [upload("catalogue/a.ttl", TURTLE)])
+    old_keys = [content_key("old " + TURTLE), content_key("old " + TURTLE) + ".gz"]
+    for key in old_keys + [content_key(TURTLE)]:
+        age(s3_client, key, 2 * GRACE)
+    state_path = str(tmp_path / "sweep.json")
+
+    first = sweep_content(s3_client, BUCKET, SweepState(state_path), GRACE)
+    assert first == {
+        "referenced": 1,
+        "unreferenced": 2,
+        "rewritten": 0,
+        "deleted": 0,
+        "failed": 0,
+    }
+
+    later = datetime.now(timezone.utc).timestamp() + GRACE
+    second = sweep_content(s3_client, BUCKET, SweepState(state_path), GRACE, now=later)
+    assert second["deleted"] == 2
+    assert all((BUCKET, key) not in s3_client.objects for key in old_keys)
+    assert (BUCKET, content_key(TURTLE)) in s3_client.objects
+    assert SweepState(state_path).unreferenced == {}
+
+
+def test_sweep_keeps_recently_written_content():
+    s3_client = FakeS3Client()
+    s3_client.put_object(Bucket=BUCKET, Key=content_key(TURTLE), Body=TURTLE)
+    state = SweepState(None)
+    state.unreferenced[content_key(TURTLE)] = 0.0
+
+    stats = sweep_content(s3_client, BUCKET, state, GRACE)
+
+    assert stats["deleted"] == 0
+    assert (BUCKET, content_key(TURTLE)) in s3_client.objects
+
+
+def test_sweep_keeps_content_rewritten_for_a_new_alias(monkeypatch):
+    s3_client = FakeS3Client()
+    run_uploads(s3_client, [upload("catalogue/a.ttl", TURTLE)], OutputEncoder(["gzip"]))
+    run_uploads(s3_client, [upload("catalogue/a.ttl", "new " + TURTLE)])
+    for key in (content_key(TURTLE), content_key(TURTLE) + ".gz"):
+        age(s3_client, key, 2 * GRACE)
+    state = SweepState(None)
+    state.unreferenced = {content_key(TURTLE): 0.0, content_key(TURTLE) + ".gz": 0.0}
+
+    # The alias moves back to the old content once the aliases have been listed.
+    listed = content_addressing.referenced_content
+
+    def referenced_then_rewritten(s3_client, bucket):
+        referenced = listed(s3_client, bucket)
+        run_uploads(s3_client, [upload("catalogue/a.ttl", TURTLE)])
+        return referenced
+
+    monkeypatch.setattr(content_addressing, "referenced_content", referenced_then_rewritten)
+    stats = sweep_content(s3_client, BUCKET, state, GRACE)
+
+    # The content object is listed as new, but its variant is only found to be by the check.
+    assert stats["rewritten"] == 1 and stats["deleted"] == 0
+    assert (BUCKET, content_key(TURTLE) + ".gz") in s3_client.objects
+
+
+def test_sweep_deletes_in_batches():
+    s3_client = FakeS3Client()
+    for n in range(2500):
+        s3_client.put_object(Bucket=BUCKET, Key=f"{CONTENT_PREFIX}{n:04}.ttl", Body="x")
+        age(s3_client, f"{CONTENT_PREFIX}{n:04}.ttl", 2 * GRACE)
+    s3_client.failing_keys.add(f"{CONTENT_PREFIX}0007.ttl")
+    state = SweepState(None)
+    state.unreferenced = {f"{CONTENT_PREFIX}{n:04}.ttl": 0.0 for n in range(2500)}
+
+    dry_run = sweep_content(s3_client, BUCKET, state, GRACE, dry_run=True)
+    assert dry_run["deleted"] == 2499 and s3_client.delete_requests == 0
+
+    stats = sweep_content(s3_client, BUCKET, state, GRACE)
+
+    assert stats == {
+        "referenced": 0,
+        "unreferenced": 2500,
+        "rewritten": 0,
+        "deleted": 2499,
+        "failed": 1,
+    }
+    assert s3_client.delete_requests == 3
+    assert list(state.unreferenced) == [f"{CONTENT_PREFIX}0007.ttl"]
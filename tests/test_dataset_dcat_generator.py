@@ -2,11 +2,17 @@ import copy
 import io
 import json
 
+import pystac
 import pytest
 from rdflib import DCTERMS, Graph, Literal, URIRef
 from rdflib.namespace import DCAT, RDF
 
-from annotations_ingester.dataset_dcat_generator import DatasetDCATMessager, Messager
+from annotations_ingester.dataset_dcat_generator import (
+    AmbiguousSTACError,
+    DatasetDCATMessager,
+    Messager,
+)
+from annotations_ingester.jsonld_context import with_inline_context
 
 SOURCE_PATH = "https://example.link.for.test/"
 TARGET = "/target_directory/"
@@ -155,8 +161,12 @@ def process_stac_to_graph(stac: dict) -> Graph:
     for action in actions:
         assert isinstance(action, Messager.S3UploadAction)
 
+        body = action.file_body
+        if action.mime_type == "application/ld+json":
+            body = with_inline_context(body)
+
         g = Graph()
-        g.parse(io.StringIO(action.file_body), format=action.mime_type)
+        g.parse(io.StringIO(body), format=action.mime_type)
 
     return g
 
@@ -218,3 +228,85 @@ def test_adds_scientific_extension_identifiers(mock_sentinel2_l2a_col):
     g = process_stac_to_graph(mock_sentinel2_l2a_col)
     assert (rootURI, DCTERMS.identifier, URIRef("https://doi.org/10.5270/S2_-742ikth")) in g
     assert (rootURI, DCTERMS.identifier, Literal("10.5270/S2_-742ikth")) in g
+
+
+def pystac_record(stac: dict):
+    """Generates a record using pystac only, for comparison with the dict-based path."""
+    messager = DatasetDCATMessager(None, None)
+    stac_obj = pystac.read_dict(copy.deepcopy(stac))
+
+    if isinstance(stac_obj, pystac.Collection):
+        return messager.record_for_collection(stac_obj)
+    else:
+        return messager.record_for_catalog(stac_obj)
+
+
+@pytest.mark.parametrize(
+    "fixture_name", ["mock_root_cat", "mock_catalog", "mock_sentinel2_l2a_col"]
+)
+def test_dict_extraction_matches_pystac(fixture_name, request):
+    stac = request.getfixturevalue(fixture_name)
+    messager = DatasetDCATMessager(None, None)
+
+    assert messager.record_from_dict(stac) == pystac_record(stac)
+
+
+@pytest.mark.parametrize(
+    "cite_as_href",
+    [
+        "doi",
+        "./doi",
+        "../../other/doi",
+        "/absolute/path",
+        "doi?x=1#frag",
+        "https://doi.org/10.5270/S2_-742ikth",
+        "urn:x:y",
+    ],
+)
+def test_dict_extraction_resolves_cite_as_like_pystac(cite_as_href, mock_sentinel2_l2a_col):
+    for link in mock_sentinel2_l2a_col["links"]:
+        if link["rel"] == "cite-as":
+            link["href"] = cite_as_href
+
+    messager = DatasetDCATMessager(None, None)
+
+    assert messager.record_from_dict(mock_sentinel2_l2a_col) == pystac_record(
+        mock_sentinel2_l2a_col
+    )
+
+
+def test_generate_record_skips_pystac(mock_sentinel2_l2a_col, mocker):
+    read_dict = mocker.spy(pystac, "read_dict")
+
+    record = DatasetDCATMessager(None, None).generate_record(mock_sentinel2_l2a_col)
+
+    assert record.iri == "https://earth-search.aws.element84.com/v1/collections/sentinel-2-l2a"
+    read_dict.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        lambda stac: stac["links"].append({"rel": "self", "href": "https://example.com/other"}),
+        lambda stac: stac["links"].__setitem__(0, {"rel": "self", "href": "relative/self.json"}),
+        lambda stac: stac["links"].append({"rel": "cite-as", "href": "//other.example.com/x"}),
+        lambda stac: stac.__setitem__("stac_version", "0.9.0"),
+    ],
+)
+def test_generate_record_falls_back_to_pystac_when_ambiguous(
+    change, mock_sentinel2_l2a_col, mocker
+):
+    # Put any new cite-as link first so that it's the one used.
+    mock_sentinel2_l2a_col["links"] = [
+        link for link in mock_sentinel2_l2a_col["links"] if link["rel"] != "cite-as"
+    ]
+    change(mock_sentinel2_l2a_col)
+    read_dict = mocker.spy(pystac, "read_dict")
+
+    messager = DatasetDCATMessager(None, None)
+    with pytest.raises(AmbiguousSTACError):
+        messager.record_from_dict(mock_sentinel2_l2a_col)
+
+    messager.generate_record(mock_sentinel2_l2a_col)
+
+    read_dict.assert_called_once()
@@ -0,0 +1,139 @@
+import copy
+import json
+
+import pytest
+from rdflib import DCAT, Graph, Literal
+from rdflib.compare import isomorphic
+
+from annotations_ingester.dataset_dcat_generator import DatasetDCATMessager
+from annotations_ingester.dcat_serialiser import DCATRecord
+from annotations_ingester.jsonld_context import with_inline_context
+
+SELF_IRI = "https://example.com/api/catalogue/stac/catalogs/cat/collections/col"
+
+
+def make_record(rdf_type=DCAT.Dataset, iri=SELF_IRI, identifiers=()):
+    record = DCATRecord(iri=iri, rdf_type=str(rdf_type))
+    record.add_identifier(iri, is_iri=True)
+    for value, is_iri in identifiers:
+        record.add_identifier(value, is_iri)
+
+    return record
+
+
+TEMPLATABLE_RECORDS = [
+    make_record(DCAT.Catalog),
+    make_record(DCAT.Dataset),
+    make_record(
+        identifiers=[("https://doi.org/10.5270/S2_-742ikth", True), ("10.5270/S2_-742ikth", False)]
+    ),
+    make_record(identifiers=[('quote " backslash \\ newline \n tab \t', False)]),
+    make_record(identifiers=[("control \x01 \x7f chars", False)]),
+    make_record(identifiers=[("unicode é ✓ 🛰", False)]),
+    make_record(iri="https://example.com/stac/é?x=1&y=2#frag"),
+    make_record(identifiers=[("", False)]),
+]
+
+
+def parsed(data: str, format: str) -> Graph:
+    if format in ("json-ld", "application/ld+json"):
+        data = with_inline_context(data)
+
+    g = Graph()
+    g.parse(data=data, format=format)
+    return g
+
+
+@pytest.mark.parametrize("record", TEMPLATABLE_RECORDS)
+def test_turtle_template_matches_rdflib(record):
+    assert record.is_templatable()
+
+    assert isomorphic(parsed(record.to_turtle(), "turtle"), record.to_graph())
+
+
+@pytest.mark.parametrize("record", TEMPLATABLE_RECORDS)
+def test_jsonld_template_matches_rdflib(record):
+    assert isomorphic(parsed(record.to_jsonld(), "json-ld"), record.to_graph())
+
+
+@pytest.mark.parametrize("record", TEMPLATABLE_RECORDS)
+def test_templates_match_rdflib_serialisation(record):
+    rdflib_graph = record.to_graph()
+
+    assert isomorphic(
+        parsed(record.to_turtle(), "turtle"),
+        parsed(rdflib_graph.serialize(format="turtle"), "turtle"),
+    )
+    assert isomorphic(
+        parsed(record.to_jsonld(), "json-ld"),
+        parsed(rdflib_graph.serialize(format="json-ld"), "json-ld"),
+    )
+
+
+def test_duplicate_identifiers_are_dropped():
+    record = make_record(identifiers=[(SELF_IRI, True), ("a", False), ("a", False)])
+
+    assert record.identifiers == [(SELF_IRI, True), ("a", False)]
+
+
+@pytest.mark.parametrize(
+    "record",
+    [
+        make_record(iri="https://example.com/with space"),
+        make_record(iri="https://example.com/<angle>"),
+        make_record(identifiers=[("https://example.com/{brace}", True)]),
+        make_record(identifiers=[(12345, False)]),
+        make_record(rdf_type="https://example.com/OtherType"),
+    ],
+)
+def test_unsafe_records_are_not_templatable(record):
+    assert not record.is_templatable()
+
+
+def test_messager_falls_back_to_rdflib_for_unsafe_records(mock_sentinel2_l2a_col):
+    # A numeric sci:doi becomes a typed literal, which the templates don't handle.
+    mock_sentinel2_l2a_col["sci:doi"] = 12345
+    messager = DatasetDCATMessager(None, None)
+
+    actions = messager.process_update_stac(
+        cat_path="/cat/path", stac=mock_sentinel2_l2a_col, source=None, target=None
+    )
+
+    ttl = parsed(actions[0].file_body, "turtle")
+    assert (None, None, Literal(12345)) in ttl
+
+
+@pytest.fixture
+def mock_catalog():
+    return {
+        "stac_version": "1.0.0",
+        "type": "Catalog",
+        "id": "root",
+        "description": "Root descr",
+        "links": [{"rel": "self", "href": "https://example.com/api/catalogue/stac"}],
+    }
+
+
+@pytest.fixture
+def mock_sentinel2_l2a_col():
+    with open("test_data/test_dcat_generation_s2_l2a.json") as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize("stac_fixture", ["mock_catalog", "mock_sentinel2_l2a_col"])
+def test_fast_and_rdflib_messagers_agree(stac_fixture, request):
+    stac = request.getfixturevalue(stac_fixture)
+
+    fast_actions = DatasetDCATMessager(None, None).process_update_stac(
+        cat_path="/cat/path", stac=copy.deepcopy(stac), source=None, target=None
+    )
+    rdflib_actions = DatasetDCATMessager(None, None, fast_serialiser=False).process_update_stac(
+        cat_path="/cat/path", stac=copy.deepcopy(stac), source=None, target=None
+    )
+
+    for fast, slow in zip(fast_actions, rdflib_actions, strict=True):
+        assert fast.key == slow.key
+        assert fast.mime_type == slow.mime_type
+        assert isomorphic(
+            parsed(fast.file_body, fast.mime_type), parsed(slow.file_body, slow.mime_type)
+        )
@@ -0,0 +1,212 @@
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from annotations_ingester.annotations_generator import (
+    AnnotationsMessager,
+    get_uuid_from_graph,
+)
+from annotations_ingester.dataset_dcat_generator import DatasetDCATMessager
+from annotations_ingester.output_cache import (
+    InvalidatingS3Client,
+    OutputFingerprintCache,
+)
+from annotations_ingester.uploads import (
+    Messager,
+    S3DeleteAction,
+    TemporaryFailure,
+    UploadExecutor,
+)
+from benchmarks.fakes import FakeMessage, FakeS3Client
+
+BUCKET = "test-bucket"
+
+
+@pytest.fixture
+def executor():
+    executor = UploadExecutor(max_concurrency=4)
+    yield executor
+    executor.shutdown()
+
+
+@pytest.fixture
+def trig():
+    with open("ontology/qa-output-1.trig", "rb") as f:
+        return f.read()
+
+
+def store(s3_client, *keys):
+    for key in keys:
+        s3_client.put_object(Bucket=BUCKET, Key=key, Body=key)
+
+
+def stored(s3_client) -> set[str]:
+    return {key for _, key in s3_client.objects}
+
+
+def upload(key: str):
+    return Messager.S3UploadAction(key=key, file_body=key)
+
+
+class ThreadRecordingS3Client(FakeS3Client):
+    def __init__(self):
+        super().__init__()
+        self.get_threads = []
+
+    def get_object(self, **kwargs):
+        self.get_threads.append(threading.current_thread().name)
+        return super().get_object(**kwargs)
+
+
+def deleted_keys_message(*keys) -> FakeMessage:
+    body = {"bucket_name": "harvested", "deleted_keys": [f"transformed/{key}" for key in keys]}
+    return FakeMessage("transformed", json.dumps(body).encode(), 1, 0.0)
+
+
+def test_deleting_a_catalog_deletes_everything_beneath_it(executor):
+    s3_client = FakeS3Client()
+    store(
+        s3_client,
+        "catalogue/catalogs/c.ttl",
+        "catalogue/catalogs/c.jsonld",
+        "catalogue/catalogs/c.jsonld.gz",
+        "catalogue/catalogs/c/collections/x.ttl",
+        "catalogue/catalogs/c/collections/x/annotations/u.ttl",
+        "catalogue/catalogs/c2.ttl",
+        "annotation-sources/catalogs/c/collections/x/qa.trig",
+        "annotation-sources/catalogs/c2/qa.trig",
+    )
+    messager = DatasetDCATMessager(s3_client, BUCKET)
+
+    actions = messager.process_delete(
+        bucket="harvested", key="transformed/catalogs/c.json", cat_path="catalogs/c.json"
+    )
+    executor.run(messager, actions)
+
+    assert stored(s3_client) == {
+        "catalogue/catalogs/c2.ttl",
+        "annotation-sources/catalogs/c2/qa.trig",
+    }
+
+
+def test_deleting_an_item_does_nothing():
+    messager = DatasetDCATMessager(None, BUCKET)
+
+    assert messager.process_delete(cat_path="catalogs/c/collections/x/items/i.json") == []
+
+
+def test_deleting_an_annotation_uses_its_recorded_uuid(executor, trig):
+    s3_client = FakeS3Client()
+    messager = AnnotationsMessager(s3_client, BUCKET)
+    cat_path = "catalogs/c/collections/x/qa.trig"
+    executor.run(messager, messager.process_update_body(trig, cat_path, "/", "/"))
+    store(s3_client, "catalogue/catalogs/c/collections/x/annotations/other.ttl")
+
+    executor.run(messager, messager.process_delete(cat_path=cat_path))
+
+    assert stored(s3_client) == {"catalogue/catalogs/c/collections/x/annotations/other.ttl"}
+
+
+def test_deleting_an_unrecorded_annotation_leaves_it_to_the_sweeper(executor):
+    s3_client = FakeS3Client()
+    store(s3_client, "catalogue/catalogs/c/annotations/u.ttl")
+    messager = AnnotationsMessager(s3_client, BUCKET)
+
+    executor.run(messager, messager.process_delete(cat_path="catalogs/c/qa.trig"))
+
+    assert stored(s3_client) == {"catalogue/catalogs/c/annotations/u.ttl"}
+
+
+def test_recorded_uuid_is_read_on_the_upload_threads(executor, trig):
+    s3_client = ThreadRecordingS3Client()
+    messager = AnnotationsMessager(s3_client, BUCKET, defer_actions=True)
+    cat_path = "catalogs/c/collections/x/qa.trig"
+    executor.run(messager, messager.process_update_body(trig, cat_path, "/", "/"))
+
+    actions = messager.process_delete(cat_path=cat_path)
+    assert s3_client.get_threads == []
+
+    executor.run(messager, actions)
+    assert s3_client.get_threads and all(t.startswith("upload") for t in s3_client.get_threads)
+    assert stored(s3_client) == set()
+
+
+def test_unchanged_annotation_is_uploaded_again_once_deleted(executor, trig):
+    cache = OutputFingerprintCache()
+    s3_client = FakeS3Client()
+    messager = AnnotationsMessager(
+        InvalidatingS3Client(s3_client, cache), BUCKET, output_cache=cache
+    )
+    cat_path = "catalogs/c/collections/x/qa.trig"
+
+    def update() -> list[Messager.Action]:
+        return cache.drop_unchanged(messager.process_update_body(trig, cat_path, "/", "/"), BUCKET)
+
+    executor.run(messager, update())
+    assert update() == []
+
+    executor.run(messager, cache.drop_unchanged(messager.process_delete(cat_path=cat_path), BUCKET))
+    executor.run(messager, update())
+    assert len(stored(s3_client)) == 3
+
+
+def test_deletes_are_ordered_with_uploads_in_a_batch(executor):
+    s3_client = FakeS3Client()
+    messager = SimpleNamespace(s3_client=s3_client, output_bucket=BUCKET)
+    delete = S3DeleteAction(keys=["catalogue/a.ttl"], prefixes=["catalogue/a/"])
+
+    trackers = executor.submit_batch(
+        [
+            (messager, [upload("catalogue/a.ttl"), upload("catalogue/a/b.ttl")]),
+            (messager, [delete]),
+            (messager, [upload("catalogue/a/c.ttl")]),
+        ]
+    )
+
+    assert all(tracker.result() is None for tracker in trackers)
+    assert stored(s3_client) == {"catalogue/a/c.ttl"}
+    assert s3_client.put_count == 1
+
+
+def test_failed_delete_is_a_temporary_failure(executor):
+    s3_client = FakeS3Client()
+    store(s3_client, "catalogue/a.ttl")
+    s3_client.failing_keys.add("catalogue/a.ttl")
+
+    with pytest.raises(TemporaryFailure):
+        executor.run(
+            SimpleNamespace(s3_client=s3_client, output_bucket=BUCKET),
+            [S3DeleteAction(keys=["catalogue/a.ttl"])],
+        )
+
+
+def test_deletes_are_made_immediately_unless_deferred():
+    s3_client = FakeS3Client()
+    store(s3_client, "catalogue/catalogs/c.ttl")
+
+    deferred = DatasetDCATMessager(s3_client, BUCKET, defer_actions=True)
+    (action,) = deferred.process_msg(deleted_keys_message("catalogs/c.json"))
+    assert isinstance(action, S3DeleteAction)
+    assert stored(s3_client) == {"catalogue/catalogs/c.ttl"}
+
+    immediate = DatasetDCATMessager(s3_client, BUCKET)
+    assert immediate.process_msg(deleted_keys_message("catalogs/c.json")) == []
+    assert stored(s3_client) == set()
+
+    store(s3_client, "catalogue/catalogs/c.ttl")
+    s3_client.failing_keys.add("catalogue/catalogs/c.ttl")
+    (failure,) = immediate.process_msg(deleted_keys_message("catalogs/c.json"))
+    assert isinstance(failure, Messager.FailureAction) and not failure.permanent
+
+
+def test_deletes_invalidate_the_output_cache(trig):
+    cache = OutputFingerprintCache()
+    uuid = get_uuid_from_graph(trig)
+    key = f"catalogue/catalogs/c/annotations/{uuid}.ttl"
+
+    assert len(cache.drop_unchanged([upload(key)], BUCKET)) == 1
+    cache.drop_unchanged([S3DeleteAction(prefixes=["catalogue/catalogs/c/"])], BUCKET)
+
+    assert len(cache.drop_unchanged([upload(key)], BUCKET)) == 1
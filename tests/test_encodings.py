@@ -0,0 +1,140 @@
+import io
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+
+from annotations_ingester import encodings
+from annotations_ingester.__main__ import IngesterOptions
+from annotations_ingester.encodings import (
+    OutputEncoder,
+    decode,
+    original_key,
+    variant_key,
+)
+from annotations_ingester.output_cache import (
+    InvalidatingS3Client,
+    OutputFingerprintCache,
+)
+from annotations_ingester.uploads import Messager, TemporaryFailure, UploadExecutor
+from benchmarks.compression import compression_report
+from benchmarks.fakes import FakeS3Client
+
+BUCKET = "test-bucket"
+TURTLE = "".join(f"<https://example.com/{n}> a <https://example.com/Thing> .\n" for n in range(100))
+
+
+def upload(key: str, body, mime_type: str = "text/turtle"):
+    return Messager.S3UploadAction(
+        key=key, file_body=body, mime_type=mime_type, cache_control="max-age=60"
+    )
+
+
+def run_uploads(s3_client, actions, encoder: OutputEncoder):
+    executor = UploadExecutor(max_concurrency=4, encoder=encoder)
+    try:
+        executor.run(SimpleNamespace(s3_client=s3_client, output_bucket=BUCKET), actions)
+    finally:
+        executor.shutdown()
+
+
+def test_variants_are_stored_with_content_encoding():
+    s3_client = FakeS3Client()
+
+    run_uploads(s3_client, [upload("catalogue/a.ttl", TURTLE)], OutputEncoder(["gzip"]))
+
+    variant = s3_client.objects[(BUCKET, "catalogue/a.ttl.gz")]
+    assert variant["ContentEncoding"] == "gzip"
+    assert variant["ContentType"] == "text/turtle"
+    assert variant["CacheControl"] == "max-age=60"
+    assert decode(variant["Body"], "gzip") == TURTLE.encode()
+    assert len(variant["Body"]) < len(TURTLE) / 5
+
+    original = s3_client.objects[(BUCKET, "catalogue/a.ttl")]
+    assert original["Body"] == TURTLE.encode()
+    assert "ContentEncoding" not in original
+
+
+def test_small_outputs_are_not_encoded():
+    s3_client = FakeS3Client()
+
+    run_uploads(s3_client, [upload("catalogue/a.ttl", "<a> <b> <c> .")], OutputEncoder(["gzip"]))
+
+    assert list(s3_client.objects) == [(BUCKET, "catalogue/a.ttl")]
+
+
+def test_file_bodies_are_encoded_a_block_at_a_time(monkeypatch):
+    monkeypatch.setattr(encodings, "_BLOCK_BYTES", 256)
+    body = tempfile.SpooledTemporaryFile()
+    body.write(TURTLE.encode())
+    body.seek(0)
+    s3_client = FakeS3Client()
+
+    run_uploads(s3_client, [upload("catalogue/a.ttl", body)], OutputEncoder(["gzip"]))
+
+    assert s3_client.body(BUCKET, "catalogue/a.ttl") == TURTLE.encode()
+    variant = s3_client.objects[(BUCKET, "catalogue/a.ttl.gz")]
+    assert variant["ContentEncoding"] == "gzip"
+    assert decode(variant["Body"], "gzip") == TURTLE.encode()
+
+
+def test_encoding_is_deterministic():
+    encoder = OutputEncoder(["gzip"])
+
+    assert encoder.encode(TURTLE, "gzip") == encoder.encode(TURTLE.encode(), "gzip")
+    assert encoder.encode(io.BytesIO(TURTLE.encode()), "gzip").read() == encoder.encode(
+        TURTLE, "gzip"
+    )
+
+
+def test_failed_variant_upload_invalidates_the_original_fingerprint():
+    cache = OutputFingerprintCache()
+    fake = FakeS3Client()
+    fake.failing_keys.add("catalogue/a.ttl.gz")
+    s3_client = InvalidatingS3Client(fake, cache)
+    actions = cache.drop_unchanged([upload("catalogue/a.ttl", TURTLE)], BUCKET)
+
+    with pytest.raises(TemporaryFailure):
+        run_uploads(s3_client, actions, OutputEncoder(["gzip"]))
+
+    assert len(cache.drop_unchanged([upload("catalogue/a.ttl", TURTLE)], BUCKET)) == 1
+
+
+def test_variant_keys():
+    assert variant_key("a/b.jsonld", "br") == "a/b.jsonld.br"
+    assert original_key("a/b.jsonld.gz") == "a/b.jsonld"
+    assert original_key("a/b.jsonld") == "a/b.jsonld"
+
+
+def test_encodings_option():
+    assert OutputEncoder.from_option("") is None
+    assert OutputEncoder.from_option(" gzip ", 10).encodings == ("gzip",)
+    assert IngesterOptions(output_encodings="gzip").pipelined
+
+    with pytest.raises(ValueError):
+        OutputEncoder.from_option("deflate")
+
+
+@pytest.mark.skipif(encodings.brotli is not None, reason="brotli is installed")
+def test_brotli_needs_the_brotli_package():
+    with pytest.raises(ValueError, match="brotli"):
+        OutputEncoder(["br"])
+
+
+@pytest.mark.skipif(encodings.brotli is None, reason="brotli isn't installed")
+def test_brotli_variant():
+    encoded = OutputEncoder(["br"]).encode(TURTLE, "br")
+
+    assert decode(encoded, "br") == TURTLE.encode()
+
+
+def test_compression_report_covers_the_samples():
+    report = compression_report(
+        gzip_levels=(6,), brotli_qualities=(5,), min_time=0, measurements=(100,)
+    )
+
+    assert {row["output"] for row in report} >= {
+        "dcat/s2_l2a.ttl",
+        "annotation/qa-output-1.jsonld",
+    }
+    assert all(row["encoded_bytes"] < row["bytes"] for row in report)
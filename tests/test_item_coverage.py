@@ -0,0 +1,217 @@
+import itertools
+import json
+import threading
+
+from rdflib import Graph
+from rdflib.compare import isomorphic
+
+from annotations_ingester.dataset_dcat_generator import DatasetDCATMessager
+from annotations_ingester.item_coverage import (
+    ItemCoverage,
+    ItemCoverageRollup,
+    coverage_from_jsonld,
+    coverage_of_item,
+    item_collection,
+    merge_jsonld,
+    merge_turtle,
+)
+from annotations_ingester.jsonld_context import DEFAULT_CONTEXT_URL, with_inline_context
+from benchmarks.fakes import FakeS3Client
+
+BUCKET = "test-bucket"
+COLLECTION_IRI = "https://example.com/catalogs/c/collections/x"
+COVERAGE = "catalogue/catalogs/c/collections/x/coverage"
+
+
+def item(n: int, **properties) -> dict:
+    return {
+        "type": "Feature",
+        "stac_version": "1.0.0",
+        "id": f"item-{n}",
+        "bbox": [n, 50.0, n + 1, 51.0 + n],
+        "geometry": None,
+        "properties": {"datetime": f"2024-01-0{n + 1}T10:00:00Z", **properties},
+        "links": [{"rel": "collection", "href": COLLECTION_IRI}],
+        "assets": {
+            "data": {"href": "data.tif", "type": "image/tiff; application=geotiff"},
+            "metadata": {"href": "metadata.xml", "type": "application/xml"},
+        },
+    }
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def stored(s3_client, extension: str) -> bytes:
+    return s3_client.objects[(BUCKET, COVERAGE + extension)]["Body"]
+
+
+def test_coverage_is_read_from_the_item_dict():
+    coverage = coverage_of_item(
+        item(0, start_datetime="2023-12-31T23:00:00-02:00", end_datetime="2024-01-02")
+    )
+
+    assert coverage.bbox == [0.0, 50.0, 1.0, 51.0]
+    assert (coverage.start, coverage.end) == ("2024-01-01T01:00:00Z", "2024-01-02T00:00:00Z")
+    assert coverage.media_types == {"image/tiff; application=geotiff", "application/xml"}
+
+
+def test_invalid_fields_are_skipped():
+    stac = item(0, datetime="yesterday")
+    stac["bbox"] = [170.0, -10.0, 100.0, 10.0, 5.0]
+    stac["assets"]["data"]["type"] = "not a media type"
+
+    coverage = coverage_of_item(stac)
+
+    assert coverage.bbox is None and coverage.start is None
+    assert coverage.media_types == {"application/xml"}
+
+    stac["bbox"] = [170.0, -10.0, 0.0, -170.0, 10.0, 0.0]
+    assert coverage_of_item(stac).bbox == [-180.0, -10.0, 180.0, 10.0]
+
+
+def test_item_collection_needs_an_items_directory_and_a_collection_link():
+    stac = item(0)
+
+    assert item_collection(stac, "catalogs/c/collections/x/items/i.json") == (
+        "catalogs/c/collections/x.json",
+        COLLECTION_IRI,
+    )
+    assert item_collection(stac, "catalogs/c/collections/x/i.json") is None
+
+    stac["links"] = [{"rel": "collection", "href": "../x.json"}]
+    assert item_collection(stac, "catalogs/c/collections/x/items/i.json") is None
+
+
+def test_merged_documents_are_the_same_in_any_order():
+    coverages = [coverage_of_item(item(n)) for n in range(3)]
+
+    turtles, jsonlds = set(), set()
+    for order in itertools.permutations(coverages):
+        turtle = jsonld = None
+        for coverage in order + order[:1]:
+            turtle = merge_turtle(turtle, iri=COLLECTION_IRI, coverage=coverage)
+            jsonld = merge_jsonld(
+                jsonld, iri=COLLECTION_IRI, coverage=coverage, context_url=DEFAULT_CONTEXT_URL
+            )
+        turtles.add(turtle)
+        jsonlds.add(jsonld)
+
+    assert len(turtles) == len(jsonlds) == 1
+
+    graph = Graph().parse(data=turtles.pop(), format="turtle")
+    jsonld = with_inline_context(jsonlds.pop().decode())
+    assert isomorphic(graph, Graph().parse(data=jsonld, format="json-ld"))
+    assert len(graph) == 16
+
+
+def test_jsonld_reads_back_the_coverage():
+    coverage = ItemCoverage([-1.5e-05, 50.0, 2.25, 61.0], "2024-01-01T00:00:00Z", None, {"a/b"})
+    coverage.end = coverage.start
+
+    assert (
+        merge_jsonld(
+            coverage.to_jsonld(COLLECTION_IRI).encode(),
+            iri=COLLECTION_IRI,
+            coverage=ItemCoverage(),
+            context_url="https://c.test/",
+        )
+        == coverage.to_jsonld(COLLECTION_IRI, "https://c.test/").encode()
+    )
+
+
+def test_items_are_written_once_the_interval_has_passed():
+    s3_client, clock = FakeS3Client(), Clock()
+    messager = DatasetDCATMessager(
+        s3_client, BUCKET, defer_actions=True, item_coverage=ItemCoverageRollup(60, clock=clock)
+    )
+
+    def process(n: int):
+        return messager.process_update_stac(
+            item(n), f"catalogs/c/collections/x/items/{n}.json", "/", "/"
+        )
+
+    assert process(0) == [] and process(1) == []
+    assert messager.flush_item_coverage() == 0
+    clock.now = 60
+    assert process(2) == []
+    assert messager.flush_item_coverage() == 1
+
+    assert s3_client.put_count == 2
+    assert json.loads(stored(s3_client, ".jsonld"))["dcterms:temporal"]["dcat:endDate"] == {
+        "@value": "2024-01-03T10:00:00Z",
+        "@type": "xsd:dateTime",
+    }
+
+    # Items arriving later widen what was written before.
+    clock.now = 61
+    assert process(0) == []
+    assert messager.flush_item_coverage(force=True) == 1
+
+    turtle = stored(s3_client, ".ttl")
+    assert turtle.startswith(b"# coverage ")
+    assert b'"POLYGON((0.0 50.0, 3.0 50.0, 3.0 53.0, 0.0 53.0, 0.0 50.0))"' in turtle
+    assert messager.flush_item_coverage(force=True) == 0
+
+
+def test_coverage_is_kept_until_it_is_written():
+    s3_client = FakeS3Client()
+    rollup = ItemCoverageRollup(60)
+    messager = DatasetDCATMessager(s3_client, BUCKET, item_coverage=rollup)
+
+    messager.process_update_stac(item(0), "catalogs/c/collections/x/items/0.json", "/", "/")
+    s3_client.failing_keys.add(COVERAGE + ".jsonld")
+    assert messager.flush_item_coverage(force=True) == 0
+
+    messager.process_update_stac(item(1), "catalogs/c/collections/x/items/1.json", "/", "/")
+    s3_client.failing_keys.clear()
+    assert messager.flush_item_coverage(force=True) == 1
+
+    # The first Item's coverage was only written to the Turtle the first time.
+    assert coverage_from_jsonld(stored(s3_client, ".jsonld")).bbox == [0.0, 50.0, 2.0, 52.0]
+
+
+def test_coverage_is_flushed_on_a_thread():
+    s3_client, clock = FakeS3Client(), Clock()
+    rollup = ItemCoverageRollup(0.01, clock=clock)
+    messager = DatasetDCATMessager(s3_client, BUCKET, item_coverage=rollup)
+    flushed = threading.Event()
+
+    def flush(force: bool):
+        if messager.flush_item_coverage(force):
+            flushed.set()
+
+    rollup.start_flushing(flush)
+    messager.process_update_stac(item(0), "catalogs/c/collections/x/items/0.json", "/", "/")
+    clock.now = 1
+    assert flushed.wait(5)
+
+    # What arrives afterwards is written when the thread is stopped.
+    clock.now = 0
+    messager.process_update_stac(item(1), "catalogs/c/collections/x/items/1.json", "/", "/")
+    rollup.stop_flushing()
+
+    assert rollup.pending_items() == 0
+    assert s3_client.put_count == 4
+
+
+def test_deleting_a_collection_forgets_its_items():
+    rollup = ItemCoverageRollup(60)
+    messager = DatasetDCATMessager(FakeS3Client(), BUCKET, defer_actions=True, item_coverage=rollup)
+
+    messager.process_update_stac(item(0), "catalogs/c/collections/x/items/0.json", "/", "/")
+    assert rollup.pending_items() == 1
+
+    messager.process_delete(cat_path="catalogs/c/collections/x.json")
+    assert rollup.pending_items() == 0
+
+
+def test_items_are_ignored_without_a_rollup():
+    messager = DatasetDCATMessager(None, None)
+
+    assert messager.process_update_stac(item(0), "catalogs/c/items/0.json", "/", "/") == []
@@ -0,0 +1,109 @@
+import json
+
+import pytest
+from rdflib import XSD, Graph, Literal
+
+from annotations_ingester.annotations_generator import parse_annotation
+from annotations_ingester.jsonld_context import (
+    CONTEXT_CACHE_CONTROL,
+    CONTEXT_KEY,
+    PREFIXES,
+    compact_iri,
+    compact_jsonld,
+    context_document,
+    context_url,
+    publish_context,
+    with_inline_context,
+)
+from benchmarks.fakes import FakeS3Client
+from benchmarks.jsonld_size import sample_graphs, size_report
+
+BUCKET = "public"
+
+
+def plain_strings(graph: Graph) -> Graph:
+    """Makes xsd:string literals plain, as compacted JSON-LD doesn't distinguish them."""
+    result = Graph()
+    for s, p, o in graph:
+        if isinstance(o, Literal) and o.datatype == XSD.string:
+            o = Literal(str(o))
+        result.add((s, p, o))
+
+    return result
+
+
+@pytest.mark.parametrize("name", sorted(sample_graphs()))
+def test_compacted_sample_expands_to_the_same_graph(name):
+    graph = sample_graphs()[name]
+
+    compacted = compact_jsonld(graph, "https://example.com/contexts/eodh-v1.jsonld")
+    expanded = Graph().parse(data=with_inline_context(compacted), format="json-ld")
+
+    assert plain_strings(expanded).isomorphic(plain_strings(graph))
+
+
+def test_compacted_output_refers_to_the_context_by_url():
+    graph = parse_annotation(open("ontology/qa-output-1.trig").read()).default_context
+
+    document = json.loads(compact_jsonld(graph, "https://example.com/contexts/eodh-v1.jsonld"))
+
+    assert document["@context"] == "https://example.com/contexts/eodh-v1.jsonld"
+    assert any("prov:wasGeneratedBy" in node for node in document["@graph"])
+
+
+def test_compact_iri():
+    assert compact_iri("http://www.w3.org/ns/dcat#Dataset") == "dcat:Dataset"
+    assert compact_iri("https://eodatahub.org.uk/api/ontologies/qa/x") == "eodhqa:x"
+    assert compact_iri("https://example.com/other") == "https://example.com/other"
+    assert compact_iri("http://schema.org///odd") == "http://schema.org///odd"
+
+
+def test_context_is_published_once_with_long_caching():
+    s3_client = FakeS3Client()
+
+    assert publish_context(s3_client, BUCKET)
+    assert not publish_context(s3_client, BUCKET)
+
+    published = s3_client.objects[(BUCKET, CONTEXT_KEY)]
+    assert published["CacheControl"] == CONTEXT_CACHE_CONTROL
+    assert published["ContentType"] == "application/ld+json"
+    assert json.loads(published["Body"]) == {"@context": PREFIXES}
+    assert s3_client.put_count == 1
+
+
+def test_out_of_date_context_is_replaced():
+    s3_client = FakeS3Client()
+    s3_client.put_object(Bucket=BUCKET, Key=CONTEXT_KEY, Body='{"@context": {}}')
+
+    assert publish_context(s3_client, BUCKET)
+    assert json.loads(s3_client.objects[(BUCKET, CONTEXT_KEY)]["Body"]) == {"@context": PREFIXES}
+
+
+@pytest.mark.parametrize(
+    "catalogue_url",
+    [
+        "https://staging.example.com/api/catalogue/stac",
+        "https://staging.example.com/api/catalogue/stac/",
+    ],
+)
+def test_context_url_is_under_the_catalogue_url(catalogue_url):
+    assert (
+        context_url(catalogue_url)
+        == "https://staging.example.com/api/catalogue/stac/contexts/eodh-v1.jsonld"
+    )
+
+
+def test_failure_to_publish_context_is_not_fatal():
+    s3_client = FakeS3Client(error_rate=1.0)
+
+    assert not publish_context(s3_client, BUCKET)
+
+
+def test_context_document_is_stable():
+    assert context_document() == context_document()
+    assert json.loads(context_document())["@context"] == PREFIXES
+
+
+def test_size_report_shows_a_reduction():
+    for sizes in size_report().values():
+        assert sizes["compacted_bytes"] < sizes["expanded_bytes"]
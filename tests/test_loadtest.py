@@ -0,0 +1,62 @@
+import json
+
+import pulsar
+import pytest
+
+from annotations_ingester.__main__ import IngesterOptions
+from benchmarks.fakes import FakeBroker, FakePulsarClient
+from benchmarks.loadtest import recorded_stream, run_load_test, synthetic_stream
+
+
+def test_fake_broker_redelivers_nacked_messages():
+    broker = FakeBroker(redelivery_delay=0.01)
+    consumer = FakePulsarClient(broker).subscribe(["a", "b"], "subscription")
+
+    broker.publish("a", b"1")
+    broker.publish("b", b"2")
+
+    first = consumer.receive(timeout_millis=100)
+    second = consumer.receive(timeout_millis=100)
+    assert {first.data(), second.data()} == {b"1", b"2"}
+
+    consumer.negative_acknowledge(first)
+    consumer.acknowledge(second)
+    assert not broker.wait_until_settled(timeout=0)
+
+    redelivered = consumer.receive(timeout_millis=1000)
+    assert redelivered is first
+    consumer.acknowledge(redelivered)
+
+    assert broker.wait_until_settled(timeout=0)
+    assert broker.redelivered == 1
+    assert len(broker.latencies) == 2
+
+    with pytest.raises(pulsar.Timeout):
+        consumer.receive(timeout_millis=10)
+
+
+def test_load_test_processes_every_message():
+    stream = synthetic_stream(10, annotation_ratio=0.5, links=5, measurements=2)
+
+    report = run_load_test(
+        stream,
+        IngesterOptions(upload_concurrency=4, max_in_flight=4),
+        messages=20,
+        s3_error_rate=0.05,
+        settle_timeout=30,
+        memory_interval=0.05,
+    )
+
+    assert report["settled"]
+    assert report["acknowledged"] == 20
+    assert report["throughput_msgs_per_s"] > 0
+    assert report["latency_ms"]["p50"] <= report["latency_ms"]["p99"]
+    assert report["memory"]["rss_peak_bytes"] > 0
+
+
+def test_recorded_stream(tmp_path):
+    path = tmp_path / "stream.jsonl"
+    record = {"topic": "transformed", "message": {"updated_keys": ["k"]}, "entries": {"k": "{}"}}
+    path.write_text(json.dumps(record) + "\n\n")
+
+    assert list(recorded_stream(str(path))) == [("transformed", record["message"], {"k": "{}"})]
@@ -0,0 +1,147 @@
+import json
+import urllib.request
+from unittest import mock
+
+import pytest
+
+from annotations_ingester import metrics
+from annotations_ingester.annotations_generator import (
+    AnnotationsMessager,
+    render_annotation,
+)
+from annotations_ingester.dataset_dcat_generator import DatasetDCATMessager
+from annotations_ingester.uploads import Messager, UploadExecutor
+from benchmarks.fakes import FakeS3Client
+
+
+class FakeMessage:
+    def __init__(self, topic: str, data: bytes):
+        self._topic = topic
+        self._data = data
+
+    def topic_name(self):
+        return f"persistent://public/default/{self._topic}"
+
+    def data(self):
+        return self._data
+
+
+@pytest.fixture
+def metrics_enabled(monkeypatch):
+    monkeypatch.setattr(metrics, "_enabled", True)
+
+
+@pytest.fixture
+def annotation_body():
+    with open("ontology/qa-output-1.trig") as f:
+        return f.read()
+
+
+def test_histogram_exposition():
+    histogram = metrics.Histogram("test_seconds", "Help text.", ("stage",), (0.1, 1))
+    histogram.observe(0.05, "parse")
+    histogram.observe(0.5, "parse")
+    histogram.observe(5, "parse")
+
+    assert histogram.exposition() == [
+        "# HELP test_seconds Help text.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{stage="parse",le="0.1"} 1',
+        'test_seconds_bucket{stage="parse",le="1"} 2',
+        'test_seconds_bucket{stage="parse",le="+Inf"} 3',
+        'test_seconds_sum{stage="parse"} 5.55',
+        'test_seconds_count{stage="parse"} 3',
+    ]
+
+
+def test_counter_escapes_label_values():
+    counter = metrics.Counter("test_total", "Help text.", ("topic",))
+    counter.inc('a"b')
+    counter.inc('a"b', amount=2)
+
+    assert counter.exposition()[-1] == 'test_total{topic="a\\"b"} 3'
+
+
+def test_stages_are_ignored_unless_recording(annotation_body):
+    metrics.lap("parse_trig")
+
+    result, observations = metrics.recording(render_annotation, annotation_body)
+
+    assert result[0] == render_annotation(annotation_body)[0]
+    assert [name for name, _ in observations] == [
+        "entry_bytes",
+        "prescan",
+        "parse_trig",
+        "validate",
+        "triples",
+        "serialise_turtle",
+        "serialise_jsonld",
+    ]
+    assert dict(observations)["triples"] == 16
+
+
+def test_messager_records_labelled_stages(metrics_enabled, annotation_body):
+    messager = AnnotationsMessager(s3_client=mock.MagicMock(), output_bucket="bucket")
+    before = metrics.STAGE_SECONDS.count("parse_trig", "annotation", "transformed-annotations")
+
+    # As MetricsMixin.process_msg does.
+    token = metrics._labels.set(("annotation", "transformed-annotations"))
+    try:
+        messager.process_update_body(annotation_body, "catalogs/a/collections/b/1.trig", "/", "/")
+    finally:
+        metrics._labels.reset(token)
+
+    metrics.flush()
+    after = metrics.STAGE_SECONDS.count("parse_trig", "annotation", "transformed-annotations")
+    assert after == before + 1
+
+
+def test_metrics_mixin_counts_messages(metrics_enabled):
+    messager = DatasetDCATMessager(s3_client=mock.MagicMock(), output_bucket="bucket")
+    before = metrics.MESSAGES.value("dataset_dcat", "transformed", "ok")
+
+    messager.process_msg(FakeMessage("transformed", json.dumps({"bucket_name": "b"}).encode()))
+    metrics.flush()
+
+    assert metrics.MESSAGES.value("dataset_dcat", "transformed", "ok") == before + 1
+    assert metrics.MESSAGE_BYTES.count("dataset_dcat", "transformed") >= 1
+
+
+def test_timed_s3_client_records_requests():
+    s3_client = metrics.TimedS3Client(mock.MagicMock())
+    before = metrics.S3_SECONDS.count("put_object", "", "")
+
+    s3_client.put_object(Bucket="bucket", Key="key", Body=b"")
+
+    assert metrics.S3_SECONDS.count("put_object", "", "") == before + 1
+
+
+def test_uploads_are_labelled_with_their_message():
+    s3_client = metrics.TimedS3Client(FakeS3Client())
+    messager = AnnotationsMessager(s3_client, "bucket", defer_actions=True)
+    labels = ("annotation", "transformed-annotations-partition-1")
+    before = metrics.S3_SECONDS.count("put_object", *labels)
+
+    executor = UploadExecutor(max_concurrency=2)
+    try:
+        actions = [Messager.S3UploadAction(key="a.ttl", file_body="a")]
+        [tracker] = executor.submit_batch([(messager, actions)], [labels])
+        assert tracker.result() is None
+    finally:
+        executor.shutdown()
+
+    assert metrics.S3_SECONDS.count("put_object", *labels) == before + 1
+
+
+def test_metrics_server(monkeypatch):
+    monkeypatch.setattr(metrics, "_enabled", False)
+    server = metrics.start_metrics_server(0, addr="127.0.0.1")
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            body = response.read().decode()
+
+        assert metrics.is_enabled()
+        assert "# TYPE annotations_ingester_stage_seconds histogram" in body
+    finally:
+        server.shutdown()
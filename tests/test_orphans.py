@@ -0,0 +1,105 @@
+import pytest
+
+from annotations_ingester.annotations_generator import get_uuid_from_graph
+from annotations_ingester.orphans import LocalSource, S3Source, sweep_orphans
+from benchmarks.fakes import FakeS3Client
+
+BUCKET = "test-bucket"
+
+EXPECTED = {
+    "catalogue/catalogs/c.ttl",
+    "catalogue/catalogs/c.jsonld",
+    "catalogue/catalogs/c.jsonld.gz",
+    "catalogue/catalogs/c/collections/x.ttl",
+    "catalogue/catalogs/c/collections/x/annotations/rollup.nt",
+    "catalogue/catalogs/c/collections/x/coverage.ttl",
+    "catalogue/content/0123.ttl",
+    "catalogue/contexts/eodh-v1.jsonld",
+    "annotation-sources/catalogs/c/collections/x/qa.trig",
+}
+ORPHANS = {
+    "catalogue/catalogs/gone.ttl",
+    "catalogue/catalogs/gone/collections/y.ttl.gz",
+    "catalogue/catalogs/c/collections/x/annotations/replaced.ttl",
+    "catalogue/catalogs/c/coverage.jsonld",
+    "annotation-sources/catalogs/c/collections/gone.trig",
+}
+
+
+@pytest.fixture
+def trig():
+    with open("ontology/qa-output-1.trig", "rb") as f:
+        return f.read()
+
+
+@pytest.fixture
+def source_files(trig):
+    return {
+        "catalogs/c.json": b"{}",
+        "catalogs/c/collections/x.json": b"{}",
+        "catalogs/c/collections/x/qa.trig": trig,
+        "catalogs/c/collections/x/items/i.json": b"{}",
+    }
+
+
+def outputs(trig) -> FakeS3Client:
+    s3_client = FakeS3Client()
+    annotation = f"catalogue/catalogs/c/collections/x/annotations/{get_uuid_from_graph(trig)}"
+
+    for key in EXPECTED | ORPHANS | {f"{annotation}.ttl", f"{annotation}.jsonld"}:
+        s3_client.put_object(Bucket=BUCKET, Key=key, Body="")
+
+    return s3_client
+
+
+def local_source(tmp_path, files: dict) -> LocalSource:
+    for name, body in files.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(body)
+
+    return LocalSource(str(tmp_path))
+
+
+def test_sweep_deletes_outputs_without_entries(tmp_path, trig, source_files):
+    s3_client = outputs(trig)
+    source = local_source(tmp_path, source_files)
+
+    dry_run = sweep_orphans(s3_client, BUCKET, source, dry_run=True)
+    assert dry_run["orphans"] == len(ORPHANS)
+    assert dry_run["deleted"] == len(ORPHANS)
+    assert s3_client.delete_requests == 0
+
+    stats = sweep_orphans(s3_client, BUCKET, source)
+
+    assert stats["deleted"] == len(ORPHANS) and stats["failed"] == 0
+    assert not ORPHANS & {key for _, key in s3_client.objects}
+    assert EXPECTED < {key for _, key in s3_client.objects}
+    assert sweep_orphans(s3_client, BUCKET, source)["orphans"] == 0
+
+
+def test_sweep_reads_an_s3_source(trig, source_files):
+    s3_client = outputs(trig)
+    for name, body in source_files.items():
+        s3_client.put_object(Bucket="harvested", Key=f"transformed/{name}", Body=body)
+
+    stats = sweep_orphans(s3_client, BUCKET, S3Source(s3_client, "harvested", "transformed"))
+
+    assert stats["deleted"] == len(ORPHANS)
+
+
+def test_unreadable_annotations_keep_their_directory(tmp_path, trig, source_files):
+    s3_client = outputs(trig)
+    source_files["catalogs/c/collections/x/broken.trig"] = b"not an annotation"
+
+    sweep_orphans(s3_client, BUCKET, local_source(tmp_path, source_files))
+
+    assert (
+        BUCKET,
+        "catalogue/catalogs/c/collections/x/annotations/replaced.ttl",
+    ) in s3_client.objects
+
+
+def test_empty_source_is_refused(tmp_path, trig):
+    with pytest.raises(ValueError, match="empty"):
+        sweep_orphans(outputs(trig), BUCKET, LocalSource(str(tmp_path / "missing")))
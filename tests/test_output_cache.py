@@ -0,0 +1,195 @@
+import datetime
+import hashlib
+import os
+import signal
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+from annotations_ingester.__main__ import IngesterOptions, ingest
+from annotations_ingester.annotations_generator import AnnotationsMessager
+from annotations_ingester.content_addressing import ContentAddressedLayout
+from annotations_ingester.output_cache import (
+    InvalidatingS3Client,
+    Messager,
+    OutputFingerprintCache,
+)
+from annotations_ingester.uploads import UploadExecutor
+from benchmarks.fakes import FakeBroker, FakePulsarClient, FakeS3Client
+
+BUCKET = "test-bucket"
+
+
+def upload(key, body, bucket=None):
+    return Messager.S3UploadAction(key=key, file_body=body, bucket=bucket)
+
+
+def terminate_once_handled(monkeypatch):
+    """
+    Calls ingest's SIGTERM handler as soon as it's installed, rather than signalling the test
+    process, which would kill it if the handler weren't installed yet.
+    """
+    install = signal.signal
+
+    def install_and_call(signum, handler):
+        previous = install(signum, handler)
+        if signum == signal.SIGTERM and callable(handler):
+            handler(signum, None)
+        return previous
+
+    monkeypatch.setattr(signal, "signal", install_and_call)
+
+
+def test_unchanged_uploads_are_dropped():
+    cache = OutputFingerprintCache()
+
+    first = cache.drop_unchanged([upload("a.ttl", "one"), upload("a.jsonld", "two")], BUCKET)
+    second = cache.drop_unchanged([upload("a.ttl", "one"), upload("a.jsonld", "changed")], BUCKET)
+
+    assert len(first) == 2
+    assert [a.key for a in second] == ["a.jsonld"]
+    assert cache.stats() == {"entries": 2, "hits": 1, "misses": 3, "hit_ratio": 0.25}
+
+
+def test_action_bucket_is_part_of_the_key():
+    cache = OutputFingerprintCache()
+
+    cache.drop_unchanged([upload("a.ttl", "one")], BUCKET)
+    remaining = cache.drop_unchanged([upload("a.ttl", "one", bucket="other-bucket")], BUCKET)
+
+    assert len(remaining) == 1
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = OutputFingerprintCache(max_entries=2)
+    fp = cache.fingerprint("body")
+
+    cache.record(BUCKET, "a", fp)
+    cache.record(BUCKET, "b", fp)
+    assert cache.is_unchanged(BUCKET, "a", fp)  # a is now the most recently used
+    cache.record(BUCKET, "c", fp)
+
+    assert len(cache) == 2
+    assert cache.is_unchanged(BUCKET, "a", fp)
+    assert not cache.is_unchanged(BUCKET, "b", fp)
+
+
+def test_entries_expire_after_max_age():
+    cache = OutputFingerprintCache(max_age=60)
+    fp = cache.fingerprint("body")
+
+    cache.record(BUCKET, "old", fp, recorded_at=0)
+    cache.record(BUCKET, "new", fp)
+
+    assert not cache.is_unchanged(BUCKET, "old", fp)
+    assert cache.is_unchanged(BUCKET, "new", fp)
+
+
+def test_fingerprint_matches_single_part_etag():
+    assert (
+        OutputFingerprintCache.fingerprint("body é") == hashlib.md5("body é".encode()).hexdigest()
+    )
+
+
+def test_fingerprint_of_file_matches_its_contents():
+    body = tempfile.SpooledTemporaryFile()
+    body.write("body é".encode())
+
+    assert OutputFingerprintCache.fingerprint(body) == OutputFingerprintCache.fingerprint("body é")
+    assert body.tell() == 0
+
+
+def test_warm_from_bucket_uses_etags():
+    s3_client = mock.MagicMock()
+    last_modified = datetime.datetime.now(datetime.timezone.utc)
+    s3_client.get_paginator.return_value.paginate.return_value = [
+        {
+            "Contents": [
+                {
+                    "Key": "catalogue/a.ttl",
+                    "ETag": f'"{OutputFingerprintCache.fingerprint("one")}"',
+                    "Size": 3,
+                    "LastModified": last_modified,
+                },
+                {
+                    "Key": "catalogue/big.ttl",
+                    "ETag": '"abc-2"',
+                    "Size": 10_000_000,
+                    "LastModified": last_modified,
+                },
+            ]
+        }
+    ]
+    cache = OutputFingerprintCache()
+
+    assert cache.warm_from_bucket(s3_client, BUCKET, "catalogue/") == 1
+    assert cache.drop_unchanged([upload("catalogue/a.ttl", "one")], BUCKET) == []
+
+
+def test_warm_from_bucket_skips_content_addressed_outputs():
+    s3_client = FakeS3Client()
+    executor = UploadExecutor(layout=ContentAddressedLayout())
+    try:
+        executor.run(
+            SimpleNamespace(s3_client=s3_client, output_bucket=BUCKET),
+            [upload("catalogue/a.ttl", "one")],
+        )
+    finally:
+        executor.shutdown()
+    cache = OutputFingerprintCache()
+
+    assert cache.warm_from_bucket(s3_client, BUCKET, "catalogue/") == 0
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = OutputFingerprintCache()
+    cache.drop_unchanged([upload("a.ttl", "one"), upload("b/c.ttl", "two")], BUCKET)
+    cache.save_snapshot(path)
+
+    restored = OutputFingerprintCache()
+    assert restored.load_snapshot(path) == 2
+    assert restored.drop_unchanged([upload("a.ttl", "one"), upload("b/c.ttl", "two")], BUCKET) == []
+
+
+def test_snapshot_is_saved_on_sigterm(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.json")
+    options = IngesterOptions(output_cache_size=10, output_cache_snapshot=path)
+
+    terminate_once_handled(monkeypatch)
+    ingest(options, FakeS3Client(), BUCKET, client=FakePulsarClient(FakeBroker()))
+
+    assert os.path.exists(path)
+    assert signal.getsignal(signal.SIGTERM) is signal.SIG_DFL
+
+
+def test_missing_snapshot_is_ignored(tmp_path):
+    assert OutputFingerprintCache().load_snapshot(str(tmp_path / "missing.json")) == 0
+
+
+def test_failed_put_invalidates_fingerprint():
+    cache = OutputFingerprintCache()
+    s3_client = mock.MagicMock()
+    s3_client.put_object.side_effect = RuntimeError("upload failed")
+    wrapped = InvalidatingS3Client(s3_client, cache)
+
+    [action] = cache.drop_unchanged([upload("a.ttl", "one")], BUCKET)
+    with pytest.raises(RuntimeError):
+        wrapped.put_object(Bucket=BUCKET, Key=action.key, Body=action.file_body)
+
+    assert len(cache.drop_unchanged([upload("a.ttl", "one")], BUCKET)) == 1
+
+
+def test_cached_annotation_output_is_stable():
+    with open("ontology/qa-output-1.trig", "rb") as f:
+        body = f.read()
+    messager = AnnotationsMessager(None, BUCKET, None, None, output_cache=OutputFingerprintCache())
+
+    first = messager.process_update_body(body, "a/b", None, None)
+    second = messager.process_update_body(body, "a/b", None, None)
+
+    assert [a.file_body for a in first] == [a.file_body for a in second]
+    assert messager.output_cache.drop_unchanged(first, BUCKET) == first
+    assert messager.output_cache.drop_unchanged(second, BUCKET) == []
@@ -0,0 +1,261 @@
+import json
+import signal
+import threading
+
+import pytest
+
+from annotations_ingester.__main__ import IngesterOptions, ingest
+from annotations_ingester.annotations_generator import (
+    AnnotationsMessager,
+    get_uuid_from_graph,
+)
+from annotations_ingester.backfill import local_entries
+from annotations_ingester.dataset_dcat_generator import DatasetDCATMessager
+from annotations_ingester.qa_index import (
+    QA_INDEX_NAME,
+    QASummaryIndex,
+    annotation_lines,
+    lookup,
+    merge_changes,
+    rebuild_index,
+    summary_line,
+)
+from benchmarks.fakes import FakeBroker, FakePulsarClient, FakeS3Client
+
+BUCKET = "test-bucket"
+PREFIX = "catalogue/qa-index/"
+
+
+@pytest.fixture
+def trigs():
+    bodies = []
+    for n in (1, 2):
+        with open(f"ontology/qa-output-{n}.trig", "rb") as f:
+            bodies.append(f.read())
+    return bodies
+
+
+def line(dataset: str, source: str = "qa.trig", value=1) -> str:
+    results = {"generatedAtTime": "2024-01-01T00:00:00Z", "results": {"m": {"value": value}}}
+    return summary_line(f"{dataset}/{source}", f"uuid-{dataset}", results)
+
+
+def stored_index(s3_client) -> dict:
+    return json.loads(s3_client.objects[(BUCKET, PREFIX + QA_INDEX_NAME)]["Body"])
+
+
+def data_keys(s3_client) -> set[str]:
+    return {key for _, key in s3_client.objects if key.startswith(PREFIX + "data/")}
+
+
+class CountingS3Client(FakeS3Client):
+    def __init__(self):
+        super().__init__()
+        self.gets = []
+
+    def get_object(self, **kwargs):
+        self.gets.append(kwargs)
+        return super().get_object(**kwargs)
+
+
+def terminate_once_handled(monkeypatch):
+    """
+    Calls ingest's SIGTERM handler as soon as it's installed, rather than signalling the test
+    process, which would kill it if the handler weren't installed yet.
+    """
+    install = signal.signal
+
+    def install_and_call(signum, handler):
+        previous = install(signum, handler)
+        if signum == signal.SIGTERM and callable(handler):
+            handler(signum, None)
+        return previous
+
+    monkeypatch.setattr(signal, "signal", install_and_call)
+
+
+def test_changes_are_merged_in_order():
+    existing = [line("a"), line("b"), line("b", "z.trig"), line("d")]
+    changes = [
+        (("a", "a/qa.trig"), None),
+        (("b", "b/qa.trig"), line("b", value=2)),
+        (("c", "c/qa.trig"), line("c")),
+        (("e", "e/qa.trig"), line("e")),
+    ]
+
+    merged = list(merge_changes(existing, changes))
+
+    assert merged == [line("b", value=2), line("b", "z.trig"), line("c"), line("d"), line("e")]
+
+
+def test_many_datasets_are_found_with_a_few_ranged_gets():
+    s3_client = CountingS3Client()
+    index = QASummaryIndex(block_bytes=1024)
+    for n in range(2000):
+        index.add_line(line(f"catalogs/c/collections/{n:05}"))
+
+    assert index.export(s3_client, BUCKET)["records"] == 2000
+    assert index.pending() == 0
+    assert len(stored_index(s3_client)["blocks"]) > 100
+
+    wanted = [f"catalogs/c/collections/{n:05}" for n in (*range(100, 300), 1500, 1999)]
+    s3_client.gets.clear()
+    found = lookup(s3_client, BUCKET, wanted + ["catalogs/c/collections/missing"])
+
+    assert all(found[dataset][0]["uuid"] == f"uuid-{dataset}" for dataset in wanted)
+    assert found["catalogs/c/collections/missing"] == []
+    assert len(s3_client.gets) == 4
+    assert all("Range" in get for get in s3_client.gets[1:])
+
+
+def test_exports_merge_with_what_other_processes_exported():
+    s3_client = FakeS3Client()
+    first, second = QASummaryIndex(block_bytes=64), QASummaryIndex(block_bytes=64)
+
+    first.add_line(line("a"))
+    first.add_line(line("b"))
+    first.export(s3_client, BUCKET)
+
+    second.add_line(line("c"))
+    second.remove("a/qa.trig")
+    second.export(s3_client, BUCKET)
+
+    assert first.export(s3_client, BUCKET) is None
+    found = lookup(s3_client, BUCKET, ["a", "b", "c"])
+    assert [len(found[dataset]) for dataset in "abc"] == [0, 1, 1]
+
+    # Only the current data file and the one before it are kept.
+    second.add_line(line("d"))
+    second.export(s3_client, BUCKET)
+    index = stored_index(s3_client)
+    assert data_keys(s3_client) == {PREFIX + index["data"], PREFIX + index["previous"]}
+
+
+def test_concurrent_exports_are_all_kept():
+    s3_client = FakeS3Client(latency=0.002)
+    barrier = threading.Barrier(4)
+
+    def export(n: int):
+        index = QASummaryIndex()
+        for m in range(5):
+            index.add_line(line(f"{n}-{m}"))
+        barrier.wait()
+        index.export(s3_client, BUCKET)
+
+    threads = [threading.Thread(target=export, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    index = stored_index(s3_client)
+    assert index["records"] == 20
+    assert s3_client.conflicts > 0
+    assert data_keys(s3_client) <= {PREFIX + index["data"], PREFIX + index["previous"]}
+
+
+def test_unexported_changes_survive_a_restart(tmp_path):
+    path = str(tmp_path / "qa-index.sqlite")
+    index = QASummaryIndex(path)
+    index.add_line(line("a"))
+    index.close()
+
+    index = QASummaryIndex(path)
+    index.remove("b/qa.trig")
+    assert index.pending() == 2
+
+    index.export(FakeS3Client(), BUCKET)
+    assert index.pending() == 0
+
+
+def test_messager_records_annotations(trigs):
+    s3_client = FakeS3Client()
+    index = QASummaryIndex()
+    messager = AnnotationsMessager(s3_client, BUCKET, qa_index=index)
+
+    for n, trig in enumerate(trigs):
+        messager.process_update_body(trig, f"catalogs/c/collections/x/qa-{n}.trig", "/", "/")
+    messager.process_delete(cat_path="catalogs/c/collections/x/qa-0.trig")
+    index.export(s3_client, BUCKET)
+
+    records = lookup(s3_client, BUCKET, ["catalogs/c/collections/x"])["catalogs/c/collections/x"]
+    assert [record["source"] for record in records] == ["catalogs/c/collections/x/qa-1.trig"]
+    assert records[0]["uuid"] == get_uuid_from_graph(trigs[1])
+    assert records[0]["results"]
+
+
+def test_deleting_a_catalog_removes_the_annotations_under_it(trigs):
+    s3_client = FakeS3Client()
+    index = QASummaryIndex()
+    messager = AnnotationsMessager(s3_client, BUCKET, qa_index=index)
+    for n, trig in enumerate(trigs):
+        messager.process_update_body(trig, f"catalogs/c{n}/collections/x/qa.trig", "/", "/")
+    index.export(s3_client, BUCKET)
+
+    messager.process_update_body(trigs[0], "catalogs/c0/qa.trig", "/", "/")
+    DatasetDCATMessager(s3_client, BUCKET, qa_index=index).process_delete(
+        cat_path="catalogs/c0.json"
+    )
+    assert index.export(s3_client, BUCKET)["removed_prefixes"] == 1
+
+    datasets = ["catalogs/c0", "catalogs/c0/collections/x", "catalogs/c1/collections/x"]
+    found = lookup(s3_client, BUCKET, datasets)
+    assert [len(found[dataset]) for dataset in datasets] == [0, 0, 1]
+    assert index.pending() == 0
+
+
+def test_streamed_annotations_are_recorded(trigs):
+    s3_client = FakeS3Client()
+    index = QASummaryIndex()
+    messager = AnnotationsMessager(s3_client, BUCKET, qa_index=index)
+    for n, trig in enumerate(trigs):
+        messager.process_update_body(trig, f"catalogs/c/collections/{'xy'[n]}/qa.trig", "/", "/")
+    index.export(s3_client, BUCKET)
+    datasets = ["catalogs/c/collections/x", "catalogs/c/collections/y"]
+    recorded = lookup(s3_client, BUCKET, datasets)
+
+    messager.streaming_threshold = 1
+    for n, trig in enumerate(trigs):
+        messager.process_update_body(trig, f"catalogs/c/collections/{'xy'[n]}/qa.trig", "/", "/")
+    index.export(s3_client, BUCKET)
+
+    assert all(recorded[dataset] for dataset in datasets)
+    assert lookup(s3_client, BUCKET, datasets) == recorded
+
+
+@pytest.mark.parametrize("streaming_threshold", [0, 1])
+def test_rebuild_reads_the_annotations_in_a_catalogue(tmp_path, trigs, streaming_threshold):
+    for n, trig in enumerate(trigs):
+        path = tmp_path / f"catalogs/c/collections/{'yx'[n]}/qa.trig"
+        path.parent.mkdir(parents=True)
+        path.write_bytes(trig)
+    (tmp_path / "catalogs/c/collections/broken.trig").write_bytes(b"not an annotation")
+
+    def read(entry) -> bytes:
+        with open(entry.location, "rb") as f:
+            return f.read()
+
+    s3_client = FakeS3Client()
+    stats = rebuild_index(
+        s3_client, BUCKET, annotation_lines(local_entries(str(tmp_path)), read, streaming_threshold)
+    )
+
+    assert stats["records"] == 2
+    found = lookup(s3_client, BUCKET, ["catalogs/c/collections/x", "catalogs/c/collections/y"])
+    assert found["catalogs/c/collections/x"][0]["uuid"] == get_uuid_from_graph(trigs[1])
+    assert found["catalogs/c/collections/y"][0]["uuid"] == get_uuid_from_graph(trigs[0])
+
+
+def test_sigterm_exports_the_index(tmp_path, monkeypatch):
+    path = str(tmp_path / "qa-index.sqlite")
+    index = QASummaryIndex(path)
+    index.add_line(line("a"))
+    index.close()
+
+    s3_client = FakeS3Client()
+    options = IngesterOptions(qa_index_interval=3600, qa_index_path=path)
+    terminate_once_handled(monkeypatch)
+    ingest(options, s3_client, BUCKET, client=FakePulsarClient(FakeBroker()))
+
+    assert stored_index(s3_client)["records"] == 1
+    assert signal.getsignal(signal.SIGTERM) is signal.SIG_DFL
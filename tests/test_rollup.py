@@ -0,0 +1,197 @@
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+from rdflib import Graph
+
+from annotations_ingester.annotations_generator import (
+    AnnotationsMessager,
+    get_uuid_from_graph,
+)
+from annotations_ingester.rollup import (
+    ROLLUP_NAME,
+    SUMMARY_NAME,
+    rollup_actions,
+    splice_run,
+    update_summary,
+)
+from annotations_ingester.uploads import (
+    UPDATE_ATTEMPTS,
+    TemporaryFailure,
+    UploadExecutor,
+    run_updates,
+)
+from benchmarks.fakes import FakeS3Client
+
+BUCKET = "test-bucket"
+DIRECTORY = "catalogue/catalogs/c/collections/x/annotations/"
+
+
+@pytest.fixture
+def executor():
+    executor = UploadExecutor(max_concurrency=4)
+    yield executor
+    executor.shutdown()
+
+
+@pytest.fixture
+def trigs():
+    bodies = []
+    for n in (1, 2):
+        with open(f"ontology/qa-output-{n}.trig", "rb") as f:
+            bodies.append(f.read())
+    return bodies
+
+
+def stored(s3_client, name: str) -> bytes:
+    return s3_client.objects[(BUCKET, DIRECTORY + name)]["Body"]
+
+
+def ntriples(n: int) -> bytes:
+    return f"<https://example.com/{n}> <https://example.com/p> <https://example.com/o> .\n".encode()
+
+
+def test_splicing_a_run_is_idempotent():
+    rollup = splice_run(None, uuid="a", source="a.trig", ntriples=ntriples(1))
+    rollup = splice_run(rollup, uuid="b", source="b.trig", ntriples=ntriples(2))
+
+    assert splice_run(rollup, uuid="a", source="a.trig", ntriples=ntriples(1)) == rollup
+    assert len(Graph().parse(data=rollup, format="nt")) == 2
+
+
+def test_splicing_replaces_runs_from_the_same_source():
+    rollup = splice_run(None, uuid="a", source="qa.trig", ntriples=ntriples(1))
+    rollup = splice_run(rollup, uuid="b", source="other.trig", ntriples=ntriples(2))
+
+    rollup = splice_run(rollup, uuid="c", source="qa.trig", ntriples=ntriples(3))
+    assert rollup.index(ntriples(3)) < rollup.index(ntriples(2))
+    assert ntriples(1) not in rollup
+
+    rollup = splice_run(rollup, uuid="c", source="qa.trig", ntriples=None)
+    assert rollup.count(b"# run ") == 1 and ntriples(2) in rollup
+
+
+def test_summary_has_the_latest_result_for_each_metric():
+    early = {"generatedAtTime": "2024-01-01", "results": {"m": {"value": 1}, "n": {"value": 2}}}
+    late = {"generatedAtTime": "2024-02-01", "results": {"m": {"value": 3}}}
+
+    summary = update_summary(None, uuid="b", source="b.trig", results=late)
+    summary = update_summary(summary, uuid="a", source="a.trig", results=early)
+    latest = json.loads(summary)["latest"]
+    assert latest["m"]["value"] == 3 and latest["m"]["run"] == "b"
+    assert latest["n"]["value"] == 2
+
+    summary = update_summary(summary, uuid="b", source="b.trig", results=None)
+    assert json.loads(summary)["latest"]["m"]["value"] == 1
+    assert list(json.loads(summary)["runs"]) == ["a"]
+
+
+def test_annotations_are_rolled_up(executor, trigs):
+    s3_client = FakeS3Client()
+    messager = AnnotationsMessager(s3_client, BUCKET, rollups=True)
+
+    for n, trig in enumerate(trigs):
+        cat_path = f"catalogs/c/collections/x/qa-{n}.trig"
+        executor.run(messager, messager.process_update_body(trig, cat_path, "/", "/"))
+
+    rollup = stored(s3_client, ROLLUP_NAME)
+    summary = json.loads(stored(s3_client, SUMMARY_NAME))
+    assert rollup.count(b"# run ") == 2
+    assert b"_:" not in rollup
+    assert set(summary["runs"]) == {get_uuid_from_graph(trig) for trig in trigs}
+    assert summary["latest"]
+
+    # Re-sending an annotation doesn't rewrite the rollup or summary.
+    puts = s3_client.put_count
+    executor.run(
+        messager,
+        messager.process_update_body(trigs[0], "catalogs/c/collections/x/qa-0.trig", "/", "/"),
+    )
+    assert s3_client.put_count == puts + 3
+
+    executor.run(messager, messager.process_delete(cat_path="catalogs/c/collections/x/qa-0.trig"))
+    assert stored(s3_client, ROLLUP_NAME).count(b"# run ") == 1
+    assert list(json.loads(stored(s3_client, SUMMARY_NAME))["runs"]) == [
+        get_uuid_from_graph(trigs[1])
+    ]
+
+
+def test_streamed_annotations_are_rolled_up_with_their_results(executor, trigs):
+    s3_client = FakeS3Client()
+    messager = AnnotationsMessager(s3_client, BUCKET, rollups=True)
+    for n, trig in enumerate(trigs):
+        cat_path = f"catalogs/c/collections/x/qa-{n}.trig"
+        executor.run(messager, messager.process_update_body(trig, cat_path, "/", "/"))
+    summary, rollup = stored(s3_client, SUMMARY_NAME), stored(s3_client, ROLLUP_NAME)
+
+    messager.streaming_threshold = 1
+    cat_path = "catalogs/c/collections/x/qa-0.trig"
+    executor.run(messager, messager.process_update_body(trigs[0], cat_path, "/", "/"))
+
+    assert stored(s3_client, SUMMARY_NAME) == summary
+    # The run's section only has the triples which identify it and give its results.
+    streamed_rollup = stored(s3_client, ROLLUP_NAME)
+    assert streamed_rollup.count(b"# run ") == 2
+    assert len(streamed_rollup) < len(rollup)
+    assert b"/prov#generatedAtTime>" in streamed_rollup.split(b"# run ")[1]
+
+
+def test_concurrent_updates_are_all_kept():
+    s3_client = FakeS3Client(latency=0.002)
+    barrier = threading.Barrier(8)
+
+    def add_runs(n: int):
+        barrier.wait()
+        for m in range(5):
+            run = f"{n}-{m}"
+            run_updates(
+                s3_client,
+                BUCKET,
+                rollup_actions(DIRECTORY, run, f"{run}.trig", ntriples(10 * n + m), None)[:1],
+            )
+
+    threads = [threading.Thread(target=add_runs, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert stored(s3_client, ROLLUP_NAME).count(b"# run ") == 40
+    assert s3_client.conflicts > 0
+
+
+def test_updates_to_one_object_in_a_batch_are_combined(executor):
+    s3_client = FakeS3Client()
+    messager = SimpleNamespace(s3_client=s3_client, output_bucket=BUCKET)
+
+    trackers = executor.submit_batch(
+        [
+            (messager, rollup_actions(DIRECTORY, str(n), f"{n}.trig", ntriples(n), None)[:1])
+            for n in range(10)
+        ]
+    )
+
+    assert all(tracker.result() is None for tracker in trackers)
+    assert stored(s3_client, ROLLUP_NAME).count(b"# run ") == 10
+    assert s3_client.put_count == 1
+
+
+def test_update_gives_up_after_repeated_conflicts(monkeypatch):
+    s3_client = FakeS3Client()
+    put_object = s3_client.put_object
+
+    def interfering_put(**kwargs):
+        # Another writer gets in first every time.
+        put_object(Bucket=BUCKET, Key=DIRECTORY + ROLLUP_NAME, Body=str(s3_client.put_count))
+        return put_object(**kwargs)
+
+    monkeypatch.setattr(s3_client, "put_object", interfering_put)
+    monkeypatch.setattr("annotations_ingester.uploads.UPDATE_BACKOFF", 0.0)
+
+    with pytest.raises(TemporaryFailure):
+        run_updates(
+            s3_client, BUCKET, rollup_actions(DIRECTORY, "a", "a.trig", ntriples(1), None)[:1]
+        )
+
+    assert s3_client.conflicts == UPDATE_ATTEMPTS
@@ -0,0 +1,367 @@
+import threading
+import time
+from unittest import mock
+
+import pulsar
+import pytest
+from botocore.exceptions import ClientError
+
+from annotations_ingester.__main__ import IngesterOptions
+from annotations_ingester.runner import (
+    Batch,
+    BatchCollector,
+    BatchMetrics,
+    Messager,
+    OrderedPipeline,
+    TopicScheduler,
+    run_pipelined,
+    topic_short_name,
+)
+from benchmarks.fakes import FakeBroker, FakePulsarClient
+
+
+class FakeMessage:
+    def __init__(self, topic: str, data: bytes, message_id: int):
+        self._topic = topic
+        self._data = data
+        self._message_id = message_id
+
+    def topic_name(self):
+        return f"persistent://public/default/{self._topic}"
+
+    def data(self):
+        return self._data
+
+    def message_id(self):
+        return self._message_id
+
+
+class FakeConsumer:
+    """Delivers a fixed list of messages then sets stop_event once they're all settled."""
+
+    def __init__(self, messages, stop_event):
+        self.pending = list(messages)
+        self.expected = len(messages)
+        self.stop_event = stop_event
+        self.acked = []
+        self.nacked = []
+
+    def receive(self, timeout_millis=None):
+        if not self.pending:
+            raise pulsar.Timeout()
+        return self.pending.pop(0)
+
+    def _settled(self):
+        if len(self.acked) + len(self.nacked) == self.expected:
+            self.stop_event.set()
+
+    def acknowledge(self, msg):
+        self.acked.append(msg.message_id())
+        self._settled()
+
+    def negative_acknowledge(self, msg):
+        self.nacked.append(msg.message_id())
+        self._settled()
+
+
+class FakeClient:
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.subscribed_topics = None
+
+    def subscribe(self, topics, subscription_name, consumer_type):
+        self.subscribed_topics = topics
+        return self.consumer
+
+    def close(self):
+        pass
+
+
+class SlowMessager:
+    """Takes longer to process earlier messages, so they complete out of order."""
+
+    def __init__(self):
+        self.s3_client = mock.MagicMock()
+        self.output_bucket = "bucket"
+
+    def process_msg(self, msg):
+        body = msg.data().decode()
+        if body == "bad":
+            raise ValueError("Malformed message")
+
+        time.sleep(0.05 / (msg.message_id() + 1))
+        return [Messager.S3UploadAction(key=f"key-{msg.message_id()}", file_body=body)]
+
+
+def run_messages(messager, messages, max_in_flight=4, **kwargs):
+    stop_event = threading.Event()
+    consumer = FakeConsumer(messages, stop_event)
+    client = FakeClient(consumer)
+
+    consumer.metrics = run_pipelined(
+        {"transformed": messager},
+        "test-subscription",
+        max_in_flight=max_in_flight,
+        client=client,
+        stop_event=stop_event,
+        **kwargs,
+    )
+
+    return consumer
+
+
+def test_topic_short_name():
+    assert topic_short_name("persistent://public/default/transformed") == "transformed"
+    assert topic_short_name("persistent://public/default/transformed_x-partition-3") == (
+        "transformed_x"
+    )
+
+
+def test_ordered_pipeline_returns_in_submission_order():
+    pipeline = OrderedPipeline(lambda delay: time.sleep(delay) or delay, max_in_flight=3)
+
+    for delay in (0.06, 0.01, 0.03):
+        pipeline.submit(delay)
+    assert pipeline.full()
+
+    results = [(item, future.result()) for item, future in pipeline.drain()]
+
+    assert results == [(0.06, 0.06), (0.01, 0.01), (0.03, 0.03)]
+    pipeline.shutdown()
+
+
+def test_run_pipelined_uploads_and_acks_in_order():
+    messager = SlowMessager()
+    messages = [FakeMessage("transformed", b"body", i) for i in range(6)]
+
+    consumer = run_messages(messager, messages)
+
+    assert consumer.acked == list(range(6))
+    uploaded_keys = [c.kwargs["Key"] for c in messager.s3_client.put_object.call_args_list]
+    assert uploaded_keys == [f"key-{i}" for i in range(6)]
+
+
+def test_run_pipelined_acks_permanent_failures():
+    messager = SlowMessager()
+    messages = [FakeMessage("transformed", b"bad", 0), FakeMessage("transformed", b"ok", 1)]
+
+    consumer = run_messages(messager, messages)
+
+    assert consumer.acked == [0, 1]
+    assert consumer.nacked == []
+
+
+def test_run_pipelined_nacks_failed_uploads():
+    messager = SlowMessager()
+    messager.s3_client.put_object.side_effect = ClientError(
+        {"Error": {"Code": "InternalError"}}, "PutObject"
+    )
+
+    consumer = run_messages(messager, [FakeMessage("transformed", b"body", 0)])
+
+    assert consumer.nacked == [0]
+
+
+@pytest.mark.parametrize("permanent, acked", [(True, [0]), (False, [])])
+def test_run_pipelined_handles_failure_actions(permanent, acked):
+    messager = SlowMessager()
+    messager.process_msg = lambda msg: [Messager.FailureAction(permanent=permanent)]
+
+    consumer = run_messages(messager, [FakeMessage("transformed", b"body", 0)])
+
+    assert consumer.acked == acked
+
+
+def test_batch_collector_releases_full_batches_per_topic():
+    collector = BatchCollector(max_size=2, max_wait=10)
+
+    collector.add(FakeMessage("a", b"", 0), now=0)
+    collector.add(FakeMessage("b", b"", 1), now=0)
+    assert collector.pop_ready(now=1) is None
+
+    collector.add(FakeMessage("a", b"", 2), now=1)
+    batch = collector.pop_ready(now=1)
+
+    assert batch.topic == "a"
+    assert [m.message_id() for m, _ in batch.messages] == [0, 2]
+    assert collector.pop_ready(now=1) is None
+
+
+def test_batch_collector_releases_batches_after_max_wait():
+    collector = BatchCollector(max_size=10, max_wait=0.5)
+
+    assert collector.seconds_until_due(now=0) is None
+
+    collector.add(FakeMessage("a", b"", 0), now=0)
+    collector.add(FakeMessage("a", b"", 1), now=0.2)
+
+    assert collector.seconds_until_due(now=0.2) == pytest.approx(0.3)
+    assert collector.pop_ready(now=0.4) is None
+
+    batch = collector.pop_ready(now=0.5)
+    assert len(batch.messages) == 2
+    assert collector.flush() == []
+
+
+def test_batch_metrics_report_added_latency():
+    collector = BatchCollector(max_size=2, max_wait=1)
+    collector.add(FakeMessage("a", b"", 0), now=0)
+    collector.add(FakeMessage("a", b"", 1), now=0.5)
+
+    metrics = BatchMetrics()
+    metrics.record_dispatch(collector.pop_ready(now=0.5), now=0.5)
+    snapshot = metrics.snapshot()
+
+    assert snapshot["batches"] == 1
+    assert snapshot["batch_sizes"] == {2: 1}
+    assert snapshot["mean_added_latency"] == pytest.approx(0.25)
+    assert snapshot["max_added_latency"] == pytest.approx(0.5)
+
+
+def test_run_pipelined_batches_messages():
+    messager = SlowMessager()
+    messages = [FakeMessage("transformed", b"body", i) for i in range(7)]
+
+    consumer = run_messages(messager, messages, batch_size=3, batch_wait=0.05)
+
+    assert consumer.acked == list(range(7))
+    assert consumer.metrics.batch_sizes == {3: 2, 1: 1}
+    uploaded_keys = [c.kwargs["Key"] for c in messager.s3_client.put_object.call_args_list]
+    assert sorted(uploaded_keys) == sorted(f"key-{i}" for i in range(7))
+
+
+def test_run_pipelined_acks_batches_partially():
+    def put_object(Key, **kwargs):
+        if Key == "key-2":
+            raise ClientError({"Error": {"Code": "InternalError"}}, "PutObject")
+
+    messager = SlowMessager()
+    messager.s3_client.put_object.side_effect = put_object
+    messages = [
+        FakeMessage("transformed", b"body", 0),
+        FakeMessage("transformed", b"bad", 1),
+        FakeMessage("transformed", b"body", 2),
+        FakeMessage("transformed", b"body", 3),
+    ]
+
+    consumer = run_messages(messager, messages, batch_size=4, batch_wait=1)
+
+    assert consumer.metrics.batch_sizes == {4: 1}
+    assert consumer.acked == [0, 1, 3]
+    assert consumer.nacked == [2]
+
+
+def test_run_pipelined_coalesces_repeated_updates():
+    class RecordingMessager(SlowMessager):
+        def __init__(self):
+            super().__init__()
+            self.processed = []
+
+        def process_msg(self, msg):
+            self.processed.append(msg.message_id())
+            return super().process_msg(msg)
+
+    messager = RecordingMessager()
+    body = b'{"bucket_name": "bucket", "updated_keys": ["a"]}'
+    messages = [FakeMessage("transformed", body, i) for i in range(5)]
+
+    consumer = run_messages(messager, messages, coalesce_window=0.05)
+
+    assert messager.processed == [4]
+    assert sorted(consumer.acked) == list(range(5))
+
+
+def test_topic_scheduler_shares_workers_by_weight():
+    scheduler = TopicScheduler(
+        lambda batch: time.sleep(1), {"a": 3.0, "b": 1.0}, topic_max_in_flight=8, max_in_flight=8
+    )
+    for i in range(8):
+        scheduler.add(Batch(topic="a", opened_at=0, messages=[(FakeMessage("a", b"", i), 0)]))
+        scheduler.add(Batch(topic="b", opened_at=0, messages=[(FakeMessage("b", b"", i), 0)]))
+
+    dispatched = [scheduler.dispatch_next().topic for _ in range(8)]
+
+    assert dispatched.count("a") == 6 and dispatched.count("b") == 2
+    assert scheduler.dispatch_next() is None
+    scheduler.shutdown()
+
+
+def test_topic_scheduler_limits_each_topic():
+    scheduler = TopicScheduler(
+        lambda batch: time.sleep(0.05), {"a": 1.0, "b": 1.0}, topic_max_in_flight=2, max_in_flight=4
+    )
+    for i in range(4):
+        scheduler.add(Batch(topic="a", opened_at=0, messages=[(FakeMessage("a", b"", i), 0)]))
+    assert not scheduler.has_room("a") and scheduler.has_room("b")
+
+    assert [scheduler.dispatch_next().topic for _ in range(2)] == ["a", "a"]
+    assert scheduler.dispatch_next() is None
+
+    assert [batch.topic for batch, _ in scheduler.drain()] == ["a", "a"]
+    scheduler.shutdown()
+
+
+def test_run_pipelined_keeps_up_with_a_quiet_topic_during_a_storm():
+    class RecordingMessager(SlowMessager):
+        def __init__(self):
+            super().__init__()
+            self.processed = []
+
+        def process_msg(self, msg):
+            time.sleep(0.005)
+            self.processed.append(topic_short_name(msg.topic_name()))
+            return []
+
+    broker = FakeBroker()
+    messager = RecordingMessager()
+    for _ in range(200):
+        broker.publish("transformed_storm", b"body")
+
+    stop_event = threading.Event()
+    result = {}
+    runner = threading.Thread(
+        target=lambda: result.setdefault(
+            "metrics",
+            run_pipelined(
+                {"transformed_storm": messager, "transformed_quiet": messager},
+                "test-subscription",
+                max_in_flight=2,
+                client=FakePulsarClient(broker),
+                stop_event=stop_event,
+            ),
+        )
+    )
+    runner.start()
+
+    time.sleep(0.05)
+    for _ in range(5):
+        broker.publish("transformed_quiet", b"body")
+
+    assert broker.wait_until_settled(timeout=30)
+    stop_event.set()
+    runner.join()
+
+    # The quiet topic's messages were taken in turn with the storm's, not after it.
+    last_quiet = len(messager.processed) - messager.processed[::-1].index("transformed_quiet")
+    assert last_quiet < 100
+
+    topics = result["metrics"].snapshot()["topics"]
+    assert topics["transformed_quiet"]["settled"] == 5
+    assert topics["transformed_storm"]["settled"] == 200
+    assert topics["transformed_quiet"]["mean_lag"] < topics["transformed_storm"]["mean_lag"]
+
+
+def test_topics_option():
+    options = IngesterOptions(topics="transformed_a=2, transformed_b,transformed-annotations=0.5")
+
+    assert options.topic_weights() == {
+        "transformed_a": 2.0,
+        "transformed_b": 1.0,
+        "transformed-annotations": 0.5,
+    }
+    assert options.pipelined
+    assert IngesterOptions().topic_weights() == {}
+
+    for topics in ("other", "transformed_a=x", "transformed_a=0"):
+        with pytest.raises(ValueError):
+            IngesterOptions(topics=topics).topic_weights()
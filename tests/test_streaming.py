@@ -0,0 +1,136 @@
+import tracemalloc
+
+import pytest
+from boto3.s3.transfer import TransferConfig
+from rdflib import XSD, Graph, Literal
+
+from annotations_ingester import uploads
+from annotations_ingester.annotations_generator import (
+    AnnotationsMessager,
+    InvalidAnnotationError,
+    render_annotation,
+    render_annotation_results,
+    render_annotation_streaming,
+    render_annotation_streaming_results,
+    streamed_run_results,
+)
+from annotations_ingester.jsonld_context import with_inline_context
+from annotations_ingester.streaming import scan_prefixes
+from benchmarks.corpora import synthetic_qa_trig
+from benchmarks.fakes import FakeS3Client
+
+SPOOL_BYTES = 64 * 1024
+
+
+def default_graph_qa_trig(measurements: int) -> bytes:
+    """A QA run with its measurements in the default graph, so all of them are published."""
+    trig = synthetic_qa_trig(measurements)
+    return trig.replace(":qualityCheckResults {\n", "").rstrip().removesuffix("}").encode()
+
+
+@pytest.mark.parametrize("path", ["ontology/qa-output-1.trig", "ontology/qa-output-2.trig"])
+def test_streamed_output_is_equivalent(path):
+    with open(path, "rb") as f:
+        body = f.read()
+
+    uuid, turtle, jsonld = render_annotation_streaming(body)
+    expected_uuid, expected_turtle, expected_jsonld = render_annotation(body)
+
+    assert uuid == expected_uuid
+    assert (
+        Graph()
+        .parse(data=turtle.read(), format="turtle")
+        .isomorphic(Graph().parse(data=expected_turtle, format="turtle"))
+    )
+    assert expanded(jsonld.read()).isomorphic(expanded(expected_jsonld))
+
+
+def expanded(jsonld: str | bytes) -> Graph:
+    """Parses compacted JSON-LD, treating xsd:string literals as plain as it does."""
+    graph = Graph()
+    for s, p, o in Graph().parse(data=with_inline_context(jsonld), format="json-ld"):
+        if isinstance(o, Literal) and o.datatype == XSD.string:
+            o = Literal(str(o))
+        graph.add((s, p, o))
+
+    return graph
+
+
+def test_streamed_output_is_stable():
+    body = default_graph_qa_trig(20)
+
+    first = render_annotation_streaming(body)
+    second = render_annotation_streaming(body)
+
+    assert first[1].read() == second[1].read()
+    assert first[2].read() == second[2].read()
+
+
+def test_streaming_memory_is_bounded():
+    body = default_graph_qa_trig(1000)
+
+    tracemalloc.start()
+    try:
+        uuid, turtle, jsonld = render_annotation_streaming(body, SPOOL_BYTES)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # The parser holds a decoded copy of the body, and each output holds at most SPOOL_BYTES
+    # before moving to disk. Parsing into a Dataset takes over 30 times the body size.
+    assert peak < len(body) + 2 * SPOOL_BYTES + 512 * 1024
+    assert turtle._rolled and jsonld._rolled
+    assert Graph().parse(data=turtle.read(), format="turtle")
+
+
+@pytest.mark.parametrize("measurements", [0, 1, 50])
+def test_streamed_results_are_the_same(measurements):
+    body = default_graph_qa_trig(measurements)
+
+    uuid, turtle, jsonld, results = render_annotation_streaming_results(body)
+    turtle.close()
+    jsonld.close()
+
+    expected_uuid, _, _, expected_results = render_annotation_results(body)
+    assert (uuid, results) == (expected_uuid, expected_results)
+    assert bool(results["results"]) == bool(measurements)
+    assert streamed_run_results(body) == (expected_uuid, expected_results)
+
+
+def test_streaming_rejects_annotation_without_uuid():
+    body = default_graph_qa_trig(1).replace(b"owl:sameAs", b"rdfs:seeAlso")
+
+    with pytest.raises(InvalidAnnotationError):
+        render_annotation_streaming(body)
+
+
+def test_scan_prefixes_drops_conflicting_declarations():
+    body = b"@prefix a: <http://a/> .\n@prefix b: <http://b/> .\nPREFIX b: <http://c/>\n"
+
+    assert scan_prefixes(body) == {"a": "http://a/"}
+
+
+def test_large_annotation_is_uploaded_in_parts(monkeypatch):
+    monkeypatch.setattr(
+        uploads,
+        "FILE_TRANSFER_CONFIG",
+        TransferConfig(multipart_threshold=SPOOL_BYTES, multipart_chunksize=SPOOL_BYTES),
+    )
+    s3_client = FakeS3Client()
+    messager = AnnotationsMessager(s3_client, "public", streaming_threshold=1024)
+    body = default_graph_qa_trig(1000)
+
+    actions = messager.process_update_body(body, "catalogs/c/collections/x/qa.trig", "/", "/")
+    executor = uploads.UploadExecutor(max_concurrency=2)
+    try:
+        executor.run(messager, actions)
+    finally:
+        executor.shutdown()
+
+    assert actions[0].file_body.closed and actions[1].file_body.closed
+    turtle = s3_client.objects[("public", actions[0].key)]
+    assert turtle["ContentType"] == "text/turtle"
+    assert turtle["parts"] > 1
+    assert len(Graph().parse(data=turtle["Body"], format="turtle")) == len(
+        Graph().parse(data=body, format="trig")
+    )
@@ -0,0 +1,178 @@
+import io
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from botocore.exceptions import ClientError
+
+from annotations_ingester.__main__ import IngesterOptions
+from annotations_ingester.throttling import (
+    AdaptiveConcurrency,
+    AIMDLimiter,
+    RetryBudget,
+    ThrottledS3Client,
+    is_retryable,
+    is_throttling,
+)
+from annotations_ingester.uploads import Messager, UploadExecutor
+from benchmarks.fakes import FakeS3Client
+from benchmarks.loadtest import run_load_test, synthetic_stream
+
+BUCKET = "test-bucket"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def client_error(code: str, status: int) -> ClientError:
+    return ClientError(
+        {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}}, "PutObject"
+    )
+
+
+def test_errors_are_classified():
+    assert is_throttling(client_error("SlowDown", 503))
+    assert is_retryable(client_error("InternalError", 500))
+    assert not is_retryable(client_error("AccessDenied", 403))
+    assert not is_retryable(client_error("PreconditionFailed", 412))
+
+
+def test_limit_halves_once_per_round_and_grows_back():
+    limiter = AIMDLimiter(16)
+    tokens = [limiter.acquire() for _ in range(8)]
+
+    # Requests throttled together only reduce the limit once.
+    for token in tokens[:4]:
+        limiter.release(token, throttled=True)
+    assert limiter.limit == 8
+
+    limiter.release(limiter.acquire(), throttled=True)
+    assert limiter.limit == 4
+
+    for token in tokens[4:]:
+        limiter.release(token)
+    for _ in range(500):
+        limiter.release(limiter.acquire())
+    assert limiter.limit == 16
+
+
+def test_limit_bounds_requests_in_flight():
+    limiter = AIMDLimiter(2)
+    first, second = limiter.acquire(), limiter.acquire()
+    acquired = threading.Event()
+
+    def third():
+        limiter.release(limiter.acquire())
+        acquired.set()
+
+    threading.Thread(target=third).start()
+    assert not acquired.wait(0.05)
+
+    limiter.release(first)
+    assert acquired.wait(1)
+    limiter.release(second)
+
+
+def test_retry_budget_refills_from_attempts_and_time():
+    clock = FakeClock()
+    budget = RetryBudget(ratio=0.5, min_per_second=1.0, max_tokens=2.0, clock=clock)
+
+    assert budget.try_withdraw() and budget.try_withdraw()
+    assert budget.exhausted() and not budget.try_withdraw()
+
+    budget.deposit()
+    budget.deposit()
+    assert budget.try_withdraw()
+
+    clock.now += 1.0
+    assert budget.try_withdraw()
+
+
+def test_throttled_requests_are_retried_and_rewound():
+    s3_client = FakeS3Client()
+    failures = iter([client_error("SlowDown", 503), client_error("SlowDown", 503)])
+    put_object = s3_client.put_object
+
+    reads = []
+
+    def flaky_put(Body, **kwargs):
+        reads.append(Body.read())
+        if error := next(failures, None):
+            raise error
+        return put_object(Body=reads[-1], **kwargs)
+
+    s3_client.put_object = flaky_put
+    concurrency = AdaptiveConcurrency(8, base_backoff=0.001)
+
+    ThrottledS3Client(s3_client, concurrency).put_object(
+        Bucket=BUCKET, Key="a", Body=io.BytesIO(b"body")
+    )
+
+    assert reads == [b"body"] * 3
+    assert concurrency.stats()["throttled"] == 2
+    assert concurrency.limiter.limit < 8
+
+
+def test_non_retryable_errors_are_raised():
+    s3_client = FakeS3Client()
+    s3_client.failing_keys.add("a")
+    concurrency = AdaptiveConcurrency(8, max_attempts=3, base_backoff=0.001)
+
+    with pytest.raises(ClientError):
+        ThrottledS3Client(s3_client, concurrency).put_object(Bucket=BUCKET, Key="a", Body="x")
+
+    # InternalError is retried, up to the limit on attempts.
+    assert concurrency.stats()["retries"] == 2
+
+
+def test_uploads_adapt_to_a_throttled_bucket():
+    # At 10 ms a request, about 10 in flight make the most of the bucket's rate.
+    s3_client = FakeS3Client(latency=0.01, rate_limit=1000)
+    concurrency = AdaptiveConcurrency(32, base_backoff=0.005)
+    messager = SimpleNamespace(
+        s3_client=ThrottledS3Client(s3_client, concurrency), output_bucket=BUCKET
+    )
+    executor = UploadExecutor(max_concurrency=32)
+
+    started = time.monotonic()
+    try:
+        trackers = executor.submit_batch(
+            [
+                (messager, [Messager.S3UploadAction(key=f"catalogue/{n}.ttl", file_body="x")])
+                for n in range(600)
+            ]
+        )
+        assert all(tracker.result() is None for tracker in trackers)
+    finally:
+        executor.shutdown()
+    elapsed = time.monotonic() - started
+
+    assert len(s3_client.objects) == 600
+    assert 0 < s3_client.throttled < 600
+    assert concurrency.limiter.limit < 32
+    assert 600 / elapsed > 0.25 * s3_client.rate_limit
+
+
+def test_ingester_loses_no_messages_when_throttled():
+    stream = synthetic_stream(40, annotation_ratio=0.5, links=5, measurements=2)
+
+    report = run_load_test(
+        stream,
+        IngesterOptions(upload_concurrency=16, max_in_flight=8, adaptive_concurrency=True),
+        messages=200,
+        s3_latency=0.001,
+        s3_rate_limit=400,
+        settle_timeout=60,
+        memory_interval=0.05,
+    )
+
+    assert report["settled"]
+    assert report["acknowledged"] == 200
+    assert report["redelivered"] == 0
+    assert report["s3_throttled"] > 0
@@ -0,0 +1,110 @@
+import io
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from annotations_ingester.uploads import (
+    Messager,
+    PermanentFailure,
+    TemporaryFailure,
+    UploadExecutor,
+)
+from benchmarks.fakes import FakeS3Client
+
+BUCKET = "test-bucket"
+
+
+def fake_messager(s3_client):
+    return SimpleNamespace(s3_client=s3_client, output_bucket=BUCKET)
+
+
+def message_actions(n: int):
+    return [
+        Messager.S3UploadAction(key=f"catalogue/{n}.ttl", file_body=f"ttl {n}"),
+        Messager.S3UploadAction(key=f"catalogue/{n}.jsonld", file_body=f"jsonld {n}"),
+    ]
+
+
+@pytest.fixture
+def executor():
+    executor = UploadExecutor(max_concurrency=16)
+    yield executor
+    executor.shutdown()
+
+
+def test_uploads_all_actions(executor):
+    s3_client = FakeS3Client()
+
+    executor.run(fake_messager(s3_client), message_actions(1))
+
+    assert s3_client.body(BUCKET, "catalogue/1.ttl") == b"ttl 1"
+    assert s3_client.body(BUCKET, "catalogue/1.jsonld") == b"jsonld 1"
+
+
+def test_concurrent_uploads_hide_latency(executor):
+    latency = 0.02
+    messages = 10
+    s3_client = FakeS3Client(latency=latency)
+    messager = fake_messager(s3_client)
+
+    start = time.perf_counter()
+    trackers = executor.submit_batch([(messager, message_actions(n)) for n in range(messages)])
+    assert all(tracker.result() is None for tracker in trackers)
+    elapsed = time.perf_counter() - start
+
+    sequential = 2 * messages * latency
+    assert s3_client.put_count == 2 * messages
+    assert elapsed < sequential / 4
+
+
+def test_failures_are_tracked_per_message(executor):
+    s3_client = FakeS3Client()
+    s3_client.failing_keys.add("catalogue/1.jsonld")
+    messager = fake_messager(s3_client)
+
+    trackers = executor.submit_batch([(messager, message_actions(n)) for n in range(3)])
+    results = [tracker.result() for tracker in trackers]
+
+    assert results[0] is None
+    assert isinstance(results[1], TemporaryFailure)
+    assert results[2] is None
+
+
+def test_later_writes_to_a_key_supersede_earlier_ones(executor):
+    s3_client = FakeS3Client()
+    messager = fake_messager(s3_client)
+    older = [Messager.S3UploadAction(key="catalogue/a.ttl", file_body="old")]
+    newer = [Messager.S3UploadAction(key="catalogue/a.ttl", file_body="new")]
+
+    trackers = executor.submit_batch([(messager, older), (messager, newer)])
+
+    assert [tracker.result() for tracker in trackers] == [None, None]
+    assert s3_client.put_count == 1
+    assert s3_client.body(BUCKET, "catalogue/a.ttl") == b"new"
+
+
+def test_file_bodies_are_closed_once_uploaded_or_superseded(executor):
+    s3_client = FakeS3Client()
+    older, newer = io.BytesIO(b"old"), io.BytesIO(b"new")
+
+    trackers = executor.submit_batch(
+        [
+            (fake_messager(s3_client), [Messager.S3UploadAction(key="a.ttl", file_body=older)]),
+            (fake_messager(s3_client), [Messager.S3UploadAction(key="a.ttl", file_body=newer)]),
+        ]
+    )
+
+    assert [tracker.result() for tracker in trackers] == [None, None]
+    assert older.closed and newer.closed
+    assert s3_client.body(BUCKET, "a.ttl") == b"new"
+
+
+@pytest.mark.parametrize(
+    "permanent, expected_failure", [(True, PermanentFailure), (False, TemporaryFailure)]
+)
+def test_failure_actions(executor, permanent, expected_failure):
+    messager = fake_messager(FakeS3Client())
+
+    with pytest.raises(expected_failure):
+        executor.run(messager, [Messager.FailureAction(permanent=permanent)])
@@ -0,0 +1,137 @@
+import pytest
+from rdflib import Graph
+
+from annotations_ingester.annotations_generator import (
+    AnnotationsMessager,
+    InvalidAnnotationError,
+    parse_annotation,
+)
+from annotations_ingester.validation import (
+    MAX_ISSUES_PER_CODE,
+    WARNING,
+    AnnotationValidationError,
+    compile_ontology,
+    default_validator,
+    ontology_tables,
+)
+from benchmarks.corpora import synthetic_qa_trig
+
+RUN_UUID = "7462319b-947c-4900-83a7-5341362cfab6"
+
+MEASUREMENT = """
+    :m{index}
+        a dqv:QualityMeasurement ;
+        dqv:isMeasurementOf {metric} ;
+        qb:dataSet :checkRun ;
+        dqv:value {value} .
+"""
+
+
+def annotation(*measurements: tuple[str, str], run: str = None) -> str:
+    """A QA run with a measurement of each (metric, value)."""
+    body = synthetic_qa_trig(0, run_uuid=RUN_UUID).removesuffix("}\n")
+    if run is not None:
+        body = body.replace(":checkRun\n", run + "\n    :checkRun\n", 1)
+
+    for index, (metric, value) in enumerate(measurements):
+        body += MEASUREMENT.format(index=index, metric=metric, value=value)
+
+    return body + "}\n"
+
+
+def validate(body: str):
+    return default_validator().validate(parse_annotation(body))
+
+
+def test_packaged_tables_match_the_ontology():
+    compiled = compile_ontology(Graph().parse("ontology/qa-ontology.ttl", format="turtle"))
+
+    # If this fails, run: python -m annotations_ingester.validation ontology/qa-ontology.ttl
+    assert compiled == ontology_tables()
+    assert compiled.metrics["https://eodatahub.org.uk/api/ontologies/qa/snr"].endswith("#double")
+
+
+def test_example_annotations_are_valid_with_warnings():
+    with open("ontology/qa-output-1.trig") as f:
+        report = validate(f.read())
+
+    assert report.valid
+    assert report.uuid == RUN_UUID
+    assert report.measurements == 2
+    assert {issue.code for issue in report.warnings} == {
+        "unknown-metric",
+        "measurement-not-in-run",
+    }
+
+
+def test_well_formed_measurements_are_valid():
+    report = validate(
+        annotation(
+            ("eodhqa:snr", "42.5"),
+            ("eodhqa:snr", '"1e3"^^xsd:double'),
+            ("eodhqa:productDetails", "eodhqa:gradeGood"),
+            ("eodhqa:userDocumentation", '"Adequate"@en'),
+            ("<https://example.com/metric>", '"anything"'),
+        )
+    )
+
+    assert report.valid and not report.issues
+    assert report.measurements == 5
+
+
+@pytest.mark.parametrize(
+    "body, code",
+    [
+        (annotation().replace("eodhqa:EODHQualityMeasurementDataset", "dqv:Dataset"),
+         "no-measurement-dataset"),
+        (annotation(run=":otherRun a eodhqa:EODHQualityMeasurementDataset ."),
+         "multiple-measurement-datasets"),
+        (annotation().replace("owl:sameAs", "rdfs:seeAlso"), "missing-uuid"),
+        (annotation(run=":checkRun owl:sameAs <urn:uuid:1234> ."), "multiple-uuids"),
+        (annotation().replace(f"urn:uuid:{RUN_UUID}", "urn:uuid:not-a-uuid"), "malformed-uuid"),
+        (annotation(("eodhqa:snr", '"high"')), "measurement-datatype"),
+        (annotation(("eodhqa:productDetails", "eodhqa:snr")), "measurement-datatype"),
+        (annotation(("eodhqa:productDetails", "12")), "measurement-datatype"),
+        (annotation().replace('"2025-01-25T04:10:00Z"', '"soon"'), "property-datatype"),
+    ],
+)  # fmt: skip
+def test_invalid_annotations_are_reported(body, code):
+    report = validate(body)
+
+    assert not report.valid
+    assert [issue.code for issue in report.errors] == [code]
+    assert report.as_dict()["counts"] == {code: 1}
+
+
+def test_measurements_without_one_metric_and_value_are_warned_about():
+    body = annotation(("eodhqa:snr", "1, 2"), ("eodhqa:snr, eodhqa:mtf", "1"), ('"snr"', "1"))
+    body = body.replace("}\n", ":bare a dqv:QualityMeasurement ; qb:dataSet :checkRun .\n}\n")
+
+    report = validate(body)
+
+    assert report.valid
+    assert report.counts == {"measurement-value": 2, "measurement-metric": 3}
+
+
+def test_repeated_issues_are_counted_but_not_all_kept():
+    report = validate(
+        annotation(*[("eodhqa:made-up", str(n)) for n in range(MAX_ISSUES_PER_CODE + 3)])
+    )
+
+    assert report.valid
+    assert report.counts["unknown-metric"] == MAX_ISSUES_PER_CODE + 3
+    assert len(report.warnings) == MAX_ISSUES_PER_CODE
+    assert report.summary(WARNING) == f"unknown-metric x{MAX_ISSUES_PER_CODE + 3}"
+
+
+def test_invalid_annotations_are_rejected_with_their_report():
+    messager = AnnotationsMessager(None, "bucket")
+
+    with pytest.raises(AnnotationValidationError) as e:
+        messager.process_update_body(
+            annotation(("eodhqa:snr", '"high"')).encode(), "catalogs/c/qa.trig", "/", "/"
+        )
+
+    assert isinstance(e.value, InvalidAnnotationError)
+    assert e.value.report.errors[0].subject.endswith("m0")
+    assert "measurement-datatype x1" in str(e.value)
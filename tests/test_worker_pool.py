@@ -0,0 +1,83 @@
+import os
+import time
+
+import pytest
+
+from annotations_ingester.annotations_generator import (
+    AnnotationsMessager,
+    render_annotation,
+)
+from annotations_ingester.dataset_dcat_generator import DatasetDCATMessager
+from annotations_ingester.worker_pool import RenderPool
+
+
+@pytest.fixture(scope="module")
+def render_pool():
+    pool = RenderPool(2)
+    yield pool
+    pool.shutdown()
+
+
+@pytest.fixture
+def annotation_body():
+    with open("ontology/qa-output-1.trig", "rb") as f:
+        return f.read()
+
+
+def test_annotations_render_in_pool_matches_in_process(render_pool, annotation_body):
+    in_process = AnnotationsMessager(None, "bucket", None, None)
+    pooled = AnnotationsMessager(None, "bucket", None, None, render_pool=render_pool)
+
+    expected = in_process.process_update_body(annotation_body, "a/b", None, None)
+    actual = pooled.process_update_body(annotation_body, "a/b", None, None)
+
+    assert [a.key for a in actual] == [a.key for a in expected]
+
+
+def test_dcat_render_in_pool_matches_in_process(render_pool):
+    stac = {
+        "stac_version": "1.0.0",
+        "type": "Catalog",
+        "id": "root",
+        "description": "Root descr",
+        "links": [{"rel": "self", "href": "https://example.com/api/catalogue/stac"}],
+    }
+    in_process = DatasetDCATMessager(None, None)
+    pooled = DatasetDCATMessager(None, None, render_pool=render_pool)
+
+    expected = in_process.process_update_stac(stac, "/cat/path", None, None)
+    actual = pooled.process_update_stac(stac, "/cat/path", None, None)
+
+    assert actual == expected
+
+
+def test_errors_are_raised_from_workers(render_pool):
+    messager = AnnotationsMessager(None, "bucket", None, None, render_pool=render_pool)
+
+    with pytest.raises(ValueError):
+        messager.process_update_body(b"not an annotation", "a/b", None, None)
+
+
+def annotation_throughput(workers: int, body: bytes, count: int) -> float:
+    pool = RenderPool(workers)
+    try:
+        # Start the workers before timing.
+        list(pool._executor.map(render_annotation, [body] * workers))
+
+        start = time.perf_counter()
+        list(pool._executor.map(render_annotation, [body] * count))
+        return count / (time.perf_counter() - start)
+    finally:
+        pool.shutdown()
+
+
+@pytest.mark.integrationtest
+@pytest.mark.skipif(len(os.sched_getaffinity(0)) < 2, reason="Needs at least two cores")
+def test_throughput_scales_with_workers(annotation_body):
+    cores = min(len(os.sched_getaffinity(0)), 4)
+
+    single = annotation_throughput(1, annotation_body, 200)
+    multiple = annotation_throughput(cores, annotation_body, 200 * cores)
+
+    # Near-linear: allow for some scheduling and IPC overhead.
+    assert multiple / single >= 0.7 * cores